@@ -0,0 +1,308 @@
+"""
+マイク / ライン入力の音からパッドの打撃を検出する (MIDI の代わり)
+
+電子ドラムの MIDI ポートが見つからないとき、training_module_v5.py の init_midi はこちらに切り替える。
+  - onset_detector.OnsetDetector を小さいフレーム (既定 256 / ホップ 64) の "energy" で回し、打撃音の立ち上がりを検出する
+    (フレームが短いとスペクトルの分解能が粗く、低い音のパッドは "flux" では拾い漏れる)
+  - 左右の判定は
+      "channel" : ステレオ入力 (0ch = 左パッド, 1ch = 右パッド)。立ち上がり直後のエネルギーが大きいチャンネル
+      "spectral": モノラル入力。立ち上がり直後のスペクトル重心が SPECTRAL_CENTROIDS_HZ のどちらに近いか
+  - 検出した打撃は mido の note_on と同じ属性 (type / note / velocity) に pad / role を加えたメッセージにして、
+    iter_pending() で取り出せるようにする (process_midi_input はそのまま使える)。
+    timestamp に立ち上がりの time.time() を持たせるので、ポーリングと検出の遅れは判定時に差し引ける
+
+入力デバイスには sounddevice (任意) を使う。WAV でも同じ処理を通せるので、ハードウェア無しで精度と遅れを測れる:
+    python audio_pad_input.py --wav pads.wav --reference hits.json
+    python audio_pad_input.py --live            # 入力デバイスから検出して表示
+"""
+import json
+import time
+import queue
+import argparse
+import threading
+
+import numpy as np
+
+import onset_detector
+
+# --- オプショナルなライブラリのインポート ---
+try:
+    import sounddevice as sd
+    SOUNDDEVICE_AVAILABLE = True
+except (ImportError, OSError):
+    SOUNDDEVICE_AVAILABLE = False
+
+# --- 設定 ---
+FRAME_SIZE = 256
+HOP_SIZE = 64
+DETECTION_METHOD = "energy"
+BLOCK_SIZE = 128                # 入力ストリームのブロック (サンプル)
+DEFAULT_SAMPLE_RATE = 48000
+LATENCY_BUDGET_MS = 20.0        # 立ち上がりから iter_pending に並ぶまでの目標 (電子ドラムの MIDI と同程度)
+MIN_INTERVAL_S = 0.03           # 同じ打撃の残響を二重に数えない
+ANALYSIS_S = 0.01               # 左右の判定と強さに使う立ち上がり後の長さ
+PAD_NOTES = {'left': 47, 'right': 48}   # training_module_v5.PAD_MAPPING の先頭のノート番号
+CHANNEL_PADS = ('left', 'right')
+SPECTRAL_CENTROIDS_HZ = {'left': 500.0, 'right': 1500.0}  # パッドの音に合わせて設定する (--wav --reference で中央値を表示)
+VELOCITY_FLOOR_DB = -50.0       # この音量で velocity 1、0 dBFS で 127
+
+
+class AudioPadMessage:
+    """mido.Message の note_on と同じ属性を持つ打撃メッセージ"""
+    __slots__ = ('type', 'note', 'velocity', 'time', 'pad', 'role', 'timestamp', 'detected_at', 'centroid_hz')
+
+    def __init__(self, note, velocity, pad, timestamp, detected_at, centroid_hz=None):
+        self.type = 'note_on'; self.note = note; self.velocity = velocity; self.time = 0
+        self.pad = pad; self.role = 'learner'
+        self.timestamp = timestamp      # 立ち上がりの time.time()
+        self.detected_at = detected_at  # 検出を確定した time.time()
+        self.centroid_hz = centroid_hz
+
+    @property
+    def latency_ms(self):
+        return (self.detected_at - self.timestamp) * 1000
+
+    def __repr__(self):
+        return f"<AudioPadMessage {self.pad} note={self.note} velocity={self.velocity} latency={self.latency_ms:.1f}ms>"
+
+
+class AudioPadDetector:
+    """
+    デバイスに依存しない検出部。process(block, block_wall_start) にブロック ([frames, channels]) を渡すと、
+    そのブロックで確定した打撃を AudioPadMessage のリストで返す
+    """
+    def __init__(self, sample_rate, channels, mode="auto", pad_notes=None, frame_size=FRAME_SIZE, hop_size=HOP_SIZE,
+                 centroids_hz=None, min_interval_s=MIN_INTERVAL_S, method=DETECTION_METHOD, **detector_options):
+        if mode == "auto": mode = "channel" if channels >= 2 else "spectral"
+        if mode not in ("channel", "spectral"): raise ValueError(f"未知の判定方法: {mode}")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.mode = mode
+        self.pad_notes = dict(pad_notes or PAD_NOTES)
+        self.centroids_hz = dict(centroids_hz or SPECTRAL_CENTROIDS_HZ)
+        self.detector = onset_detector.OnsetDetector(sample_rate, frame_size=frame_size, hop_size=hop_size,
+                                                     method=method, min_interval_s=min_interval_s, **detector_options)
+        self.analysis_samples = max(hop_size, int(ANALYSIS_S * sample_rate))
+        self._keep = frame_size + hop_size + self.analysis_samples  # 判定に使う直近のサンプル数
+        self._recent = np.zeros((0, channels), dtype=np.float32)
+        self._recent_start = 0   # _recent[0] のストリーム上のサンプル番号
+        self.samples_seen = 0
+
+    @property
+    def algorithmic_latency_s(self):
+        return self.detector.latency_s
+
+    def process(self, block, block_wall_start, now=None):
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 1: block = block[:, None]
+        block_start = self.samples_seen
+        self._recent = np.concatenate((self._recent, block))
+        self.samples_seen += len(block)
+        onsets = self.detector.process(block.mean(axis=1))
+        messages = [self._message(t, block_start, block_wall_start, now) for t in onsets]
+        if len(self._recent) > self._keep:
+            drop = len(self._recent) - self._keep
+            self._recent = self._recent[drop:]; self._recent_start += drop
+        return messages
+
+    def _message(self, onset_s, block_start, block_wall_start, now):
+        onset_sample = int(round(onset_s * self.sample_rate))
+        begin = max(0, onset_sample - self._recent_start)
+        segment = self._recent[begin:begin + self.analysis_samples]
+        pad, centroid = self._classify(segment)
+        peak = float(np.abs(segment).max()) if len(segment) else 0.0
+        level_db = 20 * np.log10(max(peak, 1e-6))
+        velocity = int(np.clip(1 + 126 * (level_db - VELOCITY_FLOOR_DB) / -VELOCITY_FLOOR_DB, 1, 127))
+        timestamp = block_wall_start + (onset_sample - block_start) / self.sample_rate
+        return AudioPadMessage(self.pad_notes[pad], velocity, pad, timestamp, time.time() if now is None else now, centroid)
+
+    def _classify(self, segment):
+        centroid = spectral_centroid(segment.mean(axis=1), self.sample_rate) if len(segment) else 0.0
+        if self.mode == "channel":
+            energy = np.einsum('ij,ij->j', segment, segment) if len(segment) else np.zeros(self.channels)
+            return CHANNEL_PADS[int(np.argmax(energy[:len(CHANNEL_PADS)]))], centroid
+        # 対数周波数で近い方
+        log_centroid = np.log(max(centroid, 1.0))
+        return min(self.centroids_hz, key=lambda pad: abs(np.log(self.centroids_hz[pad]) - log_centroid)), centroid
+
+
+def spectral_centroid(samples, sample_rate):
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    total = spectrum.sum()
+    if total <= 0: return 0.0
+    return float((np.fft.rfftfreq(len(samples), 1.0 / sample_rate) * spectrum).sum() / total)
+
+
+class AudioPadInput:
+    """
+    sounddevice の入力ストリームで AudioPadDetector を回す。mido の入力ポートと同じく
+    iter_pending() / close() / closed / name を持つので、training_module_v5 の self.inport にそのまま入れられる
+    """
+    def __init__(self, device=None, sample_rate=None, channels=None, mode="auto", pad_notes=None, block_size=BLOCK_SIZE,
+                 latency_budget_ms=LATENCY_BUDGET_MS, **detector_options):
+        if not SOUNDDEVICE_AVAILABLE: raise OSError("sounddevice ライブラリが見つかりません。")
+        info = sd.query_devices(device, 'input')
+        if info['max_input_channels'] < 1: raise OSError(f"入力デバイスではありません: {info['name']}")
+        self.name = f"audio: {info['name']}"
+        self.sample_rate = int(sample_rate or info['default_samplerate'] or DEFAULT_SAMPLE_RATE)
+        channels = channels or min(2, info['max_input_channels'])
+        self.detector = AudioPadDetector(self.sample_rate, channels, mode, pad_notes, **detector_options)
+        self.latency_budget_ms = latency_budget_ms
+        self.closed = False
+        self.latencies_ms = []      # 直近の検出遅れ (立ち上がり → 確定)
+        self.overflows = 0
+        self.raw_sink = None        # 検出した打撃を受け取る関数 (時刻, 0, ノート, ベロシティ)。midi_session_log 用
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self.stream = sd.InputStream(device=device, samplerate=self.sample_rate, channels=channels, blocksize=block_size,
+                                     dtype='float32', latency='low', callback=self._callback)
+        self.stream.start()
+        self.input_latency_ms = self.stream.latency * 1000
+
+    def _callback(self, indata, frames, time_info, status):
+        now = time.time()
+        if status.input_overflow: self.overflows += 1
+        # ブロック先頭の ADC 時刻を time.time() に直す (取れないホスト API ではブロック長だけ戻す)
+        adc = getattr(time_info, 'inputBufferAdcTime', 0.0); current = getattr(time_info, 'currentTime', 0.0)
+        block_wall_start = now - (current - adc) if adc and current else now - frames / self.sample_rate
+        for message in self.detector.process(indata.copy(), block_wall_start, now):
+            raw_sink = self.raw_sink
+            if raw_sink is not None: raw_sink(message.timestamp, 0, message.note, message.velocity)
+            self._queue.put(message)
+            with self._lock:
+                self.latencies_ms.append(message.latency_ms)
+                del self.latencies_ms[:-200]
+
+    @property
+    def devices(self):
+        """midi_input_hub と同じ形式のデバイス構成 (session_replay.py で振り分けを再現するため)"""
+        notes = {str(note): pad for pad, note in self.detector.pad_notes.items()}
+        return [{"name": "audio", "port": self.name, "role": "learner", "velocity_threshold": 0, "notes": notes}]
+
+    def iter_pending(self):
+        while True:
+            try: yield self._queue.get_nowait()
+            except queue.Empty: return
+
+    def latency_report(self):
+        """検出遅れの中央値と 95% 値 (ms)、予算内かどうか"""
+        with self._lock: latencies = list(self.latencies_ms)
+        if not latencies: return None
+        p50, p95 = np.percentile(latencies, [50, 95])
+        return {'median_ms': float(p50), 'p95_ms': float(p95), 'input_latency_ms': self.input_latency_ms,
+                'within_budget': bool(p95 + self.input_latency_ms <= self.latency_budget_ms), 'overflows': self.overflows}
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.stream.stop(); self.stream.close()
+
+
+def open_input(device=None, **options):
+    """入力デバイスを開いて AudioPadInput を返す (開けなければ OSError)"""
+    try:
+        return AudioPadInput(device, **options)
+    except OSError:
+        raise
+    except Exception as e:  # sounddevice.PortAudioError など
+        raise OSError(f"音声入力を開けません: {e}") from e
+
+
+def detect_hits_in_wav(path, mode="auto", pad_notes=None, block_size=BLOCK_SIZE, start_time=0.0, **detector_options):
+    """
+    WAV をリアルタイムと同じブロックで流して AudioPadMessage のリストを返す。
+    timestamp / detected_at は start_time を録音先頭とした時刻 (確定はブロック末尾の時刻とする)
+    """
+    detector = None; messages = []
+    for sample_rate, chunk in onset_detector.read_wav_blocks(path):
+        if detector is None: detector = AudioPadDetector(sample_rate, chunk.shape[1], mode, pad_notes, **detector_options)
+        for i in range(0, len(chunk), block_size):
+            block = chunk[i:i + block_size]
+            block_wall_start = start_time + detector.samples_seen / sample_rate
+            messages.extend(detector.process(block, block_wall_start, now=block_wall_start + len(block) / sample_rate))
+    return messages
+
+
+def load_reference(path):
+    """正解の打撃 [{'time': 秒, 'pad': 'left'|'right'}, ...] を読む ('time_ms' でも可)"""
+    with open(path, 'r', encoding='utf-8') as f: hits = json.load(f)
+    return [(h['time'] if 'time' in h else h['time_ms'] / 1000, h['pad']) for h in hits]
+
+
+def benchmark(messages, reference, tolerance_s=0.03):
+    """検出した打撃と正解を時刻で対応させ、検出率・誤検出・左右の正解率・時刻の誤差を返す"""
+    detected = sorted(messages, key=lambda m: m.timestamp)
+    times = np.array([m.timestamp for m in detected])
+    used = set(); matched = []
+    for t, pad in reference:
+        if len(times) == 0: break
+        i = int(np.argmin(np.abs(times - t)))
+        if i in used or abs(times[i] - t) > tolerance_s: continue
+        used.add(i); matched.append((detected[i], t, pad))
+    errors_ms = np.array([(m.timestamp - t) * 1000 for m, t, _ in matched])
+    latencies = np.array([m.latency_ms for m in detected])
+    centroids = {}
+    for m, _, pad in matched: centroids.setdefault(pad, []).append(m.centroid_hz)
+    return {
+        'reference': len(reference), 'detected': len(detected), 'matched': len(matched),
+        'recall': len(matched) / len(reference) if reference else 0.0,
+        'false_positives': len(detected) - len(matched),
+        'pad_accuracy': float(np.mean([m.pad == pad for m, _, pad in matched])) if matched else 0.0,
+        'timing_error_ms': (float(np.median(errors_ms)), float(np.abs(errors_ms).max())) if len(errors_ms) else None,
+        'latency_ms': (float(np.median(latencies)), float(np.percentile(latencies, 95))) if len(latencies) else None,
+        'centroid_hz': {pad: float(np.median(values)) for pad, values in centroids.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音声入力からパッドの打撃を検出する (WAV での評価 / ライブ表示)")
+    parser.add_argument('--wav', help="評価する WAV")
+    parser.add_argument('--reference', help="正解の打撃 (JSON)")
+    parser.add_argument('--live', action='store_true', help="入力デバイスから検出して表示する")
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--list-devices', action='store_true')
+    parser.add_argument('--mode', choices=('auto', 'channel', 'spectral'), default='auto')
+    args = parser.parse_args()
+
+    if args.list_devices:
+        if not SOUNDDEVICE_AVAILABLE: print("sounddevice ライブラリが見つかりません。"); return
+        print(sd.query_devices()); return
+
+    if args.wav:
+        messages = detect_hits_in_wav(args.wav, args.mode)
+        print(f"検出: {len(messages)}打 (左 {sum(m.pad == 'left' for m in messages)}, 右 {sum(m.pad == 'right' for m in messages)})")
+        if messages:
+            latencies = np.array([m.latency_ms for m in messages])
+            print(f"検出遅れ (立ち上がり → 確定, 入力デバイスの遅れを除く): 中央値 {np.median(latencies):.1f}ms, "
+                  f"95% {np.percentile(latencies, 95):.1f}ms (予算 {LATENCY_BUDGET_MS:.0f}ms)")
+        if args.reference:
+            result = benchmark(messages, load_reference(args.reference))
+            print(f"正解 {result['reference']}打: 検出率 {result['recall'] * 100:.1f}%, 誤検出 {result['false_positives']}打, "
+                  f"左右の正解率 {result['pad_accuracy'] * 100:.1f}%")
+            if result['timing_error_ms']:
+                print(f"時刻の誤差: 中央値 {result['timing_error_ms'][0]:+.1f}ms, 最大 {result['timing_error_ms'][1]:.1f}ms")
+            if result['centroid_hz']:
+                print("パッドごとのスペクトル重心 (SPECTRAL_CENTROIDS_HZ の目安): "
+                      + ", ".join(f"{pad} {hz:.0f}Hz" for pad, hz in result['centroid_hz'].items()))
+        return
+
+    if args.live:
+        port = open_input(args.device, mode=args.mode)
+        print(f"{port.name} ({port.sample_rate}Hz, 判定: {port.detector.mode}, 入力の遅れ {port.input_latency_ms:.1f}ms) Ctrl+C で終了")
+        try:
+            while True:
+                for message in port.iter_pending():
+                    print(f"{message.pad:5s} velocity={message.velocity:3d} 検出遅れ {message.latency_ms:5.1f}ms")
+                time.sleep(0.01)
+        except KeyboardInterrupt:
+            report = port.latency_report()
+            if report: print(f"検出遅れ: 中央値 {report['median_ms']:.1f}ms, 95% {report['p95_ms']:.1f}ms "
+                             f"(+入力 {report['input_latency_ms']:.1f}ms, 予算内: {report['within_budget']})")
+        finally:
+            port.close()
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""
+適応サンプリングによる Dobot キャリブレーション (tuning_script.py の全格子スイープの置き換え)
+
+  - 姿勢サンプリング専用スレッドが pose() を間隔を空けずに読み続け、
+    動き始め / 到着はしきい値を横切るサンプル間を線形補間して求める
+    (pydobot の pose() は 1 回 0.2 秒待つので、計測中の姿勢・速度・移動は dobot_link.DobotLink で直接送る。
+    ポートのロックは pydobot と共有する)
+  - データが増えるたびに dobot_kinematics のモデルをブートストラップでフィットし、
+    予測のばらつき (不確かさ) が最大の (距離, V, A) を次に計測する
+  - 不確かさが目標精度を下回るか、最大サンプル数に達したら終了する
+  - 複数ポート (COM3, COM4) を並行してキャリブレーションし、結果をバージョン付きの
+    プロファイルファイルに追記する
+
+使い方:
+    python calibration_runner.py --ports COM3 COM4 --target-ms 5
+    python calibration_runner.py --ports SIM1 --simulate          # ロボットなしで動作確認
+    python calibration_runner.py --ports COM4 --export-csv ../tuning_data.csv
+    python calibration_runner.py --ports COM3 --command-overhead-only  # 送信経路の遅れだけ測る
+
+--command-overhead (または --command-overhead-only) では、pydobot (speed + move_to) と dobot_link (速度 + PTP を 1 回の write) で
+1 動作を送り終えるまでの時間を交互に測り、その差をプロファイルの command_overhead に残す。
+robot_control_module_v4.py は command_link = "coalesced" のアームでこの実測値だけ固定補正から差し引く (未測定なら差し引かない)。
+"""
+import os
+import sys
+import csv
+import json
+import time
+import math
+import argparse
+import datetime
+import threading
+from collections import deque
+
+import numpy as np
+
+import dobot_kinematics
+import dobot_link
+
+try:
+    from pydobot import Dobot
+    PYDOBOT_AVAILABLE = True
+except ImportError:
+    PYDOBOT_AVAILABLE = False
+
+# --- 計測パラメータ (tuning_script.py と同じ姿勢・範囲) ---
+START_POS = (230, 0, 50, 0)
+CANDIDATE_DISTANCES = np.arange(5.0, 55.0 + 1e-9, 5.0)
+CANDIDATE_VELOCITIES = np.arange(100.0, 1000.0 + 1e-9, 100.0)
+CANDIDATE_ACCELERATIONS = np.arange(100.0, 1000.0 + 1e-9, 100.0)
+MOTION_THRESHOLD_MM = 0.2     # 動き始め / 到着とみなす Z の変化量
+MOVE_TIMEOUT_S = 5.0
+SETTLE_S = 0.15               # 1 往復ごとの静定待ち
+POSE_RATE_WARN_HZ = 50.0      # 姿勢の読み取りがこれより遅ければ警告する (補間の精度が落ちる)
+
+# --- 適応サンプリング ---
+DEFAULT_TARGET_MS = 5.0       # 予測のばらつき (標準偏差) の目標
+MIN_SAMPLES = 24              # これ未満では終了判定しない
+DEFAULT_MAX_SAMPLES = 300
+BOOTSTRAP_MODELS = 12
+BOOTSTRAP_SCALE_GRID = np.geomspace(0.05, 20.0, 32)  # 逐次フィット用の粗い格子
+REPEAT_PENALTY = 0.15         # 同じ点を何度も選ばないよう、計測回数 1 回ごとに不確かさを割り引く率
+
+# --- 送信経路の遅れ (command_overhead) ---
+COMMAND_OVERHEAD_SAMPLES = 12
+COMMAND_OVERHEAD_STEP_MM = 2.0  # 待機位置から上げ下げする量 (打面から離れる向き)
+
+PROFILE_PATH = 'calibration_profiles.json'
+PROFILE_FORMAT_VERSION = 1
+_profile_lock = threading.Lock()
+
+
+class PoseSampler(threading.Thread):
+    """link.pose() を最高レートで読み続け、(時刻, Z) をリングバッファに溜めるスレッド (link は open_link() の戻り値)"""
+    def __init__(self, link, capacity=8192):
+        super().__init__(daemon=True)
+        self.link = link
+        self.samples = deque(maxlen=capacity)
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.count = 0
+        self.started_at = None
+        self.error = None
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                z = self.link.pose()[2]
+                t = time.perf_counter()
+                with self.condition:
+                    self.samples.append((t, z)); self.count += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+            with self.condition: self.condition.notify_all()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=1.0)
+
+    @property
+    def rate_hz(self):
+        if not self.started_at: return 0.0
+        return self.count / max(time.perf_counter() - self.started_at, 1e-9)
+
+    def latest_z(self):
+        with self.condition:
+            while not self.samples and self.error is None: self.condition.wait(0.1)
+            if self.error: raise self.error
+            return self.samples[-1][1]
+
+    def wait_for_level(self, level, direction, since, timeout=MOVE_TIMEOUT_S):
+        """
+        since 以降に Z が level を direction (+1: 上昇, -1: 下降) 向きに横切った時刻を返す。
+        横切る前後のサンプルを線形補間するので、サンプル間隔より細かく求まる。
+        """
+        deadline = time.perf_counter() + timeout
+        with self.condition:
+            while True:
+                if self.error: raise self.error
+                previous = None
+                for t, z in self.samples:
+                    if t < since: previous = None; continue
+                    if previous is not None:
+                        t0, z0 = previous
+                        if (z0 - level) * direction < 0 <= (z - level) * direction:
+                            return t0 + (t - t0) * (level - z0) / (z - z0)
+                    previous = (t, z)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0: raise TimeoutError(f"Z={level:.1f} への到達を検出できませんでした。")
+                self.condition.wait(remaining)
+
+
+class SimulatedDobot:
+    """--simulate 用: フィット済みモデルとノイズで Dobot の動きを再現する"""
+    def __init__(self, port, model, noise_ms=8.0, pose_latency_s=0.004, seed=0):
+        self.port = port; self.model = model; self.noise_s = noise_ms / 1000.0; self.pose_latency_s = pose_latency_s
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.velocity = 100.0; self.acceleration = 100.0
+        self.segment = (time.perf_counter(), 0.0, START_POS[2], START_POS[2])  # (開始時刻, 所要時間, 始点Z, 終点Z)
+
+    def _z_at(self, t):
+        t0, duration, z0, z1 = self.segment
+        if duration <= 0 or t >= t0 + duration: return z1
+        if t <= t0: return z0
+        u = (t - t0) / duration
+        return z0 + (z1 - z0) * (3 * u ** 2 - 2 * u ** 3)
+
+    def pose(self):
+        time.sleep(self.pose_latency_s)
+        with self.lock:
+            return (START_POS[0], START_POS[1], self._z_at(time.perf_counter()), START_POS[3])
+
+    def speed(self, velocity=100.0, acceleration=100.0):
+        with self.lock: self.velocity, self.acceleration = float(velocity), float(acceleration)
+
+    def set_speed(self, velocity, acceleration):
+        self.speed(velocity=velocity, acceleration=acceleration)
+
+    def move(self, position):
+        self.move_to(*position, wait=False)
+
+    def move_to(self, x, y, z, r, wait=False):
+        with self.lock:
+            now = time.perf_counter()
+            start_z = self._z_at(now)
+            duration = float(self.model.duration(abs(z - start_z), self.velocity, self.acceleration)) + self.rng.normal(0, self.noise_s)
+            self.segment = (now + 0.02, max(duration, 0.05), start_z, z)
+            end_time = self.segment[0] + self.segment[1]
+        if wait: time.sleep(max(0.0, end_time - time.perf_counter()))
+
+    def close(self):
+        pass
+
+
+def open_link(device, port):
+    """計測中の姿勢・速度・移動を送るリンク。実機は DobotLink (pydobot の待ちを通らない)、シミュレーターはそのまま"""
+    if hasattr(device, 'ser'): return dobot_link.DobotLink(device, port)
+    return device
+
+
+class CalibrationSession:
+    """1 台分のキャリブレーション。run() はスレッドから呼んでもよい"""
+    def __init__(self, port, device_factory, target_ms=DEFAULT_TARGET_MS, max_samples=DEFAULT_MAX_SAMPLES, seed=0, command_overhead=False):
+        self.port = port
+        self.measure_overhead = command_overhead
+        self.device_factory = device_factory
+        self.target_ms = target_ms
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+        self.samples = []  # (distance, velocity, acceleration, duration, direction)
+        self.model = None
+        self.max_uncertainty_ms = float('inf')
+        self.stop_reason = None
+        self.pose_rate_hz = 0.0
+        self.command_overhead = None
+        d, v, a = np.meshgrid(CANDIDATE_DISTANCES, CANDIDATE_VELOCITIES, CANDIDATE_ACCELERATIONS, indexing='ij')
+        self.candidates = np.stack([d.ravel(), v.ravel(), a.ravel()], axis=1)
+        self.visits = np.zeros(len(self.candidates), dtype=int)
+
+    def log(self, message):
+        print(f"[{self.port}] {message}")
+
+    def _seed_points(self):
+        """最初の数点は範囲の角と中心 (空間充填)"""
+        lo, hi = self.candidates.min(axis=0), self.candidates.max(axis=0)
+        corners = [(d, v, a) for d in (lo[0], hi[0]) for v in (lo[1], hi[1]) for a in (lo[2], hi[2])]
+        center = tuple(self.candidates[np.argmin(np.abs(self.candidates - (lo + hi) / 2).sum(axis=1))])
+        return [self._candidate_index(p) for p in corners + [center]]
+
+    def _candidate_index(self, point):
+        return int(np.argmin(np.abs(self.candidates - np.asarray(point)).sum(axis=1)))
+
+    def _arrays(self):
+        data = np.array([s[:4] for s in self.samples])
+        return data[:, 0], data[:, 1], data[:, 2], data[:, 3]
+
+    def _uncertainty(self):
+        """ブートストラップしたモデル群の予測の標準偏差 (ms) を候補点ごとに返す"""
+        d, v, a, t = self._arrays()
+        predictions = []
+        for _ in range(BOOTSTRAP_MODELS):
+            idx = self.rng.integers(0, len(t), len(t))
+            model = dobot_kinematics.fit(d[idx], v[idx], a[idx], t[idx], scale_grid=BOOTSTRAP_SCALE_GRID, with_residuals=False)
+            predictions.append(model.duration(self.candidates[:, 0], self.candidates[:, 1], self.candidates[:, 2]))
+        return np.std(predictions, axis=0) * 1000
+
+    def _next_point(self, seeds):
+        if seeds: return seeds.pop(0)
+        if len(self.samples) < MIN_SAMPLES:
+            return int(self.rng.integers(len(self.candidates)))
+        uncertainty = self._uncertainty()
+        self.max_uncertainty_ms = float(uncertainty.max())
+        if self.max_uncertainty_ms <= self.target_ms:
+            return None
+        return int(np.argmax(uncertainty * (1.0 - REPEAT_PENALTY) ** self.visits))
+
+    def _measure(self, sampler, link, start_z, end_z):
+        """start_z → end_z の 1 回の移動時間 (動き始め → 到着) を計測する"""
+        direction = 1.0 if end_z > start_z else -1.0
+        t_command = time.perf_counter()
+        link.move((START_POS[0], START_POS[1], end_z, START_POS[3]))
+        t_start = sampler.wait_for_level(start_z + direction * MOTION_THRESHOLD_MM, direction, t_command)
+        t_end = sampler.wait_for_level(end_z - direction * MOTION_THRESHOLD_MM, direction, t_start)
+        return t_end - t_start
+
+    def run(self):
+        device = self.device_factory(self.port)
+        sampler = None
+        try:
+            device.speed(velocity=200, acceleration=200)
+            device.move_to(*START_POS, wait=True)
+            # 姿勢の読み取りとポートを取り合わないよう、サンプリングを始める前に測る
+            if self.measure_overhead:
+                if hasattr(device, 'ser'):
+                    self.command_overhead = measure_command_overhead(device, self.port)
+                    self.log(f"送信経路: pydobot {self.command_overhead['pydobot_ms']:.1f}ms, "
+                             f"coalesced {self.command_overhead['coalesced_ms']:.1f}ms (差 {self.command_overhead['overhead_s'] * 1000:.1f}ms)")
+                else:
+                    self.log("シリアルポートが無いため送信経路の遅れは測りません (--simulate)")
+            link = open_link(device, self.port)
+            sampler = PoseSampler(link)
+            sampler.start()
+            seeds = self._seed_points()
+            while len(self.samples) < self.max_samples:
+                index = self._next_point(seeds)
+                if index is None:
+                    self.stop_reason = 'target_accuracy'; break
+                distance, velocity, acceleration = self.candidates[index]
+                end_z = START_POS[2] - distance
+                link.set_speed(velocity, acceleration)
+                down = self._measure(sampler, link, START_POS[2], end_z)
+                time.sleep(SETTLE_S)
+                up = self._measure(sampler, link, end_z, START_POS[2])
+                time.sleep(SETTLE_S)
+                self.samples.append((distance, velocity, acceleration, down, 'down'))
+                self.samples.append((distance, velocity, acceleration, up, 'up'))
+                self.visits[index] += 1
+                self.log(f"{len(self.samples):>4}件: D={distance:4.0f} V={velocity:5.0f} A={acceleration:5.0f} -> "
+                         f"下降 {down * 1000:6.1f}ms / 上昇 {up * 1000:6.1f}ms "
+                         f"(不確かさ最大 {self.max_uncertainty_ms:.1f}ms, pose {sampler.rate_hz:.0f}Hz)")
+            else:
+                self.stop_reason = 'max_samples'
+        finally:
+            if sampler is not None:
+                self.pose_rate_hz = sampler.rate_hz
+                sampler.stop()
+            try:
+                device.move_to(*START_POS, wait=True); device.close()
+            except Exception: pass
+
+        if len(self.samples) >= 4:
+            d, v, a, t = self._arrays()
+            self.model = dobot_kinematics.fit(d, v, a, t, source=f"calibration:{self.port}")
+        self.log(f"終了 ({self.stop_reason}): {len(self.samples)}件, pose {self.pose_rate_hz:.0f}Hz")
+        if self.samples and self.pose_rate_hz < POSE_RATE_WARN_HZ:
+            self.log(f"⚠️ 姿勢の読み取りが {self.pose_rate_hz:.0f}Hz しか出ていません (目安 {POSE_RATE_WARN_HZ:.0f}Hz 以上)。"
+                     f"動き始め / 到着の補間が粗くなります")
+        return self
+
+
+def measure_command_overhead(device, port, samples=COMMAND_OVERHEAD_SAMPLES):
+    """
+    1 動作 (速度 + PTP) を送り終えるまでの時間を、pydobot (speed + move_to) と dobot_link (1 回の write) で交互に測る。
+    どちらも毎回速度を変えて送るので、差は呼び出しごとの待ち (pydobot の送受信前の sleep) の分だけになる。
+    戻り値 {'pydobot_ms', 'coalesced_ms', 'overhead_s', 'samples'} (いずれも中央値)
+    """
+    link = dobot_link.DobotLink(device, port)
+    raised = (START_POS[0], START_POS[1], START_POS[2] + COMMAND_OVERHEAD_STEP_MM, START_POS[3])
+    legacy, coalesced = [], []
+    for i in range(samples):
+        velocity = 200.0 + 10.0 * i  # 速度の省略が起きないよう毎回変える
+        started = time.perf_counter()
+        device.speed(velocity=velocity, acceleration=velocity)
+        device.move_to(*raised, wait=False)
+        legacy.append(time.perf_counter() - started)
+        time.sleep(SETTLE_S)
+        link.invalidate()
+        started = time.perf_counter()
+        link.send_motion(dobot_link.MotionPackets(velocity + 5.0, velocity + 5.0, START_POS))
+        coalesced.append(time.perf_counter() - started)
+        time.sleep(SETTLE_S)
+    legacy_s, coalesced_s = float(np.median(legacy)), float(np.median(coalesced))
+    return {'pydobot_ms': legacy_s * 1000, 'coalesced_ms': coalesced_s * 1000,
+            'overhead_s': max(0.0, legacy_s - coalesced_s), 'samples': samples}
+
+
+def load_command_overhead(path, port):
+    """プロファイルファイルから、ポートの最新の command_overhead の overhead_s を読む (未測定なら None)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    measured = [p for p in data.get('profiles', []) if p.get('port') == port and p.get('command_overhead')]
+    if not measured: return None
+    return float(max(measured, key=lambda p: p['profile_version'])['command_overhead']['overhead_s'])
+
+
+def append_profile(path, session, target_ms):
+    """プロファイルファイルにセッション結果を追記する (ポートごとに profile_version を採番)"""
+    with _profile_lock:
+        data = {'format_version': PROFILE_FORMAT_VERSION, 'profiles': []}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format_version') != PROFILE_FORMAT_VERSION:
+                raise ValueError(f"{path} の形式バージョン {data.get('format_version')} には対応していません。")
+        version = 1 + max((p['profile_version'] for p in data['profiles'] if p['port'] == session.port), default=0)
+        data['profiles'].append({
+            'port': session.port,
+            'profile_version': version,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'stop_reason': session.stop_reason,
+            'target_ms': target_ms,
+            'max_uncertainty_ms': None if math.isinf(session.max_uncertainty_ms) else session.max_uncertainty_ms,
+            'pose_rate_hz': session.pose_rate_hz,
+            'model': session.model.to_dict() if session.model else None,
+            'command_overhead': session.command_overhead,
+            'samples': [list(s) for s in session.samples],
+        })
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    return version
+
+
+def export_csv(path, session):
+    """tuning_data.csv 形式で書き出す (dobot_kinematics.load_or_fit が自動で再フィットする)"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['distance', 'target_velocity', 'target_acceleration', 'actual_duration'])
+        for distance, velocity, acceleration, duration, _ in session.samples:
+            writer.writerow([distance, velocity, acceleration, duration])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="適応サンプリングで Dobot の運動特性をキャリブレーションする")
+    parser.add_argument('--ports', nargs='+', default=['COM3', 'COM4'])
+    parser.add_argument('--target-ms', type=float, default=DEFAULT_TARGET_MS, help="予測の不確かさ (標準偏差) の目標 [ms]")
+    parser.add_argument('--max-samples', type=int, default=DEFAULT_MAX_SAMPLES)
+    parser.add_argument('--profile', default=PROFILE_PATH, help="結果を追記するプロファイルファイル")
+    parser.add_argument('--export-csv', default=None, help="最初のポートの計測結果を tuning_data.csv 形式で書き出す")
+    parser.add_argument('--simulate', action='store_true', help="ロボットの代わりに既存モデルのシミュレーターを使う")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--command-overhead', action='store_true', help="pydobot と dobot_link の送信時間の差も測る")
+    parser.add_argument('--command-overhead-only', action='store_true', help="送信時間の差だけ測る (運動特性は測らない)")
+    args = parser.parse_args()
+    if args.command_overhead_only: args.command_overhead, args.max_samples = True, 0
+
+    if args.simulate:
+        reference = dobot_kinematics.fit_csv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tuning_data.csv'))
+        factory = lambda port: SimulatedDobot(port, reference, seed=args.seed)
+    else:
+        if not PYDOBOT_AVAILABLE:
+            print("❌ pydobot が見つかりません。--simulate で動作確認できます。"); sys.exit(1)
+        factory = lambda port: Dobot(port=port, verbose=False)
+
+    sessions = [CalibrationSession(port, factory, args.target_ms, args.max_samples, seed=args.seed + i, command_overhead=args.command_overhead)
+                for i, port in enumerate(args.ports)]
+    threads = [threading.Thread(target=s.run, name=f"calibration-{s.port}") for s in sessions]
+    started = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    print(f"⏱ 全ポート完了 ({time.perf_counter() - started:.1f}s)")
+
+    for session in sessions:
+        if session.model is None and session.command_overhead is None:
+            print(f"[{session.port}] 計測データが不足しているため保存しません。"); continue
+        version = append_profile(args.profile, session, args.target_ms)
+        if session.model is not None: dobot_kinematics.print_report(session.model)
+        print(f"💾 [{session.port}] プロファイル v{version} を {args.profile} に追記しました。")
+    if args.export_csv and sessions and sessions[0].samples:
+        export_csv(args.export_csv, sessions[0])
+        print(f"💾 [{sessions[0].port}] の計測結果を {args.export_csv} に書き出しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 import sys
 import time
-import copy
 import math
 from PyQt6.QtWidgets import (
     QApplication, QDialog, QWidget, QVBoxLayout, QSizePolicy,
@@ -9,6 +8,12 @@ from PyQt6.QtWidgets import (
 from PyQt6.QtCore import Qt, QTimer, QRectF, QPointF, pyqtSlot
 from PyQt6.QtGui import QPainter, QColor, QFont, QPen, QBrush
 
+try:
+    import motion_plan_compiler
+    MOTION_COMPILER_AVAILABLE = True
+except ImportError:
+    MOTION_COMPILER_AVAILABLE = False
+
 # ui_theme.py から色をインポート (メインアプリと共通)
 try:
     from ui_theme import COLORS
@@ -65,7 +70,7 @@ class GraphWidget(QWidget):
         self.brush_command_bottom = QBrush(COLORS['success'])
 
     def start_monitoring(self, score_data, master_start_time, motion_plan_data):
-        self.score_data = copy.deepcopy(score_data)
+        self.score_data = score_data # ★ 読み取り専用の楽譜 (score_compiler) なのでコピーしない
         self.master_start_time = master_start_time
         self.command_log.clear()
         self.template_notes.clear()
@@ -74,8 +79,11 @@ class GraphWidget(QWidget):
         max_time = 0.0
         if motion_plan_data:
             for track_plan in motion_plan_data.values():
-                if track_plan:
-                     max_time = max(max_time, max(m['target_time'] for m in track_plan if 'target_time' in m)) # Safety check
+                if track_plan is None or len(track_plan) == 0: continue
+                if MOTION_COMPILER_AVAILABLE and motion_plan_compiler.is_structured_plan(track_plan):
+                    max_time = max(max_time, float(track_plan['target_time'].max()))
+                else:
+                    max_time = max(max_time, max(m['target_time'] for m in track_plan if 'target_time' in m)) # Safety check
 
         # Add padding, ensure minimum duration
         self.total_duration_sec = max(8.0, math.ceil(max_time) + 1.0)
@@ -107,6 +115,14 @@ class GraphWidget(QWidget):
             return
         for track_name, plan in motion_plan_data.items():
             if plan is None: continue
+            # ★ motion_plan_compiler の構造化配列は列単位で読む
+            if MOTION_COMPILER_AVAILABLE and motion_plan_compiler.is_structured_plan(plan):
+                for time_sec, z, action in zip(plan['target_time'].tolist(), plan['z'].tolist(), plan['action'].tolist()):
+                    self.template_notes.append({
+                        'track': track_name, 'time_sec': time_sec, 'z': z,
+                        'action': motion_plan_compiler.ACTION_NAMES[action]
+                    })
+                continue
             for motion in plan:
                  # ★ Add safety check for required keys
                  if all(k in motion for k in ['target_time', 'position', 'action']):
@@ -0,0 +1,231 @@
+"""
+controllers/ ディレクトリのコントローラーを、キャッシュ済みマニフェストで管理するレジストリ。
+
+起動時には各コントローラーファイルを ast で解析するだけで、モジュールを import しない。
+解析結果 (クラス名・表示名) はファイルの mtime とハッシュをキーに manifest.json へ保存し、
+変更のないファイルは次回以降の解析も省略する。
+コントローラーモジュールは、コンボボックスや実験設定で実際に選ばれたときに初めて import される。
+
+使い方:
+    registry = ControllerRegistry()
+    controllers = registry.load()          # {表示名: ControllerEntry}
+    controller = controllers["線形補間コントローラー"](score, ms_per_beat)
+"""
+import os
+import re
+import sys
+import ast
+import json
+import hashlib
+import importlib
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROLLER_DIR = os.path.join(SCRIPT_DIR, "controllers")
+MANIFEST_PATH = os.path.join(CONTROLLER_DIR, "manifest.json")
+TUNED_PARAMS_PATH = os.path.join(CONTROLLER_DIR, "tuned_params.json")
+MANIFEST_VERSION = 1
+
+BASE_CLASS_NAME = "BaseEntrainmentController"
+EXCLUDED_FILES = {"base_controller.py", "__init__.py"}
+# linear_controller_0.py のような退避用の古いバリアントは登録しない
+STALE_VARIANT_PATTERN = re.compile(r"_\d+$")
+
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _base_names(class_node):
+    names = []
+    for base in class_node.bases:
+        if isinstance(base, ast.Name): names.append(base.id)
+        elif isinstance(base, ast.Attribute): names.append(base.attr)
+    return names
+
+
+def _static_display_name(class_node):
+    """`name` プロパティが文字列リテラルを返すだけなら、その値を返す (動的な場合は None)"""
+    for node in class_node.body:
+        if not isinstance(node, ast.FunctionDef) or node.name != "name": continue
+        for stmt in node.body:
+            if isinstance(stmt, ast.Return) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str):
+                return stmt.value.value
+        return None
+    return None
+
+
+def parse_controller_file(path):
+    """ファイルを import せずに解析し、コントローラー候補のクラス一覧を返す"""
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    # 同一ファイル内での多段継承にも対応する
+    controller_names = {BASE_CLASS_NAME}
+    changed = True
+    while changed:
+        changed = False
+        for node in classes:
+            if node.name not in controller_names and any(b in controller_names for b in _base_names(node)):
+                controller_names.add(node.name); changed = True
+    return [
+        {'class_name': node.name, 'display_name': _static_display_name(node)}
+        for node in classes if node.name in controller_names and node.name != BASE_CLASS_NAME
+    ]
+
+
+class ControllerEntry:
+    """
+    コントローラークラスの遅延ロード用プロキシ。
+    呼び出すと (初回のみ) モジュールを import し、コントローラーを生成して返す。
+    従来のクラスと同じく `entry(score_data, ms_per_beat)` で使える。
+    """
+    def __init__(self, module_name, class_name, display_name, filename, tuned_params=None):
+        self.module_name = module_name
+        self.class_name = class_name
+        self.display_name = display_name
+        self.filename = filename
+        self.tuned_params = tuned_params or {}
+        self._cls = None
+
+    @property
+    def name(self):
+        return self.display_name
+
+    @property
+    def is_loaded(self):
+        return self._cls is not None
+
+    def load(self):
+        """モジュールを import してコントローラークラスを返す"""
+        if self._cls is None:
+            if SCRIPT_DIR not in sys.path: sys.path.insert(0, SCRIPT_DIR)
+            module = importlib.import_module(f"controllers.{self.module_name}")
+            cls = getattr(module, self.class_name)
+            if self.tuned_params:
+                cls.TUNED_PARAMS = self.tuned_params
+                print(f"チューニング済みパラメータを適用: {self.class_name} {self.tuned_params}")
+            self._cls = cls
+            print(f"コントローラーを読み込みました: {self.display_name} ({self.module_name}.{self.class_name})")
+        return self._cls
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "lazy"
+        return f"<ControllerEntry {self.display_name!r} {self.module_name}.{self.class_name} ({state})>"
+
+
+class ControllerRegistry:
+    def __init__(self, controller_dir=CONTROLLER_DIR, manifest_path=MANIFEST_PATH, tuned_params_path=TUNED_PARAMS_PATH):
+        self.controller_dir = controller_dir
+        self.manifest_path = manifest_path
+        self.tuned_params_path = tuned_params_path
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path): return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION: return {}
+            return manifest.get('files', {})
+        except Exception as e:
+            print(f"警告: マニフェスト {self.manifest_path} の読み込みに失敗: {e}")
+            return {}
+
+    def _save_manifest(self, files):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'files': files}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            print(f"警告: マニフェスト {self.manifest_path} の保存に失敗: {e}")
+
+    def _load_tuned_params(self):
+        if not os.path.exists(self.tuned_params_path): return {}
+        try:
+            with open(self.tuned_params_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"警告: {self.tuned_params_path} の読み込みに失敗: {e}")
+            return {}
+
+    def _resolve_display_name(self, module_name, class_name):
+        """name が静的に決まらないクラスだけは、従来どおり import してインスタンスから読む"""
+        if SCRIPT_DIR not in sys.path: sys.path.insert(0, SCRIPT_DIR)
+        module = importlib.import_module(f"controllers.{module_name}")
+        return getattr(module, class_name)(None, 0).name
+
+    def scan(self):
+        """マニフェストを更新し、{ファイル名: エントリ} を返す"""
+        cached = self._load_manifest()
+        files, dirty = {}, False
+        for filename in sorted(os.listdir(self.controller_dir)):
+            if not filename.endswith(".py") or filename in EXCLUDED_FILES: continue
+            path = os.path.join(self.controller_dir, filename)
+            stat = os.stat(path)
+            record = cached.get(filename)
+            if record and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size:
+                files[filename] = record; continue
+            sha1 = _file_sha1(path)
+            if record and record['sha1'] == sha1:
+                # touch されただけ: 解析結果は再利用する
+                files[filename] = {**record, 'mtime': stat.st_mtime, 'size': stat.st_size}; dirty = True; continue
+            try:
+                classes = parse_controller_file(path)
+            except SyntaxError as e:
+                print(f"エラー: コントローラーファイル {filename} の解析に失敗: {e}")
+                classes = []
+            for info in classes:
+                if info['display_name'] is None:
+                    try:
+                        info['display_name'] = self._resolve_display_name(filename[:-3], info['class_name'])
+                    except Exception as e:
+                        print(f"エラー: コントローラー {info['class_name']} の表示名取得に失敗: {e}")
+            files[filename] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1, 'classes': classes}
+            dirty = True
+        if dirty or set(files) != set(cached):
+            self._save_manifest(files)
+        return files
+
+    def load(self):
+        """{表示名: ControllerEntry} を返す (どのコントローラーもまだ import しない)"""
+        if not os.path.exists(self.controller_dir):
+            print(f"警告: コントローラーディレクトリが見つかりません: {self.controller_dir}")
+            return {}
+        tuned_params = self._load_tuned_params()
+        controllers = {}
+        for filename, record in self.scan().items():
+            module_name = filename[:-3]
+            if STALE_VARIANT_PATTERN.search(module_name):
+                print(f"スキップ: 古いバリアント {filename}")
+                continue
+            for info in record['classes']:
+                display_name, class_name = info['display_name'], info['class_name']
+                if not display_name: continue
+                if display_name in controllers:
+                    print(f"警告: 表示名 '{display_name}' が重複しています ({controllers[display_name].filename} と {filename})。先の定義を使用します。")
+                    continue
+                controllers[display_name] = ControllerEntry(
+                    module_name, class_name, display_name, filename,
+                    tuned_params.get(class_name, {}).get('params', {}))
+        print(f"読み込まれたコントローラー: {list(controllers.keys())}")
+        return controllers
+
+    def find_by_class(self, class_name):
+        """クラス名から ControllerEntry を探す (古いバリアントは対象外)"""
+        for entry in self.load().values():
+            if entry.class_name == class_name: return entry
+        raise ValueError(f"コントローラー '{class_name}' が controllers/ に見つかりません。")
+
+
+def load_controllers():
+    """{表示名: ControllerEntry} を返す。各アプリの load_controllers() はこれに委譲する。"""
+    return ControllerRegistry().load()
+
+
+if __name__ == "__main__":
+    for display_name, entry in load_controllers().items():
+        print(f"  {display_name}: {entry.module_name}.{entry.class_name}")
@@ -0,0 +1,401 @@
+# controller_sweep.py
+# 同調制御コントローラーのパラメータ (CORRECTION_RATE, ANALYSIS_LOOPS など) を
+# グリッド探索 / ランダム探索で評価し、最良の設定を tuned_params.json として出力するツール。
+#
+# 使い方の例:
+#   python controller_sweep.py LinearController --grid CORRECTION_RATE=0.05:0.5:10 --grid ANALYSIS_LOOPS=1,2,3
+#   python controller_sweep.py LinearController --random 50 --grid CORRECTION_RATE=0.0:0.5 --install
+#   python controller_sweep.py LinearController --session session_a.json --session session_b.json
+#
+# 評価は「合成学習者 (synthetic learner)」に対してループ練習をシミュレーションして行う。
+# --session で記録済みの judgement_history (JSON) を渡した場合は、そこから学習者の
+# 初期ズレ・ばらつきを推定して学習者モデルを作る。
+# 評価結果は (コントローラー, パラメータ, データセットのハッシュ) をキーに sweep_cache/ に保存され、
+# 同じ点は再計算しない。
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import itertools
+import importlib
+import contextlib
+from multiprocessing import Pool
+
+import numpy as np
+
+import controller_registry
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROLLER_DIR = os.path.join(SCRIPT_DIR, "controllers")
+CACHE_DIR = os.path.join(SCRIPT_DIR, "sweep_cache")
+RESULTS_DIR = os.path.join(SCRIPT_DIR, "sweep_results")
+TUNED_PARAMS_PATH = os.path.join(CONTROLLER_DIR, "tuned_params.json")
+DEFAULT_SCORE_PATH = os.path.join(SCRIPT_DIR, "..", "music", "test1.json")
+
+# --- 判定設定 (training_module_v5.py と同じ値) ---
+JUDGEMENT_WINDOWS = {'perfect': 55, 'great': 90, 'good': 110}
+JUDGEMENT_WEIGHTS = {'perfect': 1.0, 'great': 0.7, 'good': 0.4}
+NUM_MEASURES = 2
+
+# --- シミュレーション設定 ---
+SIM_LOOPS = 27             # 5分間の練習 ≒ 27ループ (test1.json, BPM45)
+SIM_SEEDS = 8              # 1つの学習者プロファイルあたりの試行回数
+EVAL_LAST_LOOPS = 5        # 評価に使う最後のループ数
+
+# 合成学習者プロファイル
+#   initial_error_ms: 練習開始時の平均ズレ (+: 遅れ, -: 走り)
+#   jitter_ms:        1打ごとのばらつき (標準偏差)
+#   coupling:         ロボットのタイミングに引き込まれる割合 (0〜1)
+#   self_correction:  ループごとに自力で理想に近づく割合 (0〜1)
+#   drift_ms:         ループごとの平均ズレの揺らぎ
+DEFAULT_LEARNER_PROFILES = [
+    {'name': 'rushing',  'initial_error_ms': {'top': -45.0, 'bottom': -35.0}, 'jitter_ms': 35.0, 'coupling': 0.35, 'self_correction': 0.05, 'drift_ms': 4.0},
+    {'name': 'dragging', 'initial_error_ms': {'top': 70.0, 'bottom': 55.0},   'jitter_ms': 40.0, 'coupling': 0.30, 'self_correction': 0.04, 'drift_ms': 5.0},
+    {'name': 'noisy',    'initial_error_ms': {'top': 15.0, 'bottom': -10.0},  'jitter_ms': 60.0, 'coupling': 0.20, 'self_correction': 0.03, 'drift_ms': 8.0},
+]
+
+
+# ==========================================================
+# データセット (学習者プロファイル + 楽譜)
+# ==========================================================
+def _load_score(score_path):
+    with open(score_path, 'r', encoding='utf-8') as f:
+        score = json.load(f)
+    tracks = {}
+    for track_name in ['top', 'bottom']:
+        track = score.get(track_name)
+        if not track: continue
+        bpm = track.get('bpm', 120)
+        ms_per_beat = 60000.0 / bpm
+        beats_per_measure = (track.get('numerator', 4) / track.get('denominator', 4)) * 4.0
+        total_beats = track.get('total_beats', beats_per_measure * NUM_MEASURES)
+        note_beats = sorted(item['beat'] for item in track.get('items', []) if item.get('class') == 'note')
+        tracks[track_name] = {
+            'ms_per_beat': ms_per_beat,
+            'loop_duration_ms': total_beats * ms_per_beat,
+            'note_times_ms': [beat * ms_per_beat for beat in note_beats],
+        }
+    return score, tracks
+
+
+def _profile_from_session(session_path):
+    """
+    記録済みの judgement_history (ループごとの判定リストのリスト) から学習者プロファイルを推定する。
+    最初のループ群から初期ズレ、全体からばらつきを求める。引き込み率などは既定値を使う。
+    """
+    with open(session_path, 'r', encoding='utf-8') as f:
+        history = json.load(f)
+    if isinstance(history, dict):
+        history = history.get('judgement_history', [])
+
+    initial_error, jitters = {}, []
+    for track in ['top', 'bottom']:
+        first_errors = [j['error_ms'] for loop in history[:3] for j in loop if j.get('pad') == track and j.get('error_ms') is not None]
+        initial_error[track] = float(np.mean(first_errors)) if first_errors else 0.0
+        for loop in history:
+            errors = [j['error_ms'] for j in loop if j.get('pad') == track and j.get('error_ms') is not None]
+            if len(errors) >= 2: jitters.append(float(np.std(errors)))
+
+    return {
+        'name': os.path.splitext(os.path.basename(session_path))[0],
+        'initial_error_ms': initial_error,
+        'jitter_ms': float(np.mean(jitters)) if jitters else 40.0,
+        'coupling': 0.3, 'self_correction': 0.04, 'drift_ms': 5.0,
+    }
+
+
+def build_dataset(score_path, session_paths=None):
+    """評価用データセットを作成し、その内容ハッシュと一緒に返す"""
+    with open(score_path, 'rb') as f:
+        score_bytes = f.read()
+    profiles = [_profile_from_session(p) for p in session_paths] if session_paths else DEFAULT_LEARNER_PROFILES
+
+    dataset = {
+        'score_path': os.path.abspath(score_path),
+        'profiles': profiles,
+        'sim_loops': SIM_LOOPS,
+        'sim_seeds': SIM_SEEDS,
+    }
+    hasher = hashlib.sha1(score_bytes)
+    hasher.update(json.dumps({k: v for k, v in dataset.items() if k != 'score_path'}, sort_keys=True).encode('utf-8'))
+    return dataset, hasher.hexdigest()[:16]
+
+
+# ==========================================================
+# 合成学習者によるシミュレーション
+# ==========================================================
+def _judge(error_ms):
+    abs_error = abs(error_ms)
+    for judgement in ['perfect', 'great', 'good']:
+        if abs_error <= JUDGEMENT_WINDOWS[judgement]: return judgement
+    return None
+
+
+def simulate_practice(controller, tracks, profile, loops, rng):
+    """
+    1回分の練習をシミュレーションし、ループごとの判定リスト (judgement_history と同じ形式) を返す。
+    学習者はロボットの提示タイミング (オフセット) に coupling の割合で引き込まれ、
+    self_correction の割合で自力で理想に近づく。
+    """
+    controller.reset()
+    mean_error = {t: float(profile['initial_error_ms'].get(t, 0.0)) for t in tracks}
+    history = []
+
+    for _ in range(loops):
+        loop_judgements = []
+        for track_name, track in tracks.items():
+            note_times = track['note_times_ms']
+            if not note_times: continue
+            guided_offsets = [controller.get_guided_timing(track_name, t)[0] - t for t in note_times]
+            robot_offset = float(np.mean(guided_offsets))
+
+            errors = mean_error[track_name] + rng.normal(0.0, profile['jitter_ms'], len(note_times))
+            for note_index, error_ms in enumerate(errors):
+                judgement = _judge(error_ms)
+                note_id = f"{track_name}-{note_index}"
+                if judgement:
+                    loop_judgements.append({'judgement': judgement, 'error_ms': float(error_ms), 'pad': track_name, 'note_id': note_id})
+                else:
+                    loop_judgements.append({'judgement': 'extra', 'error_ms': None, 'pad': track_name, 'note_id': None})
+                    loop_judgements.append({'judgement': 'dropped', 'error_ms': None, 'pad': track_name, 'note_id': note_id})
+
+            # 次のループに向けた学習者の状態更新
+            mean_error[track_name] += profile['coupling'] * (robot_offset - mean_error[track_name])
+            mean_error[track_name] -= profile['self_correction'] * mean_error[track_name]
+            mean_error[track_name] += rng.normal(0.0, profile['drift_ms'])
+
+        history.append(loop_judgements)
+        controller.update_performance_data(history)
+    return history
+
+
+def _summarize(history, total_notes):
+    """最後の EVAL_LAST_LOOPS ループの平均 |誤差| と得点率を計算する"""
+    tail = history[-EVAL_LAST_LOOPS:]
+    abs_errors = [abs(j['error_ms']) for loop in tail for j in loop if j['error_ms'] is not None]
+    weighted = sum(JUDGEMENT_WEIGHTS.get(j['judgement'], 0.0) for loop in tail for j in loop)
+    score = weighted / (total_notes * len(tail)) * 100 if total_notes and tail else 0.0
+    # 範囲外 (dropped) は good の窓の端として誤差に含め、打鍵しないことが有利にならないようにする
+    dropped = sum(1 for loop in tail for j in loop if j['judgement'] == 'dropped')
+    abs_errors.extend([JUDGEMENT_WINDOWS['good']] * dropped)
+    return (float(np.mean(abs_errors)) if abs_errors else 0.0), score
+
+
+def _import_controller_class(module_name, class_name):
+    if SCRIPT_DIR not in sys.path: sys.path.insert(0, SCRIPT_DIR)
+    module = importlib.import_module(f"controllers.{module_name}")
+    return getattr(module, class_name)
+
+
+def evaluate_point(task):
+    """
+    1つのパラメータ点を評価する (multiprocessing のワーカーから呼ばれる)。
+    task: (module_name, class_name, params, dataset, seed_base)
+    """
+    module_name, class_name, params, dataset, seed_base = task
+    controller_cls = _import_controller_class(module_name, class_name)
+    score_data, tracks = _load_score(dataset['score_path'])
+    total_notes = sum(len(t['note_times_ms']) for t in tracks.values())
+    ms_per_beat = next(iter(tracks.values()))['ms_per_beat'] if tracks else 0
+
+    abs_errors, scores = [], []
+    for profile_index, profile in enumerate(dataset['profiles']):
+        for seed in range(dataset['sim_seeds']):
+            rng = np.random.default_rng(seed_base + profile_index * 1000 + seed)
+            controller = controller_cls(score_data, ms_per_beat)
+            controller.apply_params(params)
+            # コントローラーの print ログは大量に出るので捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                history = simulate_practice(controller, tracks, profile, dataset['sim_loops'], rng)
+            mean_abs_error, score = _summarize(history, total_notes)
+            abs_errors.append(mean_abs_error); scores.append(score)
+
+    return {
+        'params': params,
+        'mean_abs_error_ms': float(np.mean(abs_errors)),
+        'std_abs_error_ms': float(np.std(abs_errors)),
+        'score': float(np.mean(scores)),
+    }
+
+
+# ==========================================================
+# 探索空間
+# ==========================================================
+def parse_param_spec(spec, default_value):
+    """
+    'NAME=0.05:0.5:10' (linspace), 'NAME=0.0:0.5' (ランダム探索用の範囲), 'NAME=1,2,3' (列挙) を解釈する。
+    戻り値: (name, values or None, (low, high) or None)
+    """
+    name, _, body = spec.partition('=')
+    cast = int if isinstance(default_value, int) else float
+    if ',' in body:
+        return name, [cast(v) for v in body.split(',')], None
+    parts = body.split(':')
+    low, high = float(parts[0]), float(parts[1])
+    if len(parts) == 3:
+        values = np.linspace(low, high, int(parts[2]))
+        values = sorted(set(int(round(v)) for v in values)) if cast is int else [round(float(v), 6) for v in values]
+        return name, values, (low, high)
+    return name, None, (low, high)
+
+
+def build_search_points(defaults, specs, random_count, rng):
+    """グリッドまたはランダム探索の点 (パラメータ辞書のリスト) を作る"""
+    grid, ranges = {}, {}
+    for spec in specs:
+        name = spec.partition('=')[0]
+        if name not in defaults:
+            raise ValueError(f"パラメータ '{name}' はチューニング対象ではありません。候補: {list(defaults)}")
+        name, values, value_range = parse_param_spec(spec, defaults[name])
+        if values is not None: grid[name] = values
+        if value_range is not None: ranges[name] = value_range
+
+    if not specs:
+        # 指定がなければ、各パラメータの既定値の 0.5倍 / 1倍 / 1.5倍 を試す
+        for name, value in defaults.items():
+            cast = int if isinstance(value, int) else float
+            grid[name] = sorted(set(cast(value * k) if cast is float else max(0, int(round(value * k))) for k in (0.5, 1.0, 1.5)))
+
+    if random_count:
+        points = []
+        for _ in range(random_count):
+            point = {}
+            for name in set(grid) | set(ranges):
+                if name in ranges:
+                    low, high = ranges[name]
+                    point[name] = int(rng.integers(int(low), int(high) + 1)) if isinstance(defaults[name], int) else round(float(rng.uniform(low, high)), 6)
+                else:
+                    point[name] = grid[name][int(rng.integers(len(grid[name])))]
+            points.append(point)
+        return points
+
+    names = sorted(grid)
+    return [dict(zip(names, combo)) for combo in itertools.product(*(grid[n] for n in names))]
+
+
+# ==========================================================
+# キャッシュ
+# ==========================================================
+def cache_key(class_name, params, dataset_hash):
+    payload = json.dumps({'controller': class_name, 'params': params, 'dataset': dataset_hash}, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def load_cached(key):
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path): return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError): return None
+
+
+def store_cached(key, result):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = os.path.join(CACHE_DIR, f"{key}.json.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(result, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(CACHE_DIR, f"{key}.json"))
+
+
+# ==========================================================
+# メイン処理
+# ==========================================================
+def find_controller(class_name):
+    """controllers/ 内からクラス名でコントローラーを探し、(モジュール名, クラス) を返す"""
+    entry = controller_registry.ControllerRegistry().find_by_class(class_name)
+    return entry.module_name, entry.load()
+
+
+def run_sweep(class_name, specs, random_count=0, session_paths=None, score_path=DEFAULT_SCORE_PATH,
+              processes=None, seed=0, install=False):
+    module_name, controller_cls = find_controller(class_name)
+    defaults = controller_cls(None, 0).get_tunable_params()
+    if not defaults:
+        raise ValueError(f"{class_name} にはチューニング可能なパラメータがありません。")
+
+    dataset, dataset_hash = build_dataset(score_path, session_paths)
+    points = build_search_points(defaults, specs, random_count, np.random.default_rng(seed))
+    print(f"🔍 {class_name}: {len(points)} 点を評価します (データセット {dataset_hash}, 学習者 {len(dataset['profiles'])} 種)")
+
+    results, pending = [], []
+    for params in points:
+        full_params = {**defaults, **params}
+        key = cache_key(class_name, full_params, dataset_hash)
+        cached = load_cached(key)
+        if cached: results.append(cached)
+        else: pending.append((key, full_params))
+    print(f"   キャッシュ済み: {len(results)} 点 / 新規評価: {len(pending)} 点")
+
+    if pending:
+        tasks = [(module_name, class_name, params, dataset, seed) for _, params in pending]
+        started = time.time()
+        with Pool(processes=processes) as pool:
+            for (key, _), result in zip(pending, pool.imap(evaluate_point, tasks)):
+                store_cached(key, result)
+                results.append(result)
+                print(f"   [{len(results)}/{len(points)}] {result['params']} -> |err|={result['mean_abs_error_ms']:.1f}ms score={result['score']:.1f}%")
+        print(f"   評価時間: {time.time() - started:.1f} 秒")
+
+    # 平均 |誤差| が小さい順、同点なら得点率が高い順
+    results.sort(key=lambda r: (r['mean_abs_error_ms'], -r['score']))
+    print_ranking(results, list(defaults))
+    best_path = write_best_config(class_name, results[0], dataset_hash, install)
+    return results, best_path
+
+
+def print_ranking(results, param_names, limit=20):
+    header = " 順位 | " + " | ".join(f"{n:>16}" for n in param_names) + " | |誤差|(ms) | ばらつき | 得点率(%)"
+    print("\n" + header); print("-" * len(header))
+    for rank, r in enumerate(results[:limit], start=1):
+        values = " | ".join(f"{r['params'].get(n, ''):>16}" for n in param_names)
+        print(f" {rank:>4} | {values} | {r['mean_abs_error_ms']:>10.2f} | {r['std_abs_error_ms']:>8.2f} | {r['score']:>9.1f}")
+
+
+def write_best_config(class_name, best, dataset_hash, install):
+    """最良設定を sweep_results/ に書き出し、install=True なら tuned_params.json に反映する"""
+    entry = {
+        'params': best['params'],
+        'mean_abs_error_ms': best['mean_abs_error_ms'],
+        'score': best['score'],
+        'dataset': dataset_hash,
+        'generated': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    best_path = os.path.join(RESULTS_DIR, f"best_{class_name}.json")
+    with open(best_path, 'w', encoding='utf-8') as f:
+        json.dump({class_name: entry}, f, indent=4, ensure_ascii=False)
+    print(f"\n🏆 最良設定: {best['params']} -> {best_path}")
+
+    if install:
+        tuned = {}
+        if os.path.exists(TUNED_PARAMS_PATH):
+            with open(TUNED_PARAMS_PATH, 'r', encoding='utf-8') as f: tuned = json.load(f)
+        tuned[class_name] = entry
+        with open(TUNED_PARAMS_PATH, 'w', encoding='utf-8') as f:
+            json.dump(tuned, f, indent=4, ensure_ascii=False)
+        print(f"✅ {TUNED_PARAMS_PATH} に反映しました (次回起動時に load_controllers が読み込みます)")
+    return best_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="同調制御コントローラーのパラメータ探索")
+    parser.add_argument("controller", help="コントローラーのクラス名 (例: LinearController)")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=SPEC",
+                        help="探索範囲。'NAME=low:high:count', 'NAME=low:high' (--random用), 'NAME=v1,v2,...'")
+    parser.add_argument("--random", type=int, default=0, metavar="N", help="ランダム探索の点数 (0ならグリッド探索)")
+    parser.add_argument("--session", action="append", default=[], help="学習者モデルの推定に使う judgement_history JSON")
+    parser.add_argument("--score", default=DEFAULT_SCORE_PATH, help="評価に使う楽譜 JSON")
+    parser.add_argument("--processes", type=int, default=None, help="並列プロセス数 (既定: CPU数)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--install", action="store_true", help="最良設定を controllers/tuned_params.json に反映する")
+    args = parser.parse_args(argv)
+
+    run_sweep(args.controller, args.grid, random_count=args.random, session_paths=args.session or None,
+              score_path=args.score, processes=args.processes, seed=args.seed, install=args.install)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,13 @@ class BaseEntrainmentController:
     """
     全ての同調制御コントローラーの基底クラス。
     新しいコントローラーは必ずこのクラスを継承してください。
+
+    大文字の数値属性 (例: CORRECTION_RATE) はチューニング対象のパラメータとして扱われ、
+    controller_sweep.py による探索や tuned_params.json による上書きの対象になります。
     """
+    # load_controllers() が tuned_params.json から設定する上書き値
+    TUNED_PARAMS = {}
+
     def __init__(self, score_data, ms_per_beat):
         self.score_data = score_data
         self.ms_per_beat = ms_per_beat
@@ -47,4 +53,25 @@ class BaseEntrainmentController:
 
     def reset(self):
         """練習がリセットされたときに内部状態を初期化するメソッド"""
-        pass
\ No newline at end of file
+        pass
+
+    def get_tunable_params(self):
+        """チューニング可能なパラメータ (大文字の数値属性) を辞書で返す"""
+        return {
+            key: value for key, value in vars(self).items()
+            if key.isupper() and isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+
+    def apply_params(self, params):
+        """
+        パラメータを上書きする。存在しないパラメータ名は無視する。
+        元の型 (int/float) に合わせて変換する。
+        """
+        tunable = self.get_tunable_params()
+        for key, value in (params or {}).items():
+            if key in tunable:
+                setattr(self, key, type(tunable[key])(value))
+
+    def apply_tuned_params(self):
+        """tuned_params.json の値 (TUNED_PARAMS) を適用する。継承先の __init__ の最後で呼び出す"""
+        self.apply_params(self.TUNED_PARAMS)
\ No newline at end of file
@@ -18,6 +18,8 @@ class LinearController(BaseEntrainmentController):
         self.ANALYSIS_LOOPS = 2      # 最初の1ループだけ様子見
         self.CORRECTION_RATE = 0.10  # ユーザーのズレの10%分だけ理想に寄せた位置で弾く
                                      # (0.10 は「優しく誘導」、0.50だと「強く矯正」)
+        self.DECAY_RATE = 0.95       # 打鍵がなかったループでのオフセット減衰率
+        self.apply_tuned_params()
 
     def reset(self):
         """状態をリセット"""
@@ -63,7 +65,7 @@ class LinearController(BaseEntrainmentController):
                 status_texts.append(f"{track}: User={current_avg_error:+.0f}ms -> Robot={new_offset:+.0f}ms")
             else:
                 # 打鍵がなかった場合は、前回のオフセットを少し減衰させて維持
-                self.phase_offset_ms[track] *= 0.95
+                self.phase_offset_ms[track] *= self.DECAY_RATE
         
         # ループごとのサマリーログ
         status_str = ", ".join(status_texts) if status_texts else "No input"
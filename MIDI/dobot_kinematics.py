@@ -0,0 +1,247 @@
+"""
+Dobot の運動特性モデル (tuning_data.csv の全スイープに台形速度モデルをフィット)
+
+    duration = max(min_duration, offset + gain * trapezoid(distance, v * velocity_scale, a * acceleration_scale))
+
+  - velocity_scale / acceleration_scale: Dobot の指令値 → 実効値 (mm/s, mm/s^2) の換算係数 (格子探索)
+  - offset / gain: 通信・処理の固定遅れと時間スケール (最小二乗。遅れは負にならないよう offset >= 0 で解く)
+  - min_duration: 実測の最短移動時間 (これより速い到着は観測されない)
+
+duration() と逆関数 distance() は numpy のブロードキャストに対応しており、
+V/A の任意の組み合わせを表引きなしで評価できる。フィット結果は JSON に保存して再利用する
+(保存するのは下の CLI だけ。load_or_fit は保存済みのモデルが古ければメモリ上でフィットし直すだけで、ファイルは書かない)。
+
+使い方:
+    python dobot_kinematics.py [tuning_data.csv] [-o dobot_kinematics.json]
+"""
+import os
+import csv
+import json
+import hashlib
+import argparse
+import datetime
+
+import numpy as np
+
+DEFAULT_MODEL_PATH = 'dobot_kinematics.json'
+MODEL_VERSION = 1
+SCALE_GRID = np.geomspace(0.05, 20.0, 64)  # 換算係数の探索範囲
+CANDIDATE_STEP = 50.0                      # プランナーに渡す V/A 候補の刻み
+MIN_DURATION_QUANTILE = 0.01               # 最短移動時間として使う実測値の分位点
+
+
+def trapezoid(distance, velocity, acceleration):
+    """台形速度プロファイル (加速 → 等速 → 減速) の移動時間。距離が短いと三角形プロファイルになる"""
+    distance = np.maximum(np.asarray(distance, dtype=float), 0.0)
+    velocity = np.asarray(velocity, dtype=float); acceleration = np.asarray(acceleration, dtype=float)
+    triangular = 2.0 * np.sqrt(distance / acceleration)
+    trapezoidal = distance / velocity + velocity / acceleration
+    return np.where(distance < velocity ** 2 / acceleration, triangular, trapezoidal)
+
+
+def trapezoid_distance(duration, velocity, acceleration):
+    """trapezoid() の逆関数: 移動時間から距離を求める"""
+    duration = np.maximum(np.asarray(duration, dtype=float), 0.0)
+    velocity = np.asarray(velocity, dtype=float); acceleration = np.asarray(acceleration, dtype=float)
+    triangular = acceleration * duration ** 2 / 4.0
+    trapezoidal = velocity * (duration - velocity / acceleration)
+    return np.where(duration < 2.0 * velocity / acceleration, triangular, trapezoidal)
+
+
+class DobotKinematics:
+    def __init__(self, velocity_scale, acceleration_scale, offset_s, gain, min_duration_s,
+                 velocity_range=(100.0, 1000.0), acceleration_range=(100.0, 1000.0), residuals=None, source=None, source_sha1=None):
+        self.velocity_scale = float(velocity_scale)
+        self.acceleration_scale = float(acceleration_scale)
+        self.offset_s = float(offset_s)
+        self.gain = float(gain)
+        self.min_duration_s = float(min_duration_s)
+        self.velocity_range = tuple(float(v) for v in velocity_range)
+        self.acceleration_range = tuple(float(a) for a in acceleration_range)
+        self.residuals = residuals or {}
+        self.source = source
+        self.source_sha1 = source_sha1
+        # プランナー用の V/A 候補 (スイープした範囲内を CANDIDATE_STEP 刻み)
+        self.velocities = np.arange(self.velocity_range[0], self.velocity_range[1] + 1e-9, CANDIDATE_STEP)
+        self.accelerations = np.arange(self.acceleration_range[0], self.acceleration_range[1] + 1e-9, CANDIDATE_STEP)
+
+    @classmethod
+    def theoretical(cls):
+        """実測データが無い場合の理論モデル (指令値をそのまま mm/s, mm/s^2 とみなす)"""
+        return cls(1.0, 1.0, 0.0, 1.0, 0.0)
+
+    def _raw_duration(self, distance, velocity, acceleration):
+        velocity = np.asarray(velocity, dtype=float) * self.velocity_scale
+        acceleration = np.asarray(acceleration, dtype=float) * self.acceleration_scale
+        return self.offset_s + self.gain * trapezoid(distance, velocity, acceleration)
+
+    def duration(self, distance, velocity, acceleration):
+        """移動時間 (秒)"""
+        return np.maximum(self._raw_duration(distance, velocity, acceleration), self.min_duration_s)
+
+    def distance(self, duration, velocity, acceleration):
+        """duration() の逆関数: その時間で移動できる距離 (mm)。最短時間以下は最短時間で届く最大距離を返す"""
+        duration = np.maximum(np.asarray(duration, dtype=float), self.min_duration_s)
+        trap_time = (duration - self.offset_s) / self.gain
+        return trapezoid_distance(trap_time, np.asarray(velocity, dtype=float) * self.velocity_scale,
+                                  np.asarray(acceleration, dtype=float) * self.acceleration_scale)
+
+    def to_dict(self):
+        return {
+            'version': MODEL_VERSION,
+            'velocity_scale': self.velocity_scale, 'acceleration_scale': self.acceleration_scale,
+            'offset_s': self.offset_s, 'gain': self.gain, 'min_duration_s': self.min_duration_s,
+            'velocity_range': list(self.velocity_range), 'acceleration_range': list(self.acceleration_range),
+            'residuals': self.residuals, 'source': self.source, 'source_sha1': self.source_sha1,
+            'generated': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != MODEL_VERSION: raise ValueError(f"未対応のモデルバージョン: {data.get('version')}")
+        # 負の遅れ (指令より前に動き出す) は物理的にあり得ないので、制約の無い古いフィットの結果は使わない
+        if data['offset_s'] < 0: raise ValueError(f"offset_s が負です ({data['offset_s'] * 1000:.1f}ms)。フィットし直してください")
+        return cls(data['velocity_scale'], data['acceleration_scale'], data['offset_s'], data['gain'], data['min_duration_s'],
+                   data.get('velocity_range', (100.0, 1000.0)), data.get('acceleration_range', (100.0, 1000.0)),
+                   data.get('residuals'), data.get('source'), data.get('source_sha1'))
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+# --- フィット ---
+def read_sweep(path):
+    """tuning_data.csv を (distance, velocity, acceleration, duration) の配列で返す"""
+    columns = ([], [], [], [])
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                values = (float(row['distance']), float(row['target_velocity']), float(row['target_acceleration']), float(row['actual_duration']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            for column, value in zip(columns, values): column.append(value)
+    if not columns[0]: raise ValueError(f"{path} に有効な行がありません。")
+    return tuple(np.array(c) for c in columns)
+
+
+def _fit_linear(basis, durations, mask):
+    """
+    durations ≈ offset + gain * basis を mask の行だけ、offset >= 0 で解く (basis は (S, M) で S 通りを一括)。
+    制約の無い解の offset が負なら、制約付きの最適解は offset = 0 (原点を通る直線の最小二乗)
+    """
+    x = basis[:, mask]; y = durations[mask]
+    x_mean = x.mean(axis=1, keepdims=True); y_mean = y.mean()
+    variance = ((x - x_mean) ** 2).sum(axis=1)
+    gain = ((x - x_mean) * (y - y_mean)).sum(axis=1) / np.where(variance > 0, variance, np.inf)
+    offset = y_mean - gain * x_mean[:, 0]
+    negative = offset < 0
+    if negative.any():
+        squares = (x[negative] ** 2).sum(axis=1)
+        gain[negative] = (x[negative] * y).sum(axis=1) / np.where(squares > 0, squares, np.inf)
+        offset[negative] = 0.0
+    return offset, gain
+
+
+def residual_report(model, distances, velocities, accelerations, durations):
+    """フィット残差の要約 (全体と距離別)"""
+    error = model.duration(distances, velocities, accelerations) - durations
+    report = {
+        'samples': int(error.size),
+        'rmse_ms': float(np.sqrt(np.mean(error ** 2)) * 1000),
+        'mae_ms': float(np.mean(np.abs(error)) * 1000),
+        'max_abs_ms': float(np.max(np.abs(error)) * 1000),
+        'bias_ms': float(np.mean(error) * 1000),
+        'by_distance': {},
+    }
+    for d in np.unique(distances):
+        e = error[distances == d]
+        report['by_distance'][f"{d:g}"] = {'rmse_ms': float(np.sqrt(np.mean(e ** 2)) * 1000), 'bias_ms': float(np.mean(e) * 1000)}
+    return report
+
+
+def fit(distances, velocities, accelerations, durations, source=None, source_sha1=None, scale_grid=SCALE_GRID, with_residuals=True):
+    """換算係数を格子探索し、各点で offset/gain を最小二乗で解いて最良のモデルを返す"""
+    min_duration = float(np.quantile(durations, MIN_DURATION_QUANTILE))
+    kv, ka = (g.ravel() for g in np.meshgrid(scale_grid, scale_grid, indexing='ij'))
+    basis = trapezoid(distances[None, :], velocities[None, :] * kv[:, None], accelerations[None, :] * ka[:, None])  # (S, M)
+
+    # 最短時間に張り付いた実測値は打ち切りデータなので、2 回目以降のフィットから外す
+    mask = np.ones(durations.size, dtype=bool)
+    for _ in range(3):
+        offset, gain = _fit_linear(basis, durations, mask)
+        predicted = np.maximum(offset[:, None] + gain[:, None] * basis, min_duration)
+        rmse = np.sqrt(np.mean((predicted - durations[None, :]) ** 2, axis=1))
+        best = int(np.argmin(rmse))
+        raw = offset[best] + gain[best] * basis[best]
+        mask = (durations > min_duration * 1.05) | (raw > min_duration)
+
+    model = DobotKinematics(kv[best], ka[best], offset[best], gain[best], min_duration,
+                            (velocities.min(), velocities.max()), (accelerations.min(), accelerations.max()),
+                            source=source, source_sha1=source_sha1)
+    if with_residuals:
+        model.residuals = residual_report(model, distances, velocities, accelerations, durations)
+    return model
+
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fit_csv(path):
+    distances, velocities, accelerations, durations = read_sweep(path)
+    return fit(distances, velocities, accelerations, durations, source=os.path.basename(path), source_sha1=_file_sha1(path))
+
+
+def load_or_fit(csv_path, model_path=None):
+    """
+    保存済みモデルが csv_path と同じ内容から作られていればそれを読み、
+    そうでなければメモリ上でフィットし直す (読み込みでファイルは書かない。保存は CLI で明示的に行う)。
+    """
+    model_path = model_path or os.path.join(os.path.dirname(os.path.abspath(csv_path)), DEFAULT_MODEL_PATH)
+    sha1 = _file_sha1(csv_path)
+    if os.path.exists(model_path):
+        try:
+            model = DobotKinematics.load(model_path)
+            if model.source_sha1 == sha1: return model
+            print(f"注意: {model_path} は {os.path.basename(csv_path)} の今の内容から作られていません。フィットし直します。")
+        except Exception as e:
+            print(f"警告: {model_path} の読み込みに失敗 ({e})。フィットし直します。")
+    model = fit_csv(csv_path)
+    print(f"   (毎回のフィットを省くには: python dobot_kinematics.py {csv_path} -o {model_path})")
+    return model
+
+
+def print_report(model):
+    r = model.residuals
+    print(f"📐 フィット結果 ({model.source}, {r.get('samples', 0)} サンプル)")
+    print(f"   V換算={model.velocity_scale:.4g}, A換算={model.acceleration_scale:.4g}, "
+          f"offset={model.offset_s * 1000:.1f}ms, gain={model.gain:.4g}, 最短={model.min_duration_s * 1000:.1f}ms")
+    print(f"   残差: RMSE {r['rmse_ms']:.1f}ms / MAE {r['mae_ms']:.1f}ms / 最大 {r['max_abs_ms']:.1f}ms / 平均 {r['bias_ms']:+.1f}ms")
+    for distance, stats in r['by_distance'].items():
+        print(f"     {distance:>5}mm: RMSE {stats['rmse_ms']:6.1f}ms, 平均 {stats['bias_ms']:+6.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tuning_data.csv に Dobot の運動特性モデルをフィットする")
+    parser.add_argument('csv', nargs='?', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tuning_data.csv'))
+    parser.add_argument('-o', '--output', default=None, help=f"保存先 (既定: CSV と同じ場所の {DEFAULT_MODEL_PATH})")
+    args = parser.parse_args()
+
+    model = fit_csv(args.csv)
+    print_report(model)
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.csv)), DEFAULT_MODEL_PATH)
+    model.save(output)
+    print(f"💾 保存しました: {output}")
+
+
+if __name__ == "__main__":
+    main()
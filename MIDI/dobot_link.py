@@ -0,0 +1,373 @@
+"""
+RobotController と pydobot の間に入るコマンド層
+
+  - 最後に送った速度・加速度を覚えておき、同じ値の速度/パラメータパケットは送らない
+  - モーションプランのパケットは、プラン作成時に encode_plan() でバイト列にしておく
+  - 1 動作分 (速度 + PTP、先読みモードでは WAIT も) をまとめて 1 回の write で送り、応答を N 個読む
+  - ポートごとの送受信バイト数 / 秒 とパケット往復時間を集計する (link_stats())
+  - AsyncDobotLink は同じ処理を asyncio 上でノンブロッキングに行う (robot_orchestrator.py 用)
+
+pydobot の _send_command は送受信の前に 0.1 秒ずつ待つため、キュー投入はこの層で直接行う。
+接続・初期化・待機位置への移動などは従来どおり pydobot の Dobot を使う。
+"""
+import time
+import struct
+import asyncio
+import threading
+from collections import deque
+
+# --- Dobot 通信プロトコル ---
+CMD_GET_POSE = 10
+CMD_SET_PTP_COORDINATE_PARAMS = 81
+CMD_SET_PTP_COMMON_PARAMS = 83
+CMD_SET_PTP_CMD = 84
+CMD_SET_WAIT_CMD = 110
+CMD_SET_QUEUED_CMD_START_EXEC = 240
+CMD_SET_QUEUED_CMD_STOP_EXEC = 241
+CMD_SET_QUEUED_CMD_FORCE_STOP_EXEC = 242
+CMD_SET_QUEUED_CMD_CLEAR = 245
+CMD_GET_QUEUED_CMD_CURRENT_INDEX = 246
+CTRL_READ = 0x00
+CTRL_WRITE = 0x01
+CTRL_QUEUED_WRITE = 0x03
+PTP_MODE_MOVL_XYZ = 0x02
+
+RESPONSE_TIMEOUT_S = 0.5
+LATENCY_WINDOW = 256          # 往復時間の集計に使う直近のサンプル数
+ASYNC_POLL_INTERVAL_S = 0.001 # add_reader が使えない環境 (Windows の COM ポート等) での受信確認間隔
+
+
+# --- フレームの組み立てと読み取り ---
+def encode_packet(cmd_id, ctrl, params=b""):
+    payload = bytes([cmd_id, ctrl]) + bytes(params)
+    return bytes([0xAA, 0xAA, len(payload)]) + payload + bytes([(-sum(payload)) & 0xFF])
+
+
+def read_packet(ser, timeout=RESPONSE_TIMEOUT_S):
+    """応答フレームを 1 つ読み、(cmd_id, params, フレーム長) を返す"""
+    deadline = time.perf_counter() + timeout
+    previous = None
+    while True:  # ヘッダ AA AA まで読み飛ばす
+        byte = ser.read(1)
+        if not byte:
+            if time.perf_counter() > deadline: raise TimeoutError("Dobot からの応答がありません。")
+            continue
+        if previous == 0xAA and byte[0] == 0xAA: break
+        previous = byte[0]
+    length = ser.read(1)
+    body = ser.read(length[0] + 1) if length else b""
+    if not length or len(body) != length[0] + 1: raise TimeoutError("Dobot の応答が途中で切れました。")
+    payload, checksum = body[:-1], body[-1]
+    if (sum(payload) + checksum) & 0xFF:
+        raise ValueError(f"チェックサム不一致 (ID {payload[0]})")
+    return payload[0], payload[2:], len(body) + 3
+
+
+def extract_frames(buffer):
+    """
+    受信バッファ (bytearray) から完結したフレームを取り出し、[(cmd_id, params, フレーム長)] を返す。
+    取り出した分と、ヘッダ前のゴミはバッファから消す。
+    """
+    frames = []
+    while True:
+        start = buffer.find(b"\xAA\xAA")
+        if start < 0:
+            del buffer[:max(len(buffer) - 1, 0)]; return frames
+        if start: del buffer[:start]
+        if len(buffer) < 3: return frames
+        size = buffer[2] + 4
+        if len(buffer) < size: return frames
+        payload, checksum = bytes(buffer[3:size - 1]), buffer[size - 1]
+        del buffer[:size]
+        if (sum(payload) + checksum) & 0xFF or len(payload) < 2:
+            print(f"[dobot_link] 不正なフレームを破棄しました ({payload.hex()})"); continue
+        frames.append((payload[0], payload[2:], size))
+
+
+def parse_queued_index(params):
+    if len(params) >= 8: return struct.unpack_from('<Q', params, 0)[0]
+    return struct.unpack_from('<I', params, 0)[0]
+
+
+def halt_packets():
+    """実行中の動作もその場で止め (ForceStopExec)、キューを空にする"""
+    return [encode_packet(CMD_SET_QUEUED_CMD_FORCE_STOP_EXEC, CTRL_WRITE), encode_packet(CMD_SET_QUEUED_CMD_CLEAR, CTRL_WRITE)]
+
+def start_exec_packet():
+    return encode_packet(CMD_SET_QUEUED_CMD_START_EXEC, CTRL_WRITE)
+
+
+def parse_pose(params):
+    """GetPose の応答 (x, y, z, r, j1..j4) から (x, y, z, r) を返す"""
+    return struct.unpack_from('<ffff', params, 0)
+
+
+def wait_packet(ms):
+    return encode_packet(CMD_SET_WAIT_CMD, CTRL_QUEUED_WRITE, struct.pack('<I', int(ms)))
+
+def speed_packets(velocity, acceleration):
+    return (encode_packet(CMD_SET_PTP_COMMON_PARAMS, CTRL_QUEUED_WRITE, struct.pack('<ff', velocity, acceleration)),
+            encode_packet(CMD_SET_PTP_COORDINATE_PARAMS, CTRL_QUEUED_WRITE, struct.pack('<ffff', velocity, velocity, acceleration, acceleration)))
+
+def ptp_packet(position):
+    return encode_packet(CMD_SET_PTP_CMD, CTRL_QUEUED_WRITE, bytes([PTP_MODE_MOVL_XYZ]) + struct.pack('<ffff', *position))
+
+
+class MotionPackets:
+    """1 動作分のエンコード済みパケット (速度は送る必要があるときだけ使う)"""
+    __slots__ = ('params', 'speed', 'ptp')
+
+    def __init__(self, velocity, acceleration, position):
+        self.params = (float(velocity), float(acceleration))
+        self.speed = speed_packets(*self.params)
+        self.ptp = ptp_packet(position)
+
+
+def encode_plan(motion_plan):
+    """motion_plan_compiler の構造化配列を、行ごとの MotionPackets のリストにする"""
+    return [MotionPackets(row['velocity'], row['acceleration'], (row['x'], row['y'], row['z'], row['r'])) for row in motion_plan]
+
+
+class DobotLink:
+    """
+    1 ポート分のコマンド層。pydobot の Dobot (device.ser と device.lock) を共有して使う。
+    pydobot 側で速度を変えた後は invalidate() を呼ぶこと。
+    """
+    def __init__(self, device, port):
+        self.device = device
+        self.port = port
+        self.last_params = None
+        self.started_at = time.perf_counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.packets_elided = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # pydobot はタイムアウトなしでポートを開くため、応答待ちが無限にならないよう設定する
+        self.device.ser.timeout = RESPONSE_TIMEOUT_S
+        with _registry_lock: _links[port] = self
+
+    def invalidate(self):
+        """ロボット側の速度設定が分からなくなったとき (pydobot で speed() した後など)"""
+        self.last_params = None
+
+    def send(self, packets):
+        """
+        パケット列を 1 回の write で送り、同じ数の応答を読んで params のリストで返す。
+        packets は bytes のリスト (各要素が 1 パケット)。
+        """
+        buffer = b"".join(packets)
+        with self.device.lock:
+            started = time.perf_counter()
+            self.device.ser.write(buffer)
+            responses = []
+            for _ in packets:
+                _, params, size = read_packet(self.device.ser)
+                responses.append(params); self.bytes_received += size
+            self.latencies.append(time.perf_counter() - started)
+        self.bytes_sent += len(buffer); self.packets_sent += len(packets)
+        return responses
+
+    def _motion_packets(self, motion_packets, wait_ms):
+        packets = []
+        if wait_ms is not None: packets.append(wait_packet(wait_ms))
+        if self._speed_needed(motion_packets.params):
+            packets.extend(motion_packets.speed)
+        packets.append(motion_packets.ptp)
+        return packets
+
+    def transact(self, packet):
+        return self.send([packet])[0]
+
+    def _speed_needed(self, params):
+        if params == self.last_params:
+            self.packets_elided += 2
+            return False
+        self.last_params = params
+        return True
+
+    def set_speed(self, velocity, acceleration):
+        """速度・加速度を設定する (前回と同じなら何も送らない)"""
+        params = (float(velocity), float(acceleration))
+        if self._speed_needed(params): self.send(list(speed_packets(*params)))
+
+    def send_motion(self, motion_packets, wait_ms=None):
+        """
+        [WAIT] [速度 (変わるときだけ)] [PTP] をまとめて送り、PTP のキューインデックスを返す。
+        """
+        return parse_queued_index(self.send(self._motion_packets(motion_packets, wait_ms))[-1])
+
+    def move(self, position):
+        """PTP だけを送る (速度は set_speed で設定済みのもの)。キューインデックスを返す"""
+        return parse_queued_index(self.transact(ptp_packet(position)))
+
+    def current_index(self):
+        return parse_queued_index(self.transact(encode_packet(CMD_GET_QUEUED_CMD_CURRENT_INDEX, CTRL_READ)))
+
+    def pose(self):
+        return parse_pose(self.transact(encode_packet(CMD_GET_POSE, CTRL_READ)))
+
+    def reset_queue(self):
+        """キューを止めて空にし、再び実行状態にする"""
+        self.send([encode_packet(CMD_SET_QUEUED_CMD_STOP_EXEC, CTRL_WRITE),
+                   encode_packet(CMD_SET_QUEUED_CMD_CLEAR, CTRL_WRITE),
+                   encode_packet(CMD_SET_QUEUED_CMD_START_EXEC, CTRL_WRITE)])
+        self.invalidate()
+
+    def halt(self):
+        """非常停止: 実行中の動作を止めてキューを空にする (再開には start_exec())"""
+        self.send(halt_packets())
+        self.invalidate()
+
+    def start_exec(self):
+        self.transact(start_exec_packet())
+
+    def stats(self):
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        latencies = sorted(self.latencies)
+        return {
+            'port': self.port,
+            'tx_bytes_per_s': self.bytes_sent / elapsed,
+            'rx_bytes_per_s': self.bytes_received / elapsed,
+            'packets_sent': self.packets_sent,
+            'packets_elided': self.packets_elided,
+            'latency_mean_ms': (sum(latencies) / len(latencies) * 1000) if latencies else None,
+            'latency_p95_ms': latencies[int(0.95 * (len(latencies) - 1))] * 1000 if latencies else None,
+        }
+
+    def stats_line(self):
+        s = self.stats()
+        latency = f"{s['latency_mean_ms']:.1f}ms (p95 {s['latency_p95_ms']:.1f}ms)" if s['latency_mean_ms'] is not None else "-"
+        return (f"[{self.port}] 送信 {s['tx_bytes_per_s']:.0f}B/s, 受信 {s['rx_bytes_per_s']:.0f}B/s, "
+                f"{s['packets_sent']}パケット (省略 {s['packets_elided']}), 往復 {latency}")
+
+
+class AsyncDobotLink(DobotLink):
+    """
+    asyncio 版のコマンド層。ポートは timeout=0 (ノンブロッキング) にし、
+    受信はイベントループの add_reader (使えなければ短い間隔の確認) で行う。
+    応答はコマンド順に返るので、送信ごとの Future を FIFO で待たせて順に解決する。
+    イベントループのスレッドからだけ使うこと (pydobot の device.lock は取らない)。
+    """
+    def __init__(self, device, port):
+        super().__init__(device, port)
+        self.device.ser.timeout = 0
+        self.rx_buffer = bytearray()
+        self.waiting = deque()   # [future, 残り応答数, 応答リスト, 送信時刻]
+        self.timeouts = 0
+        try: self.owner_loop = asyncio.get_running_loop()  # 他のスレッドから使うときの依頼先
+        except RuntimeError: self.owner_loop = None
+        self._loop = None
+        self._reader_installed = False
+        self._poll_task = None
+
+    def _start_reader(self):
+        if self._loop is not None: return
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._loop.add_reader(self.device.ser.fileno(), self._on_readable)
+            self._reader_installed = True
+        except (NotImplementedError, AttributeError, ValueError, OSError):
+            self._poll_task = self._loop.create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            if self.waiting: self._on_readable()
+            await asyncio.sleep(ASYNC_POLL_INTERVAL_S)
+
+    def _on_readable(self):
+        try:
+            data = self.device.ser.read(max(self.device.ser.in_waiting, 1))
+        except Exception as e:
+            self._fail_all(e); return
+        if not data: return
+        self.rx_buffer.extend(data)
+        for _, params, size in extract_frames(self.rx_buffer):
+            self.bytes_received += size
+            if not self.waiting: continue  # タイムアウト済みコマンドへの遅れた応答
+            entry = self.waiting[0]
+            entry[2].append(params); entry[1] -= 1
+            if entry[1] == 0:
+                self.waiting.popleft()
+                self.latencies.append(time.perf_counter() - entry[3])
+                if not entry[0].done(): entry[0].set_result(entry[2])
+
+    def _fail_all(self, error):
+        while self.waiting:
+            future = self.waiting.popleft()[0]
+            if not future.done(): future.set_exception(error)
+        self.rx_buffer.clear()
+
+    async def send(self, packets):
+        self._start_reader()
+        buffer = b"".join(packets)
+        future = self._loop.create_future()
+        self.waiting.append([future, len(packets), [], time.perf_counter()])
+        self.device.ser.write(buffer)
+        self.bytes_sent += len(buffer); self.packets_sent += len(packets)
+        try:
+            return await asyncio.wait_for(future, RESPONSE_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            # 応答の対応がずれるので、待ちを全部捨てて受信し直す
+            self.timeouts += 1
+            self._fail_all(TimeoutError("Dobot からの応答がありません。"))
+            self.invalidate()
+            raise TimeoutError(f"[{self.port}] Dobot からの応答がありません。")
+
+    async def transact(self, packet):
+        return (await self.send([packet]))[0]
+
+    async def set_speed(self, velocity, acceleration):
+        params = (float(velocity), float(acceleration))
+        if self._speed_needed(params): await self.send(list(speed_packets(*params)))
+
+    async def send_motion(self, motion_packets, wait_ms=None):
+        return parse_queued_index((await self.send(self._motion_packets(motion_packets, wait_ms)))[-1])
+
+    async def current_index(self):
+        return parse_queued_index(await self.transact(encode_packet(CMD_GET_QUEUED_CMD_CURRENT_INDEX, CTRL_READ)))
+
+    async def pose(self):
+        return parse_pose(await self.transact(encode_packet(CMD_GET_POSE, CTRL_READ)))
+
+    async def reset_queue(self):
+        await self.send([encode_packet(CMD_SET_QUEUED_CMD_STOP_EXEC, CTRL_WRITE),
+                         encode_packet(CMD_SET_QUEUED_CMD_CLEAR, CTRL_WRITE),
+                         encode_packet(CMD_SET_QUEUED_CMD_START_EXEC, CTRL_WRITE)])
+        self.invalidate()
+
+    def pose_threadsafe(self, timeout=RESPONSE_TIMEOUT_S * 2):
+        """イベントループ以外のスレッドから姿勢を読む (ループに依頼して結果を待つ)"""
+        if self.owner_loop is None: raise RuntimeError("イベントループ上で作られたリンクではありません。")
+        return asyncio.run_coroutine_threadsafe(self.pose(), self.owner_loop).result(timeout)
+
+    async def halt(self):
+        await self.send(halt_packets())
+        self.invalidate()
+
+    async def start_exec(self):
+        await self.transact(start_exec_packet())
+
+    def close(self):
+        """受信の登録を外し、ポートを pydobot 用の設定 (ブロッキング読み取り) に戻す"""
+        if self._reader_installed:
+            try: self._loop.remove_reader(self.device.ser.fileno())
+            except Exception: pass
+        if self._poll_task: self._poll_task.cancel()
+        self._fail_all(ConnectionError("リンクを閉じました。"))
+        self._loop = None; self._reader_installed = False; self._poll_task = None
+        self.device.ser.timeout = RESPONSE_TIMEOUT_S
+
+    def stats(self):
+        s = super().stats()
+        s['timeouts'] = self.timeouts
+        return s
+
+
+_links = {}
+_registry_lock = threading.Lock()
+
+def link_stats():
+    """ポートごとの通信統計 {port: dict}"""
+    with _registry_lock:
+        return {port: link.stats() for port, link in _links.items()}
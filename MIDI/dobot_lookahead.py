@@ -0,0 +1,158 @@
+"""
+Dobot のコマンドキューを使った先読み実行モード
+
+RobotController.run の通常モード (just_in_time) は、打撃の直前に speed + move_to を送るため、
+シリアル往復とホスト側スケジューリングの揺らぎがそのまま打撃タイミングに乗る。
+先読みモードでは、horizon 秒先までの動作を
+    [WAIT (ID 110)] [速度設定 (V/A が変わるときだけ)] [PTP]
+の形でロボット側のキューに積んでおき、タイミングはロボット内部の WAIT で刻む。
+
+  - 進捗は pose ではなく GetQueuedCmdCurrentIndex (ID 246) で追跡する
+  - コントローラーのオフセット変更と、観測したロボット側の遅れ (ドリフト) は、
+    まだキューに積んでいない動作の WAIT に吸収させる (積んだ動作は書き換えない)
+  - キューが空になった (ホストが遅れた) 場合は、その時点を基準に組み直す
+
+シリアル送受信は dobot_link.DobotLink 経由で、1 動作分の WAIT / 速度 / PTP を 1 回の write で送る。
+"""
+import time
+import itertools
+from collections import deque
+
+import numpy as np
+
+import motion_plan_compiler
+import dobot_link
+
+# --- 先読みパラメータ ---
+LOOKAHEAD_HORIZON_S = 1.5     # この秒数先までの動作をキューに積んでおく
+POLL_INTERVAL_S = 0.02        # 実行インデックスの確認間隔
+LINK_LATENCY_S = 0.01         # 書き込みからロボットが受け取るまでの見込み
+MIN_WAIT_MS = 1               # これ未満の WAIT は積まない
+DRIFT_GAIN = 0.2              # 観測した遅れを予測タイムラインに反映する割合
+MAX_DRIFT_OBSERVATION_S = 0.5 # これより大きい遅れの観測は外れ値として捨てる
+LATE_WARNING_S = 0.02         # これ以上遅れて開始する動作をログに出す
+
+
+class _QueuedMotion:
+    __slots__ = ('index', 'motion', 'predicted_start', 'predicted_end')
+
+    def __init__(self, index, motion, predicted_start, predicted_end):
+        self.index = index; self.motion = motion
+        self.predicted_start = predicted_start; self.predicted_end = predicted_end
+
+
+class LookaheadExecutor:
+    """
+    モーションプランをループ再生しながら、horizon_s 先までをロボットのキューに積み続ける。
+    コールバック:
+        on_log(str), on_motion_started(motion_dict), on_estimated_arrival(arrival_abs, z), on_strike(arrival_abs)
+    link は dobot_link.DobotLink (速度パケットの省略はリンク側の状態で判断する)
+    """
+    def __init__(self, link, track_name, controller, kinematics, horizon_s=LOOKAHEAD_HORIZON_S,
+                 on_log=print, on_controller_log=None, on_motion_started=None, on_estimated_arrival=None, on_strike=None):
+        self.link = link; self.track_name = track_name; self.controller = controller; self.kinematics = kinematics
+        self.horizon_s = horizon_s
+        self.on_log = on_log
+        self.on_controller_log = on_controller_log or on_log
+        self.on_motion_started = on_motion_started
+        self.on_estimated_arrival = on_estimated_arrival
+        self.on_strike = on_strike
+        self.pending = deque()
+        self.robot_free_at = None   # ロボットがキューを消化し終える見込み時刻 (ホスト時刻)
+        self.last_position = None
+        self.drift_s = 0.0
+        self.late_count = 0
+
+    # --- キュー操作 ---
+    def reset_queue(self):
+        self.link.reset_queue()
+        self.pending.clear(); self.robot_free_at = None
+
+    def _enqueue(self, motion, packets, target_time):
+        """target_time (絶対時刻) に打撃が届くように WAIT / 速度 / PTP を積む"""
+        now = time.time()
+        if self.robot_free_at is None or self.robot_free_at < now + LINK_LATENCY_S:
+            # キューが空: この時点を基準に組み直す
+            self.robot_free_at = now + LINK_LATENCY_S
+
+        # 移動時間は直前に積んだ位置からの距離で見積もる (初回は待機位置から)
+        distance = np.linalg.norm(np.subtract(motion["position"][:3], (self.last_position or motion["position"])[:3]))
+        duration = float(self.kinematics.duration(distance, motion["velocity"], motion["acceleration"]))
+        # 振り下ろしは到着時刻、振り上げ (is_compensated) は開始時刻が target_time
+        start = target_time if motion["is_compensated"] else target_time - duration
+
+        wait_ms = int(round((start - self.robot_free_at) * 1000))
+        if wait_ms >= MIN_WAIT_MS:
+            self.robot_free_at += wait_ms / 1000.0
+        else:
+            wait_ms = None
+            if self.robot_free_at - start > LATE_WARNING_S:
+                self.late_count += 1
+                self.on_log(f"[{self.track_name}] 先読み: {motion['action']} が {(self.robot_free_at - start) * 1000:.0f}ms 遅れて開始します")
+
+        index = self.link.send_motion(packets, wait_ms=wait_ms)
+        entry = _QueuedMotion(index, motion, self.robot_free_at, self.robot_free_at + duration)
+        self.robot_free_at = entry.predicted_end
+        self.last_position = motion["position"]
+        self.pending.append(entry)
+        if motion["action"] == "strike" and self.on_estimated_arrival:
+            self.on_estimated_arrival(entry.predicted_end, motion["position"][2])
+
+    def _update_progress(self, previous_poll):
+        """実行インデックスを読み、開始した動作の通知とドリフト推定を行う"""
+        current = self.link.current_index()
+        now = time.time()
+        while self.pending and self.pending[0].index <= current:
+            entry = self.pending.popleft()
+            # 開始は前回の確認から今回の確認までの間。予測がその範囲外なら、近い端までのずれを遅れとみなす
+            earliest_lag = previous_poll - entry.predicted_start
+            latest_lag = now - entry.predicted_start
+            observed_lag = earliest_lag if earliest_lag > 0 else (latest_lag if latest_lag < 0 else 0.0)
+            if observed_lag and abs(observed_lag) < MAX_DRIFT_OBSERVATION_S:
+                correction = DRIFT_GAIN * observed_lag
+                self.drift_s += correction
+                self.robot_free_at += correction
+                for later in self.pending:
+                    later.predicted_start += correction; later.predicted_end += correction
+            if self.on_motion_started: self.on_motion_started(entry.motion)
+            if entry.motion["action"] == "strike" and self.on_strike: self.on_strike(entry.predicted_end)
+        return now
+
+    # --- 実行ループ ---
+    def run(self, motion_plan, master_start_time, loop_duration, stop_event, start_position=None, motion_packets=None):
+        """motion_packets はプラン作成時に dobot_link.encode_plan で作ったもの (省略時はここで作る)"""
+        motions = [motion_plan_compiler.motion_to_dict(row) for row in motion_plan]
+        if not motions: return
+        if motion_packets is None: motion_packets = dobot_link.encode_plan(motion_plan)
+        self.last_position = start_position
+        self.reset_queue()
+        self.on_log(f"[{self.track_name}] 先読みキュー実行を開始 (horizon={self.horizon_s:.2f}s)")
+
+        schedule = ((loop, motion, packets) for loop in itertools.count() for motion, packets in zip(motions, motion_packets))
+        next_loop, next_motion, next_packets = next(schedule)
+        last_poll = time.time()
+        while not stop_event.is_set():
+            # horizon 内に入った動作を積む (オフセットは積む時点の値を使う)
+            while True:
+                ideal_time_ms = next_motion["target_time"] * 1000
+                loop_start = master_start_time + next_loop * loop_duration
+                if loop_start + ideal_time_ms / 1000.0 - time.time() > self.horizon_s: break
+                guided_time_ms, log_msg = self.controller.get_guided_timing(self.track_name, ideal_time_ms)
+                if log_msg: self.on_controller_log(f"[{self.track_name}] {log_msg}")
+                self._enqueue(next_motion, next_packets, loop_start + guided_time_ms / 1000.0)
+                next_loop, next_motion, next_packets = next(schedule)
+                if stop_event.is_set(): break
+
+            stop_event.wait(POLL_INTERVAL_S)
+            last_poll = self._update_progress(last_poll)
+
+        self.stop()
+
+    def stop(self):
+        """キューを止めて空にする (実行中の動作の後で止まる)"""
+        try:
+            self.link.reset_queue()
+        except Exception as e:
+            self.on_log(f"[{self.track_name}] キュー停止に失敗: {e}")
+        self.pending.clear()
+        self.on_log(f"[{self.track_name}] 先読み実行を終了 (推定ドリフト {self.drift_s * 1000:+.1f}ms, 遅延開始 {self.late_count}件)")
@@ -4,8 +4,7 @@ import json
 import time
 import copy
 import threading
-import importlib
-import inspect
+import controller_registry  # ★ コントローラーはマニフェスト経由で遅延読み込み
 
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QWidget, QLabel, QVBoxLayout, QHBoxLayout,
@@ -97,40 +96,8 @@ def resource_path(relative_path):
 
 # --- コントローラー動的読み込み ---
 def load_controllers():
-    """'controllers' ディレクトリから BaseEntrainmentController のサブクラスを動的に読み込む"""
-    controllers = {}
-    
-    # ★修正点1: スクリプト自身の場所を基準にする
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    controller_dir = os.path.join(script_dir, "controllers")
-
-    if not os.path.exists(controller_dir):
-        print(f"Warning: Controller directory not found at {controller_dir}")
-        return {}
-    
-    # ★修正点2: スクリプトの親ディレクトリをパスに追加する
-    sys.path.insert(0, os.path.dirname(script_dir))
-    
-    try:
-        from controllers.base_controller import BaseEntrainmentController
-        for filename in os.listdir(controller_dir):
-            if filename.endswith(".py") and filename != "base_controller.py" and filename != "__init__.py":
-                module_name = f"controllers.{filename[:-3]}"
-                try:
-                    module = importlib.import_module(module_name)
-                    for name, obj in inspect.getmembers(module, inspect.isclass):
-                        if issubclass(obj, BaseEntrainmentController) and obj is not BaseEntrainmentController:
-                            try:
-                               instance = obj(None, 0) 
-                               controllers[instance.name] = obj
-                            except Exception as e:
-                               print(f"Error instantiating controller {name} for name check: {e}")
-                except ImportError as e:
-                    print(f"Failed to import controller module {module_name}: {e}")
-    except ImportError as e:
-        print(f"Could not import BaseEntrainmentController. Ensure 'controllers/__init__.py' exists. Error: {e}")
-
-    return controllers
+    """'controllers' ディレクトリのコントローラーを {表示名: 遅延ロードエントリ} で返す"""
+    return controller_registry.load_controllers()
 
 # --- モダンUIコンポーネントクラス ---
 class ModernButton(QPushButton):
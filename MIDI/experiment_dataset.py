@@ -0,0 +1,231 @@
+"""
+実験データの列指向データセット (.npz のチャンク)
+
+experiment_result_*.txt を正規表現で読み直さなくても解析できるよう、実験の記録 (experiment_recorder のレコード) を
+型付きの列に分けて保存する。表は 3 つ:
+    hits  : 1 打 (または見逃し) ごと  session, participant, set, step, method, condition, score_file, loop, pad, note_id, judgement, error_ms, hit_time
+    loops : 練習ループ × パッド ('all' / 'top' / 'bottom') ごとの統計
+    steps : ステップ × パッドごとの統計
+統計の列は STAT_COLUMNS (accuracy, score, avg_error, std_dev, perfect, great, good, dropped)。
+テストのステップの打撃は loop = -1、値の無い error_ms / hit_time は NaN。
+method はステップの手法 (テストは TEST_METHOD)、condition はセットの条件 (練習ステップの手法) で、
+同じセットの前後のテストの行にも入るので、条件ごとのテスト結果を condition だけで絞り込める。
+
+保存形式:
+    <root>/<表>/<session>_<連番>.npz   ステップ 1 つ分のチャンク。列ごとに 1 メンバー (allow_pickle 無し)
+ステップが終わるたびにチャンクを 1 つ足すだけなので追記は既存ファイルに触れず、途中で落ちても書き終えたチャンクは残る。
+np.load の .npz はメンバーを開いたときに初めて読むので、1 列だけ読むときは他の列を読み込まない。
+
+    python experiment_dataset.py build 実験データ/experiment_*.jsonl          # 既存の記録からデータセットを作る
+    python experiment_dataset.py show --table hits --columns judgement error_ms
+"""
+import os
+import glob
+import argparse
+
+import numpy as np
+
+# --- 設定 ---
+DEFAULT_DATASET_DIR = 'dataset'
+TABLES = ('hits', 'loops', 'steps')
+PADS = ('top', 'bottom')
+TEST_LOOP = -1
+TEST_METHOD = "Test (None)"
+STAT_COLUMNS = (('accuracy', 'f4'), ('score', 'f4'), ('avg_error', 'f4'), ('std_dev', 'f4'),
+                ('perfect', 'i4'), ('great', 'i4'), ('good', 'i4'), ('dropped', 'i4'))
+KEY_COLUMNS = (('session', 'U'), ('participant', 'U'), ('set', 'i2'), ('step', 'i2'), ('method', 'U'), ('condition', 'U'),
+               ('score_file', 'U'))
+COLUMNS = {
+    'hits': KEY_COLUMNS + (('loop', 'i4'), ('pad', 'U'), ('note_id', 'U'), ('judgement', 'U'), ('error_ms', 'f4'), ('hit_time', 'f8')),
+    'loops': KEY_COLUMNS + (('loop', 'i4'), ('pad', 'U')) + STAT_COLUMNS,
+    'steps': KEY_COLUMNS + (('pad', 'U'),) + STAT_COLUMNS,
+}
+
+
+def _column(values, kind):
+    """None を NaN / 空文字にして型付きの配列にする (文字列は必要な幅の U)"""
+    if kind == 'U': return np.array(['' if v is None else str(v) for v in values], dtype=str)
+    if kind.startswith('f'): return np.array([np.nan if v is None else v for v in values], dtype=kind)
+    return np.array([0 if v is None else v for v in values], dtype=kind)
+
+
+def _stats_row(stats):
+    return {name: stats.get(name) for name, _ in STAT_COLUMNS}
+
+
+def _stat_rows(keys, stats, pad_stats):
+    rows = [dict(keys, pad='all', **_stats_row(stats or {}))]
+    for pad in PADS:
+        if pad in (pad_stats or {}): rows.append(dict(keys, pad=pad, **_stats_row(pad_stats[pad])))
+    return rows
+
+
+def step_condition(step):
+    """ステップのセットの条件。記録に condition が無ければ、練習ステップなら自分の手法 (テストのステップは分からない)"""
+    if step.get('condition'): return step['condition']
+    method = step.get('method')
+    return method if method not in (None, TEST_METHOD) else None
+
+
+def fill_conditions(records):
+    """
+    condition の無い step レコードに、同じセットの練習ステップの手法を入れたリストを返す
+    (condition を記録する前のログや、テキストから取り込んだ記録用。練習より前のテストにも入る)
+    """
+    records = list(records)
+    conditions = {}
+    for record in records:
+        if record.get('type') == 'step' and step_condition(record) is not None:
+            conditions.setdefault(record.get('set_index'), step_condition(record))
+    return [dict(record, condition=conditions.get(record.get('set_index')))
+            if record.get('type') == 'step' and not record.get('condition') else record for record in records]
+
+
+def step_tables(step, loops, session, participant=''):
+    """step レコードとその練習ループから {表: [行 dict, ...]} を作る"""
+    keys = {'session': session, 'participant': participant, 'set': step.get('set_index'), 'step': step.get('step_index'),
+            'method': step.get('method'), 'condition': step_condition(step), 'score_file': step.get('score_file')}
+    hits = []; loop_rows = []
+    for loop in loops:
+        loop_keys = dict(keys, loop=loop.get('loop_count'))
+        loop_rows.extend(_stat_rows(loop_keys, loop.get('stats'), loop.get('pad_stats')))
+        hits.extend(dict(loop_keys, **_hit_row(hit)) for hit in loop.get('details', []))
+    if not loops:
+        hits.extend(dict(keys, loop=TEST_LOOP, **_hit_row(hit)) for hit in step.get('raw_hits', []))
+    return {'hits': hits, 'loops': loop_rows, 'steps': _stat_rows(keys, step.get('stats'), step.get('pad_stats'))}
+
+
+def _hit_row(hit):
+    return {'pad': hit.get('pad'), 'note_id': hit.get('note_id'), 'judgement': hit.get('judgement'),
+            'error_ms': hit.get('error_ms'), 'hit_time': hit.get('hit_time')}
+
+
+def rows_to_columns(table, rows):
+    return {name: _column([row.get(name) for row in rows], kind) for name, kind in COLUMNS[table]}
+
+
+class DatasetWriter:
+    """ステップ 1 つごとに各表へチャンクを 1 つ追加する"""
+    def __init__(self, root=DEFAULT_DATASET_DIR, session='session', participant=''):
+        self.root = root; self.session = session; self.participant = participant
+        for table in TABLES: os.makedirs(os.path.join(root, table), exist_ok=True)
+        existing = glob.glob(os.path.join(root, 'steps', f"{session}_*.npz"))
+        self.sequence = len(existing)
+
+    def begin(self, record):
+        """experiment_start を受け取る (データセットでは参加者 ID だけ使う)"""
+        if record.get('participant'): self.participant = record['participant']
+
+    def end(self, record):
+        pass
+
+    def append_step(self, step, loops=()):
+        self.sequence += 1
+        for table, rows in step_tables(step, loops, self.session, self.participant).items():
+            if not rows: continue
+            path = os.path.join(self.root, table, f"{self.session}_{self.sequence:04d}.npz")
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f: np.savez(f, **rows_to_columns(table, rows))
+            os.replace(tmp_path, path)
+
+
+class StepCollector:
+    """
+    experiment_recorder のレコードを順に受け取り、step が来たら直前までの練習ループと合わせて書く。
+    writer は begin(start) / append_step(step, loops) / end(end) を持つもの (DatasetWriter, experiment_store.StoreWriter)
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending_loops = []
+
+    def add(self, record):
+        record_type = record.get('type')
+        if record_type == 'experiment_start':
+            self.writer.begin(record)
+        elif record_type == 'experiment_end':
+            self.writer.end(record)
+        elif record_type == 'practice_loop':
+            self.pending_loops.append(record)
+        elif record_type == 'step_aborted':
+            self.pending_loops = []
+        elif record_type == 'step':
+            key = (record.get('set_index'), record.get('step_index'))
+            loops = [loop for loop in self.pending_loops if (loop.get('set_index'), loop.get('step_index')) == key] \
+                if record.get('is_practice') else []
+            self.pending_loops = []
+            self.writer.append_step(record, loops)
+
+
+def chunk_paths(root, table, sessions=None):
+    paths = sorted(glob.glob(os.path.join(root, table, '*.npz')))
+    if sessions is not None:
+        sessions = set(sessions)
+        paths = [p for p in paths if os.path.basename(p).rsplit('_', 1)[0] in sessions]
+    return paths
+
+
+def load_column(root, table, column, sessions=None):
+    """1 列だけを全チャンクから読んで連結する"""
+    kind = dict(COLUMNS[table])[column]
+    parts = []
+    for path in chunk_paths(root, table, sessions):
+        with np.load(path, allow_pickle=False) as data:
+            if column in data.files: parts.append(data[column]); continue
+            # 列を足す前に書いたチャンク (condition など) は空の値で埋める
+            rows = len(data[data.files[0]]) if data.files else 0
+            parts.append(_column([None] * rows, kind))
+    if not parts: return _column([], kind)
+    return np.concatenate(parts)
+
+
+def load_table(root, table, columns=None, sessions=None):
+    """指定した列 (省略時はすべて) を {列名: 配列} で返す"""
+    columns = columns or [name for name, _ in COLUMNS[table]]
+    return {name: load_column(root, table, name, sessions) for name in columns}
+
+
+def sessions_in(root):
+    return sorted({os.path.basename(p).rsplit('_', 1)[0] for p in chunk_paths(root, 'steps')})
+
+
+def build_from_records(records, root, session, participant=''):
+    """記録済みのレコード列からデータセットを作る (同じ session のチャンクがあれば消して作り直す)"""
+    for table in TABLES:
+        for path in chunk_paths(root, table, [session]): os.remove(path)
+    collector = StepCollector(DatasetWriter(root, session, participant))
+    for record in fill_conditions(records): collector.add(record)
+    return collector.writer.sequence
+
+
+def main():
+    import experiment_recorder
+    parser = argparse.ArgumentParser(description="実験データの列指向データセット")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="experiment_recorder の記録 (.jsonl) からデータセットを作る")
+    build.add_argument('logs', nargs='+')
+    build.add_argument('--root', default=DEFAULT_DATASET_DIR)
+    show = sub.add_parser('show', help="表の列を表示する")
+    show.add_argument('--root', default=DEFAULT_DATASET_DIR)
+    show.add_argument('--table', choices=TABLES, default='steps')
+    show.add_argument('--columns', nargs='*', default=None)
+    show.add_argument('--session', nargs='*', default=None)
+    show.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for path in args.logs:
+            session = os.path.splitext(os.path.basename(path))[0]
+            steps = build_from_records(experiment_recorder.load_records(path), args.root, session)
+            print(f"{path}: {steps} ステップ → {args.root}")
+        return
+    columns = load_table(args.root, args.table, args.columns, args.session)
+    count = len(next(iter(columns.values()))) if columns else 0
+    print(f"{args.table}: {count} 行, セッション {len(args.session or sessions_in(args.root))}")
+    names = list(columns)
+    print("\t".join(names))
+    for i in range(min(count, args.limit)):
+        print("\t".join(str(columns[name][i]) for name in names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+既存の experiment_result_*.txt (save_experiment_data_to_file のテキスト) を読み込んで列指向データセットに取り込む
+
+テキストを 1 行ずつ 1 回だけ読み、experiment_recorder と同じ形のレコード列
+(experiment_start / practice_loop / step / experiment_end) に戻してから experiment_dataset に書く。
+そのため取り込んだ過去のデータも、新しい記録と同じ hits / loops / steps の表で扱える
+(テキストには打撃時刻が無いので hit_time は NaN)。--store を渡すと experiment_store の SQLite ストアにも入れる。
+
+  - 複数のファイルはプロセスを分けて並列に解析する (--jobs)
+  - 取り込んだファイルは内容のハッシュで索引 (<root>/import_index.json) に残し、変わっていなければ次回は飛ばす
+  - 途中で終わっているファイルや読めない行は「問題」として報告し、読めた部分だけを取り込む
+
+    python experiment_log_import.py ../実験データ
+    python experiment_log_import.py ../実験データ --root dataset --jobs 4 --force
+    python experiment_log_import.py ../実験データ --store experiments.sqlite
+"""
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import concurrent.futures
+
+import experiment_store
+import experiment_dataset
+
+# --- 設定 ---
+INDEX_FILENAME = 'import_index.json'
+FILE_PATTERN = 'experiment_result_*.txt'
+PARSER_VERSION = 1  # 解析の結果が変わる修正をしたら上げる (索引を作り直す)
+EXPECTED_STEPS_PER_SET = 3
+PAD_KEYS = {'左': 'top', '右': 'bottom'}
+
+_NUMBER = r'([-+]?\d+(?:\.\d+)?)'
+RE_HEADER = re.compile(r'^\s*(実験開始日時|実験終了日時|楽譜順序|手法順序):\s*(.*?)\s*$')
+RE_SET = re.compile(r'^\s*実験セット\s+(\d+)\s+\(楽譜:\s*(.*?)\)\s*$')
+RE_STEP = re.compile(r'^\s*---\s*ステップ\s+(\d+):\s*(.*?)\s*---\s*$')
+RE_FIELD = re.compile(r'^\s*(手法|日時):\s*(.*?)\s*$')
+RE_STATS = re.compile(rf'Acc:\s*{_NUMBER}%,\s*Score:\s*{_NUMBER}%,\s*Err:\s*{_NUMBER}ms,\s*Dev:\s*{_NUMBER}ms')
+RE_TOTAL = re.compile(r'^\s*(【?)全体】')
+RE_PAD = re.compile(r'^\s*\[(左|右)手\]')
+RE_COUNTS = re.compile(r'\(P:(\d+)\s+Gr:(\d+)\s+Go:(\d+)\s+M:(\d+)\)')
+RE_LOOP = re.compile(r'^\s*>\s*Loop\s+(\d+)\s+\((.*?)\)\s*$')
+RE_NOTE = re.compile(r'^\s*Note\s+(\S+)\s*:\s*(\w+)\s+(\S+)\s*$')
+RE_ROBOT_ROW = re.compile(rf'^\s*(\S+)\s*\|\s*(\S+)\s*\|\s*{_NUMBER}\s*\|\s*{_NUMBER}\s*\|\s*{_NUMBER}\s*$')
+RE_RULE = re.compile(r'^\s*[=#]{10,}\s*$|^\s*-{5,}[-+]*\s*$')
+SECTION_MARKERS = {'[各ループの推移]': 'loops', '[打鍵詳細データ]': 'hits'}
+ROBOT_MARKER = '[ロボット制御ログ]'
+HEADER_KEYS = {'実験開始日時': 'experiment_start_time', '実験終了日時': 'end_time', '楽譜順序': 'score_order', '手法順序': 'experiment_order'}
+
+
+def _stats(line):
+    match = RE_STATS.search(line)
+    if not match: return None
+    accuracy, score, avg_error, std_dev = (float(v) for v in match.groups())
+    stats = {'accuracy': accuracy, 'score': score, 'avg_error': avg_error, 'std_dev': std_dev}
+    counts = RE_COUNTS.search(line)
+    if counts:
+        stats.update(zip(('perfect', 'great', 'good', 'dropped'), (int(v) for v in counts.groups())))
+    return stats
+
+
+def _sum_counts(stats, pad_stats):
+    """【全体】 の行には個数が無いので、左右の個数を足して補う"""
+    for key in ('perfect', 'great', 'good', 'dropped'):
+        if key not in stats and pad_stats: stats[key] = sum(p.get(key, 0) for p in pad_stats.values())
+
+
+class _LogParser:
+    """1 ファイル分の状態機械。feed(行番号, 行) を順に呼び、finish() でレコード列と問題のリストを返す"""
+    def __init__(self):
+        self.header = {}; self.records = []; self.issues = []
+        self.set_index = None; self.score_file = None; self.steps_in_set = 0
+        self.step = None; self.loops = []; self.loop = None
+        self.section = None
+
+    def issue(self, line_no, message):
+        self.issues.append((line_no, message))
+
+    def feed(self, line_no, line):
+        stripped = line.strip()
+        if not stripped or RE_RULE.match(line) or stripped == 'リズム実験データログ': return
+        if stripped in SECTION_MARKERS: self.section = SECTION_MARKERS[stripped]; self._close_loop(line_no); return
+        if stripped.startswith(ROBOT_MARKER): self._close_loop(line_no); self.section = 'robot'; return
+
+        match = RE_HEADER.match(line)
+        if match and self.set_index is None:
+            key, value = HEADER_KEYS[match.group(1)], match.group(2)
+            self.header[key] = [v.strip() for v in value.split('->')] if key in ('score_order', 'experiment_order') else value
+            return
+        match = RE_SET.match(line)
+        if match:
+            self._close_step(line_no); self._close_set(line_no)
+            if not self.records: self._start()
+            self.set_index = int(match.group(1)); self.score_file = match.group(2); self.steps_in_set = 0
+            return
+        match = RE_STEP.match(line)
+        if match:
+            self._close_step(line_no)
+            if self.set_index is None: self.issue(line_no, "実験セットの見出しより前にステップがあります"); self.set_index = 0
+            self.step = {'set_index': self.set_index, 'step_index': int(match.group(1)), 'score_file': self.score_file,
+                         'method': None, 'timestamp': None, 'stats': None, 'pad_stats': {}, 'raw_hits': [], '_line': line_no}
+            self.loops = []; self.loop = None; self.section = None; self.steps_in_set += 1
+            return
+        if self.step is None:
+            self.issue(line_no, f"ステップの外にある行を読み飛ばしました: {stripped[:40]}"); return
+
+        match = RE_FIELD.match(line)
+        if match and self.section is None:
+            self.step['method' if match.group(1) == '手法' else 'timestamp'] = match.group(2); return
+        match = RE_LOOP.match(line)
+        if match and self.section == 'loops':
+            self._close_loop(line_no)
+            self.loop = {'set_index': self.set_index, 'step_index': self.step['step_index'], 'loop_count': int(match.group(1)),
+                         'timestamp': match.group(2), 'stats': None, 'pad_stats': {}, 'details': [], '_line': line_no}
+            return
+        target = self.loop if self.section == 'loops' else self.step
+        total = RE_TOTAL.match(line)
+        if total or RE_PAD.match(line):
+            stats = _stats(line)
+            if target is None or stats is None: self.issue(line_no, f"統計の行を解釈できません: {stripped[:40]}"); return
+            if total and not total.group(1): self.issue(line_no, "【全体】の行が欠けています (数値は読めたので取り込みます)")
+            pad = RE_PAD.match(line)
+            if pad: target['pad_stats'][PAD_KEYS[pad.group(1)]] = stats
+            else: target['stats'] = stats
+            return
+        match = RE_NOTE.match(line)
+        if match and self.section == 'hits':
+            note_id, judgement, error = match.groups()
+            note_id = None if note_id == 'Unknown' else note_id
+            try: error_ms = None if error == '---' else float(error.rstrip('ms'))
+            except ValueError: self.issue(line_no, f"誤差を解釈できません: {error}"); return
+            pad = note_id.split('-')[0] if note_id else None
+            self.step['raw_hits'].append({'note_id': note_id, 'judgement': judgement, 'error_ms': error_ms, 'pad': pad})
+            return
+        if self.section == 'robot':
+            match = RE_ROBOT_ROW.match(line)
+            if match:
+                timestamp, track, ideal, offset, guided = match.groups()
+                self.step.setdefault('robot_history', []).append(
+                    {'timestamp': timestamp, 'track': track, 'ideal': float(ideal), 'offset': float(offset), 'guided': float(guided)})
+                return
+            if stripped.startswith('Time'): return
+        self.issue(line_no, f"解釈できない行: {stripped[:40]}")
+
+    def _start(self):
+        self.records.append({'type': 'experiment_start', 'experiment_start_time': self.header.get('experiment_start_time', 'Unknown'),
+                             'score_order': self.header.get('score_order', []), 'experiment_order': self.header.get('experiment_order', [])})
+
+    def _close_loop(self, line_no):
+        loop = self.loop
+        if loop is None: return
+        self.loop = None
+        if loop['stats'] is None:
+            self.issue(loop['_line'], f"Loop {loop['loop_count']} に【全体】の行がありません (途中で切れています)"); return
+        _sum_counts(loop['stats'], loop['pad_stats'])
+        del loop['_line']; loop['type'] = 'practice_loop'
+        self.loops.append(loop)
+
+    def _close_step(self, line_no):
+        self._close_loop(line_no)
+        step = self.step
+        if step is None: return
+        self.step = None; self.section = None
+        label = f"セット {step['set_index']} ステップ {step['step_index']}"
+        if step['stats'] is None:
+            self.issue(step['_line'], f"{label}: 【全体】の行がありません (途中で切れています)"); return
+        _sum_counts(step['stats'], step['pad_stats'])
+        is_practice = bool(self.loops) or step['method'] not in (None, experiment_dataset.TEST_METHOD)
+        if is_practice and not self.loops: self.issue(step['_line'], f"{label}: 練習ループの記録がありません")
+        if not is_practice and not step['raw_hits']: self.issue(step['_line'], f"{label}: 打鍵データがありません")
+        del step['_line']
+        self.records.extend(self.loops); self.loops = []
+        self.records.append(dict(step, type='step', is_practice=is_practice))
+
+    def _close_set(self, line_no):
+        if self.set_index is not None and self.steps_in_set != EXPECTED_STEPS_PER_SET:
+            self.issue(line_no, f"セット {self.set_index}: ステップが {self.steps_in_set} 個しかありません")
+
+    def finish(self, line_no):
+        self._close_step(line_no); self._close_set(line_no)
+        if not self.records:
+            if self.header: self._start()
+            self.issue(line_no, "実験セットがありません")
+        if 'end_time' in self.header:
+            self.records.append({'type': 'experiment_end', 'recorded_at': self.header['end_time']})
+        else:
+            self.issue(line_no, "実験終了日時がありません")
+        return self.records, self.issues
+
+
+def parse_experiment_log(path):
+    """テキストを 1 回だけ読んで (レコード列, [(行番号, 問題), ...]) を返す"""
+    parser = _LogParser(); line_no = 0
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line_no, line in enumerate(f, 1): parser.feed(line_no, line)
+    return parser.finish(line_no)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''): digest.update(block)
+    return digest.hexdigest()
+
+
+def _parse_job(path):
+    """ワーカープロセスで実行する (例外もここで問題として返す)"""
+    try:
+        records, issues = parse_experiment_log(path)
+        return path, records, issues
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        return path, None, [(0, f"読み込みに失敗しました: {e}")]
+
+
+def load_index(root):
+    path = os.path.join(root, INDEX_FILENAME)
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f: index = json.load(f)
+        return index if index.get('parser_version') == PARSER_VERSION else {}
+    except (OSError, ValueError) as e:
+        print(f"索引 '{path}' を読めないため作り直します: {e}"); return {}
+
+
+def save_index(root, index):
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, INDEX_FILENAME); tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def import_logs(paths, root=experiment_dataset.DEFAULT_DATASET_DIR, jobs=None, force=False, on_log=print, store_path=None):
+    """
+    ファイルを取り込んで {パス: 問題のリスト} を返す。
+    索引にある (内容のハッシュが同じで、store_path にも入れ済みの) ファイルは解析せず、前回の問題をそのまま返す
+    """
+    index = load_index(root); index['parser_version'] = PARSER_VERSION
+    files = index.setdefault('files', {})
+    hashes = {path: file_hash(path) for path in paths}
+    store_key = os.path.abspath(store_path) if store_path else None
+
+    def is_current(path):
+        entry = files.get(hashes[path])
+        return entry is not None and (store_key is None or store_key in entry.get('stores', []))
+
+    todo = [path for path in paths if force or not is_current(path)]
+    report = {path: files[hashes[path]]['issues'] for path in paths if path not in todo}
+    if todo:
+        workers = min(jobs or os.cpu_count() or 1, len(todo))
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool: results = list(pool.map(_parse_job, todo))
+        else:
+            results = [_parse_job(path) for path in todo]
+        conn = experiment_store.connect(store_path) if store_path else None
+        for path, records, issues in results:
+            digest = hashes[path]; session = os.path.splitext(os.path.basename(path))[0]
+            steps = experiment_dataset.build_from_records(records, root, session) if records else 0
+            if conn is not None and records: experiment_store.build_from_records(conn, records, session, source=path)
+            issues = [list(issue) for issue in issues]
+            files[digest] = {'path': path, 'session': session, 'steps': steps, 'issues': issues,
+                             'stores': [store_key] if store_key else []}
+            report[path] = issues
+            on_log(f"取り込み: {os.path.basename(path)} ({steps} ステップ{f', 問題 {len(issues)} 件' if issues else ''})")
+        if conn is not None: conn.close()
+        save_index(root, index)
+    on_log(f"{len(paths)} ファイル中 {len(todo)} ファイルを解析しました (残りは索引から)")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="experiment_result_*.txt を列指向データセットに取り込む")
+    parser.add_argument('inputs', nargs='+', help="ファイルまたはフォルダ")
+    parser.add_argument('--root', default=experiment_dataset.DEFAULT_DATASET_DIR)
+    parser.add_argument('--jobs', type=int, default=None, help="並列数 (省略時は CPU 数)")
+    parser.add_argument('--force', action='store_true', help="索引を無視してすべて解析し直す")
+    parser.add_argument('--store', default=None, help="SQLite ストアにも取り込む (experiment_store)")
+    args = parser.parse_args()
+
+    paths = []
+    for target in args.inputs:
+        paths.extend(sorted(glob.glob(os.path.join(target, FILE_PATTERN))) if os.path.isdir(target) else [target])
+    if not paths: print("取り込むファイルがありません。"); return
+    report = import_logs(paths, args.root, args.jobs, args.force, store_path=args.store)
+    problems = {path: issues for path, issues in report.items() if issues}
+    for path, issues in problems.items():
+        print(f"\n⚠️ {os.path.basename(path)}: 問題 {len(issues)} 件")
+        for line_no, message in issues[:10]: print(f"    {line_no}行目: {message}")
+        if len(issues) > 10: print(f"    ... ほか {len(issues) - 10} 件")
+    if problems: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
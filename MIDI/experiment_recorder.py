@@ -0,0 +1,270 @@
+"""
+実験データを 1 レコードずつ追記する記録係 (JSON Lines)
+
+これまでは save_experiment_data_to_file が実験の最後に UI スレッドで大きなテキストを一気に書いていたため、
+途中で落ちるとそれまでのセットがすべて失われ、書き出しの間 UI も止まっていた。
+ここでは練習ループ / ステップの結果が出た時点でキューに入れ、バックグラウンドのスレッドが
+1 行ずつ書いて flush + fsync する。読みやすいテキスト (従来の experiment_result_*.txt と同じ形式) は
+このストリームから必要なときに作る。
+dataset_dir / store_path を渡すと、ステップが終わるたびに experiment_dataset の列指向データセットと
+experiment_store の SQLite ストアにも追記する。
+
+    python experiment_recorder.py 実験データ/experiment_20251020_153000.jsonl            # テキストを表示
+    python experiment_recorder.py 実験データ/experiment_20251020_153000.jsonl -o out.txt # テキストを保存
+
+レコードの種類 ("type"):
+    experiment_start : 実験開始日時, 参加者 ID, 楽譜順序, 手法順序
+    practice_loop    : 練習ループ 1 回分 (set_index / step_index 付き)
+    step             : ステップ 1 つ分 (練習ループは含めず、直前までの practice_loop から組み立てる)
+    step_aborted     : 中止されたステップ (それまでの practice_loop は捨てる)
+    experiment_end   : 実験終了日時
+"""
+import os
+import sys
+import json
+import queue
+import sqlite3
+import argparse
+import datetime
+import threading
+
+import experiment_store
+import experiment_dataset
+
+# --- 設定 ---
+DEFAULT_DATA_DIR = r"C:\卒研\実験データ"
+DATASET_SUBDIR = 'dataset'
+STORE_FILENAME = 'experiments.sqlite'
+PAD_LABELS = {'top': '左', 'bottom': '右'}
+STEP_NAMES = ["事前テスト (Test 1)", "練習 (Practice)", "事後テスト (Test 2)"]
+
+
+def resolve_data_dir(directory=DEFAULT_DATA_DIR, on_log=print):
+    """保存先フォルダを用意する。作れなければカレントディレクトリ"""
+    if os.path.isdir(directory): return directory
+    try:
+        os.makedirs(directory)
+        on_log(f"保存用フォルダを作成しました: {directory}")
+        return directory
+    except OSError as e:
+        on_log(f"フォルダ作成エラー: {e}")
+        return os.getcwd()
+
+
+class ExperimentRecorder:
+    """
+    レコードをキューに入れるだけで戻る (UI スレッドから呼ぶ)。書き込みは専用スレッドで行い、1 レコードごとに fsync する。
+    on_log は書き込みスレッドから呼ばれるので、UI に出すときはシグナル経由で渡すこと
+    """
+    def __init__(self, path, on_log=print, dataset_dir=None, store_path=None):
+        self.path = path
+        self.on_log = on_log
+        self.count = 0
+        self.session = os.path.splitext(os.path.basename(path))[0]
+        self._collectors = []   # ステップ単位で書く先 (データセット / SQLite)
+        if dataset_dir:
+            self._collectors.append(experiment_dataset.StepCollector(experiment_dataset.DatasetWriter(dataset_dir, self.session)))
+        if store_path:
+            # 接続は書き込みスレッドだけが使う
+            conn = experiment_store.connect(store_path, check_same_thread=False)
+            self._collectors.append(experiment_dataset.StepCollector(experiment_store.StoreWriter(conn, self.session, source=path)))
+        self._queue = queue.Queue()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name="ExperimentRecorder", daemon=True)
+        self._thread.start()
+
+    @property
+    def closed(self):
+        return not self._thread.is_alive()
+
+    def record(self, record_type, **fields):
+        fields['type'] = record_type
+        fields.setdefault('recorded_at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        self._queue.put(('record', fields))
+
+    def request_report(self, report_path):
+        """ここまでのレコードを書き終えたあとで、テキストのレポートを report_path に書く"""
+        self._queue.put(('report', report_path))
+
+    def close(self, timeout=5.0):
+        """残りを書き切ってスレッドを止める"""
+        if self.closed: return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None: break
+                kind, payload = job
+                try:
+                    if kind == 'record': self._write(payload)
+                    else: self._report(payload)
+                except (OSError, TypeError, ValueError) as e:
+                    self.on_log(f"実験データの書き込みエラー: {e}")
+        finally:
+            self._file.close()
+            for collector in self._collectors:
+                if hasattr(collector.writer, 'conn'): collector.writer.conn.close()
+
+    def _write(self, fields):
+        self._file.write(json.dumps(fields, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.count += 1
+        for collector in self._collectors:
+            try: collector.add(fields)
+            except (OSError, sqlite3.Error, ValueError) as e: self.on_log(f"実験データ ({type(collector.writer).__name__}) の書き込みエラー: {e}")
+
+    def _report(self, report_path):
+        write_report(load_records(self.path), report_path)
+        self.on_log(f"実験ログを保存しました: {report_path}")
+
+
+def new_recorder(directory=DEFAULT_DATA_DIR, on_log=print):
+    """保存先フォルダに experiment_<日時>.jsonl を開く (データセット / SQLite ストアも同じフォルダ)"""
+    directory = resolve_data_dir(directory, on_log)
+    now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return ExperimentRecorder(os.path.join(directory, f"experiment_{now_str}.jsonl"), on_log,
+                              dataset_dir=os.path.join(directory, DATASET_SUBDIR),
+                              store_path=os.path.join(directory, STORE_FILENAME))
+
+
+def load_records(path):
+    """レコードを順に読む (途中で落ちて最後の行が欠けていれば、その行だけ捨てる)"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            try: records.append(json.loads(line))
+            except json.JSONDecodeError: continue
+    return records
+
+
+def build_step_logs(records):
+    """レコード列を従来の experiment_logs と同じ形 (練習ステップには practice_loops 付き) に戻す"""
+    logs = []; pending_loops = []
+    for record in records:
+        record_type = record.get('type')
+        if record_type == 'practice_loop':
+            pending_loops.append(record)
+        elif record_type == 'step_aborted':
+            pending_loops = []
+        elif record_type == 'step':
+            log = dict(record)
+            if log.pop('is_practice', False):
+                log['practice_loops'] = [loop for loop in pending_loops
+                                         if (loop.get('set_index'), loop.get('step_index')) == (log['set_index'], log['step_index'])]
+            pending_loops = []
+            logs.append(log)
+    return logs
+
+
+def _stats_line(stats):
+    return (f"Acc: {stats.get('accuracy', 0):.1f}%, Score: {stats.get('score', 0):.1f}%, "
+            f"Err: {stats.get('avg_error', 0):.1f}ms, Dev: {stats.get('std_dev', 0):.1f}ms")
+
+
+def _pad_lines(pad_stats, indent):
+    lines = []
+    for pad_key in ['top', 'bottom']:
+        if pad_key in pad_stats:
+            p_s = pad_stats[pad_key]
+            label = PAD_LABELS.get(pad_key, pad_key)
+            lines.append(f"{indent}[{label}手] {_stats_line(p_s)} (P:{p_s['perfect']} Gr:{p_s['great']} Go:{p_s['good']} M:{p_s['dropped']})\n")
+    return lines
+
+
+def _hit_sort_key(hit):
+    nid = hit['note_id']
+    if not nid: return ("z", 0)
+    try:
+        parts = nid.split('-')
+        return (parts[0], int(parts[1]))
+    except (ValueError, IndexError):
+        return (str(nid), 0)
+
+
+def render_report(records):
+    """従来の save_experiment_data_to_file と同じ形式のテキストを返す"""
+    header = next((r for r in records if r.get('type') == 'experiment_start'), {})
+    footer = next((r for r in reversed(records) if r.get('type') == 'experiment_end'), None)
+    end_time = footer['recorded_at'] if footer else f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (未完了)"
+    out = []
+    out.append("==================================================\n")
+    out.append(" リズム実験データログ\n")
+    out.append(f" 実験開始日時: {header.get('experiment_start_time', 'Unknown')}\n")
+    out.append(f" 実験終了日時: {end_time}\n")
+    out.append(f" 楽譜順序: {' -> '.join(header.get('score_order', []))}\n")
+    out.append(f" 手法順序: {' -> '.join(header.get('experiment_order', []))}\n")
+    out.append("==================================================\n\n")
+
+    current_set = -1
+    for log in build_step_logs(records):
+        set_idx = log['set_index']
+        step_idx = log['step_index']
+
+        # セットの区切り
+        if set_idx != current_set:
+            out.append("\n##################################################\n")
+            out.append(f" 実験セット {set_idx} (楽譜: {log['score_file']})\n")
+            out.append("##################################################\n")
+            current_set = set_idx
+
+        step_name = STEP_NAMES[step_idx - 1] if 0 < step_idx <= len(STEP_NAMES) else f"Step {step_idx}"
+        out.append(f"\n--- ステップ {step_idx}: {step_name} ---\n")
+        out.append(f"手法: {log['method']}\n")
+        out.append(f"日時: {log['timestamp']}\n")
+        out.append(f"【全体】 {_stats_line(log['stats'])}\n")
+        out.extend(_pad_lines(log.get('pad_stats', {}), "  "))
+
+        # --- 練習ループの詳細推移 ---
+        if 'practice_loops' in log:
+            out.append("\n  [各ループの推移]\n")
+            for loop in log['practice_loops']:
+                out.append(f"  > Loop {loop['loop_count']} ({loop['timestamp']})\n")
+                out.append(f"    【全体】 {_stats_line(loop['stats'])}\n")
+                out.extend(_pad_lines(loop.get('pad_stats', {}), "      "))
+                out.append("\n")
+
+        # --- テストの詳細打鍵データ ---
+        elif 'raw_hits' in log:
+            out.append("\n  [打鍵詳細データ]\n")
+            for hit in sorted(log['raw_hits'], key=_hit_sort_key):
+                note_id = hit['note_id'] if hit['note_id'] else "Unknown"
+                error_str = f"{hit['error_ms']:+.0f}ms" if hit['error_ms'] is not None else "---"
+                out.append(f"  Note {note_id:<10} : {hit['judgement']:<8} {error_str}\n")
+
+        # --- ロボット制御ログ ---
+        if log.get('robot_history'):
+            out.append("\n  [ロボット制御ログ] (LinearController)\n")
+            out.append(f"  {'Time':<12} | {'Track':<7} | {'Ideal(ms)':<10} | {'Offset(ms)':<11} | {'Guided(ms)':<10}\n")
+            out.append(f"  {'-'*12}-+-{'-'*7}-+-{'-'*10}-+-{'-'*11}-+-{'-'*10}\n")
+            for r in log['robot_history']:
+                offset_str = f"{r['offset']:+.1f}"
+                out.append(f"  {r['timestamp']:<12} | {r['track']:<7} | {r['ideal']:<10.0f} | {offset_str:<11} | {r['guided']:<10.0f}\n")
+    return "".join(out)
+
+
+def write_report(records, report_path):
+    tmp_path = report_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: f.write(render_report(records))
+    os.replace(tmp_path, report_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="実験データ (JSON Lines) からテキストのレポートを作る")
+    parser.add_argument('log')
+    parser.add_argument('-o', '--output', default=None, help="保存先 (省略時は標準出力)")
+    args = parser.parse_args()
+    records = load_records(args.log)
+    if args.output:
+        write_report(records, args.output); print(f"レポートを保存しました: {args.output}")
+    else:
+        sys.stdout.write(render_report(records))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+参加者をまたいだ実験の集計レポート
+
+これまで実験日の後に手で計算していた「手法ごとの事前テスト → 事後テストの伸び」を、全セッションからまとめて出す。
+  - 入力: experiment_store の SQLite (--store) か、experiment_result_*.txt / experiment_*.jsonl (--logs)
+  - セッションごとの処理 (読み込み + 事前/事後の組み立て + 練習ループの抜き出し) はプロセスを分けて並列に行う
+  - セッションごとの結果は出力先の cache に指紋付きで残し、次回は指紋の変わったセッションだけ計算し直す
+  - 集計 (手法別 / 手法 × 楽譜別の伸び、対応のある効果量 d_z、手法間の Hedges' g、練習ループの学習曲線) は NumPy でまとめて計算
+  - 出力: summary.txt, improvement_by_method.csv, improvement_by_score.csv, method_effects.csv, learning_curves.csv
+          (matplotlib があれば learning_curve_*.png / improvement_*.png も)
+
+    python experiment_report.py --store experiments.sqlite --out report
+    python experiment_report.py --logs ../実験データ --out report --jobs 4
+
+指標は Acc, Score, |Err| (平均誤差の絶対値), Dev。伸び = 事後 - 事前 (|Err| と Dev は下がるほど良い)。
+1 セットの「手法」はそのセットの練習ステップの手法。練習ループが 1 つも無いセット (途中で飛ばしたセット) は除く。
+"""
+import os
+import csv
+import glob
+import json
+import argparse
+import itertools
+import concurrent.futures
+
+import numpy as np
+
+import experiment_store
+import experiment_dataset
+
+# --- オプショナルなライブラリのインポート ---
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    MATPLOTLIB_AVAILABLE = True
+except ImportError:
+    MATPLOTLIB_AVAILABLE = False
+
+# --- 設定 ---
+METRICS = ('accuracy', 'score', 'abs_error', 'std_dev')
+METRIC_LABELS = {'accuracy': 'Acc (%)', 'score': 'Score (%)', 'abs_error': '|Err| (ms)', 'std_dev': 'Dev (ms)'}
+PRE_STEP, PRACTICE_STEP, POST_STEP = 1, 2, 3
+CACHE_FILENAME = 'report_cache.json'
+CACHE_VERSION = 1
+MIN_CURVE_SESSIONS = 2      # 学習曲線はこの数以上のセッションがあるループまで描く
+
+
+def _metrics(row):
+    error = row.get('avg_error')
+    return [row.get('accuracy'), row.get('score'), None if error is None else abs(error), row.get('std_dev')]
+
+
+def session_contribution(steps, loops):
+    """
+    1 セッション分の steps / loops の行 (pad='all') から
+    {'pairs': [{set, method, score_file, pre, post}], 'curves': [{method, score_file, loop, metrics}]} を作る
+    """
+    by_set = {}
+    for row in steps: by_set.setdefault(row['set'], {})[row['step']] = row
+    practiced = {row['set'] for row in loops}
+    pairs = []
+    for set_index in sorted(by_set):
+        rows = by_set[set_index]
+        pre, practice, post = rows.get(PRE_STEP), rows.get(PRACTICE_STEP), rows.get(POST_STEP)
+        if not (pre and practice and post) or set_index not in practiced: continue
+        pairs.append({'set': set_index, 'method': practice['method'], 'score_file': practice['score_file'],
+                      'pre': _metrics(pre), 'post': _metrics(post)})
+    curves = [{'method': row['method'], 'score_file': row['score_file'], 'loop': row['loop'], 'metrics': _metrics(row)}
+              for row in loops]
+    return {'pairs': pairs, 'curves': curves}
+
+
+# --- セッションの読み込み (ワーカープロセスで実行) ---
+
+class _RowCollector:
+    """experiment_dataset.StepCollector の書き込み先。pad='all' の steps / loops の行だけ手元に残す"""
+    def __init__(self, session):
+        self.session = session; self.participant = ''; self.steps = []; self.loops = []
+
+    def begin(self, record):
+        self.participant = record.get('participant') or ''
+
+    def end(self, record):
+        pass
+
+    def append_step(self, step, loops=()):
+        tables = experiment_dataset.step_tables(step, loops, self.session, self.participant)
+        self.steps.extend(row for row in tables['steps'] if row['pad'] == 'all')
+        self.loops.extend(row for row in tables['loops'] if row['pad'] == 'all')
+
+
+def _rows_from_records(records, session):
+    collector = experiment_dataset.StepCollector(_RowCollector(session))
+    for record in records: collector.add(record)
+    return collector.writer.participant, collector.writer.steps, collector.writer.loops
+
+
+def _load_log(path, session):
+    if path.endswith('.jsonl'):
+        import experiment_recorder
+        records = experiment_recorder.load_records(path)
+    else:
+        import experiment_log_import
+        records, _ = experiment_log_import.parse_experiment_log(path)
+    return _rows_from_records(records, session)
+
+
+def _load_from_store(store_path, session):
+    conn = experiment_store.connect(store_path)
+    try:
+        names = {'set_index': 'set', 'step_index': 'step'}
+        def fetch(table, columns):
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE session = ? AND pad = 'all'", (session,))
+            return [{names.get(c, c): v for c, v in zip(columns, row)} for row in cursor]
+        stats = ['accuracy', 'score', 'avg_error', 'std_dev']
+        steps = fetch('steps', ['set_index', 'step_index', 'method', 'score_file'] + stats)
+        loops = fetch('loops', ['set_index', 'step_index', 'method', 'score_file', 'loop'] + stats)
+        participant = conn.execute("SELECT participant FROM sessions WHERE session = ?", (session,)).fetchone()
+    finally:
+        conn.close()
+    return (participant[0] if participant and participant[0] else ''), steps, loops
+
+
+def _session_job(job):
+    kind, locator, session = job
+    try:
+        participant, steps, loops = _load_from_store(locator, session) if kind == 'store' else _load_log(locator, session)
+        return session, dict(session_contribution(steps, loops), participant=participant), None
+    except Exception as e:  # 1 セッションの失敗でレポート全体を止めない
+        return session, None, f"{type(e).__name__}: {e}"
+
+
+# --- セッションの列挙と指紋 ---
+
+def store_sessions(store_path):
+    """[(session, 指紋, ジョブ)]。指紋は行数と統計の合計 (索引だけで引ける)"""
+    conn = experiment_store.connect(store_path)
+    try:
+        sessions = [row[0] for row in conn.execute("SELECT DISTINCT session FROM steps ORDER BY session")]
+        result = []
+        for session in sessions:
+            fingerprint = [list(conn.execute(f"SELECT COUNT(*), TOTAL(accuracy), TOTAL(score), TOTAL(avg_error) FROM {table} WHERE session = ?",
+                                             (session,)).fetchone()) for table in ('steps', 'loops')]
+            result.append((session, json.dumps(fingerprint), ('store', store_path, session)))
+        return result
+    finally:
+        conn.close()
+
+
+def log_sessions(inputs):
+    import experiment_log_import
+    paths = []
+    for target in inputs:
+        if os.path.isdir(target):
+            paths.extend(sorted(glob.glob(os.path.join(target, experiment_log_import.FILE_PATTERN))))
+            paths.extend(sorted(glob.glob(os.path.join(target, 'experiment_*.jsonl'))))
+        else:
+            paths.append(target)
+    result = []
+    for path in paths:
+        session = os.path.splitext(os.path.basename(path))[0]
+        result.append((session, experiment_log_import.file_hash(path), ('log', path, session)))
+    return result
+
+
+def load_cache(out_dir):
+    path = os.path.join(out_dir, CACHE_FILENAME)
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f: cache = json.load(f)
+        return cache.get('sessions', {}) if cache.get('version') == CACHE_VERSION else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(out_dir, sessions):
+    path = os.path.join(out_dir, CACHE_FILENAME); tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({'version': CACHE_VERSION, 'sessions': sessions}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def collect_contributions(sources, out_dir, jobs=None, on_log=print):
+    """指紋の変わったセッションだけ並列に計算し、全セッションの {session: 結果} を返す"""
+    cache = load_cache(out_dir)
+    todo = []
+    for session, fingerprint, job in sources:
+        entry = cache.get(session)
+        if entry is None or entry.get('fingerprint') != fingerprint: todo.append((session, fingerprint, job))
+    live = {session for session, _, _ in sources}
+    cache = {session: entry for session, entry in cache.items() if session in live}
+    if todo:
+        workers = min(jobs or os.cpu_count() or 1, len(todo))
+        job_list = [job for _, _, job in todo]
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool: results = list(pool.map(_session_job, job_list))
+        else:
+            results = [_session_job(job) for job in job_list]
+        for (session, fingerprint, _), (_, contribution, error) in zip(todo, results):
+            if error: on_log(f"⚠️ {session}: 集計できません ({error})"); cache.pop(session, None); continue
+            cache[session] = {'fingerprint': fingerprint, 'contribution': contribution}
+    on_log(f"{len(sources)} セッション中 {len(todo)} セッションを計算しました (残りはキャッシュから)")
+    save_cache(out_dir, cache)
+    return {session: entry['contribution'] for session, entry in cache.items()}
+
+
+# --- 集計 ---
+
+def _to_float(values):
+    return np.array([[np.nan if v is None else v for v in row] for row in values], dtype=float).reshape(len(values), len(METRICS))
+
+
+def improvement_arrays(contributions):
+    """全セッションの事前/事後を配列にまとめる: (sessions, methods, scores, pre[n, 4], post[n, 4])"""
+    pairs = [(session, pair) for session, c in sorted(contributions.items()) for pair in c['pairs']]
+    sessions = np.array([s for s, _ in pairs], dtype=str)
+    methods = np.array([p['method'] or '' for _, p in pairs], dtype=str)
+    scores = np.array([p['score_file'] or '' for _, p in pairs], dtype=str)
+    return sessions, methods, scores, _to_float([p['pre'] for _, p in pairs]), _to_float([p['post'] for _, p in pairs])
+
+
+def describe_groups(keys, pre, post):
+    """keys (グループのラベルの配列) ごとに n, 事前/事後の平均, 伸びの平均と SD, 対応のある効果量 d_z を返す"""
+    delta = post - pre
+    rows = []
+    for key in np.unique(keys):
+        mask = keys == key; n = int(mask.sum())
+        d = delta[mask]
+        mean_delta = np.nanmean(d, axis=0)
+        sd_delta = np.nanstd(d, axis=0, ddof=1) if n > 1 else np.full(len(METRICS), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'): d_z = mean_delta / sd_delta
+        rows.append({'group': str(key), 'n': n, 'pre': np.nanmean(pre[mask], axis=0), 'post': np.nanmean(post[mask], axis=0),
+                     'delta': mean_delta, 'sd': sd_delta, 'd_z': d_z})
+    return rows
+
+
+def hedges_g(a, b):
+    """2 群の伸びの差の効果量 (小標本の補正付き)。列ごとに計算する"""
+    n1, n2 = len(a), len(b)
+    if n1 < 2 or n2 < 2: return np.full(a.shape[1] if a.ndim > 1 else len(METRICS), np.nan)
+    pooled = np.sqrt(((n1 - 1) * np.nanvar(a, axis=0, ddof=1) + (n2 - 1) * np.nanvar(b, axis=0, ddof=1)) / (n1 + n2 - 2))
+    with np.errstate(divide='ignore', invalid='ignore'): d = (np.nanmean(a, axis=0) - np.nanmean(b, axis=0)) / pooled
+    return d * (1 - 3 / (4 * (n1 + n2) - 9))
+
+
+def method_effects(methods, pre, post):
+    delta = post - pre
+    return [{'a': a, 'b': b, 'n_a': int((methods == a).sum()), 'n_b': int((methods == b).sum()),
+             'g': hedges_g(delta[methods == a], delta[methods == b])}
+            for a, b in itertools.combinations(np.unique(methods), 2)]
+
+
+def learning_curves(contributions):
+    """手法ごと・ループごとの平均と標準誤差: {手法: (loops, mean[n, 4], sem[n, 4], count[n])}"""
+    curves = [c for contribution in contributions.values() for c in contribution['curves']]
+    if not curves: return {}
+    methods = np.array([c['method'] or '' for c in curves], dtype=str)
+    loops = np.array([c['loop'] for c in curves], dtype=int)
+    values = _to_float([c['metrics'] for c in curves])
+    result = {}
+    for method in np.unique(methods):
+        mask = methods == method
+        loop_ids = loops[mask]; v = values[mask]
+        length = loop_ids.max() + 1
+        valid = ~np.isnan(v)
+        counts = np.stack([np.bincount(loop_ids, weights=valid[:, k], minlength=length) for k in range(len(METRICS))], axis=1)
+        sums = np.stack([np.bincount(loop_ids, weights=np.where(valid[:, k], v[:, k], 0), minlength=length) for k in range(len(METRICS))], axis=1)
+        squares = np.stack([np.bincount(loop_ids, weights=np.where(valid[:, k], v[:, k] ** 2, 0), minlength=length) for k in range(len(METRICS))], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums / counts
+            var = (squares - counts * mean ** 2) / (counts - 1)
+            sem = np.sqrt(np.maximum(var, 0) / counts)
+        keep = counts[:, 0] >= MIN_CURVE_SESSIONS
+        result[str(method)] = (np.arange(length)[keep], mean[keep], sem[keep], counts[keep, 0].astype(int))
+    return result
+
+
+# --- 出力 ---
+
+def _fmt(value, digits=1):
+    return "---" if value is None or not np.isfinite(value) else f"{value:.{digits}f}"
+
+
+def _group_table(title, rows):
+    lines = [f"\n■ {title}", f"{'グループ':<28} {'n':>3}  " + "  ".join(f"{METRIC_LABELS[m]:>26}" for m in METRICS),
+             f"{'':<28} {'':>3}  " + "  ".join(f"{'事前→事後 (伸び, d_z)':>26}" for _ in METRICS)]
+    for row in rows:
+        cells = [f"{_fmt(row['pre'][k])}→{_fmt(row['post'][k])} ({row['delta'][k]:+.1f}, {_fmt(row['d_z'][k], 2)})" for k in range(len(METRICS))]
+        lines.append(f"{row['group']:<28} {row['n']:>3}  " + "  ".join(f"{c:>26}" for c in cells))
+    return lines
+
+
+def _write_group_csv(path, rows):
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['group', 'n'] + [f"{m}_{part}" for m in METRICS for part in ('pre', 'post', 'delta', 'sd', 'd_z')])
+        for row in rows:
+            writer.writerow([row['group'], row['n']] + [f"{row[part][k]:.4f}" for k in range(len(METRICS)) for part in ('pre', 'post', 'delta', 'sd', 'd_z')])
+
+
+def _plot(out_dir, curves, by_method):
+    written = []
+    for k, metric in enumerate(METRICS):
+        fig, ax = plt.subplots(figsize=(8, 4.5))
+        for method, (loops, mean, sem, _) in curves.items():
+            ax.plot(loops, mean[:, k], marker='o', markersize=3, label=method)
+            ax.fill_between(loops, mean[:, k] - sem[:, k], mean[:, k] + sem[:, k], alpha=0.2)
+        ax.set_xlabel('Loop'); ax.set_ylabel(METRIC_LABELS[metric]); ax.set_title(f'Learning curve: {METRIC_LABELS[metric]}')
+        ax.grid(alpha=0.3); ax.legend(fontsize=8)
+        path = os.path.join(out_dir, f"learning_curve_{metric}.png"); fig.tight_layout(); fig.savefig(path, dpi=120); plt.close(fig)
+        written.append(path)
+
+        fig, ax = plt.subplots(figsize=(6, 4.5))
+        labels = [row['group'] for row in by_method]
+        ax.bar(range(len(labels)), [row['delta'][k] for row in by_method],
+               yerr=[row['sd'][k] / np.sqrt(row['n']) if row['n'] > 1 else 0 for row in by_method], capsize=4)
+        ax.set_xticks(range(len(labels))); ax.set_xticklabels(labels, rotation=15, fontsize=8)
+        ax.axhline(0, color='gray', linewidth=0.8); ax.set_ylabel(f"Δ {METRIC_LABELS[metric]} (post - pre)")
+        path = os.path.join(out_dir, f"improvement_{metric}.png"); fig.tight_layout(); fig.savefig(path, dpi=120); plt.close(fig)
+        written.append(path)
+    return written
+
+
+def write_report(contributions, out_dir):
+    """集計してファイルに書き、書いたパスのリストを返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    sessions, methods, scores, pre, post = improvement_arrays(contributions)
+    by_method = describe_groups(methods, pre, post)
+    by_score = describe_groups(np.char.add(np.char.add(methods, ' / '), scores), pre, post)
+    effects = method_effects(methods, pre, post)
+    curves = learning_curves(contributions)
+
+    lines = ["==================================================", " 実験集計レポート",
+             f" セッション {len(contributions)} / 参加者 {len({c.get('participant') for c in contributions.values() if c.get('participant')})}"
+             f" / 集計したセット {len(sessions)}", "=================================================="]
+    lines += _group_table("手法別 (事前テスト → 事後テスト)", by_method)
+    lines += _group_table("手法 × 楽譜別", by_score)
+    lines.append("\n■ 手法間の伸びの差 (Hedges' g, a - b)")
+    for effect in effects:
+        lines.append(f"  {effect['a']} (n={effect['n_a']}) vs {effect['b']} (n={effect['n_b']}): "
+                     + ", ".join(f"{METRIC_LABELS[m]} {_fmt(effect['g'][k], 2)}" for k, m in enumerate(METRICS)))
+    lines.append("\n■ 練習ループの学習曲線 (平均, 最初と最後のループ)")
+    for method, (loops, mean, _, counts) in curves.items():
+        if not len(loops): continue
+        lines.append(f"  {method}: Loop {loops[0]}→{loops[-1]} (n={counts[0]}→{counts[-1]}) "
+                     + ", ".join(f"{METRIC_LABELS[m]} {_fmt(mean[0, k])}→{_fmt(mean[-1, k])}" for k, m in enumerate(METRICS)))
+
+    written = []
+    path = os.path.join(out_dir, 'summary.txt')
+    with open(path, 'w', encoding='utf-8') as f: f.write("\n".join(lines) + "\n")
+    written.append(path)
+    for name, rows in (('improvement_by_method.csv', by_method), ('improvement_by_score.csv', by_score)):
+        _write_group_csv(os.path.join(out_dir, name), rows); written.append(os.path.join(out_dir, name))
+    path = os.path.join(out_dir, 'method_effects.csv')
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f); writer.writerow(['a', 'b', 'n_a', 'n_b'] + [f"g_{m}" for m in METRICS])
+        for effect in effects: writer.writerow([effect['a'], effect['b'], effect['n_a'], effect['n_b']] + [f"{g:.4f}" for g in effect['g']])
+    written.append(path)
+    path = os.path.join(out_dir, 'learning_curves.csv')
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f); writer.writerow(['method', 'loop', 'n'] + [f"{m}_{part}" for m in METRICS for part in ('mean', 'sem')])
+        for method, (loops, mean, sem, counts) in curves.items():
+            for i, loop in enumerate(loops):
+                writer.writerow([method, int(loop), int(counts[i])] + [f"{v:.4f}" for k in range(len(METRICS)) for v in (mean[i, k], sem[i, k])])
+    written.append(path)
+    if MATPLOTLIB_AVAILABLE: written += _plot(out_dir, curves, by_method)
+    return written, "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="参加者をまたいだ実験の集計レポート")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store', help="experiment_store の SQLite")
+    source.add_argument('--logs', nargs='+', help="experiment_result_*.txt / experiment_*.jsonl (フォルダ可)")
+    parser.add_argument('--out', default='report')
+    parser.add_argument('--jobs', type=int, default=None, help="並列数 (省略時は CPU 数)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    sources = store_sessions(args.store) if args.store else log_sessions(args.logs)
+    if not sources: print("セッションがありません。"); return
+    contributions = collect_contributions(sources, args.out, args.jobs)
+    written, summary = write_report(contributions, args.out)
+    print(summary)
+    if not MATPLOTLIB_AVAILABLE: print("\n(matplotlib が無いためグラフは出力しません)")
+    print(f"\n出力: {', '.join(os.path.basename(p) for p in written)} → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
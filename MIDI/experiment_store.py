@@ -0,0 +1,225 @@
+"""
+実験データの SQLite ストア (参加者をまたいだ集計用)
+
+experiment_dataset と同じ hits / loops / steps の表 (+ sessions) を 1 つの SQLite ファイルに持つ。
+  - 実験中は experiment_recorder の書き込みスレッドがステップごとに追記する
+  - 過去の experiment_result_*.txt は experiment_log_import が取り込む
+  - WAL モードなので、アプリが書いている最中でも別のプロセスから読める
+  - (method, score_file, set_index, loop, pad) と (condition, score_file, step_index, loop, pad) に索引があるので、
+    全セッションをまたいだ集計もすぐ返る (condition はセットの条件で、練習の前後のテストの行にも入る)
+
+    python experiment_store.py query --table loops --value avg_error --group-by method --score-file test2.json --loop 10 --pad all
+    python experiment_store.py query --table hits --value abs_error --group-by condition step_index --loop -1   # 条件ごとのテストの打撃
+    python experiment_store.py query --table loops --value accuracy --group-by method --pad all
+    python experiment_store.py sessions
+    python experiment_store.py build 実験データ/experiment_*.jsonl     # 記録 (.jsonl) から取り込む
+
+Python からは aggregate(connect(), 'loops', 'avg_error', group_by=['method'], score_file='test2.json', loop=10, pad='all')。
+(練習ループの打撃ごとの hits は新しい記録にだけある。取り込んだテキストには練習中の打撃の詳細が無い)
+"""
+import os
+import json
+import math
+import sqlite3
+import argparse
+
+import experiment_dataset
+
+# --- 設定 ---
+DEFAULT_STORE_PATH = 'experiments.sqlite'
+SCHEMA_VERSION = 2
+BUSY_TIMEOUT_S = 5.0
+
+_STAT_SQL = "accuracy REAL, score REAL, avg_error REAL, std_dev REAL, perfect INTEGER, great INTEGER, good INTEGER, dropped INTEGER"
+_KEY_SQL = "session TEXT NOT NULL, participant TEXT, set_index INTEGER, step_index INTEGER, method TEXT, condition TEXT, score_file TEXT"
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY, participant TEXT, started_at TEXT, ended_at TEXT,
+    score_order TEXT, experiment_order TEXT, source TEXT);
+CREATE TABLE IF NOT EXISTS steps ({_KEY_SQL}, pad TEXT, {_STAT_SQL});
+CREATE TABLE IF NOT EXISTS loops ({_KEY_SQL}, loop INTEGER, pad TEXT, {_STAT_SQL});
+CREATE TABLE IF NOT EXISTS hits ({_KEY_SQL}, loop INTEGER, pad TEXT, note_id TEXT, judgement TEXT, error_ms REAL, hit_time REAL);
+"""
+# 索引は移行 (列の追加) のあとに作る
+INDEXES = """
+CREATE INDEX IF NOT EXISTS hits_query ON hits (method, score_file, set_index, loop, pad);
+CREATE INDEX IF NOT EXISTS loops_query ON loops (method, score_file, set_index, loop, pad);
+CREATE INDEX IF NOT EXISTS steps_query ON steps (method, score_file, set_index, step_index, pad);
+CREATE INDEX IF NOT EXISTS hits_condition ON hits (condition, score_file, step_index, loop, pad);
+CREATE INDEX IF NOT EXISTS loops_condition ON loops (condition, score_file, step_index, loop, pad);
+CREATE INDEX IF NOT EXISTS steps_condition ON steps (condition, score_file, step_index, pad);
+CREATE INDEX IF NOT EXISTS hits_session ON hits (session);
+CREATE INDEX IF NOT EXISTS loops_session ON loops (session);
+CREATE INDEX IF NOT EXISTS steps_session ON steps (session);
+"""
+TABLES = experiment_dataset.TABLES
+# experiment_dataset の列名 → SQLite の列名 (set / step は SQL のキーワードと紛らわしいので付け替える)
+COLUMN_NAMES = {'set': 'set_index', 'step': 'step_index'}
+FILTER_COLUMNS = ('session', 'participant', 'set_index', 'step_index', 'method', 'condition', 'score_file', 'loop', 'pad', 'judgement')
+# 集計できる値: 名前 → (SQL の式, 元の列 (NULL を除く) )
+VALUES = {
+    'abs_error': ('ABS(error_ms)', 'error_ms'), 'error': ('error_ms', 'error_ms'), 'hit_time': ('hit_time', 'hit_time'),
+    'rows': ('1', None),
+    **{name: (name, name) for name in ('accuracy', 'score', 'avg_error', 'std_dev', 'perfect', 'great', 'good', 'dropped')},
+}
+AGGREGATES = ('avg', 'min', 'max', 'sum', 'count', 'std')
+
+
+def connect(path=DEFAULT_STORE_PATH, check_same_thread=True):
+    """ストアを開く (無ければ作る)。WAL モードで、書き込み中の読み取りを待たせない"""
+    directory = os.path.dirname(path)
+    if directory: os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_S, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _migrate(conn)
+    conn.executescript(INDEXES)
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return conn
+
+
+def _migrate(conn):
+    """
+    バージョン 1 のストアに condition 列を足し、同じセットの練習ステップの手法で埋める
+    (練習ステップの行が無いセットは NULL のまま)
+    """
+    with conn:
+        for table in TABLES:
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if 'condition' in columns: continue
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN condition TEXT")
+            conn.execute(
+                f"UPDATE {table} SET condition = (SELECT MIN(s.method) FROM steps s WHERE s.session = {table}.session "
+                f"AND s.set_index IS {table}.set_index AND s.method IS NOT NULL AND s.method != ?)",
+                (experiment_dataset.TEST_METHOD,))
+
+
+def _table_columns(table):
+    return [COLUMN_NAMES.get(name, name) for name, _ in experiment_dataset.COLUMNS[table]]
+
+
+def insert_rows(conn, table, rows):
+    names = [name for name, _ in experiment_dataset.COLUMNS[table]]
+    sql = f"INSERT INTO {table} ({', '.join(_table_columns(table))}) VALUES ({', '.join('?' * len(names))})"
+    conn.executemany(sql, ([row.get(name) for name in names] for row in rows))
+
+
+def delete_session(conn, session):
+    with conn:
+        for table in TABLES + ('sessions',): conn.execute(f"DELETE FROM {table} WHERE session = ?", (session,))
+
+
+class StoreWriter:
+    """experiment_dataset.StepCollector の書き込み先。ステップごとに 1 トランザクションで追記する"""
+    def __init__(self, conn, session, participant='', source=None):
+        self.conn = conn; self.session = session; self.participant = participant; self.source = source
+        self.sequence = 0
+
+    def begin(self, record):
+        if record.get('participant'): self.participant = record['participant']
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions (session, participant, started_at, score_order, experiment_order, source) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.session, self.participant, record.get('experiment_start_time'),
+                 json.dumps(record.get('score_order', []), ensure_ascii=False),
+                 json.dumps(record.get('experiment_order', []), ensure_ascii=False), self.source))
+
+    def end(self, record):
+        with self.conn:
+            self.conn.execute("UPDATE sessions SET ended_at = ? WHERE session = ?", (record.get('recorded_at'), self.session))
+
+    def append_step(self, step, loops=()):
+        self.sequence += 1
+        with self.conn:
+            for table, rows in experiment_dataset.step_tables(step, loops, self.session, self.participant).items():
+                if rows: insert_rows(self.conn, table, rows)
+
+
+def build_from_records(conn, records, session, participant='', source=None):
+    """記録済みのレコード列を取り込む (同じ session があれば消して入れ直す)。取り込んだステップ数を返す"""
+    delete_session(conn, session)
+    collector = experiment_dataset.StepCollector(StoreWriter(conn, session, participant, source))
+    for record in experiment_dataset.fill_conditions(records): collector.add(record)
+    return collector.writer.sequence
+
+
+def aggregate(conn, table='hits', value='abs_error', agg='avg', group_by=(), **filters):
+    """
+    value (VALUES のキー) を group_by の列ごとに集計して [(グループの値..., 集計値, 件数), ...] を返す。
+    filters は FILTER_COLUMNS の列 = 値 (リストなら IN)。列名は固定の表からしか選ばないので SQL に直接埋め込める
+    """
+    if table not in TABLES: raise ValueError(f"不明な表です: {table}")
+    if value not in VALUES: raise ValueError(f"不明な値です: {value} ({', '.join(VALUES)})")
+    if agg not in AGGREGATES: raise ValueError(f"不明な集計です: {agg} ({', '.join(AGGREGATES)})")
+    available = set(_table_columns(table))
+    for column in list(group_by) + list(filters):
+        if column not in FILTER_COLUMNS or column not in available: raise ValueError(f"{table} に使えない列です: {column}")
+    expression, source = VALUES[value]
+    if source is not None and source not in available: raise ValueError(f"{table} には {value} がありません")
+    # SQLite の数学関数は組み込みに無いことがあるので、標準偏差は平均と二乗平均から Python で計算する
+    aggregate_sql = f"AVG({expression}), AVG(({expression}) * ({expression}))" if agg == 'std' else f"{agg.upper()}({expression})"
+
+    where = []; params = []
+    for column, wanted in filters.items():
+        if wanted is None: continue
+        if isinstance(wanted, (list, tuple)):
+            where.append(f"{column} IN ({', '.join('?' * len(wanted))})"); params.extend(wanted)
+        else:
+            where.append(f"{column} = ?"); params.append(wanted)
+    if source is not None: where.append(f"{source} IS NOT NULL")
+    group_sql = ", ".join(group_by)
+    sql = (f"SELECT {group_sql + ', ' if group_sql else ''}{aggregate_sql}, COUNT(*) FROM {table}"
+           f"{' WHERE ' + ' AND '.join(where) if where else ''}"
+           f"{' GROUP BY ' + group_sql + ' ORDER BY ' + group_sql if group_sql else ''}")
+    rows = conn.execute(sql, params).fetchall()
+    if agg != 'std': return rows
+    return [row[:-3] + (math.sqrt(max(row[-2] - row[-3] ** 2, 0.0)) if row[-3] is not None else None, row[-1]) for row in rows]
+
+
+def list_sessions(conn):
+    return conn.execute("SELECT session, participant, started_at, ended_at, source FROM sessions ORDER BY started_at").fetchall()
+
+
+def main():
+    import time
+    import experiment_recorder
+    parser = argparse.ArgumentParser(description="実験データの SQLite ストア")
+    parser.add_argument('--store', default=DEFAULT_STORE_PATH)
+    sub = parser.add_subparsers(dest='command', required=True)
+    query = sub.add_parser('query', help="集計する")
+    query.add_argument('--table', choices=TABLES, default='hits')
+    query.add_argument('--value', choices=list(VALUES), default='abs_error')
+    query.add_argument('--agg', choices=AGGREGATES, default='avg')
+    query.add_argument('--group-by', nargs='*', default=[])
+    for column in FILTER_COLUMNS:
+        kind = int if column in ('set_index', 'step_index', 'loop') else str
+        query.add_argument(f"--{column.replace('_', '-')}", type=kind, nargs='*', default=None)
+    sub.add_parser('sessions', help="セッションの一覧")
+    build = sub.add_parser('build', help="experiment_recorder の記録 (.jsonl) から取り込む")
+    build.add_argument('logs', nargs='+')
+    args = parser.parse_args()
+
+    conn = connect(args.store)
+    if args.command == 'sessions':
+        for row in list_sessions(conn): print("\t".join('' if v is None else str(v) for v in row))
+    elif args.command == 'build':
+        for path in args.logs:
+            session = os.path.splitext(os.path.basename(path))[0]
+            steps = build_from_records(conn, experiment_recorder.load_records(path), session, source=path)
+            print(f"{path}: {steps} ステップ → {args.store}")
+    else:
+        filters = {column: (values[0] if len(values) == 1 else values)
+                   for column in FILTER_COLUMNS if (values := getattr(args, column)) is not None}
+        started = time.perf_counter()
+        rows = aggregate(conn, args.table, args.value, args.agg, args.group_by, **filters)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print("\t".join(args.group_by + [f"{args.agg}({args.value})", 'n']))
+        for row in rows:
+            print("\t".join(f"{v:.2f}" if isinstance(v, float) else str(v) for v in row))
+        print(f"({len(rows)} 行, {elapsed_ms:.1f}ms)")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
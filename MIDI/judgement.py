@@ -0,0 +1,89 @@
+"""
+打撃の判定 (training_module_v5.py から切り出し)
+
+UI (PyQt6 / pygame) に依存しないので、session_replay.py で記録した入力をヘッドレスに流し直したり、
+判定ロジックを変えたときに結果を突き合わせたりできる。
+楽譜は score_compiler.CompiledScore (dict を渡すとその場でコンパイルする)。ノートの発音時刻はトラックの配列でまとめて比べる。
+judged_notes は {ノートID: 最後に判定した時刻(ms)} の辞書で、呼び出し側が持つ (ループの切り替わりで clear する)。
+長い楽譜でも 1 打・1 フレームの処理が曲の長さによらないよう、判定は発音時刻の索引 (CompiledTrack.notes_between) で
+good の範囲にあるノートだけを、見逃しは前回の確認からの時刻の範囲だけを見る。
+"""
+import numpy as np
+
+import score_compiler
+
+# --- 判定設定 ---
+JUDGEMENT_WINDOWS = {'perfect': 55, 'great': 90, 'good': 110}
+DROPPED_THRESHOLD = 120
+NUM_MEASURES = score_compiler.NUM_MEASURES
+
+
+def judge_hit(hit, score, judged_notes, windows=JUDGEMENT_WINDOWS):
+    """
+    hit = {'time': 経過時間(ms), 'pad': 'top'|'bottom'} を判定して (判定, 誤差ms, ノートID) を返す。
+    good 以内で当たったノートは judged_notes に判定時刻を記録する
+    """
+    pad, hit_time = hit['pad'], hit['time']
+    track = score_compiler.compile_score(score).tracks.get(pad)
+    if track is None or track.note_count == 0: return 'extra', None, None
+    loop_duration_ms = track.loop_duration_ms
+    if loop_duration_ms == 0: return 'extra', None, None
+
+    hit_time_in_loop = hit_time % loop_duration_ms
+    note_times = track.note_onset_ms
+
+    # good の範囲にあるノートだけを索引で拾う (現在、過去ループ、未来ループ。境界の丸めのぶん 1ms 広く拾う)
+    reach = windows['good'] + 1.0
+    candidates = np.unique(np.concatenate([track.notes_between(hit_time_in_loop - shift - reach, hit_time_in_loop - shift + reach)
+                                           for shift in (0.0, -loop_duration_ms, loop_duration_ms)]))
+    if candidates.size == 0: return 'extra', None, None
+
+    # ループを考慮した最短距離 (現在、過去ループ、未来ループ)
+    times = note_times[candidates]
+    diff = np.minimum(np.abs(hit_time_in_loop - times),
+                      np.minimum(np.abs(hit_time_in_loop - (times - loop_duration_ms)),
+                                 np.abs(hit_time_in_loop - (times + loop_duration_ms))))
+
+    # そのノートが「まだ判定されていない」または「前回の判定からループの半分以上時間が経っている」場合、対象とする
+    last_judged = np.array([judged_notes.get(track.note_id_list[i], -1) for i in candidates.tolist()], dtype=float)
+    allowed = ((last_judged == -1) | ((hit_time - last_judged) > (loop_duration_ms * 0.5))) & (diff <= windows['good'])
+    if not allowed.any(): return 'extra', None, None
+    closest = int(candidates[np.argmin(np.where(allowed, diff, np.inf))])   # 同じ距離なら楽譜で先のノート
+    note_id = track.note_id_list[closest]
+
+    # 見つかったノートを基準に、符号付きの誤差を計算する (現在、過去ループ、未来ループのうち最も近い基準時間)
+    note_time = float(note_times[closest])
+    candidates = [note_time, note_time - loop_duration_ms, note_time + loop_duration_ms]
+    actual_note_time_instance = min(candidates, key=lambda x: abs(hit_time_in_loop - x))
+    error_ms = hit_time_in_loop - actual_note_time_instance
+
+    if abs(error_ms) <= windows['good']:
+        judged_notes[note_id] = hit_time
+        if abs(error_ms) <= windows['perfect']: return 'perfect', error_ms, note_id
+        if abs(error_ms) <= windows['great']: return 'great', error_ms, note_id
+        return 'good', error_ms, note_id
+
+    return 'extra', None, None
+
+
+def dropped_notes(score, judged_notes, current_time_in_loop, threshold_ms=DROPPED_THRESHOLD, since_ms=None):
+    """
+    まだ判定されておらず、予定時刻 + threshold_ms を過ぎたノートを (トラック名, ノートID) で返す。
+    current_time_in_loop は全トラック共通のマスターループ内の時刻 (ms)。
+    since_ms に前回確認したときの時刻を渡すと、そのあとで期限を過ぎたノートだけを見る
+    (前回までに返したノートは呼び出し側が judged_notes に入れている前提。ループが戻ったときは全体を見直す)
+    """
+    full_scan = since_ms is None or current_time_in_loop < since_ms
+    dropped = []
+    for track_name, track in score_compiler.compile_score(score).tracks.items():
+        if track.ms_per_beat <= 0: continue
+        if full_scan:
+            candidates = np.flatnonzero(current_time_in_loop > track.note_onset_ms + threshold_ms)
+        else:
+            # 期限 (発音時刻 + threshold_ms) が [since_ms, current_time_in_loop) に入ったノート。境界の丸めのぶん 1ms 広く拾う
+            candidates = track.notes_between(since_ms - threshold_ms - 1.0, current_time_in_loop - threshold_ms + 1.0)
+            candidates = candidates[current_time_in_loop > track.note_onset_ms[candidates] + threshold_ms]
+        for i in candidates.tolist():
+            note_id = track.note_id_list[i]
+            if note_id not in judged_notes: dropped.append((track_name, note_id))
+    return dropped
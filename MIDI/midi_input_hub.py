@@ -0,0 +1,177 @@
+"""
+複数の MIDI 入力ポートをまとめて 1 本の時刻順キューにする
+
+training_module_v5.py の init_midi はこれまで input_ports[0] だけを開き、ノート番号は PAD_MAPPING で決め打ちだった。
+ここでは MIDI_DEVICES_PATH (無ければ PAD_MAPPING 相当の 1 台) に書いたポートをすべて開き、
+  - ポートごとに mido のコールバックで受け取った瞬間に time.time() を付けて共有キューに入れ、
+  - デバイスごとに事前に作った 128 要素の表 (ノート番号 → パッド / ゾーン / 役割 / 感度) で振り分け、
+  - iter_pending() で時刻順に取り出す (mido の入力ポートと同じ使い方)。
+受信はポートごとのスレッドで行い、振り分けは表を 1 回引くだけなので、ポートを増やしても 1 打あたりの遅れは増えない。
+学習者 + 指導者の 2 セットや、ゾーンの多いフルキットはデバイス構成を書き足すだけで扱える。
+
+midi_devices.json の例:
+    [
+      {"name": "learner", "port": "DTX Drums", "role": "learner",
+       "notes": {"38": {"pad": "left", "zone": "head"}, "40": {"pad": "left", "zone": "rim"}, "48": "right"}},
+      {"name": "instructor", "port": "TD-07", "role": "instructor", "velocity_threshold": 20,
+       "notes": {"38": "left", "45": "right"}}
+    ]
+"port" はポート名 (前方一致) か "*" (まだ開いていない最初のポート)。
+"""
+import os
+import json
+import time
+import queue
+import functools
+
+# --- オプショナルなライブラリのインポート ---
+try:
+    import mido
+    MIDO_AVAILABLE = True
+except ImportError:
+    MIDO_AVAILABLE = False
+
+# --- 設定 ---
+MIDI_DEVICES_PATH = 'midi_devices.json'
+ANY_PORT = '*'
+DEFAULT_ROLE = 'learner'
+NOTE_COUNT = 128
+
+
+class Route:
+    """ノート 1 つの振り分け先"""
+    __slots__ = ('pad', 'zone', 'role', 'device', 'velocity_threshold')
+
+    def __init__(self, pad, zone, role, device, velocity_threshold):
+        self.pad = pad; self.zone = zone; self.role = role; self.device = device
+        self.velocity_threshold = velocity_threshold
+
+
+class HubMessage:
+    """mido.Message の note_on と同じ属性 + 振り分け結果と受信時刻"""
+    __slots__ = ('type', 'note', 'velocity', 'time', 'pad', 'zone', 'role', 'device', 'timestamp')
+
+    def __init__(self, route, note, velocity, timestamp):
+        self.type = 'note_on'; self.note = note; self.velocity = velocity; self.time = 0
+        self.pad = route.pad; self.zone = route.zone; self.role = route.role; self.device = route.device
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f"<HubMessage {self.device}:{self.note} → {self.pad}/{self.zone} ({self.role}) velocity={self.velocity}>"
+
+
+def default_devices(pad_mapping, velocity_threshold):
+    """PAD_MAPPING ({'left': [47, 56], ...}) と同じ振り分けの 1 台構成"""
+    notes = {str(note): pad for pad, pad_notes in pad_mapping.items() for note in pad_notes}
+    return [{"name": "pads", "port": ANY_PORT, "role": DEFAULT_ROLE, "velocity_threshold": velocity_threshold, "notes": notes}]
+
+
+def load_device_configs(path, pad_mapping, velocity_threshold):
+    """デバイス構成を読む。ファイルが無い / 壊れているときは PAD_MAPPING 相当の 1 台構成"""
+    if not path or not os.path.exists(path): return default_devices(pad_mapping, velocity_threshold)
+    try:
+        with open(path, 'r', encoding='utf-8') as f: devices = json.load(f)
+        for i, device in enumerate(devices):
+            device.setdefault("name", f"device{i + 1}")
+            device.setdefault("port", ANY_PORT)
+            device.setdefault("role", DEFAULT_ROLE)
+            device.setdefault("velocity_threshold", velocity_threshold)
+            if not device.get("notes"): raise ValueError(f"{device['name']}: notes は必須です")
+        return devices
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        print(f"MIDI デバイス構成 '{path}' の読み込みに失敗したため、既定の構成を使います: {e}")
+        return default_devices(pad_mapping, velocity_threshold)
+
+
+def build_routing_table(device):
+    """ノート番号を添字にした 128 要素の表 (振り分けの無いノートは None)"""
+    table = [None] * NOTE_COUNT
+    for note, target in device["notes"].items():
+        if isinstance(target, str): target = {"pad": target}
+        table[int(note)] = Route(target["pad"], target.get("zone"), target.get("role", device["role"]),
+                                 device["name"], target.get("velocity_threshold", device["velocity_threshold"]))
+    return tuple(table)
+
+
+def match_port(pattern, available, claimed):
+    """ポート名 (完全一致 → 前方一致) か "*" で、まだ開いていないポートを選ぶ"""
+    candidates = [name for name in available if name not in claimed]
+    if pattern == ANY_PORT: return candidates[0] if candidates else None
+    for name in candidates:
+        if name == pattern: return name
+    for name in candidates:
+        if name.startswith(pattern): return name
+    return None
+
+
+class MidiInputHub:
+    """
+    構成したポートをすべて開いて 1 本のキューにまとめる。
+    iter_pending() / close() / closed / name を持つので、training_module_v5 の self.inport にそのまま入れられる
+    """
+    def __init__(self, devices, on_log=print):
+        self.devices = devices
+        self.tables = [build_routing_table(device) for device in devices]
+        self.on_log = on_log
+        self.ports = []            # (デバイス名, ポート)
+        self.closed = False
+        self.received = 0
+        self.ignored = 0           # 振り分けの無いノート / 感度未満
+        self.raw_sink = None       # 振り分け前の note_on を受け取る関数 (時刻, デバイスの添字, ノート, ベロシティ)。midi_session_log 用
+        self._queue = queue.SimpleQueue()
+
+    @property
+    def name(self):
+        return ", ".join(f"{device_name}={port.name}" for device_name, port in self.ports)
+
+    def open(self):
+        """構成したポートを開く。1 つも開けなければ OSError"""
+        if not MIDO_AVAILABLE: raise OSError("mido ライブラリが見つかりません。")
+        available = mido.get_input_names()
+        claimed = set()
+        for index, device in enumerate(self.devices):
+            port_name = match_port(device["port"], available, claimed)
+            if port_name is None:
+                self.on_log(f"⚠️ MIDI デバイス '{device['name']}' のポート '{device['port']}' が見つかりません")
+                continue
+            try:
+                port = mido.open_input(port_name, callback=functools.partial(self._receive, index))
+            except OSError as e:
+                self.on_log(f"⚠️ MIDI デバイス '{device['name']}' ({port_name}) を開けません: {e}")
+                continue
+            claimed.add(port_name); self.ports.append((device["name"], port))
+        if not self.ports: raise OSError("MIDI入力ポートが見つかりません。")
+        return self
+
+    def _receive(self, index, msg):
+        """ポートのスレッドから呼ばれる: 受信時刻を付けて表で振り分ける"""
+        timestamp = time.time()
+        if msg.type != 'note_on' or msg.velocity == 0: return
+        self.received += 1
+        raw_sink = self.raw_sink
+        if raw_sink is not None: raw_sink(timestamp, index, msg.note, msg.velocity)
+        route = self.tables[index][msg.note]
+        if route is None or msg.velocity < route.velocity_threshold:
+            self.ignored += 1; return
+        self._queue.put(HubMessage(route, msg.note, msg.velocity, timestamp))
+
+    def iter_pending(self):
+        """溜まっている打撃を受信時刻の順に返す (ポートのスレッドをまたぐと入る順が前後しうるので並べ直す)"""
+        pending = []
+        while True:
+            try: pending.append(self._queue.get_nowait())
+            except queue.Empty: break
+        if len(pending) > 1: pending.sort(key=lambda message: message.timestamp)
+        return iter(pending)
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        for _, port in self.ports:
+            try: port.close()
+            except Exception: pass
+
+
+def open_hub(pad_mapping, velocity_threshold, path=MIDI_DEVICES_PATH, on_log=print):
+    """デバイス構成を読んでポートを開いた MidiInputHub を返す (開けなければ OSError)"""
+    return MidiInputHub(load_device_configs(path, pad_mapping, velocity_threshold), on_log).open()
@@ -0,0 +1,129 @@
+"""
+練習中の生の note_on をコンパクトなバイナリで追記するセッションログ
+
+save_experiment_data_to_file が残すのは判定後のテキストだけなので、入力そのもの
+(ポート, ノート, ベロシティ, 受信時刻) をこちらに残し、session_replay.py で判定とコントローラーを流し直せるようにする。
+
+ファイル形式 (リトルエンディアン):
+    MAGIC (8 バイト) + バージョン (uint16)
+    レコード: RECORD = <dBBBB (時刻 time.time, 種類, ポート, ノート, ベロシティ) の 12 バイト
+      種類 KIND_NOTE_ON: 打撃 1 つ (ポートは midi_input_hub のデバイスの添字)
+      種類 KIND_META   : 続けて uint32 の長さ + UTF-8 の JSON
+                         ({"event": "session_start", 楽譜, デバイス構成, master_start_time, ...} / {"event": "session_end"})
+途中で落ちても、読み込み側は最後の不完全なレコードを捨てるだけで済む。
+"""
+import os
+import json
+import time
+import struct
+import threading
+
+import numpy as np
+
+# --- 設定 ---
+LOG_DIR = 'session_logs'
+MAGIC = b'MIDISLOG'
+VERSION = 1
+HEADER = struct.Struct('<8sH')
+RECORD = struct.Struct('<dBBBB')
+META_LENGTH = struct.Struct('<I')
+KIND_NOTE_ON = 1
+KIND_META = 2
+
+NOTE_DTYPE = np.dtype([('t', 'f8'), ('port', 'u1'), ('note', 'u1'), ('velocity', 'u1')])
+
+
+class SessionLogWriter:
+    """
+    追記専用のログ。note_on は MIDI / 音声入力のスレッドから呼ばれるのでロックで守る。
+    書き込みはバッファ付きで、メタ情報を書いたときと close で flush する
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if is_new: self._file.write(HEADER.pack(MAGIC, VERSION))
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def note_on(self, timestamp, port, note, velocity):
+        record = RECORD.pack(timestamp, KIND_NOTE_ON, port, note, velocity)
+        with self._lock:
+            if self._file.closed: return
+            self._file.write(record); self.count += 1
+
+    def meta(self, event, timestamp=None, **fields):
+        payload = json.dumps(dict(fields, event=event), ensure_ascii=False, default=str).encode('utf-8')
+        with self._lock:
+            if self._file.closed: return
+            self._file.write(RECORD.pack(time.time() if timestamp is None else timestamp, KIND_META, 0, 0, 0))
+            self._file.write(META_LENGTH.pack(len(payload))); self._file.write(payload)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed: return
+            self._file.flush(); self._file.close()
+
+
+def new_log_path(directory=LOG_DIR):
+    return os.path.join(directory, time.strftime('midi_%Y%m%d_%H%M%S.mlog'))
+
+
+def iter_events(path):
+    """('note_on', 時刻, ポート, ノート, ベロシティ) / ('meta', 時刻, dict) を順に返す"""
+    with open(path, 'rb') as f: data = f.read()
+    if len(data) < HEADER.size: return
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != MAGIC: raise ValueError(f"セッションログではありません: {path}")
+    if version > VERSION: raise ValueError(f"未対応のバージョンです: {version}")
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        timestamp, kind, port, note, velocity = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if kind == KIND_NOTE_ON:
+            yield ('note_on', timestamp, port, note, velocity)
+        elif kind == KIND_META:
+            if offset + META_LENGTH.size > len(data): return
+            (length,) = META_LENGTH.unpack_from(data, offset); offset += META_LENGTH.size
+            if offset + length > len(data): return
+            yield ('meta', timestamp, json.loads(data[offset:offset + length].decode('utf-8')))
+            offset += length
+        else:
+            raise ValueError(f"壊れたレコードです (offset {offset - RECORD.size})")
+
+
+class LoggedSession:
+    """session_start から session_end (または次の session_start / ファイル末尾) までの 1 回分"""
+    def __init__(self, start):
+        self.start = start          # session_start のメタ情報
+        self.end = None             # session_end のメタ情報
+        self.end_time = None
+        self._notes = []
+
+    @property
+    def notes(self):
+        """打撃の構造化配列 (t, port, note, velocity)、時刻順"""
+        notes = np.array(self._notes, dtype=NOTE_DTYPE)
+        return notes[np.argsort(notes['t'], kind='stable')]
+
+
+def load_sessions(path):
+    """ログ内のセッションをすべて読む (session_start より前の打撃は捨てる)"""
+    sessions = []; current = None
+    for event in iter_events(path):
+        if event[0] == 'meta':
+            info = event[2]
+            if info.get('event') == 'session_start':
+                current = LoggedSession(info); sessions.append(current)
+            elif info.get('event') == 'session_end' and current is not None:
+                current.end = info; current.end_time = event[1]; current = None
+        elif current is not None:
+            current._notes.append(event[1:])
+    return sessions
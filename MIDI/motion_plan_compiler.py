@@ -0,0 +1,294 @@
+"""
+モーションプラン・コンパイラ (ロボット制御 / コマンドモニター / 可視化 で共通)
+
+トラックのノート発音時刻を配列として受け取り、全ノートについてベクトル化して
+「振り上げ高さ」と「速度・加速度 (V/A)」を同時に決める。
+
+  - 各ノートの次の打撃までの間隔に、振り上げ + 反転待ち + 振り下ろし が収まる候補だけを残す
+  - 残った候補から、表現モデル (間隔が長いほど高く・ゆっくり振る) に最も近いものを選ぶ
+  - どの候補も間隔に収まらない場合は最短で往復できる候補を選び、is_feasible=False を立てる
+
+移動時間は tuning_data.csv (距離 × 速度 × 加速度 のスイープ) にフィットしたモデル (dobot_kinematics.py) から求める。
+出力は MOTION_DTYPE の構造化配列で、1 ノートにつき strike / upstroke の 2 行になる。
+長い楽譜は StreamingPlan で PLAN_CHUNK_NOTES ノートずつ、再生位置より先に作る (結果は compile_track と同じ)。
+"""
+import os
+
+import numpy as np
+
+import dobot_kinematics
+
+# --- 表現モデル (visualize_motion_plan.py から移動) ---
+MIN_EXPECTED_INTERVAL_S = 0.1
+MAX_EXPECTED_INTERVAL_S = 2.0
+MIN_VELOCITY = 100.0
+MAX_VELOCITY = 400.0
+MIN_ACCELERATION = 100.0
+MAX_ACCELERATION = 800.0
+EXPRESSION_EXPONENT = 0.75
+
+# --- 計画パラメータ ---
+UPSTROKE_DELAY_S = 0.01      # 打撃から振り上げ開始までの待ち (反転待ち)
+MIN_NOTE_INTERVAL_S = 0.02   # これより近いノートは同時打ちとみなして 1 打にまとめる
+MIN_STROKE_MM = 5.0          # 振り上げ量の下限 (tuning_data.csv で計測した最小距離)
+HEIGHT_STEP_MM = 1.0         # 振り上げ高さの探索刻み
+VELOCITY_WEIGHT = 0.5        # 表現モデルとのずれのコスト重み (高さ = 1.0)
+ACCELERATION_WEIGHT = 0.5
+FALLBACK_PENALTY_S = 0.005  # 妥協時の同着判定用: 振り上げ量・V/A の不足 (正規化) 1 あたりに加える時間 (秒)
+PLAN_CHUNK_NOTES = 64        # 候補の選択・長い楽譜のプラン作成をこのノート数ずつ行う
+
+DEFAULT_SAFETY_LIMITS = {
+    'x_min': 160.0, 'x_max': 250.0,
+    'y_min': -180.0, 'y_max': 180.0,
+    'z_min': 0, 'z_max': 130.0,
+}
+
+ACTION_STRIKE = 0
+ACTION_UPSTROKE = 1
+ACTION_NAMES = ("strike", "upstroke")
+
+MOTION_DTYPE = np.dtype([
+    ('target_time', 'f8'),     # ループ先頭からの目標時刻 (秒)
+    ('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('r', 'f4'),
+    ('velocity', 'f4'), ('acceleration', 'f4'),
+    ('duration', 'f4'),        # 予測移動時間 (秒)
+    ('action', 'u1'),          # ACTION_STRIKE / ACTION_UPSTROKE
+    ('note_index', 'i4'),      # 発音時刻順のノート番号
+    ('is_compensated', '?'),   # True: target_time が送信基準 (移動時間を差し引かない)
+    ('is_feasible', '?'),      # False: 間隔内に往復が収まらなかった
+])
+
+
+# --- 運動特性 ---
+_KINEMATICS_CACHE = {}
+
+def _resolve_data_path(path):
+    """カレント → このファイルの場所 → リポジトリ直下 の順に探す"""
+    if os.path.isabs(path) or os.path.exists(path): return path
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for base in (script_dir, os.path.dirname(script_dir)):
+        candidate = os.path.join(base, path)
+        if os.path.exists(candidate): return candidate
+    return path
+
+def load_kinematics(path='tuning_data.csv'):
+    """
+    tuning_data.csv にフィットした運動特性モデル (dobot_kinematics.DobotKinematics) を返す。
+    ファイルの mtime が同じ間はキャッシュを返す。
+    """
+    path = _resolve_data_path(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        print(f"警告: {path} が見つかりません。理論モデルで移動時間を見積もります。")
+        return dobot_kinematics.DobotKinematics.theoretical()
+    cached = _KINEMATICS_CACHE.get(path)
+    if cached and cached[0] == mtime: return cached[1]
+    try:
+        kinematics = dobot_kinematics.load_or_fit(path)
+    except Exception as e:
+        print(f"警告: {path} からのモデル作成に失敗 ({e})。理論モデルで移動時間を見積もります。")
+        return dobot_kinematics.DobotKinematics.theoretical()
+    _KINEMATICS_CACHE[path] = (mtime, kinematics)
+    return kinematics
+
+
+# --- 楽譜 → 発音時刻 ---
+def empty_plan():
+    return np.zeros(0, dtype=MOTION_DTYPE)
+
+
+def note_onsets(note_items, bpm):
+    """items からノートの発音時刻 (秒) を昇順の配列で返す"""
+    beats = np.array([item.get("beat", 0) for item in note_items if item.get("class") == "note"], dtype=float)
+    return np.sort(beats) * (60.0 / bpm)
+
+
+def expressive_targets(intervals, min_backswing_z, max_backswing_z):
+    """間隔から表現モデル上の (振り上げ Z, 速度, 加速度) の目標値を求める"""
+    normalized = np.clip((intervals - MIN_EXPECTED_INTERVAL_S) / (MAX_EXPECTED_INTERVAL_S - MIN_EXPECTED_INTERVAL_S), 0.0, 1.0)
+    eased = normalized ** EXPRESSION_EXPONENT
+    target_z = min_backswing_z + (max_backswing_z - min_backswing_z) * eased
+    target_v = MIN_VELOCITY + (MAX_VELOCITY - MIN_VELOCITY) * (1.0 - eased)
+    target_a = MIN_ACCELERATION + (MAX_ACCELERATION - MIN_ACCELERATION) * (1.0 - eased)
+    return target_z, target_v, target_a
+
+
+class TrackPlanner:
+    """
+    1 トラック分の下ごしらえ (近いノートのまとめ・間隔・候補の格子) を 1 度だけ行い、ノートの範囲ごとにプランを作る。
+    候補のコスト配列は (ノート数, H, K) になるので、PLAN_CHUNK_NOTES ノートずつ作って長い楽譜でもメモリを抑える
+    """
+    def __init__(self, onsets, loop_duration, strike_pos, ready_pos, kinematics,
+                 min_backswing_z, max_backswing_z, safety_limits=None):
+        self.limits = limits = safety_limits or DEFAULT_SAFETY_LIMITS
+        onsets = np.sort(np.asarray(onsets, dtype=float))
+
+        # 近すぎるノートは 1 打にまとめる
+        keep = np.ones(onsets.size, dtype=bool)
+        keep[1:] = np.diff(onsets) > MIN_NOTE_INTERVAL_S
+        self.note_index = np.flatnonzero(keep)
+        self.onsets = onsets = onsets[keep]
+        self.note_count = onsets.size
+        if onsets.size == 0: return
+        intervals = np.diff(np.append(onsets, onsets[0] + loop_duration))
+        intervals[intervals <= 0] = loop_duration  # 1 ノートだけのループ
+        self.intervals = intervals
+
+        strike_x, strike_y, strike_z, strike_r = strike_pos
+        ready_x, ready_y, _, ready_r = ready_pos
+        strike_z = float(np.clip(strike_z, limits['z_min'], limits['z_max']))
+        self.strike_pos = (strike_x, strike_y, strike_z, strike_r)
+        self.ready_pos = (ready_x, ready_y, ready_r)
+        top_z = min(max_backswing_z, limits['z_max'])
+        self.low_z = low_z = min(max(min_backswing_z, strike_z + MIN_STROKE_MM), top_z)
+        self.top_z = top_z
+
+        # 候補: 高さ (H) × 格子上の V/A の組 (K)
+        heights = np.arange(strike_z + MIN_STROKE_MM, top_z + 1e-9, HEIGHT_STEP_MM)
+        if heights.size == 0: heights = np.array([top_z])
+        cand_v, cand_a = (g.ravel() for g in np.meshgrid(kinematics.velocities, kinematics.accelerations, indexing='ij'))
+        # 振り上げ位置は待機位置の XY なので、打撃位置との水平距離も含めた 3 次元距離で見積もる
+        stroke_length = np.sqrt((ready_x - strike_x) ** 2 + (ready_y - strike_y) ** 2 + (heights - strike_z) ** 2)
+        self.stroke = kinematics.duration(stroke_length[:, None], cand_v[None, :], cand_a[None, :])  # (H, K)
+        self.cycle = UPSTROKE_DELAY_S + 2.0 * self.stroke
+        self.heights, self.cand_v, self.cand_a = heights, cand_v, cand_a
+
+        self.z_span = z_span = max(top_z - low_z, 1.0)
+        self.v_span = v_span = max(np.ptp(kinematics.velocities), 1.0)
+        self.a_span = a_span = max(np.ptp(kinematics.accelerations), 1.0)
+        # 不可能な間隔は最短往復で妥協する (ほぼ同じ時間なら低い振り上げ・高い V/A を優先)
+        slack = ((heights - strike_z) / z_span)[:, None] \
+            + ((kinematics.velocities.max() - cand_v) / v_span + (kinematics.accelerations.max() - cand_a) / a_span)[None, :]
+        self.fastest = np.argmin(self.cycle + FALLBACK_PENALTY_S * slack)
+
+    def _select(self, notes):
+        """notes (まとめた後のノート番号) ごとに (振り上げ Z, 速度, 加速度, 移動時間, 間隔に収まるか) を決める"""
+        intervals = self.intervals[notes]
+        # 表現モデルとのずれをコストにし、間隔に収まらない候補は除外する (N, H, K)
+        target_z, target_v, target_a = expressive_targets(intervals, self.low_z, self.top_z)
+        cost = (((self.heights[None, :] - target_z[:, None]) / self.z_span) ** 2)[:, :, None] \
+            + VELOCITY_WEIGHT * (((self.cand_v[None, :] - target_v[:, None]) / self.v_span) ** 2)[:, None, :] \
+            + ACCELERATION_WEIGHT * (((self.cand_a[None, :] - target_a[:, None]) / self.a_span) ** 2)[:, None, :]
+        feasible = self.cycle[None, :, :] <= intervals[:, None, None]
+        is_feasible = feasible.any(axis=(1, 2))
+        best = np.where(is_feasible, np.argmin(np.where(feasible, cost, np.inf).reshape(len(intervals), -1), axis=1), self.fastest)
+        h_idx, k_idx = np.unravel_index(best, self.cycle.shape)
+        return self.heights[h_idx], self.cand_v[k_idx], self.cand_a[k_idx], self.stroke[h_idx, k_idx], is_feasible
+
+    def plan(self, start=0, stop=None):
+        """ノート start..stop-1 (まとめた後の番号) のプラン。全体 (省略時) も PLAN_CHUNK_NOTES ずつ選んでからつなぐ"""
+        if stop is None: stop = self.note_count
+        if stop <= start: return empty_plan()
+        # ノート i の打撃は、直前ノート (i-1、先頭は前のループの最後のノート) の振り上げ位置から振り下ろす
+        notes = np.arange(start - 1, stop) % self.note_count
+        selected = [self._select(notes[i:i + PLAN_CHUNK_NOTES]) for i in range(0, notes.size, PLAN_CHUNK_NOTES)]
+        backswing_z, velocity, acceleration, duration, is_feasible = (np.concatenate(parts) for parts in zip(*selected))
+        onsets = self.onsets[start:stop]
+        strike_x, strike_y, strike_z, strike_r = self.strike_pos
+        ready_x, ready_y, ready_r = self.ready_pos
+
+        n = onsets.size
+        plan = np.zeros(2 * n, dtype=MOTION_DTYPE)
+        strikes, upstrokes = plan[0::2], plan[1::2]
+        strikes['target_time'] = onsets
+        strikes['x'], strikes['y'], strikes['z'], strikes['r'] = strike_x, strike_y, strike_z, strike_r
+        strikes['velocity'] = velocity[:-1]; strikes['acceleration'] = acceleration[:-1]
+        strikes['duration'] = duration[:-1]
+        strikes['action'] = ACTION_STRIKE
+        strikes['is_feasible'] = is_feasible[:-1]
+
+        upstrokes['target_time'] = onsets + UPSTROKE_DELAY_S
+        upstrokes['x'], upstrokes['y'], upstrokes['z'], upstrokes['r'] = ready_x, ready_y, backswing_z[1:], ready_r
+        upstrokes['velocity'] = velocity[1:]; upstrokes['acceleration'] = acceleration[1:]
+        upstrokes['duration'] = duration[1:]
+        upstrokes['action'] = ACTION_UPSTROKE
+        upstrokes['is_compensated'] = True
+        upstrokes['is_feasible'] = is_feasible[1:]
+
+        strikes['note_index'] = self.note_index[start:stop]; upstrokes['note_index'] = self.note_index[start:stop]
+        for axis in ('x', 'y', 'z'):
+            np.clip(plan[axis], self.limits[f'{axis}_min'], self.limits[f'{axis}_max'], out=plan[axis])
+        return plan[np.argsort(plan['target_time'], kind='stable')]
+
+
+def compile_track(onsets, loop_duration, strike_pos, ready_pos, kinematics,
+                  min_backswing_z, max_backswing_z, safety_limits=None):
+    """
+    1 トラック分のモーションプランを MOTION_DTYPE の構造化配列で返す。
+    onsets はループ先頭からの発音時刻 (秒)。最後のノートの間隔は次ループの先頭ノートまで。
+    """
+    return TrackPlanner(onsets, loop_duration, strike_pos, ready_pos, kinematics,
+                        min_backswing_z, max_backswing_z, safety_limits).plan()
+
+
+class StreamingPlan:
+    """
+    長い楽譜用: プランを chunk_notes ノートずつ、実行中のチャンクの 1 つ先まで作る (持つのは実行中と次のチャンクだけ)。
+    for で回すと 1 ループ分の (行, 送信パケット) を順に返す。チャンクの最初の動作を返した直後に次のチャンクを作るので、
+    作るのは送信を待っているあいだになる。encode はプランから送信パケットを作る関数 (dobot_link.encode_plan)
+    """
+    def __init__(self, planner, chunk_notes=PLAN_CHUNK_NOTES, encode=None):
+        self.planner = planner
+        self.chunk_notes = max(1, int(chunk_notes))
+        self.encode = encode
+        self.num_chunks = -(-planner.note_count // self.chunk_notes)
+        self._chunks = {}
+
+    def chunk(self, index):
+        """index 番目のチャンクの (プラン, 送信パケット)"""
+        if index not in self._chunks:
+            start = index * self.chunk_notes
+            plan = self.planner.plan(start, min(start + self.chunk_notes, self.planner.note_count))
+            self._chunks[index] = (plan, self.encode(plan) if self.encode else [None] * len(plan))
+        return self._chunks[index]
+
+    def __iter__(self):
+        for index in range(self.num_chunks):
+            plan, packets = self.chunk(index)
+            for position, item in enumerate(zip(plan, packets)):
+                yield item
+                if position == 0: self._prefetch(index)
+
+    def _prefetch(self, index):
+        following = (index + 1) % self.num_chunks  # 最後のチャンクの次は次ループの先頭
+        for old in [key for key in self._chunks if key not in (index, following)]: del self._chunks[old]
+        self.chunk(following)
+
+    def full_plan(self):
+        """全体のプラン (保存・可視化用。候補の選択はチャンクずつなのでメモリは増えない)"""
+        return self.planner.plan()
+
+
+# --- 利用側のヘルパー ---
+def is_structured_plan(plan):
+    return isinstance(plan, np.ndarray) and plan.dtype.names is not None and 'target_time' in plan.dtype.names
+
+def motion_position(row):
+    # float32 の丸め誤差 (0.30000001 等) を Dobot に送らないよう 0.001mm に丸める
+    return tuple(round(float(row[axis]), 3) for axis in ('x', 'y', 'z', 'r'))
+
+def motion_to_dict(row):
+    """構造化配列の 1 行を、command_sent シグナル等で使う従来形式の dict に変換する"""
+    return {
+        "target_time": float(row['target_time']),
+        "position": motion_position(row),
+        "velocity": float(row['velocity']),
+        "acceleration": float(row['acceleration']),
+        "duration": float(row['duration']),
+        "is_compensated": bool(row['is_compensated']),
+        "is_feasible": bool(row['is_feasible']),
+        "note_index": int(row['note_index']),
+        "action": ACTION_NAMES[row['action']],
+    }
+
+def plan_to_dicts(plan):
+    return [motion_to_dict(row) for row in plan]
+
+def plan_summary(plan):
+    """ログ用の要約 (ノート数, 実行不可能な間隔の数, 振り上げ高さの範囲)"""
+    upstrokes = plan[plan['action'] == ACTION_UPSTROKE]
+    if upstrokes.size == 0: return "ノートなし"
+    infeasible = int(np.count_nonzero(~upstrokes['is_feasible']))
+    return (f"{upstrokes.size}打, 振り上げZ {upstrokes['z'].min():.1f}-{upstrokes['z'].max():.1f}mm, "
+            f"V {upstrokes['velocity'].min():.0f}-{upstrokes['velocity'].max():.0f}, 間に合わない間隔 {infeasible}件")
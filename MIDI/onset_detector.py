@@ -0,0 +1,194 @@
+"""
+ブロック単位のオンセット (打撃音の立ち上がり) 検出
+
+録音ファイルの解析 (strike_latency_analyzer.py) とマイク入力 (リアルタイム) の両方で使えるよう、
+process(block) にサンプル列を少しずつ渡すと、確定したオンセット時刻 (ストリーム先頭からの秒) を返す。
+保持するのは 1 フレーム分のサンプルと検出関数の履歴だけなので、長い録音でもメモリは一定。
+
+検出関数:
+  "flux"   : 対数圧縮した振幅スペクトルの正の差分 (スペクトルフラックス) を、背景より FLUX_ACTIVE_MARGIN 以上
+             大きい「鳴っている」ビンだけで平均したもの (単位は対数振幅 = ネイパー)。
+             背景はビンごとの対数スペクトルの指数移動平均 (時定数 median_window_s) で、定常ノイズや鳴り続ける音は背景に入る。
+             全ビンで平均すると、200Hz のクリックのような狭帯域の打撃音は数ビンしか上がらず、
+             ノイズの揺らぎとフレーム長 (ビン数) に薄められて下限を超えないため、鳴っているビンだけで平均する。
+             こうするとフレーム長に依らず、下限 DEFAULT_FLOOR["flux"] は「鳴っているビンが平均でどれだけ立ち上がったか」になる
+  "energy" : フレームエネルギーの対数の増加分
+しきい値は直近 median_window_s の検出関数の 中央値 + k × MAD、中央値 × ratio (ノイズに追従する)、絶対下限 の最大値。
+ピークは 1 フレーム遅れで確定し、時刻はそのフレーム内で振幅が最大値の REFINE_FRACTION を超えた最初のサンプルに補正する。
+"""
+import wave
+from collections import deque
+
+import numpy as np
+
+# --- 既定パラメータ ---
+DEFAULT_FRAME_SIZE = 1024
+DEFAULT_HOP_SIZE = 256
+DEFAULT_THRESHOLD_K = 4.0       # 中央値 + k × MAD
+DEFAULT_THRESHOLD_RATIO = 2.0   # 中央値の何倍を超えたら候補にするか (背景ノイズのゆらぎを除く)
+DEFAULT_FLOOR = {"flux": 1.0, "energy": 1.0}   # 検出関数の絶対下限 (flux は鳴っているビンの平均の立ち上がり、ネイパー)
+DEFAULT_MEDIAN_WINDOW_S = 0.5
+DEFAULT_MIN_INTERVAL_S = 0.05   # これより近い連続オンセットは 1 つにまとめる
+DEFAULT_MIN_RMS = 10 ** (-50 / 20)  # -50 dBFS 未満のフレームは無視する
+LOG_COMPRESSION = 100.0
+FLUX_ACTIVE_MARGIN = 2.0        # 背景 (ビンごとの移動平均) よりこれだけ大きいビンを「鳴っている」とみなす (ネイパー、約 17dB)
+REFINE_FRACTION = 0.2
+WAV_BLOCK_FRAMES = 65536
+
+
+class OnsetDetector:
+    def __init__(self, sample_rate, frame_size=DEFAULT_FRAME_SIZE, hop_size=DEFAULT_HOP_SIZE, method="flux",
+                 threshold_k=DEFAULT_THRESHOLD_K, threshold_ratio=DEFAULT_THRESHOLD_RATIO, floor=None, median_window_s=DEFAULT_MEDIAN_WINDOW_S,
+                 min_interval_s=DEFAULT_MIN_INTERVAL_S, min_rms=DEFAULT_MIN_RMS):
+        if method not in DEFAULT_FLOOR: raise ValueError(f"未知の検出方法: {method}")
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.method = method
+        self.threshold_k = threshold_k
+        self.threshold_ratio = threshold_ratio
+        self.floor = DEFAULT_FLOOR[method] if floor is None else floor
+        self.min_interval_s = min_interval_s
+        self.min_rms = min_rms
+        self.window = np.hanning(frame_size).astype(np.float32)
+        self.history = deque(maxlen=max(3, int(median_window_s * sample_rate / hop_size)))
+        self.background_rate = min(1.0, hop_size / (median_window_s * sample_rate))
+        self.reset()
+
+    def reset(self):
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_start = 0          # _buffer[0] のストリーム上のサンプル番号
+        self._previous_spectrum = None
+        self._background = None        # ビンごとの対数スペクトルの移動平均 (flux)
+        self._previous_energy = None
+        self._candidate = None          # (odf, フレーム開始サンプル, フレーム) 次のフレームで極大か確かめる
+        self._last_odf = 0.0
+        self._last_onset_s = -np.inf
+        self.history.clear()
+
+    @property
+    def latency_s(self):
+        """入力から検出が確定するまでの最大の遅れ (1 フレーム + 確認の 1 ホップ)"""
+        return (self.frame_size + self.hop_size) / self.sample_rate
+
+    def _odf(self, frames):
+        if self.method == "flux":
+            spectrum = np.log1p(LOG_COMPRESSION * np.abs(np.fft.rfft(frames * self.window, axis=1)))
+            previous = np.vstack(([spectrum[0] if self._previous_spectrum is None else self._previous_spectrum], spectrum[:-1]))
+            self._previous_spectrum = spectrum[-1]
+            rise = np.maximum(spectrum - previous, 0.0)
+            odf = np.zeros(len(frames))
+            background = spectrum[0].copy() if self._background is None else self._background
+            for i in range(len(frames)):
+                active = spectrum[i] > background + FLUX_ACTIVE_MARGIN
+                count = np.count_nonzero(active)
+                if count: odf[i] = rise[i][active].sum() / count
+                # 打撃音そのもので背景が持ち上がりすぎないよう、背景 + マージンで頭打ちにして追従させる
+                background += self.background_rate * (np.minimum(spectrum[i], background + FLUX_ACTIVE_MARGIN) - background)
+            self._background = background
+            return odf
+        energy = np.log(np.einsum('ij,ij->i', frames, frames * self.window) + 1e-10)
+        previous = np.concatenate(([energy[0] if self._previous_energy is None else self._previous_energy], energy[:-1]))
+        self._previous_energy = energy[-1]
+        return np.maximum(energy - previous, 0.0)
+
+    def _threshold(self):
+        if len(self.history) < 3: return np.inf
+        values = np.fromiter(self.history, dtype=float)
+        median = np.median(values)
+        return max(self.floor, median * self.threshold_ratio, median + self.threshold_k * np.median(np.abs(values - median)))
+
+    def _refine(self, frame_start, frame):
+        """フレーム内で振幅が最大値の REFINE_FRACTION を初めて超えたサンプルを立ち上がりとする"""
+        amplitude = np.abs(frame)
+        peak = amplitude.max()
+        if peak <= 0: return frame_start
+        return frame_start + int(np.argmax(amplitude >= REFINE_FRACTION * peak))
+
+    def process(self, samples):
+        """サンプル列 (float, モノラル) を渡し、確定したオンセット時刻 (秒) のリストを返す"""
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim > 1: samples = samples.mean(axis=1)
+        buffer = np.concatenate((self._buffer, samples)) if len(self._buffer) else samples
+        if len(buffer) < self.frame_size:
+            self._buffer = buffer; return []
+        n_frames = (len(buffer) - self.frame_size) // self.hop_size + 1
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, self.frame_size)[::self.hop_size][:n_frames]
+        odf = self._odf(frames)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+
+        onsets = []
+        for i in range(n_frames):
+            value = float(odf[i]) if rms[i] >= self.min_rms else 0.0
+            candidate = self._candidate
+            if candidate is not None:
+                # 候補フレームが極大 (次のフレームより大きい) ならオンセットとして確定する
+                if value < candidate[0]:
+                    onset_s = self._refine(candidate[1], candidate[2]) / self.sample_rate
+                    if onset_s - self._last_onset_s >= self.min_interval_s:
+                        onsets.append(onset_s); self._last_onset_s = onset_s
+                    self._candidate = None
+                elif value > candidate[0]:
+                    self._candidate = None
+            if self._candidate is None and value > self._last_odf and value > self._threshold():
+                self._candidate = (value, self._buffer_start + i * self.hop_size, frames[i].copy())
+            self.history.append(value)
+            self._last_odf = value
+
+        consumed = n_frames * self.hop_size
+        self._buffer = buffer[consumed:].copy()
+        self._buffer_start += consumed
+        return onsets
+
+    def flush(self):
+        """ストリームの終わり: 保留中の候補を確定させる"""
+        onsets = []
+        if self._candidate is not None:
+            onset_s = self._refine(self._candidate[1], self._candidate[2]) / self.sample_rate
+            if onset_s - self._last_onset_s >= self.min_interval_s: onsets.append(onset_s)
+            self._candidate = None
+        return onsets
+
+
+def read_wav_blocks(path, block_frames=WAV_BLOCK_FRAMES):
+    """
+    PCM WAV を block_frames ずつ読み、(sample_rate, float32 配列 [frames, channels]) を順に返す。
+    8/16/24/32bit 整数 PCM に対応 (標準ライブラリの wave は浮動小数点 WAV を読めない)。
+    """
+    with wave.open(path, 'rb') as wav:
+        sample_rate = wav.getframerate(); channels = wav.getnchannels(); width = wav.getsampwidth()
+        while True:
+            raw = wav.readframes(block_frames)
+            if not raw: break
+            yield sample_rate, pcm_to_float(raw, width, channels)
+
+
+def pcm_to_float(raw, width, channels):
+    if width == 1:
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif width == 2:
+        data = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768.0
+    elif width == 3:
+        bytes3 = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        ints = (bytes3[:, 0].astype(np.int32) | (bytes3[:, 1].astype(np.int32) << 8) | (bytes3[:, 2].astype(np.int32) << 16))
+        ints = np.where(ints & 0x800000, ints - 0x1000000, ints)
+        data = ints.astype(np.float32) / 8388608.0
+    elif width == 4:
+        data = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648.0
+    else:
+        raise ValueError(f"未対応のサンプル幅: {width * 8}bit")
+    return data.reshape(-1, channels)
+
+
+def wav_duration(path):
+    with wave.open(path, 'rb') as wav: return wav.getnframes() / wav.getframerate()
+
+
+def detect_onsets_in_wav(path, channel=None, **detector_options):
+    """WAV 全体のオンセット時刻 (秒、ファイル先頭から) を返す。channel=None なら全チャンネルの平均"""
+    detector = None; onsets = []
+    for sample_rate, block in read_wav_blocks(path):
+        if detector is None: detector = OnsetDetector(sample_rate, **detector_options)
+        onsets.extend(detector.process(block[:, channel] if channel is not None else block.mean(axis=1)))
+    if detector is not None: onsets.extend(detector.flush())
+    return np.asarray(onsets)
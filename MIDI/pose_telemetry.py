@@ -0,0 +1,258 @@
+"""
+Dobot の姿勢テレメトリ記録
+
+motion_log.csv は 0.2 秒刻み、magician/get_pose.py や test.py の PoseMonitorWorker は
+pydobot の pose() (1 回 0.2 秒の待ちが入る) を sleep 付きで回して 1 サンプルずつシグナルに流していた。
+ここでは
+  - 専用スレッドで dobot_link 経由で GetPose を連続して読み (リンクが許す限り速く)、
+  - 各サンプルに単調時計 (perf_counter) の時刻を付けて、事前に確保した NumPy リングバッファに入れ、
+  - 終了時にメタデータ付きの .npz (samples / metadata / 任意でモーションプラン) に書き出す。
+RobotController と同じリンクを共有するので、練習中の演奏と並行して記録できる
+(robot_control_module_v4.py の POSE_TELEMETRY_ENABLED / アームごとの "pose_telemetry")。
+
+オフライン解析:
+    python pose_telemetry.py telemetry/pose_top_1760000000.npz
+で、記録から打撃 (z の極小) を復元し、プランの打撃時刻とのずれを表示する。
+"""
+import os
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+# --- 設定 ---
+DEFAULT_CAPACITY = 200_000     # 約 1kHz で 3 分強
+DEFAULT_OUTPUT_DIR = 'telemetry'
+ERROR_BACKOFF_S = 0.05         # 読み取りに失敗したときの待ち
+STRIKE_TOLERANCE_MM = 1.5      # 打撃位置からこの範囲の z 極小を打撃とみなす
+ARRIVAL_TOLERANCE_MM = 0.5     # 目標の z のこの手前を横切った時刻を到着とみなす
+FORMAT_VERSION = 1
+
+SAMPLE_DTYPE = np.dtype([
+    ('t', 'f8'),      # perf_counter (要求と応答の中点)
+    ('rtt', 'f4'),    # 要求から応答までの時間 (秒)。t の不確かさの目安
+    ('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('r', 'f4'),
+])
+
+
+class PoseRingBuffer:
+    """事前確保したリングバッファ。満杯になると古いサンプルから上書きする"""
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.data = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.capacity = capacity
+        self.count = 0          # これまでに書いた総数
+        self._lock = threading.Lock()
+
+    def append(self, t, rtt, pose):
+        with self._lock:
+            row = self.data[self.count % self.capacity]
+            row['t'] = t; row['rtt'] = rtt
+            row['x'], row['y'], row['z'], row['r'] = pose[:4]
+            self.count += 1
+
+    @property
+    def dropped(self):
+        return max(0, self.count - self.capacity)
+
+    def since(self, t):
+        """時刻 t (perf_counter) 以降のサンプルのコピー (古い順。最近の分だけ見るので、バッファ全体は写さない)"""
+        with self._lock:
+            if self.count <= self.capacity: segments = (self.data[:self.count],)
+            else:
+                head = self.count % self.capacity
+                segments = (self.data[head:], self.data[:head])
+            return np.concatenate([segment[np.searchsorted(segment['t'], t):] for segment in segments])
+
+    def snapshot(self):
+        """古い順に並べたコピー"""
+        with self._lock:
+            if self.count <= self.capacity: return self.data[:self.count].copy()
+            head = self.count % self.capacity
+            return np.concatenate((self.data[head:], self.data[:head]))
+
+
+def pose_source(link):
+    """リンクから姿勢を読む関数を返す (AsyncDobotLink はイベントループに依頼する)"""
+    return getattr(link, 'pose_threadsafe', None) or link.pose
+
+
+class PoseTelemetryRecorder:
+    """
+    read_pose() を専用スレッドで回し続けて記録する。
+    read_pose は (x, y, z, r, ...) を返す関数 (pose_source(link) など)。
+    """
+    def __init__(self, read_pose, name, capacity=DEFAULT_CAPACITY, min_interval_s=0.0, metadata=None):
+        self.read_pose = read_pose
+        self.name = name
+        self.buffer = PoseRingBuffer(capacity)
+        self.min_interval_s = min_interval_s
+        self.metadata = dict(metadata or {})
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+        # perf_counter と time.time の対応 (プランや command_sent の時刻と合わせるため)
+        self.anchor_perf = None; self.anchor_wall = None
+        self.started_at = None; self.stopped_at = None
+
+    def start(self):
+        self.anchor_perf = time.perf_counter(); self.anchor_wall = time.time()
+        self.started_at = self.anchor_perf
+        self._thread = threading.Thread(target=self._run, name=f"PoseTelemetry-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            requested = time.perf_counter()
+            try:
+                pose = self.read_pose()
+            except Exception as e:
+                self.errors += 1
+                if self.errors in (1, 10, 100): print(f"[telemetry {self.name}] 姿勢の読み取りに失敗 ({self.errors}回目): {e}")
+                self._stop.wait(ERROR_BACKOFF_S); continue
+            received = time.perf_counter()
+            self.buffer.append((requested + received) / 2, received - requested, pose)
+            if self.min_interval_s:
+                remaining = self.min_interval_s - (time.perf_counter() - requested)
+                if remaining > 0: self._stop.wait(remaining)
+
+    def stop(self, timeout=1.0):
+        self._stop.set()
+        if self._thread is not None: self._thread.join(timeout)
+        self.stopped_at = time.perf_counter()
+
+    def to_wall(self, t):
+        """perf_counter の時刻を time.time() の時刻に直す"""
+        return np.asarray(t) - self.anchor_perf + self.anchor_wall
+
+    def arrival_time(self, since_wall, start_z, target_z, tolerance_mm=ARRIVAL_TOLERANCE_MM):
+        """
+        since_wall (time.time 基準) 以降に start_z → target_z の移動が目標の tolerance_mm 手前を横切った時刻 (time.time 基準)。
+        記録に無い・動きが小さすぎるときは None
+        """
+        if self.anchor_perf is None or abs(target_z - start_z) <= tolerance_mm: return None
+        direction = 1.0 if target_z > start_z else -1.0
+        samples = self.buffer.since(since_wall - self.anchor_wall + self.anchor_perf)
+        t = level_crossing(samples['t'], samples['z'], target_z - direction * tolerance_mm, direction)
+        return None if t is None else float(self.to_wall(t))
+
+    def summary(self):
+        samples = self.buffer.snapshot()
+        duration = (self.stopped_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        return {
+            'samples': int(self.buffer.count),
+            'dropped': int(self.buffer.dropped),
+            'errors': self.errors,
+            'rate_hz': self.buffer.count / duration if duration > 0 else 0.0,
+            'rtt_median_ms': float(np.median(samples['rtt']) * 1000) if len(samples) else None,
+        }
+
+    def save(self, directory=DEFAULT_OUTPUT_DIR, motion_plan=None, filename=None):
+        """samples / metadata (JSON 文字列) / motion_plan (任意) を .npz に書いてパスを返す"""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename or f"pose_{self.name}_{int(self.anchor_wall or time.time())}.npz")
+        metadata = dict(self.metadata, format_version=FORMAT_VERSION, name=self.name,
+                        anchor_perf=self.anchor_perf, anchor_wall=self.anchor_wall, **self.summary())
+        arrays = {'samples': self.buffer.snapshot(), 'metadata': np.array(json.dumps(metadata, ensure_ascii=False))}
+        if motion_plan is not None and getattr(motion_plan, 'dtype', None) is not None and motion_plan.dtype.names:
+            arrays['motion_plan'] = motion_plan
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f: np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        return path
+
+
+def load_telemetry(path):
+    """(samples, wall, metadata, motion_plan or None) を返す。wall は各サンプルの time.time 基準の時刻"""
+    with np.load(path, allow_pickle=False) as data:
+        samples = data['samples']; metadata = json.loads(str(data['metadata']))
+        motion_plan = data['motion_plan'] if 'motion_plan' in data.files else None
+    wall = samples['t'] - metadata['anchor_perf'] + metadata['anchor_wall']
+    return samples, wall, metadata, motion_plan
+
+
+def level_crossing(times, z, level, direction):
+    """z が level を direction (+1: 上昇, -1: 下降) 向きに最初に横切った時刻 (前後のサンプルを線形補間)。無ければ None"""
+    times = np.asarray(times, dtype=float); z = np.asarray(z, dtype=float)
+    reached = (z - level) * direction >= 0
+    crossings = np.flatnonzero(reached[1:] & ~reached[:-1])
+    if len(crossings) == 0: return None
+    i = crossings[0]
+    return float(times[i] + (times[i + 1] - times[i]) * (level - z[i]) / (z[i + 1] - z[i]))
+
+
+def find_strikes(times, z, strike_z, tolerance_mm=STRIKE_TOLERANCE_MM):
+    """
+    z の極小のうち strike_z ± tolerance_mm のものを打撃とみなし、放物線補間した時刻の配列を返す。
+    止まっている区間 (同じ z が続く) はその区間の始まりを打撃とする。
+    """
+    times = np.asarray(times, dtype=float); z = np.asarray(z, dtype=float)
+    if len(z) < 3: return np.empty(0)
+    dz = np.diff(z)
+    # 下降 → (横ばい) → 上昇 に変わる位置を探す
+    signs = np.sign(dz)
+    nonzero = np.flatnonzero(signs)
+    if len(nonzero) < 2: return np.empty(0)
+    turns = nonzero[1:][(signs[nonzero[:-1]] < 0) & (signs[nonzero[1:]] > 0)]
+    starts = nonzero[:-1][(signs[nonzero[:-1]] < 0) & (signs[nonzero[1:]] > 0)] + 1  # 最初に底に着いたサンプル
+    strikes = []
+    for bottom, turn in zip(starts, turns):
+        if abs(z[bottom] - strike_z) > tolerance_mm: continue
+        if bottom == turn and 0 < bottom < len(z) - 1:
+            # 鋭い極小: 前後 3 点の放物線の頂点
+            t0, t1, t2 = times[bottom - 1:bottom + 2]; z0, z1, z2 = z[bottom - 1:bottom + 2]
+            denom = (t0 - t1) * (t0 - t2) * (t1 - t2)
+            a = (t2 * (z1 - z0) + t1 * (z0 - z2) + t0 * (z2 - z1)) / denom if denom else 0.0
+            b = (t2 * t2 * (z0 - z1) + t1 * t1 * (z2 - z0) + t0 * t0 * (z1 - z2)) / denom if denom else 0.0
+            strikes.append(-b / (2 * a) if a > 0 else times[bottom])
+        else:
+            strikes.append(times[bottom])
+    return np.asarray(strikes)
+
+
+def planned_strike_times(motion_plan, master_start_time, loop_duration, until):
+    """プランの打撃予定時刻 (time.time 基準) を until まで並べる"""
+    import motion_plan_compiler
+    targets = motion_plan['target_time'][motion_plan['action'] == motion_plan_compiler.ACTION_STRIKE].astype(float)
+    if len(targets) == 0 or loop_duration <= 0: return np.empty(0)
+    loops = int(max(0, until - master_start_time) // loop_duration) + 1
+    return (master_start_time + np.arange(loops)[:, None] * loop_duration + targets[None, :]).ravel()
+
+
+def nearest_events(events, targets):
+    """targets の各時刻に最も近い events の時刻 (events は昇順)"""
+    events = np.asarray(events, dtype=float); targets = np.asarray(targets, dtype=float)
+    if len(events) == 1: return np.full(len(targets), events[0])
+    index = np.clip(np.searchsorted(events, targets), 1, len(events) - 1)
+    left, right = events[index - 1], events[index]
+    return np.where(np.abs(right - targets) < np.abs(left - targets), right, left)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="姿勢テレメトリ (.npz) から打撃を復元し、プランとのずれを表示する")
+    parser.add_argument('path')
+    parser.add_argument('--strike-z', type=float, default=None, help="打撃位置の z (省略時はメタデータ)")
+    args = parser.parse_args()
+
+    samples, wall, metadata, motion_plan = load_telemetry(args.path)
+    print(f"{metadata.get('name')}: {metadata['samples']}サンプル ({metadata['rate_hz']:.0f}Hz, 欠落 {metadata['dropped']}, "
+          f"読み取り失敗 {metadata['errors']}, 往復中央値 {metadata['rtt_median_ms'] or 0:.1f}ms)")
+    strike_z = args.strike_z if args.strike_z is not None else metadata.get('strike_z')
+    if strike_z is None: print("打撃位置 (--strike-z) が分からないため、打撃の復元は省略します。"); return
+    strikes = find_strikes(wall, samples['z'], strike_z)
+    print(f"復元した打撃: {len(strikes)}回")
+    if motion_plan is None or metadata.get('master_start_time') is None: return
+    if len(wall) == 0: return
+    planned = planned_strike_times(motion_plan, metadata['master_start_time'], metadata.get('loop_duration', 0), wall[-1])
+    planned = planned[(planned >= wall[0]) & (planned <= wall[-1])]  # リングバッファに残っている範囲だけ
+    if len(planned) == 0 or len(strikes) == 0: return
+    # 各予定に最も近い復元打撃を対応させる
+    errors_ms = (nearest_events(strikes, planned) - planned) * 1000
+    print(f"予定との誤差: 平均 {errors_ms.mean():+.1f}ms, 標準偏差 {errors_ms.std():.1f}ms, 最大 {np.abs(errors_ms).max():.1f}ms")
+    for i, (p, e) in enumerate(zip(planned, errors_ms)):
+        print(f"  {i + 1:3d}: {p - metadata['master_start_time']:8.3f}s  {e:+7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
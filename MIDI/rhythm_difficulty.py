@@ -0,0 +1,305 @@
+"""
+リズムの難易度評価 (rhythm_editor_module_v4.py の RhythmEditor から切り出し)
+
+UI に依存しないので、エディターと楽譜ライブラリ (score_library.py) で同じ採点を使える。
+track は楽譜 JSON の 1 トラック分 (bpm / numerator / denominator / items)。dict でも score_compiler.CompiledTrack でもよい。
+  measure_difficulty(track, items) : 1 小節分の items (拍は小節の頭から) の難易度。1.0〜10.0、空なら 0.0
+  track_difficulty(track)          : 小節ごとの難易度の平均 (エディターの「2小節の平均」)
+  rhythm_profile(track)            : 1 小節目の 16 分音符ごとの状態 ('S' 打撃 / 'H' 伸ばし / '-' なし)
+  combined_difficulty(top, bottom) : 2 トラックの総合難易度 (拍子の違い・左右の重なり方で補正)
+  score_difficulty(score)          : {'top': ..., 'bottom': ..., 'combined': ...} (1 トラックなら bottom / combined は None)
+  score_files(paths, jobs)         : 楽譜ファイルをまとめて採点 ({パス: score_difficulty の結果})
+
+採点は items の dict を直接見ずに、小節ごとに MeasureCode (音符・休符の (種類, 拍, 長さ) の並びと、
+16 分音符スロットの打撃 / 伸ばしのビットマスク) に直してから行う。
+  - 1 小節の採点は MeasureCode.key (BPM・拍子・並び) でメモ化する。ループ楽譜は 2 小節目が 1 小節目と同じことが多く、
+    エディターの AI 生成は同じ小節を何度も採点し直すので、2 回目からは表を引くだけになる
+  - 左右の重なり方はスロットごとのループではなく、ビットマスクの AND と popcount で状態の組み合わせごとに数える
+  - すべて純粋な関数なので、score_files はファイル数が多ければプロセスを分けて並列に採点する
+
+    python rhythm_difficulty.py ../music --jobs 4
+"""
+import os
+import json
+import glob
+import argparse
+import functools
+import concurrent.futures
+from collections import Counter
+
+# --- 設定 ---
+NUM_MEASURES = 2
+SLOT_BEATS = 0.25            # 16 分音符
+W1_REST, W2_OFF_BEAT = 0.15, 1.5
+DIFFICULTY_VALUES = {
+    2.0: 2, 3.0: 2, 4.0: 2, 6.0: 2,
+    1.0: 4, 1.5: 5, 0.5: 6, 0.75: 6,
+    0.25: 8, 0.375: 8,
+}
+UNKNOWN_DURATION_VALUE = 9   # 表に無い長さ
+POLYMETER_PENALTY = 2.5
+# 左右の 16 分音符スロットの組み合わせの点数 (高いほど叩きやすい)
+INTERACTION_SCORES = {
+    ('S', 'S'): 2,                                 # 両方打撃 -> 最も簡単
+    ('S', 'H'): 0, ('H', 'S'): 0,                  # 抑えながら叩く
+    ('S', '-'): -2, ('-', 'S'): -2,                # ポリリズム
+    ('H', '-'): -1, ('-', 'H'): -1,                # 抑えながら休む
+}
+SAME_STATE_SCORE = 1         # 両方同じ状態 (H-H or ---) -> 安定
+MEMO_SIZE = 4096             # 小節の採点を覚えておく数
+PARALLEL_MIN_FILES = 32      # score_files で jobs を省略したとき、この数以上ならプロセスを分ける
+
+
+def beats_per_measure(track):
+    return (track.get('numerator', 4) / track.get('denominator', 4)) * 4.0
+
+
+def _popcount(mask):
+    return bin(mask).count('1')
+
+
+class MeasureCode:
+    """
+    1 小節分の符号。key = (bpm, numerator, denominator, ((種類, 拍, 長さ), ...)) (並びは items の順、拍は小節の頭から)。
+    strikes / holds: 16 分音符スロットの打撃 / 伸ばしのビットマスク (スロット i がビット i。重なり方を見るときだけ作る)、
+    num_slots: 小節のスロット数
+    """
+    __slots__ = ('key', 'num_slots', '_masks')
+
+    def __init__(self, key, num_slots):
+        self.key, self.num_slots, self._masks = key, num_slots, None
+
+    def _slot_masks(self):
+        if self._masks is None:
+            strikes = holds = 0
+            for cls, beat, duration in self.key[3]:
+                if cls != 'note': continue
+                start_slot = int(beat / SLOT_BEATS)
+                if not 0 <= start_slot < self.num_slots: continue
+                # 後の音符が前の音符の状態を上書きする (打撃と伸ばしは重ならない)
+                bit = 1 << start_slot
+                strikes |= bit; holds &= ~bit
+                end_slot = min(start_slot + int(duration / SLOT_BEATS), self.num_slots)
+                if end_slot > start_slot + 1:
+                    hold_bits = ((1 << end_slot) - 1) & ~((1 << (start_slot + 1)) - 1)
+                    holds |= hold_bits; strikes &= ~hold_bits
+            self._masks = (strikes, holds)
+        return self._masks
+
+    @property
+    def strikes(self): return self._slot_masks()[0]
+
+    @property
+    def holds(self): return self._slot_masks()[1]
+
+    @property
+    def rests(self):
+        """どちらでもないスロットのビットマスク"""
+        strikes, holds = self._slot_masks()
+        return ((1 << self.num_slots) - 1) & ~(strikes | holds)
+
+    def states(self):
+        strikes, holds = self._slot_masks()
+        return {'S': strikes, 'H': holds, '-': ((1 << self.num_slots) - 1) & ~(strikes | holds)}
+
+    def difficulty(self):
+        return _measure_score(self.key)
+
+
+def _measure_key(track, entries):
+    return (track.get('bpm', 120), track.get('numerator', 4), track.get('denominator', 4), tuple(entries))
+
+
+def encode_measure(track, items):
+    """items のうち 1 小節分 (拍が小節の長さ未満のもの。拍は小節の頭から) を MeasureCode にする"""
+    measure_length = beats_per_measure(track)
+    entries = [(item.get('class'), item['beat'], item.get('duration')) for item in items if item['beat'] < measure_length]
+    return MeasureCode(_measure_key(track, entries), max(int(measure_length / SLOT_BEATS), 0))
+
+
+def measure_codes(track, num_measures=NUM_MEASURES):
+    """小節ごとの MeasureCode のリスト (拍は小節の頭からにずらす)。範囲内に items が 1 つも無ければ None"""
+    measure_length = beats_per_measure(track)
+    if measure_length == 0: return None
+    measures = [[] for _ in range(num_measures)]; found = False
+    for item in track.get('items', []):
+        beat = item['beat']
+        index = int(beat // measure_length)
+        if 0 <= index < num_measures:
+            found = True
+            beat -= index * measure_length
+            if beat < measure_length: measures[index].append((item.get('class'), beat, item.get('duration')))
+    if not found: return None
+    num_slots = max(int(measure_length / SLOT_BEATS), 0)
+    return [MeasureCode(_measure_key(track, entries), num_slots) for entries in measures]
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def _measure_score(key):
+    bpm, _numerator, denominator, entries = key
+    if not entries: return 0.0
+
+    notes = [(beat, duration) for cls, beat, duration in entries if cls == 'note']
+    if not notes: return 1.0
+
+    duration_counts = Counter(duration for _, duration in notes)
+    most_common = duration_counts.most_common(1)[0]
+    L_list = [d for d, c in duration_counts.items() if c == most_common[1]]
+
+    Dp = sum(DIFFICULTY_VALUES.get(d, UNKNOWN_DURATION_VALUE) for d in L_list) / len(L_list)
+    N = sum(c for d, c in duration_counts.items() if d not in L_list)
+
+    D1 = Dp
+    if N > 0:
+        Amax, Smax = (10 - Dp) / N, (Dp - 1) / N
+        A, S = 0.0, 0.0
+        for dur, count in duration_counts.items():
+            if dur in L_list: continue
+            Dc_curr = DIFFICULTY_VALUES.get(dur, UNKNOWN_DURATION_VALUE)
+            if Dc_curr > Dp: A += ((Dc_curr - Dp) / Dp) * Amax * count
+            else: S += ((Dp - Dc_curr) / Dp) * Smax * count
+        D1 += (A - S)
+
+    # 一番短い休符が音符と接していれば、その長さに応じて加点
+    rest_penalty = 0.0
+    rests = sorted([(beat, duration) for cls, beat, duration in entries if cls == 'rest'], key=lambda x: x[1])
+    if rests:
+        rest_beat, rest_duration = rests[0]
+        is_adjacent = any(
+            abs(beat - (rest_beat + rest_duration)) < 0.01 or abs((beat + duration) - rest_beat) < 0.01
+            for beat, duration in notes
+        )
+        if is_adjacent:
+            rest_penalty = W1_REST * DIFFICULTY_VALUES.get(rest_duration, UNKNOWN_DURATION_VALUE)
+
+    # 裏拍の打撃 (直前の音符とあわせて 1 拍になるものは除く) があれば加点
+    off_beat_penalty = 0.0
+    beat_unit = 4.0 / denominator
+    sorted_notes = sorted(notes, key=lambda x: x[0])
+    for i, (beat, duration) in enumerate(sorted_notes):
+        if beat % beat_unit > 0.01:
+            if i > 0:
+                prev_beat, prev_duration = sorted_notes[i - 1]
+                if abs(prev_beat + prev_duration - beat) < 0.01:
+                    if abs((duration + prev_duration) - beat_unit) < 0.01:
+                        continue
+            off_beat_penalty = W2_OFF_BEAT
+            break
+
+    base_score = D1 + rest_penalty + off_beat_penalty
+    bpm_modifier = 1.0 + (bpm - 120) * 0.005
+    return max(1.0, min(10.0, base_score * bpm_modifier))
+
+
+def measure_difficulty(track, items):
+    """1 小節分の items の難易度 (小節の外の items は無視する)"""
+    return encode_measure(track, items).difficulty()
+
+
+def track_difficulty(track, num_measures=NUM_MEASURES):
+    """小節ごとに (拍を小節の頭からにずらして) 採点した平均。items が無ければ 0.0"""
+    codes = measure_codes(track, num_measures)
+    if codes is None: return 0.0
+    return sum(code.difficulty() for code in codes) / num_measures
+
+
+def rhythm_profile(track):
+    """1 小節目のリズム状態を 16 分音符単位のリストで返す"""
+    code = encode_measure(track, track.get('items', []))
+    return ['S' if code.strikes >> i & 1 else 'H' if code.holds >> i & 1 else '-' for i in range(code.num_slots)]
+
+
+def interaction_modifier(code_top, code_bottom):
+    """1 小節目どうしの重なり方の補正値 (-2.0 簡単 〜 +2.5 難しい)。小節の長さが違えば 0.0"""
+    if code_top.num_slots != code_bottom.num_slots or code_top.num_slots == 0: return 0.0
+    top, bottom = code_top.states(), code_bottom.states()
+    interaction_score = 0.0
+    for (state_top, state_bottom), points in INTERACTION_SCORES.items():
+        if points: interaction_score += points * _popcount(top[state_top] & bottom[state_bottom])
+    interaction_score += SAME_STATE_SCORE * (_popcount(top['H'] & bottom['H']) + _popcount(top['-'] & bottom['-']))
+    normalized_score = interaction_score / (code_top.num_slots * 2.0)
+    return (1.0 - normalized_score) * 2.25 - 2.0
+
+
+def combined_difficulty(top, bottom, d_top=None, d_bottom=None, num_measures=NUM_MEASURES):
+    """2 トラックの総合難易度 (1.0〜10.0)。d_top / d_bottom は計算済みならそれを使う"""
+    if d_top is None: d_top = track_difficulty(top, num_measures)
+    if d_bottom is None: d_bottom = track_difficulty(bottom, num_measures)
+    base_difficulty = (d_top + d_bottom) / 2.0
+
+    polymeter_penalty = 0.0
+    if top.get('numerator') != bottom.get('numerator') or top.get('denominator') != bottom.get('denominator'):
+        polymeter_penalty = POLYMETER_PENALTY
+
+    # 左右の重なり方 (拍子が違って小節の長さが違う場合は比較しない)
+    modifier = interaction_modifier(encode_measure(top, top.get('items', [])), encode_measure(bottom, bottom.get('items', [])))
+    return max(1.0, min(10.0, base_difficulty + modifier + polymeter_penalty))
+
+
+def score_difficulty(score, num_measures=None):
+    """楽譜全体の難易度。num_measures を省略すると楽譜の "num_measures" (無ければ NUM_MEASURES)"""
+    if num_measures is None: num_measures = int(score.get('num_measures', NUM_MEASURES))
+    result = {'top': None, 'bottom': None, 'combined': None}
+    for name in ('top', 'bottom'):
+        if name in score: result[name] = track_difficulty(score[name], num_measures)
+    if result['top'] is not None and result['bottom'] is not None:
+        result['combined'] = combined_difficulty(score['top'], score['bottom'], result['top'], result['bottom'], num_measures)
+    return result
+
+
+def memo_info():
+    """小節の採点のメモの使われ方 (functools の CacheInfo: hits / misses / currsize)"""
+    return _measure_score.cache_info()
+
+
+# --- まとめて採点 ---
+
+def run_batch(func, args, jobs=None):
+    """
+    func を args の各要素に適用した結果のリスト (args の順)。jobs を省略すると件数が PARALLEL_MIN_FILES 以上のときだけ
+    CPU 数のプロセスに分ける (jobs=1 なら常にこのプロセスで、メモを共有する)。func はモジュールの関数 (pickle できるもの)
+    """
+    args = list(args)
+    if not args: return []
+    workers = min(jobs or os.cpu_count() or 1, len(args))
+    if workers > 1 and (jobs or len(args) >= PARALLEL_MIN_FILES):
+        # 連続した楽譜をまとめて渡し、ワーカーの中でもメモが効くようにする
+        chunksize = max(1, len(args) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool: return list(pool.map(func, args, chunksize=chunksize))
+    return [func(arg) for arg in args]
+
+
+def score_file(path):
+    """1 ファイルを採点して (path, 結果, エラー) を返す (ワーカーからも呼ぶ)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return path, score_difficulty(json.load(f)), None
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+        return path, None, str(e)
+
+
+def score_files(paths, jobs=None, on_log=print):
+    """楽譜ファイルをまとめて採点して {パス: score_difficulty の結果} を返す (読めなかったファイルは None)"""
+    results = {}
+    for path, result, error in run_batch(score_file, paths, jobs):
+        if error: on_log(f"⚠️ {os.path.basename(path)}: 採点できません ({error})")
+        results[path] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="楽譜ファイル (またはフォルダ内の全楽譜) の難易度をまとめて計算する")
+    parser.add_argument('inputs', nargs='+', help="楽譜ファイルかフォルダ")
+    parser.add_argument('--jobs', type=int, default=None, help="並列数 (省略時はファイル数が多ければ CPU 数)")
+    args = parser.parse_args()
+    paths = []
+    for target in args.inputs:
+        paths.extend(sorted(glob.glob(os.path.join(target, '*.json'))) if os.path.isdir(target) else [target])
+
+    def fmt(value): return f"{value:5.2f}" if value is not None else "    -"
+    for path, result in score_files(paths, args.jobs).items():
+        if result is None: continue
+        print(f"{os.path.splitext(os.path.basename(path))[0]:<24} 上段 {fmt(result['top'])}  下段 {fmt(result['bottom'])}  総合 {fmt(result['combined'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,13 @@ import openai
 import os
 import json
 import pygame
-from collections import Counter
+import rhythm_difficulty  # ★ 難易度評価 (UI 非依存、楽譜ライブラリと共用)
+import score_library  # ★ 楽譜フォルダの索引 (フォルダの監視で一覧を更新)
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                                QPushButton, QListWidget, QMenuBar, QFileDialog, QMessageBox,
-                               QLabel, QSpinBox, QRadioButton, QGridLayout, QButtonGroup, QComboBox, QCheckBox, QGroupBox, QScrollArea)
+                               QLabel, QSpinBox, QRadioButton, QGridLayout, QButtonGroup, QComboBox, QCheckBox, QGroupBox, QScrollArea, QListWidgetItem)
 from PySide6.QtGui import (QPainter, QColor, QPen, QAction, QFont, QPixmap, QIcon, QLinearGradient, QCursor)
-from PySide6.QtCore import Qt, QTimer, QRectF, QPointF, QSize
+from PySide6.QtCore import Qt, QTimer, QRectF, QPointF, QSize, QFileSystemWatcher
 from PySide6.QtCore import QThread, Signal, Slot 
 from PySide6.QtWidgets import QDoubleSpinBox 
 
@@ -705,6 +706,7 @@ class MainWindow(QMainWindow):
         # --- ▼▼▼ 修正点 1 (変数名を score_directory に変更) ▼▼▼ ---
         self.score_directory = r"C:\卒研\music"
         # --- ▲▲▲ 修正点 1 ▲▲▲ ---
+        self.score_library = score_library.get_library(self.score_directory)  # ★ 楽譜フォルダの索引
 
         self.generation_worker = None
         self.ai_conversation_history = []
@@ -738,6 +740,8 @@ class MainWindow(QMainWindow):
         self.item_images = self._load_item_images()
         self.setup_ui()
         self.refresh_file_list()
+        # ★ 他のウィンドウやエクスプローラーでの追加・削除も一覧に反映する
+        self.score_watcher = score_library.watch(QFileSystemWatcher(self), self.score_library, self.refresh_file_list)
 
     def _backup_track_data(self, track_name):
         """指定されたトラックの現在の状態をバックアップする"""
@@ -1305,11 +1309,19 @@ class MainWindow(QMainWindow):
                 print(f"警告: 楽譜ディレクトリ '{score_dir}' が見つかりません。")
                 os.makedirs(score_dir) # 存在しない場合は作成する
                 print(f"'{score_dir}' を作成しました。")
-            
-            for f in sorted(os.listdir(score_dir)):
-                if f.endswith(".json"): self.file_list_widget.addItem(f)
-        except FileNotFoundError: 
-            print(f"楽譜ディレクトリ '{score_dir}' が見つかりません。")
+        except OSError as e:
+            print(f"楽譜ディレクトリ '{score_dir}' を作成できません: {e}")
+            return
+        # ★ 一覧は楽譜索引から (変わったファイルだけ読み直す)。BPM・難易度はツールチップに
+        self.score_library.refresh()
+        for entry in self.score_library.query('name'):
+            item = QListWidgetItem(entry['filename'])
+            if 'error' in entry:
+                item.setToolTip(f"読み込めません: {entry['error']}")
+            else:
+                difficulty = f"{entry['difficulty']:.2f}" if entry.get('difficulty') is not None else "-"
+                item.setToolTip(f"BPM {entry['bpm']} ・ {entry['time_signature']} ・ {entry['num_measures']}小節 ・ 難易度 {difficulty}")
+            self.file_list_widget.addItem(item)
     # --- ▲▲▲ 修正点 2 ▲▲▲ ---
 
     def new_score(self, ask_confirm=True):
@@ -1413,60 +1425,14 @@ class MainWindow(QMainWindow):
                 
 
     def _get_2_measure_average_score(self, track_name):
-        """
-        指定されたトラックの2小節分の平均難易度スコアを計算します。
-        (内部で _calculate_single_track_difficulty を2回呼び出します)
-        """
+        """指定されたトラックの2小節分の平均難易度スコア (rhythm_difficulty.track_difficulty)"""
         if track_name not in self.rhythm_widget.score:
             return 0.0
-            
-        track_data = self.rhythm_widget.score[track_name]
-        
-        beats_per_measure = track_data.get('beats_per_measure', 4.0)
-        if beats_per_measure == 0:
-            return 0.0 # ゼロ除算を回避
-
-        all_items = track_data.get('items', [])
-        
-        # 1. 1小節目と2小節目のアイテムに分割
-        items_m1 = [item for item in all_items if item['beat'] < beats_per_measure]
-        items_m2_original = [item for item in all_items if item['beat'] >= beats_per_measure]
-        
-        # 2. 2小節目のアイテムの 'beat' を 0 始まりにシフトする
-        items_m2_shifted = []
-        for item in items_m2_original:
-            shifted_item = item.copy()
-            shifted_item['beat'] -= beats_per_measure
-            items_m2_shifted.append(shifted_item)
-
-        # 3. 採点
-        # _calculate_single_track_difficulty が参照できるように、
-        # track_data の items を一時的に書き換える
-        
-        original_items = track_data['items'] # バックアップ
-        
-        try:
-            # 4. 1小節目を採点
-            track_data['items'] = items_m1
-            score_m1 = self._calculate_single_track_difficulty(track_name)
-
-            # 5. 2小節目を採点
-            track_data['items'] = items_m2_shifted
-            score_m2 = self._calculate_single_track_difficulty(track_name) if items_m2_shifted else 0.0
-        
-        finally:
-            # 6. 必ず元のアイテムリストに戻す
-            track_data['items'] = original_items
-
-        # 7. 平均スコアを計算 (2小節とも空の場合は 0.0)
-        average_score = (score_m1 + score_m2) / 2.0 if (items_m1 or items_m2_shifted) else 0.0
-        
-        return average_score
+        return rhythm_difficulty.track_difficulty(self.rhythm_widget.score[track_name], NUM_MEASURES)
                 
-    # ### ▼▼▼ 変更・追加箇所 ▼▼▼ (難易度評価ロジックを全面的に更新)
+    # ### ▼▼▼ 変更・追加箇所 ▼▼▼ (難易度評価ロジックは rhythm_difficulty.py)
     
     def evaluate_all_difficulties(self):
-        # --- ▼▼▼ 変更 ▼▼▼ ---
         # 1小節だけではなく、2小節の平均点を計算する
         d_top = self._get_2_measure_average_score('top')
         self.top_difficulty_label.setText(f"上段(L)難易度: {d_top:.2f}")
@@ -1474,158 +1440,14 @@ class MainWindow(QMainWindow):
         if self.mode_2_track_rb.isChecked():
             d_bottom = self._get_2_measure_average_score('bottom')
             self.bottom_difficulty_label.setText(f"下段(R)難易度: {d_bottom:.2f}")
-            # --- ▲▲▲ 変更 ▲▲▲ ---
-
-            track_top = self.rhythm_widget.score['top']
-            track_bottom = self.rhythm_widget.score['bottom']
-            
-            base_difficulty = (d_top + d_bottom) / 2.0
-            
-            polymeter_penalty = 0.0
-            if (track_top.get('numerator') != track_bottom.get('numerator') or
-                track_top.get('denominator') != track_bottom.get('denominator')):
-                polymeter_penalty = 2.5
-            
-            # --- 新しい総合難易度ロジック ---
-            interaction_modifier = 0.0
-            profile_top = self._get_rhythm_profile('top')
-            profile_bottom = self._get_rhythm_profile('bottom')
-
-            # 拍子が異なり、小節の長さが違う場合は比較しない
-            if len(profile_top) == len(profile_bottom) and profile_top:
-                interaction_score = 0.0
-                for i in range(len(profile_top)):
-                    slot_top = profile_top[i]
-                    slot_bottom = profile_bottom[i]
-
-                    # 両方S(tart) -> 最も簡単
-                    if slot_top == 'S' and slot_bottom == 'S':
-                        interaction_score += 2
-                    # 両方同じ状態 (H-H or ---) -> 安定
-                    elif slot_top == slot_bottom:
-                        interaction_score += 1
-                    # SとH -> 抑えながら叩く
-                    elif (slot_top == 'S' and slot_bottom == 'H') or (slot_top == 'H' and slot_bottom == 'S'):
-                        interaction_score += 0
-                    # Sと- -> ポリリズム
-                    elif (slot_top == 'S' and slot_bottom == '-') or (slot_top == '-' and slot_bottom == 'S'):
-                        interaction_score -= 2
-                    # Hと- -> 抑えながら休む
-                    elif (slot_top == 'H' and slot_bottom == '-') or (slot_top == '-' and slot_bottom == 'H'):
-                        interaction_score -= 1
-                
-                max_score = len(profile_top) * 2.0
-                normalized_score = interaction_score / max_score if max_score > 0 else 0
-                # -2.0 (簡単) から +2.5 (難しい) の補正値に変換
-                interaction_modifier = (1.0 - normalized_score) * 2.25 - 2.0
 
-            combined_difficulty = base_difficulty + interaction_modifier + polymeter_penalty
-            final_score = max(1.0, min(10.0, combined_difficulty))
+            final_score = rhythm_difficulty.combined_difficulty(
+                self.rhythm_widget.score['top'], self.rhythm_widget.score['bottom'], d_top, d_bottom, NUM_MEASURES)
             self.combined_difficulty_label.setText(f"総合難易度: {final_score:.2f}")
         else:
             self.bottom_difficulty_label.setText("下段(R)難易度: -")
             self.combined_difficulty_label.setText("総合難易度: -")
 
-    def _get_rhythm_profile(self, track_name):
-        """小節のリズム状態を16分音符単位の文字列で返すヘルパー関数"""
-        track_data = self.rhythm_widget.score[track_name]
-        beats_per_measure = track_data.get('beats_per_measure', 4.0)
-        
-        # 16分音符を基準としたスロット数を計算
-        num_slots = int(beats_per_measure / 0.25)
-        if num_slots == 0: return []
-
-        profile = ['-'] * num_slots
-        
-        measure_items = [item for item in track_data.get('items', []) if item['beat'] < beats_per_measure]
-        
-        for item in measure_items:
-            start_slot = int(item['beat'] / 0.25)
-            duration_slots = int(item['duration'] / 0.25)
-            
-            if start_slot < num_slots and item['class'] == 'note':
-                profile[start_slot] = 'S' # Start
-                for i in range(1, duration_slots):
-                    if start_slot + i < num_slots:
-                        profile[start_slot + i] = 'H' # Hold
-        return profile
-
-    def _calculate_single_track_difficulty(self, track_name):
-        track_data = self.rhythm_widget.score[track_name]
-        beats_per_measure = track_data.get('beats_per_measure', 4.0)
-        measure_items = [item for item in track_data.get('items', []) if item['beat'] < beats_per_measure]
-        bpm = track_data.get('bpm', 120)
-
-        if not measure_items: return 0.0
-            
-        W1_REST, W2_OFF_BEAT = 0.15, 1.5
-        DIFFICULTY_VALUES = {
-            2.0: 2, 3.0: 2, 4.0: 2, 6.0: 2,
-            1.0: 4, 1.5: 5, 0.5: 6, 0.75: 6,
-            0.25: 8, 0.375: 8,
-        }
-        
-        notes = [item for item in measure_items if item['class'] == 'note']
-        if not notes: return 1.0
-            
-        note_durations = [n['duration'] for n in notes]
-        duration_counts = Counter(note_durations)
-        
-        most_common = duration_counts.most_common(1)[0]
-        L_list = [d for d, c in duration_counts.items() if c == most_common[1]]
-        
-        Dp = sum(DIFFICULTY_VALUES.get(d, 9) for d in L_list) / len(L_list)
-        N = sum(c for d, c in duration_counts.items() if d not in L_list)
-        
-        D1 = Dp
-        if N > 0:
-            Amax, Smax = (10 - Dp) / N, (Dp - 1) / N
-            A, S = 0.0, 0.0
-            for dur, count in duration_counts.items():
-                if dur in L_list: continue
-                Dc_curr = DIFFICULTY_VALUES.get(dur, 9)
-                if Dc_curr > Dp: A += ((Dc_curr - Dp) / Dp) * Amax * count
-                else: S += ((Dp - Dc_curr) / Dp) * Smax * count
-            D1 += (A - S)
-
-        rest_penalty = 0.0
-        rests = sorted([i for i in measure_items if i['class'] == 'rest'], key=lambda x: x['duration'])
-        if rests:
-            shortest_rest = rests[0]
-            is_adjacent = any(
-                abs(n['beat'] - (shortest_rest['beat'] + shortest_rest['duration'])) < 0.01 or \
-                abs((n['beat'] + n['duration']) - shortest_rest['beat']) < 0.01
-                for n in notes
-            )
-            if is_adjacent:
-                rest_Dc = DIFFICULTY_VALUES.get(shortest_rest['duration'], 9)
-                rest_penalty = W1_REST * rest_Dc
-        
-        off_beat_penalty = 0.0
-        beat_unit = 4.0 / track_data.get('denominator', 4)
-        has_off_beat = False
-        sorted_notes = sorted(notes, key=lambda x: x['beat'])
-
-        for i, note in enumerate(sorted_notes):
-            if note['beat'] % beat_unit > 0.01:
-                if i > 0:
-                    prev_note = sorted_notes[i-1]
-                    if abs(prev_note['beat'] + prev_note['duration'] - note['beat']) < 0.01:
-                       if abs((note['duration'] + prev_note['duration']) - beat_unit) < 0.01:
-                           continue 
-                has_off_beat = True
-                break
-        
-        if has_off_beat:
-            off_beat_penalty = W2_OFF_BEAT
-            
-        base_score = D1 + rest_penalty + off_beat_penalty
-        
-        bpm_modifier = 1.0 + (bpm - 120) * 0.005
-        
-        final_score = base_score * bpm_modifier
-        return max(1.0, min(10.0, final_score))
-
     def closeEvent(self, event):
         """ウィンドウを閉じる際のイベント"""
         if self.generation_worker and self.generation_worker.isRunning():
@@ -5,8 +5,7 @@ import time
 import copy
 import threading
 import signal
-import importlib
-import inspect
+import controller_registry  # ★ コントローラーはマニフェスト経由で遅延読み込み
 import io
 import wave
 import datetime  # ★ タイムスタンプ用にインポート
@@ -76,27 +75,8 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 def load_controllers():
-    controllers = {}
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    controller_dir = os.path.join(script_dir, "controllers")
-    if not os.path.exists(controller_dir): return {}
-    if controller_dir not in sys.path: sys.path.insert(0, controller_dir)
-    if script_dir not in sys.path: sys.path.insert(0, script_dir)
-    try:
-        from controllers.base_controller import BaseEntrainmentController
-        for filename in os.listdir(controller_dir):
-            if filename.endswith(".py") and filename not in ["base_controller.py", "__init__.py"]:
-                module_name = f"controllers.{filename[:-3]}"
-                try:
-                    module = importlib.import_module(module_name)
-                    for name, obj in inspect.getmembers(module, inspect.isclass):
-                        if issubclass(obj, BaseEntrainmentController) and obj is not BaseEntrainmentController:
-                            try:
-                                instance = obj(None, 0); controllers[instance.name] = obj
-                            except Exception as e: print(f"エラー: コントローラー {name} のインスタンス化に失敗: {e}")
-                except ImportError as e: print(f"エラー: コントローラーモジュール {module_name} のインポートに失敗: {e}")
-    except ImportError as e: print(f"エラー: BaseEntrainmentControllerをインポートできませんでした。詳細: {e}")
-    return controllers
+    """controllers/ のコントローラーを {表示名: 遅延ロードエントリ} で返す"""
+    return controller_registry.load_controllers()
 
 class ModernButton(QPushButton):
     def __init__(self, text, button_type="primary", parent=None):
@@ -2,8 +2,17 @@ import time
 import threading
 import math
 import os
-from PyQt6.QtCore import QObject, pyqtSignal, QThread
-import threading
+from collections import deque
+from PyQt6.QtCore import QObject, pyqtSignal
+import json
+import motion_plan_compiler
+import dobot_lookahead
+import dobot_link
+import robot_orchestrator
+import pose_telemetry
+import robot_timing_log
+import strike_latency_analyzer
+import calibration_runner
 
 # --- 必須ライブラリのインポート ---
 try:
@@ -12,37 +21,103 @@ try:
 except ImportError:
     PYDOBOT_AVAILABLE = False
 
-try:
-    import pandas as pd
-    import numpy as np
-    from scipy.spatial import cKDTree
-    PANDAS_SCIPY_AVAILABLE = True
-except ImportError:
-    PANDAS_SCIPY_AVAILABLE = False
-
 # --- ロボット設定 ---
 ROBOT1_CONFIG = { "port": "COM3", "ready_pos": (230, 0, 60, 0), "strike_pos": (226, 0.3, 41, 0) }
 ROBOT2_CONFIG = { "port": "COM4", "ready_pos": (230, 0, 60, 0), "strike_pos": (226, 0.3, 41, 0) }
-FIXED_VELOCITY = 1000.0      # ユーザー指定の固定速度
-FIXED_ACCELERATION = 1000.0  # ユーザー指定の固定加速度
+
+# --- アーム構成 ---
+# 各アームの接続先と担当トラック ("track" は楽譜 JSON のキー)。ROBOT_ARMS_PATH があればそちらを使う。
+# 楽譜 JSON に "robot_routing": {"アーム名": "トラック名"} があれば、その演奏だけ担当を差し替える。
+# 例 (robot_arms.json):
+#   [{"name": "arm1", "port": "COM3", "track": "top", "ready_pos": [230, 0, 60, 0], "strike_pos": [226, 0.3, 41, 0]},
+#    {"name": "kick", "port": "COM5", "track": "kick", "ready_pos": [...], "strike_pos": [...], "execution_mode": "lookahead"}]
+ROBOT_ARMS = [
+    dict(ROBOT1_CONFIG, name="arm1", track="top"),
+    dict(ROBOT2_CONFIG, name="arm2", track="bottom"),
+]
+ROBOT_ARMS_PATH = 'robot_arms.json'
+
+def load_arm_configs(path=ROBOT_ARMS_PATH):
+    """アーム構成を読み込む (ファイルが無い・壊れている場合は ROBOT_ARMS)"""
+    if not os.path.exists(path): return [dict(arm) for arm in ROBOT_ARMS]
+    try:
+        with open(path, 'r', encoding='utf-8') as f: arms = json.load(f)
+        for i, arm in enumerate(arms):
+            arm.setdefault("name", f"arm{i + 1}")
+            for key in ("ready_pos", "strike_pos"): arm[key] = tuple(arm[key])
+            if "port" not in arm or "track" not in arm: raise ValueError(f"{arm['name']}: port と track は必須です")
+        return arms
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"アーム構成 '{path}' の読み込みに失敗したため、既定の構成を使います: {e}")
+        return [dict(arm) for arm in ROBOT_ARMS]
 
 # --- 動作パラメータ ---
 COMMUNICATION_LATENCY_S = 0.05
 TUNING_DATA_CSV_PATH = 'tuning_data.csv'
 
 # 一打目の遅延を強制的に補正する値 (秒)
+# ★ ウォームアップで送信の遅れを測れたアームでは使わない (測れなかったときの予備)
 FIRST_HIT_COMPENSATION_S = 0.4
 
-# --- 表現力パラメータ ---
-MAX_EXPECTED_INTERVAL_S = 2.0
-MIN_EXPECTED_INTERVAL_S = 0.1
-MIN_VELOCITY = 100.0
-MAX_VELOCITY = 400.0
-MIN_ACCELERATION = 100.0
-MAX_ACCELERATION = 800.0
-MAX_BACKSWING_HEIGHT = ROBOT1_CONFIG["ready_pos"][2]
+# ★ 音のタイミング微調整用 (秒)
+# まだ音が早い場合は、この数字を 0.1, 0.15 と大きくしてください
+SOUND_DELAY_ADJUST_S = 0.32
+
+# --- 実行モード ---
+# "just_in_time": 打撃の直前に speed + move_to を送る (従来)
+# "lookahead"   : dobot_lookahead.py で LOOKAHEAD_HORIZON_S 先までロボットのキューに積み、WAIT で時刻を刻む
+# ロボットごとに config の "execution_mode" で上書きできる
+EXECUTION_MODE = "just_in_time"
+LOOKAHEAD_HORIZON_S = 1.5
+
+# --- コマンド送信経路 ---
+# "pydobot"  : 従来どおり device.speed + device.move_to (既定)
+# "coalesced": dobot_link.py 経由 (同じ速度の再送を省き、速度 + PTP を 1 回の write で送る)
+# ロボットごとに config の "command_link" で切り替える。
+# FIRST_HIT_COMPENSATION_S と SOUND_DELAY_ADJUST_S は pydobot の送信の遅れ込みで合わせた値なので、coalesced では
+# calibration_runner.py --command-overhead で測った差 (CALIBRATION_PROFILE_PATH のポートの最新値) だけ差し引く。
+# 未測定のポートでは差し引かない
+COMMAND_LINK = "pydobot"
+CALIBRATION_PROFILE_PATH = calibration_runner.PROFILE_PATH
+
+# --- ウォームアップ (カウントダウン中の予備動作、robot_orchestrator.py) ---
+# 待機位置から少しだけ上げ下げして、往復時間と送信の遅れ (到着 - 送信 - モデルの移動時間) をアームごとに測り、
+# 一打目からその値で送信時刻を決める。アームごとに config の "warmup": False で無効にできる (先読みモードのアームはしない)。
+# pydobot 経由のアームも予備動作は speed + move_to で送り、姿勢だけ dobot_link で直接読む
+WARMUP_ENABLED = True
+WARMUP_BUDGET_S = 1.2          # 予備動作に使う時間 (get_first_move_preparation_time に上乗せする、coalesced)
+WARMUP_BUDGET_PYDOBOT_S = 2.5  # pydobot 経由は 1 回の送信に 0.3〜0.4 秒かかるので長めに取る
+
+# --- 姿勢テレメトリ (pose_telemetry.py) ---
+# 演奏と並行して姿勢を連続記録し、終了時に POSE_TELEMETRY_DIR へ .npz で保存する (pydobot 経由のアームも姿勢は dobot_link で直接読む)。
+# 記録しているアームはタイミング記録の到着を実測で埋める
+# アームごとに config の "pose_telemetry" で上書きできる
+POSE_TELEMETRY_ENABLED = False
+POSE_TELEMETRY_DIR = 'telemetry'
+
+# --- タイミング記録 (robot_timing_log.py) ---
+# 送った動作ごとに予定・送信 (予定と、送信が戻った時刻)・到着の見込みを TIMING_LOG_DIR の timing_data_<トラック>_<時刻>.jsonl へ
+# 1 行ずつ追記する (先読みモードでは記録しない)。アームごとに config の "timing_log" で上書きできる。
+# 到着 (actual_arrival_time) は実測だけを書く: 姿勢テレメトリを記録しているアームは、見込みの ARRIVAL_WAIT_S 後に
+# テレメトリから目標の z に着いた時刻を探す。記録していなければ空のまま
+# (録音があれば strike_latency_analyzer.py --annotate-timing-log で打撃音から埋められる)
+TIMING_LOG_ENABLED = True
+TIMING_LOG_DIR = POSE_TELEMETRY_DIR
+ARRIVAL_WAIT_S = 0.8
+
+# --- 打撃音による補正 (strike_latency_analyzer.py --write-calibration) ---
+# 録音から測った「打撃音 − 予定」の定常的なずれをアームごとに保存したファイル。
+# 起動時に読んで送信の遅れに上乗せする (音が遅ければその分早く送る。鳴らす打撃音の時刻は変わらない)
+STRIKE_CALIBRATION_PATH = 'strike_calibration.json'
+
+# --- 停止 ---
+# 停止要求から全アームが静止するまでの目標 (ms)。アームごとに config の "stop_sla_ms" で上書きできる
+STOP_SLA_MS = 200.0
+
+# --- 表現力パラメータ (間隔・速度の表現モデルは motion_plan_compiler.py) ---
+# 長い間隔では従来の固定振り上げ量 (35mm) まで振り上げ、短い間隔では低く速く振る
+MAX_BACKSWING_HEIGHT = ROBOT1_CONFIG["strike_pos"][2] + 35.0
 MIN_BACKSWING_HEIGHT = ROBOT1_CONFIG["strike_pos"][2] + 10.0
-EXPRESSION_EXPONENT = 0.75
 
 SAFETY_LIMITS = {
     'x_min': 160.0, 'x_max': 250.0,
@@ -53,9 +128,14 @@ SAFETY_LIMITS = {
 def get_distance(pos1, pos2):
     return math.sqrt((pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2 + (pos1[2] - pos2[2])**2)
 
+def warmup_budget(arm):
+    """アームの予備動作に取る時間 (秒)。ウォームアップしないアーム (無効・先読みモード) は 0"""
+    if not arm.get("warmup", WARMUP_ENABLED) or arm.get("execution_mode", EXECUTION_MODE) == "lookahead": return 0.0
+    return WARMUP_BUDGET_S if arm.get("command_link", COMMAND_LINK) == "coalesced" else WARMUP_BUDGET_PYDOBOT_S
+
+
 class RobotController(QObject):
     log_message = pyqtSignal(str)
-    finished = pyqtSignal()
     command_sent = pyqtSignal(str, dict)
     estimated_arrival = pyqtSignal(str, float, float)
     log_message_from_worker = pyqtSignal(str) 
@@ -91,300 +171,253 @@ class RobotController(QObject):
         self.safe_ready_pos = self.config["ready_pos"]
         self.safe_strike_pos = self.config["strike_pos"]
         
-        self.motion_profile_df = None
-        self.fixed_profile_df = None # ★ V=1000, A=1000 のみのデータフレーム
-        self.motion_plan = []
+        self.kinematics = None # ★ 運動特性モデル (motion_plan_compiler.load_kinematics)
+        self.motion_plan = motion_plan_compiler.empty_plan()
+        self.motion_packets = [] # ★ プラン作成時にエンコードした送信パケット (dobot_link.encode_plan)
+        self.plan_stream = None # ★ 長い楽譜: チャンクずつ先に作るプラン (motion_plan_compiler.StreamingPlan)。motion_plan は最初のチャンク
+        self.link = None
+        self.measured_latency_s = None # ★ ウォームアップで測った送信の遅れ (秒)
+        self.strike_offset_s = strike_latency_analyzer.load_strike_offset(STRIKE_CALIBRATION_PATH, config.get("name", track_name)) # ★ 録音から求めた補正 (秒)
+        self.command_overhead_s = calibration_runner.load_command_overhead(CALIBRATION_PROFILE_PATH, config["port"]) # ★ 実測した送信経路の差 (秒、未測定なら None)
+        self.telemetry = None
+        self.timing_log = None
+        self.pending_timing = deque() # ★ 到着の実測を待っている記録 (期限, 始点の z, レコード)
+        self.last_guided_time = None # ★ schedule_motion で決めた介入後の目標時刻 (time.time 基準)
         self.motor_reversal_pause_s = 0.050 
 
     def _load_motion_profile(self, filepath):
-        if not PANDAS_SCIPY_AVAILABLE: self.log_message.emit("警告: pandas/scipy未インストール。"); return
-        if not os.path.exists(filepath): self.log_message.emit(f"警告: {filepath} が見つかりません。"); return
-        try:
-            self.log_message.emit(f"運動特性データ {filepath} を読み込み中...")
-            df = pd.read_csv(filepath)
-            self.motion_profile_df = df # 全データも一応保持
-            
-            # ★★★ フィルタリング処理 ★★★
-            # target_velocity と target_acceleration が固定値(1000)のものだけを抽出
-            self.fixed_profile_df = df[
-                (df['target_velocity'] == FIXED_VELOCITY) & 
-                (df['target_acceleration'] == FIXED_ACCELERATION)
-            ].copy()
-            
-            # 線形補間のために actual_duration でソートしておく
-            self.fixed_profile_df.sort_values(by='actual_duration', inplace=True)
-            self.fixed_profile_df.reset_index(drop=True, inplace=True)
-
-            count = len(self.fixed_profile_df)
-            self.log_message.emit(f" -> V={FIXED_VELOCITY}, A={FIXED_ACCELERATION} のデータを {count}件 抽出しました。")
-            
-            if count == 0:
-                self.log_message.emit("警告: 指定された速度・加速度のデータがCSVに存在しません。")
-
-        except Exception as e:
-            self.log_message.emit(f"エラー: {filepath} の読み込みに失敗。{e}"); self.motion_profile_df = None
-
-    def _get_distance_from_duration_linear(self, target_duration):
-        """
-        ★新規メソッド: 時間(target_duration) から 距離(distance) を線形補間で求める。
-        """
-        if self.fixed_profile_df is None or self.fixed_profile_df.empty:
-            # データがない場合はデフォルト値を返す
-            return 30.0 
-
-        df = self.fixed_profile_df
-        
-        # 範囲外のチェック
-        min_duration = df['actual_duration'].min()
-        max_duration = df['actual_duration'].max()
-        
-        if target_duration <= min_duration:
-            return df.iloc[0]['distance']
-        if target_duration >= max_duration:
-            return df.iloc[-1]['distance']
-
-        # 線形補間
-        # target_duration を挟む2点を探す
-        # (dfはソート済み)
-        upper_idx = df[df['actual_duration'] >= target_duration].index[0]
-        lower_idx = upper_idx - 1
-        
-        row_lower = df.iloc[lower_idx]
-        row_upper = df.iloc[upper_idx]
+        self.kinematics = motion_plan_compiler.load_kinematics(filepath)
+        source = self.kinematics.source or "理論モデル"
+        self.log_message.emit(f"運動特性データ: {source} (V {len(self.kinematics.velocities)}種 × A {len(self.kinematics.accelerations)}種)")
+
+    def _get_duration(self, distance, velocity, acceleration):
+        """運動特性モデルから移動時間 (秒) を求める"""
+        if self.kinematics is None: self.kinematics = motion_plan_compiler.load_kinematics(TUNING_DATA_CSV_PATH)
+        return float(self.kinematics.duration(distance, velocity, acceleration))
+
+    def _create_planner(self):
+        """ノートの発音時刻からプランの下ごしらえ (motion_plan_compiler.TrackPlanner) を作る"""
+        if self.kinematics is None: self._load_motion_profile(TUNING_DATA_CSV_PATH)
+        onsets = motion_plan_compiler.note_onsets(self.note_items, self.bpm)
+        return motion_plan_compiler.TrackPlanner(
+            onsets, self.loop_duration, self.safe_strike_pos, self.safe_ready_pos, self.kinematics,
+            min_backswing_z=MIN_BACKSWING_HEIGHT, max_backswing_z=MAX_BACKSWING_HEIGHT, safety_limits=SAFETY_LIMITS)
+
+    def uses_coalesced_link(self):
+        return self.config.get("execution_mode", EXECUTION_MODE) == "lookahead" or self.config.get("command_link", COMMAND_LINK) == "coalesced"
+
+    def command_overhead_removed(self):
+        """FIRST_HIT_COMPENSATION_S / SOUND_DELAY_ADJUST_S に含まれる pydobot の遅れのうち、今回の経路で無くなる分 (実測値のみ)"""
+        if self.link is None or self.command_overhead_s is None: return 0.0
+        return self.command_overhead_s
+
+    def send_legacy(self, device, motion):
+        """pydobot で速度 + 移動を送る (command_link = "pydobot")"""
+        device.speed(velocity=motion["velocity"], acceleration=motion["acceleration"])
+        device.move_to(*motion["position"], wait=False)
+
+    def command_latency(self):
+        """送信時刻の計算に使う遅れ (ウォームアップで測れていればその値) + 録音から求めた補正"""
+        latency = COMMUNICATION_LATENCY_S if self.measured_latency_s is None else self.measured_latency_s
+        return latency + self.strike_offset_s
+
+    def loop_compensation(self):
+        if self.measured_latency_s is not None: return 0.0  # 実測の遅れに含まれている
+        return FIRST_HIT_COMPENSATION_S - self.command_overhead_removed()
+
+    def sound_delay(self, move_duration):
+        """送信してから打撃音を鳴らすまでの時間 (移動時間 + 通信ラグ + 手動調整値)"""
+        return max(0, move_duration + self.command_latency() + SOUND_DELAY_ADJUST_S - self.command_overhead_removed())
+
+    def arrival_time(self, send_command_time, move_duration):
+        return send_command_time + self.command_latency() + move_duration
+
+    def run_lookahead(self):
+        """先読みキュー実行: タイミングはロボット側の WAIT で刻み、進捗は実行インデックスで追う"""
+        sound_delay_adjust = SOUND_DELAY_ADJUST_S - self.command_overhead_removed()
+        def on_strike(arrival_abs):
+            delay = max(0, arrival_abs + sound_delay_adjust - time.time())
+            threading.Timer(delay, self.play_hit_sound.emit).start()
+
+        executor = dobot_lookahead.LookaheadExecutor(
+            self.link, self.track_name, self.controller, self.kinematics,
+            horizon_s=self.config.get("lookahead_horizon_s", LOOKAHEAD_HORIZON_S),
+            on_log=self.log_message.emit,
+            on_controller_log=self.log_message_from_worker.emit,
+            on_motion_started=lambda motion: self.command_sent.emit(self.track_name, motion),
+            on_estimated_arrival=lambda arrival_abs, z: self.estimated_arrival.emit(self.track_name, arrival_abs - self.master_start_time, z),
+            on_strike=on_strike)
+        executor.run(self.motion_plan, self.master_start_time, self.loop_duration, self.stop_event,
+                     start_position=self.safe_ready_pos, motion_packets=self.motion_packets)
+
+    def prepare_plan(self):
+        """安全範囲への丸め・運動特性の読み込み・プラン作成と送信パケットのエンコード (ノートが無ければ False)"""
+        self.safe_ready_pos = self._clamp_position(self.config["ready_pos"])
+        self.safe_strike_pos = self._clamp_position(self.config["strike_pos"])
+        self.motor_reversal_pause_s = self._get_pause_for_bpm(self.bpm)
         
-        t1 = row_lower['actual_duration']
-        t2 = row_upper['actual_duration']
-        d1 = row_lower['distance']
-        d2 = row_upper['distance']
-        
-        # 時間の比率を計算
-        if t2 - t1 == 0: return d1
-        ratio = (target_duration - t1) / (t2 - t1)
-        
-        # 距離を補間
-        interpolated_distance = d1 + ratio * (d2 - d1)
+        self._load_motion_profile(TUNING_DATA_CSV_PATH)
+        planner = self._create_planner()
+        # 長い楽譜は再生位置より先にチャンクずつ作る (先読みモードはキューに先まで積むので全体を作る)
+        if planner.note_count > motion_plan_compiler.PLAN_CHUNK_NOTES and self.config.get("execution_mode", EXECUTION_MODE) != "lookahead":
+            self.plan_stream = motion_plan_compiler.StreamingPlan(planner, encode=dobot_link.encode_plan)
+            self.motion_plan, self.motion_packets = self.plan_stream.chunk(0)
+            self.log_message.emit(f"[{self.track_name}] 長い楽譜のため、プランを{motion_plan_compiler.PLAN_CHUNK_NOTES}打ずつ先に作ります "
+                                  f"(全{planner.note_count}打, {self.plan_stream.num_chunks}チャンク)")
+        else:
+            self.plan_stream = None
+            self.motion_plan = planner.plan()
+            self.motion_packets = dobot_link.encode_plan(self.motion_plan)
+            self.log_message.emit(f"[{self.track_name}] プラン作成完了 (全{len(self.motion_plan)}手: {motion_plan_compiler.plan_summary(self.motion_plan)})")
+        if self.strike_offset_s: self.log_message.emit(f"[{self.track_name}] 打撃音の補正: {self.strike_offset_s * 1000:+.1f}ms ({STRIKE_CALIBRATION_PATH})")
+        if self.uses_coalesced_link():
+            if self.command_overhead_s is None:
+                self.log_message.emit(f"[{self.track_name}] 送信経路の差が未測定のため、固定補正はそのまま使います "
+                                      f"(calibration_runner.py --ports {self.config['port']} --command-overhead-only)")
+            else:
+                self.log_message.emit(f"[{self.track_name}] 送信経路の差 (実測): {self.command_overhead_s * 1000:.1f}ms を固定補正から差し引きます")
+        return len(self.motion_plan) > 0
+
+    def connect(self):
+        """ロボットに接続して待機位置へ移動する (ブロッキング)"""
+        port = self.config["port"]
+        if not PYDOBOT_AVAILABLE: raise ImportError("pydobotライブラリが見つかりません。")
+        device = Dobot(port=port, verbose=False); self.device_list.append(device)
         
-        return interpolated_distance
+        # 初期移動
+        device.speed(velocity=200, acceleration=200)
+        device.move_to(*self.safe_ready_pos, wait=True)
+        self.log_message.emit(f"ロボット [{port}] 準備完了")
+        return device
+
+    def start_telemetry(self, link):
+        """姿勢テレメトリの記録を始める (有効なときだけ)。link は姿勢を読むリンク (pydobot 経由のアームは直接送る DobotLink)"""
+        if link is None or not self.config.get("pose_telemetry", POSE_TELEMETRY_ENABLED): return
+        self.telemetry = pose_telemetry.PoseTelemetryRecorder(
+            pose_telemetry.pose_source(link), self.config.get("name", self.track_name),
+            metadata={'port': self.config["port"], 'track': self.track_name, 'bpm': self.bpm,
+                      'strike_z': self.safe_strike_pos[2], 'master_start_time': self.master_start_time,
+                      'loop_duration': self.loop_duration})
+        self.telemetry.start()
+
+    def finish_telemetry(self):
+        """記録を止めて保存する (ブロッキング)"""
+        if self.telemetry is None: return
+        self.telemetry.stop()
+        try:
+            motion_plan = self.plan_stream.full_plan() if self.plan_stream is not None else self.motion_plan
+            path = self.telemetry.save(POSE_TELEMETRY_DIR, motion_plan=motion_plan)
+            summary = self.telemetry.summary()
+            self.log_message.emit(f"[{self.track_name}] 姿勢テレメトリ保存: {path} ({summary['samples']}サンプル, {summary['rate_hz']:.0f}Hz)")
+        except OSError as e:
+            self.log_message.emit(f"[{self.track_name}] 姿勢テレメトリの保存に失敗: {e}")
+        self.telemetry = None
+
+    def start_timing_log(self):
+        """動作ごとのタイミング記録を始める (有効なときだけ)"""
+        if not self.config.get("timing_log", TIMING_LOG_ENABLED): return
+        try:
+            self.timing_log = robot_timing_log.TimingLogWriter(self.config.get("name", self.track_name), TIMING_LOG_DIR,
+                                                               on_log=self.log_message.emit)
+        except OSError as e:
+            self.log_message.emit(f"[{self.track_name}] タイミング記録を開けません: {e}")
 
-    def _get_duration_from_distance_linear(self, target_distance):
+    def log_timing(self, loop_count, motion_index, motion, loop_start_time, scheduled_send_time, command_sent_time, lateness,
+                   start_z, move_duration):
         """
-        ★新規メソッド: 距離(target_distance) から 時間(actual_duration) を線形補間で求める。
-        （安全範囲制限で距離が縮まった場合に、正確な移動時間を再計算するために使用）
+        送った動作 1 つ分を記録する。予定はプランの時刻、送信は予定の時刻と送信が戻った時刻 (command_sent_time)、
+        到着は見込み (predicted_arrival_time) と、姿勢テレメトリがあればそこから測った実測値
         """
-        if self.fixed_profile_df is None or self.fixed_profile_df.empty:
-            # 概算: 等加速度運動として計算 (x = 1/2 a t^2 => t = sqrt(2x/a)) ※加速のみの場合
-            # ここでは簡易的に返す
-            return 0.2
-
-        df = self.fixed_profile_df
-        # 距離でソート（元のDFは時間ソートだが、距離と時間は概ね正比例するためそのままでも使えるが念のため）
-        # ただし、同じ距離でデータが複数あると困るので、ここでは元のDF（時間ソート済み）を使う
-        
-        min_dist = df['distance'].min()
-        max_dist = df['distance'].max()
-
-        if target_distance <= min_dist: return df.iloc[0]['actual_duration']
-        if target_distance >= max_dist: return df.iloc[-1]['actual_duration']
-
-        # 距離で挟む位置を探す
-        # 注意: DFは duration でソートされているが、物理法則的に distance も昇順のはず
-        upper_idx = df[df['distance'] >= target_distance].index[0]
-        lower_idx = upper_idx - 1
-        
-        row_lower = df.iloc[lower_idx]
-        row_upper = df.iloc[upper_idx]
-        
-        d1 = row_lower['distance']
-        d2 = row_upper['distance']
-        t1 = row_lower['actual_duration']
-        t2 = row_upper['actual_duration']
-        
-        if d2 - d1 == 0: return t1
-        ratio = (target_distance - d1) / (d2 - d1)
-        
-        interpolated_duration = t1 + ratio * (t2 - t1)
-        return interpolated_duration
-
-    def _create_motion_plan(self):
-        notes_only = sorted([item for item in self.note_items if item.get("class") == "note"], key=lambda x: x['beat'])
-        # ログメッセージも少し変更しておくと分かりやすいです
-        self.log_message.emit(f"[{self.track_name}] モーションプラン作成 (固定距離=40.0mm, V={FIXED_VELOCITY}, A={FIXED_ACCELERATION})")
-
-        if not notes_only: return []
-
-        motion_plan = []
-        seconds_per_beat = 60.0 / self.bpm
-
-        for i, current_note in enumerate(notes_only):
-            current_strike_time = current_note.get("beat", 0) * seconds_per_beat
-
-            # --- 1.「振り下ろし (Strike)」動作 ---
-            motion_plan.append({
-                "target_time": current_strike_time,
-                "position": self.safe_strike_pos,
-                "velocity": FIXED_VELOCITY,
-                "acceleration": FIXED_ACCELERATION,
-                "is_compensated": False, 
-                "action": "strike"
-            })
-
-            # --- 2.「振り上げ (Upstroke)」動作 ---
-            
-            # --- 以下、可変計算ロジックは不要になるため削除または無視 ---
-            # next_note_index = (i + 1) % len(notes_only)
-            # ... (中略: 時間計算ロジック) ...
-            # target_upstroke_duration = available_time / 2.0
-            
-            # ★★★ 変更点: 距離を固定値 40.0mm に設定 ★★★
-            ideal_backswing_distance = 35.0 
-            # ------------------------------------------------
-            
-            # 安全範囲チェック (Z軸 130mmリミットなどは維持)
-            strike_z = self.safe_strike_pos[2]
-            max_safe_z = SAFETY_LIMITS['z_max']
-            actual_backswing_distance = min(ideal_backswing_distance, max_safe_z - strike_z)
-            
-            # 振り上げ位置の決定
-            backswing_z = strike_z + actual_backswing_distance
-            ready_x, ready_y, _, ready_r = self.safe_ready_pos
-            backswing_pos = self._clamp_position((ready_x, ready_y, backswing_z, ready_r))
-            
-            # 振り上げ開始タイミング (Strike直後)
-            upstroke_start_time = current_strike_time + 0.01
-            
-            motion_plan.append({
-                "target_time": upstroke_start_time,
-                "position": backswing_pos,
-                "velocity": FIXED_VELOCITY,
-                "acceleration": FIXED_ACCELERATION,
-                "is_compensated": True, 
-                "action": "upstroke"
-            })
-
-        self.log_message.emit(f"[{self.track_name}] プラン作成完了 (全{len(motion_plan)}手)")
-        return sorted(motion_plan, key=lambda x: x['target_time'])
-    
-    def run(self):
-        device = None; port = self.config["port"]
-        
-        # ★ 音のタイミング微調整用 (秒)
-        # まだ音が早い場合は、この数字を 0.1, 0.15 と大きくしてください
-        SOUND_DELAY_ADJUST_S = 0.32
-
+        if self.timing_log is None: return
+        predicted = self.arrival_time(scheduled_send_time, move_duration)
+        record = {'loop_number': loop_count, 'motion_index': motion_index, 'target_position': motion["position"],
+                  'planned_time': loop_start_time + motion["target_time"], 'guided_time': self.last_guided_time,
+                  'scheduled_send_time': scheduled_send_time, 'command_sent_time': command_sent_time, 'lateness': lateness,
+                  'predicted_arrival_time': predicted, 'motion_type': motion["action"]}
+        # テレメトリが無ければ待っても測れないので、すぐ書く
+        deadline = predicted + ARRIVAL_WAIT_S if self.telemetry is not None else command_sent_time
+        self.pending_timing.append((deadline, start_z, record))
+        self._flush_timing(command_sent_time)
+
+    def _flush_timing(self, now):
+        """期限が来た記録の到着をテレメトリから探して書き出す (送った順)"""
+        while self.pending_timing and self.pending_timing[0][0] <= now:
+            _, start_z, record = self.pending_timing.popleft()
+            arrival = None
+            if self.telemetry is not None:
+                arrival = self.telemetry.arrival_time(record['scheduled_send_time'], start_z, record['target_position'][2])
+            self.timing_log.record(actual_arrival_time=arrival, arrival_source='pose' if arrival is not None else None, **record)
+
+    def finish_timing_log(self):
+        """残りの記録を書き切って閉じる (ブロッキング。テレメトリを止める前に呼ぶ)"""
+        if self.timing_log is None: return
+        self._flush_timing(math.inf)
+        timing_log = self.timing_log; self.timing_log = None
+        timing_log.close()
+        self.log_message.emit(f"[{self.track_name}] タイミング記録: {timing_log.path} ({timing_log.count}動作)")
+
+    def park(self, device):
+        """待機位置に戻して切断する (ブロッキング)"""
         try:
-            self.log_message.emit(f"--- [{port}] スレッド開始 ---")
-            self.safe_ready_pos = self._clamp_position(self.config["ready_pos"])
-            self.safe_strike_pos = self._clamp_position(self.config["strike_pos"])
-            self.motor_reversal_pause_s = self._get_pause_for_bpm(self.bpm)
-            
-            self._load_motion_profile(TUNING_DATA_CSV_PATH)
-            self.motion_plan = self._create_motion_plan()
-            
-            if not self.motion_plan:
-                self.finished.emit(); return
-            
-            if not PYDOBOT_AVAILABLE: raise ImportError("pydobotライブラリが見つかりません。")
-            device = Dobot(port=port, verbose=False); self.device_list.append(device)
-            
-            # 初期移動
-            device.speed(velocity=200, acceleration=200)
-            device.move_to(*self.safe_ready_pos, wait=True)
-            self.log_message.emit(f"ロボット [{port}] 準備完了")
-            
-            loop_count = 0
-            current_pos = self.safe_ready_pos
-            
-            while not self.stop_event.is_set():
-                current_loop_start_time = self.master_start_time + (loop_count * self.loop_duration)
-                loop_compensation = FIRST_HIT_COMPENSATION_S
-                
-                for motion in self.motion_plan:
-                    if self.stop_event.is_set(): break
-                    ideal_time_ms = motion["target_time"] * 1000
-                    
-                    # コントローラー介入
-                    guided_time_ms, log_msg = self.controller.get_guided_timing(self.track_name, ideal_time_ms)
-                    if log_msg: self.log_message_from_worker.emit(f"[{self.track_name}] {log_msg}")
-                    
-                    target_time = current_loop_start_time + (guided_time_ms / 1000.0) - loop_compensation
-                    
-                    move_duration = 0.0
-                    is_compensated = motion.get("is_compensated", False)
-
-                    if is_compensated:
-                        # 振り上げ等は補正済み時間として処理
-                        send_command_time = target_time - COMMUNICATION_LATENCY_S
-                    else:
-                        # 振り下ろしは距離から時間を再計算
-                        distance = get_distance(current_pos, motion["position"])
-                        # 固定V/Aでの所要時間を取得
-                        move_duration = self._get_duration_from_distance_linear(distance)
-                        send_command_time = target_time - move_duration - COMMUNICATION_LATENCY_S
-                    
-                    wait_time = send_command_time - time.time()
-                    
-                    # Pre-motion等の短縮処理
-                    if motion['action'] in ['upstroke', 'pre-motion']:
-                        wait_time -= 0.05 
-
-                    if wait_time > 0:
-                        if wait_time > 0.010: time.sleep(wait_time - 0.005)
-                        while time.time() < send_command_time:
-                            if self.stop_event.is_set(): break
-                            time.sleep(0.0001)
-                    
-                    if not self.stop_event.is_set():
-                        self.command_sent.emit(self.track_name, motion)
-                        
-                        # --- 音の再生ロジック ---
-                        if motion.get('action') == 'strike':
-                            # 移動時間 + 通信ラグ + 手動調整値 だけ待ってから鳴らす
-                            # これで「打撃の瞬間」に合わせる
-                            delay = max(0, move_duration + COMMUNICATION_LATENCY_S + SOUND_DELAY_ADJUST_S)
-                            threading.Timer(delay, self.play_hit_sound.emit).start()
-                        # -----------------------
-
-                        # 速度設定
-                        device.speed(velocity=motion["velocity"], acceleration=motion["acceleration"])
-                        
-                        # ★★★ 修正: この行が抜けていたため動きませんでした。復活させます！ ★★★
-                        device.move_to(*motion["position"], wait=False)
-                        # -------------------------------------------------------------------
-                        
-                        current_pos = motion["position"]
-
-                        if move_duration > 0:
-                            est_arr_abs = send_command_time + COMMUNICATION_LATENCY_S + move_duration
-                            self.estimated_arrival.emit(self.track_name, est_arr_abs - self.master_start_time, motion["position"][2])
-                    
-                if self.stop_event.is_set(): break
-                loop_count += 1
+            if device in self.device_list: self.device_list.remove(device)
+            device.move_to(*(self._clamp_position((230, 0, 60, 0))), wait=True)
+            device.close()
+        except: pass
+
+    def schedule_motion(self, motion, loop_start_time, current_pos, loop_compensation):
+        """コントローラー介入を反映して、(送信時刻, 移動時間) を返す (移動時間は振り下ろしのときだけ)"""
+        ideal_time_ms = motion["target_time"] * 1000
+        
+        # コントローラー介入
+        guided_time_ms, log_msg = self.controller.get_guided_timing(self.track_name, ideal_time_ms)
+        if log_msg: self.log_message_from_worker.emit(f"[{self.track_name}] {log_msg}")
         
-        except Exception as e: self.log_message.emit(f"ロボット [{port}] エラー: {e}")
-        finally:
-            if device:
-                try:
-                    if device in self.device_list: self.device_list.remove(device)
-                    device.move_to(*(self._clamp_position((230, 0, 60, 0))), wait=True)
-                    device.close()
-                except: pass
-            self.finished.emit()
+        self.last_guided_time = loop_start_time + guided_time_ms / 1000.0
+        target_time = self.last_guided_time - loop_compensation
+        return self._send_time(motion, target_time, current_pos)
+
+    def _send_time(self, motion, target_time, current_pos):
+        if motion.get("is_compensated", False):
+            # 振り上げ等は補正済み時間として処理
+            return target_time - self.command_latency(), 0.0
+        # 振り下ろしは現在位置からの距離で時間を再計算 (初回は待機位置から)
+        distance = get_distance(current_pos, motion["position"])
+        move_duration = self._get_duration(distance, motion["velocity"], motion["acceleration"])
+        return target_time - move_duration - self.command_latency(), move_duration
+
+    def iter_motions(self):
+        """1 ループ分の (プランの行, 送信パケット)。長い楽譜はチャンクを先に作りながら返す"""
+        if self.plan_stream is not None: return iter(self.plan_stream)
+        return zip(self.motion_plan, self.motion_packets)
+
+    def first_send_time(self):
+        """最初の動作の送信時刻 (コントローラー介入前)。ウォームアップはこれより前に終える"""
+        motion = motion_plan_compiler.motion_to_dict(self.motion_plan[0])
+        target_time = self.master_start_time + motion["target_time"] - self.loop_compensation()
+        return self._send_time(motion, target_time, self.safe_ready_pos)[0]
 
 
 # ★★★ ここから RobotManager (training_module_v3.py から移動) ★★★
 class RobotManager(QObject):
+    """全アームを robot_orchestrator.RobotOrchestrator (1 本のイベントループ) で動かす"""
     log_message = pyqtSignal(str)
     command_sent = pyqtSignal(str, dict)
     estimated_arrival = pyqtSignal(str, float, float)
+    arm_metrics = pyqtSignal(dict)          # {アーム名: 状態・タイミング・通信統計}
+    orchestration_finished = pyqtSignal(object)
     
     def __init__(self, parent=None):
         super().__init__(parent)
         # ★★★ 修正1: parent (MainWindow) を self.main_window として保存 ★★★
         self.main_window = parent 
-        self.threads = []
         self.workers = []
+        self.orchestrator = None
+        self.last_arm_metrics = {}
+        self.measured_latencies = {}  # アーム名 → ウォームアップで測った送信の遅れ (秒)
         self.stop_event = threading.Event()
         self.active_devices = []
+        self.arm_metrics.connect(self._on_arm_metrics)
+        self.orchestration_finished.connect(self._on_orchestration_finished)
 
     def get_first_move_preparation_time(self, score_data):
         try:
@@ -415,59 +448,66 @@ class RobotManager(QObject):
             temp_rc.safe_strike_pos = temp_rc._clamp_position(temp_rc.config["strike_pos"])
             temp_rc.motor_reversal_pause_s = temp_rc._get_pause_for_bpm(temp_rc.bpm)
             
-            # CSV読み込みとプラン作成
+            # CSV読み込みとプラン作成 (使うのは最初の動作だけなので、最初のノートの分だけ作る)
             temp_rc._load_motion_profile(TUNING_DATA_CSV_PATH)
-            temp_rc.motion_plan = temp_rc._create_motion_plan()
+            temp_rc.motion_plan = temp_rc._create_planner().plan(0, 1)
             
-            if not temp_rc.motion_plan: return 0.2
+            if len(temp_rc.motion_plan) == 0: return 0.2
             
             ready_pos = temp_rc.safe_ready_pos
-            first_motion = temp_rc.motion_plan[0]
+            first_motion = motion_plan_compiler.motion_to_dict(temp_rc.motion_plan[0])
             
-            if first_motion.get("is_compensated", False):
+            if first_motion["is_compensated"]:
                 move_duration = 0.0 
             else:
                 distance = get_distance(ready_pos, first_motion["position"])
-                
-                # ★★★ 修正2: メソッド名を変更し、引数を distance だけにする ★★★
-                # 旧: temp_rc._get_estimated_duration(distance, first_motion["velocity"], first_motion["acceleration"])
-                move_duration = temp_rc._get_duration_from_distance_linear(distance)
+                move_duration = temp_rc._get_duration(distance, first_motion["velocity"], first_motion["acceleration"])
 
-            return move_duration + FIRST_HIT_COMPENSATION_S + COMMUNICATION_LATENCY_S
+            if WARMUP_ENABLED and self.measured_latencies:
+                # 前回のウォームアップの実測値 (今回の値は予備動作の後で各アームに反映される)
+                latency = max(self.measured_latencies.values()); compensation = 0.0
+            else:
+                latency = COMMUNICATION_LATENCY_S; compensation = FIRST_HIT_COMPENSATION_S
+                if temp_rc.uses_coalesced_link(): compensation -= temp_rc.command_overhead_s or 0.0
+            # 実際にウォームアップするアームがあるときだけ、その時間を取る
+            warmup_s = max((warmup_budget(arm) for arm in load_arm_configs()), default=0.0)
+            return move_duration + compensation + latency + warmup_s
             
         except Exception as e:
             print(f"get_first_move_preparation_time でエラー: {e}")
             return 0.2
         
     def start_control(self, score_data, active_controller, master_start_time):
-        self.stop_control(); self.stop_event.clear()
+        self.stop_control()
+        # 前回の演奏が退避中でも止まったままでいられるよう、停止フラグは演奏ごとに新しくする
+        self.stop_event = threading.Event()
         
         self.log_message.emit("🎼 JSONデータ(score_data)受信。楽譜分析とモーションプランニング開始...")
         
-        top_score = score_data.get("top", {}); bottom_score = score_data.get("bottom", {})
-        top_bpm = top_score.get("bpm", 120); bottom_bpm = bottom_score.get("bpm", 120)
-        top_items = top_score.get("items", []); bottom_items = bottom_score.get("items", [])
+        arms = load_arm_configs()
+        routing = score_data.get("robot_routing", {})
+        for arm in arms: arm["track"] = routing.get(arm["name"], arm["track"])
+        tracks = list(dict.fromkeys(arm["track"] for arm in arms))
         
-        self.log_message.emit(f"    [top] トラック情報: BPM={top_bpm}, ノート数={len([i for i in top_items if i.get('class') == 'note'])}")
-        self.log_message.emit(f"    [bottom] トラック情報: BPM={bottom_bpm}, ノート数={len([i for i in bottom_items if i.get('class') == 'note'])}")
+        for track_name in tracks:
+            track_score = score_data.get(track_name, {})
+            items = track_score.get("items", [])
+            self.log_message.emit(f"    [{track_name}] トラック情報: BPM={track_score.get('bpm', 120)}, ノート数={len([i for i in items if i.get('class') == 'note'])}")
         
-        top_beats = top_score.get("total_beats", 8); bottom_beats = bottom_score.get("total_beats", 8)
-        top_duration = top_beats * (60.0 / top_bpm); bottom_duration = bottom_beats * (60.0 / bottom_bpm)
-        loop_duration_sec = max(top_duration, bottom_duration)
-        configs = [(ROBOT1_CONFIG, top_items, top_bpm, 'top'), (ROBOT2_CONFIG, bottom_items, bottom_bpm, 'bottom')]
+        loop_duration_sec = max(score_data.get(t, {}).get("total_beats", 8) * (60.0 / score_data.get(t, {}).get("bpm", 120)) for t in tracks)
         
-        self.log_message.emit("🤖 各ロボットのコントローラを起動します...") 
+        self.log_message.emit("🤖 各アームのモーションプランを作成します...") 
         
-        for config, items, bpm, track_name in configs:
-            thread = QThread()
-            worker = RobotController(config, items, bpm, loop_duration_sec, self.stop_event, self.active_devices, track_name, active_controller, master_start_time)
+        workers = []
+        for arm in arms:
+            track_score = score_data.get(arm["track"], {})
+            worker = RobotController(arm, track_score.get("items", []), track_score.get("bpm", 120), loop_duration_sec,
+                                     self.stop_event, self.active_devices, arm["track"], active_controller, master_start_time)
             
             worker.command_sent.connect(self.command_sent.emit)
             worker.estimated_arrival.connect(self.estimated_arrival.emit)
-            worker.moveToThread(thread)
-            
             worker.log_message.connect(self.log_message.emit) 
-            thread.started.connect(worker.run)
+            worker.log_message_from_worker.connect(self.log_message)
             
             # ★★★ 修正3: ドラム音再生シグナルの接続 ★★★
             # self.main_window が None でないかチェックしてから接続
@@ -476,20 +516,38 @@ class RobotManager(QObject):
             else:
                 self.log_message.emit("警告: play_robot_drum_sound が見つからないため、ロボット音は再生されません。")
 
-            worker.finished.connect(thread.quit); worker.finished.connect(worker.deleteLater); thread.finished.connect(thread.deleteLater)
-            thread.finished.connect(lambda t=thread, w=worker: self._on_thread_finished(t, w)); thread.start()
-            self.threads.append(thread); self.workers.append(worker)
-            
-            if hasattr(worker, 'log_message_from_worker'):
-                worker.log_message_from_worker.connect(self.log_message)
+            if not worker.prepare_plan():
+                self.log_message.emit(f"    [{arm['name']}] トラック '{arm['track']}' にノートが無いため待機します。"); continue
+            workers.append(worker)
+        
+        self.workers = workers
+        if not workers: return
+        self.orchestrator = robot_orchestrator.RobotOrchestrator(
+            workers, self.stop_event, master_start_time, default_execution_mode=EXECUTION_MODE, warmup=WARMUP_ENABLED, stop_sla_ms=STOP_SLA_MS,
+            on_log=self.log_message.emit, on_metrics=self.arm_metrics.emit, on_finished=self.orchestration_finished.emit)
+        self.orchestrator.start()
 
     def stop_control(self):
-        if not self.threads: return
-        self.log_message.emit("🛑 演奏停止中..."); self.stop_event.set()
+        if not self.orchestrator or not self.orchestrator.is_running(): return
+        self.log_message.emit("🛑 演奏停止中..."); self.orchestrator.request_stop()
 
     def trigger_start(self):
         pass
 
-    def _on_thread_finished(self, thread_obj, worker_obj):
-        if thread_obj in self.threads: self.threads.remove(thread_obj)
-        if worker_obj in self.workers: self.workers.remove(worker_obj)
\ No newline at end of file
+    def get_arm_metrics(self):
+        """アームごとの状態 (healthy / state / error)、送信遅れ、通信統計"""
+        return self.orchestrator.metrics() if self.orchestrator else dict(self.last_arm_metrics)
+
+    def _on_arm_metrics(self, metrics):
+        self.last_arm_metrics = metrics
+        for name, arm in metrics.items():
+            warmup = arm.get('warmup') or {}
+            if warmup.get('latency_s') is not None: self.measured_latencies[name] = warmup['latency_s']
+
+    def _on_orchestration_finished(self, orchestrator):
+        if orchestrator is not self.orchestrator: return  # 既に次の演奏が始まっている
+        self.workers = []; self.orchestrator = None
+
+    def get_link_stats(self):
+        """ポートごとの通信統計 (送受信バイト/秒、パケット数、省略数、往復時間)"""
+        return dobot_link.link_stats()
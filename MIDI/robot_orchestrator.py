@@ -0,0 +1,475 @@
+"""
+複数アームを 1 つの asyncio イベントループで動かすオーケストレーター
+
+従来の RobotManager はロボットごとに QThread を立て、各スレッドが自分で待機 (sleep + 空回し) と
+シリアル送受信をしていたため、アームを増やすたびに空回しするスレッドが増えていた。
+ここでは
+  - command_link = "coalesced" のアームはシリアル送受信を dobot_link.AsyncDobotLink でノンブロッキングに行い
+    (既定の "pydobot" のアームは従来どおり speed + move_to をスレッドプールで送る)、
+  - 送信時刻の待ち合わせを 1 つの DeadlineScheduler (締め切り順のヒープ) にまとめ、
+  - 全アームの接続と待機位置への移動が終わってから一斉に開始する (バリア)。
+  - バリアの後、開始までのカウントダウン中に予備動作 (ウォームアップ) をして、
+    往復時間と送信→到着の遅れをアームごとに測り、一打目からその値で送信時刻を決める。
+停止 (request_stop) では、全アームに同時に ForceStopExec + キュー消去を送り、
+静止するまでの時間を測って SLA (stop_sla_ms) と比べてログに出してから、全アームを同時に退避させる。
+プランの作成・タイミング計算・接続/退避は RobotController (robot_control_module_v4.py) のものを使う。
+アームごとの状態とタイミングの統計は on_metrics に METRICS_INTERVAL_S ごとに渡す。
+
+先読みモード (execution_mode="lookahead") のアームは、待ちをロボット側の WAIT に任せるため
+dobot_lookahead.LookaheadExecutor を従来どおりスレッドプール上で動かす。
+"""
+import sys
+import time
+import statistics
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import deque
+
+import motion_plan_compiler
+import dobot_link
+
+# Windows ではイベントループのタイマー精度が 15ms 程度なので、締め切りの手前から空回しに切り替える
+SPIN_MARGIN_S = 0.02 if sys.platform == "win32" else 0.005
+MAX_IDLE_WAIT_S = 0.1        # 外部から stop_event が立てられたときに気づくまでの最大時間
+LATE_THRESHOLD_S = 0.005     # これ以上遅れて送った動作を「遅延」として数える
+METRICS_INTERVAL_S = 1.0
+LATENESS_WINDOW = 256
+MAX_CONSECUTIVE_ERRORS = 3   # 連続して送信に失敗したらそのアームを止める
+
+# --- ウォームアップ ---
+WARMUP_AMPLITUDE_MM = 3.0    # 待機位置から上に動かす量 (打面から離れる向き)
+WARMUP_MOVES = 3             # 上げ下げの往復回数 (時間が足りなければ減らす)
+WARMUP_RTT_SAMPLES = 5
+WARMUP_POLL_S = 0.005        # 姿勢の確認間隔
+WARMUP_MOVE_TIMEOUT_S = 1.0  # モデルの移動時間をこれだけ過ぎても着かなければ測定失敗
+WARMUP_SETTLE_MM = 0.1       # 目標からこの距離に入ったら到着とみなす
+WARMUP_GUARD_S = 0.15        # 最初の本番動作の送信時刻までに空けておく時間
+
+# --- 停止 ---
+STOP_SLA_MS = 200.0          # 停止要求から静止までの目標 (アームごとに config の "stop_sla_ms" で上書き)
+STILL_POLL_S = 0.01
+STILL_TOLERANCE_MM = 0.05    # 連続する姿勢の差がこれ未満なら静止とみなす
+STOP_TIMEOUT_S = 2.0
+
+
+class DeadlineScheduler:
+    """全アーム共通の締め切りスケジューラ。wait_until() で待ち、call_at() でコールバックを予約する"""
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._closed = False
+
+    def _push(self, deadline, item):
+        heapq.heappush(self._heap, (deadline, next(self._seq), item))
+        if self._heap[0][2] is item: self._wakeup.set()
+
+    def wait_until(self, deadline):
+        """deadline (time.time() 基準) に解決される Future。結果は実際の遅れ (秒)、中止時は None"""
+        future = asyncio.get_running_loop().create_future()
+        if self._closed: future.set_result(None)
+        else: self._push(deadline, future)
+        return future
+
+    def call_at(self, deadline, callback):
+        if not self._closed: self._push(deadline, callback)
+
+    def close(self):
+        """待っている Future を全て None で解決し、以後の予約を受け付けない"""
+        self._closed = True
+        for _, _, item in self._heap:
+            if isinstance(item, asyncio.Future) and not item.done(): item.set_result(None)
+        self._heap.clear(); self._wakeup.set()
+
+    async def run(self, stop_event):
+        while not self._closed:
+            if stop_event.is_set(): self.close(); break
+            if not self._heap:
+                await self._wait(MAX_IDLE_WAIT_S); continue
+            deadline, _, item = self._heap[0]
+            remaining = deadline - time.time()
+            if remaining > SPIN_MARGIN_S:
+                await self._wait(min(remaining - SPIN_MARGIN_S, MAX_IDLE_WAIT_S)); continue
+            if remaining > 0:
+                await asyncio.sleep(0); continue  # 締め切り直前だけ他のタスクに譲りながら空回しする
+            heapq.heappop(self._heap)
+            if isinstance(item, asyncio.Future):
+                if not item.done(): item.set_result(-remaining)
+            else:
+                try: item()
+                except Exception as e: print(f"[scheduler] コールバックでエラー: {e}")
+
+    async def _wait(self, timeout):
+        try: await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError: pass
+        self._wakeup.clear()
+
+
+class ArmRunner:
+    """1 アーム分の実行。worker は prepare_plan() 済みの RobotController"""
+    def __init__(self, worker, orchestrator):
+        self.worker = worker
+        self.orchestrator = orchestrator
+        self.name = worker.config.get("name", worker.config["port"])
+        self.device = None
+        self.link = None
+        self.direct_link = None  # pydobot 経由のアームで、姿勢の読み取り・往復時間の測定・停止だけ直接送るリンク
+        self.state = "idle"
+        self.error = None
+        self.motions_sent = 0
+        self.late_count = 0
+        self.consecutive_errors = 0
+        self.lateness = deque(maxlen=LATENESS_WINDOW)
+        self.warmup = None
+        self.stop_result = None
+
+    @property
+    def execution_mode(self):
+        return self.worker.config.get("execution_mode", self.orchestrator.default_execution_mode)
+
+    @property
+    def pose_link(self):
+        """姿勢の読み取りや停止に使うリンク (pydobot 経由のアームは direct_link)"""
+        return self.link if self.link is not None else self.direct_link
+
+    def _fail(self, error):
+        self.state = "error"; self.error = str(error)
+        self.orchestrator.log(f"ロボット [{self.worker.config['port']}] エラー: {error}")
+
+    async def prepare(self, loop):
+        self.state = "connecting"
+        try:
+            self.device = await loop.run_in_executor(None, self.worker.connect)
+            if self.execution_mode == "lookahead":
+                self.link = dobot_link.DobotLink(self.device, self.worker.config["port"])
+            elif self.worker.uses_coalesced_link():
+                self.link = dobot_link.AsyncDobotLink(self.device, self.worker.config["port"])
+            else:
+                # pydobot とはポートのロック (device.lock) を共有するので、送信とは交互になる
+                self.direct_link = dobot_link.DobotLink(self.device, self.worker.config["port"])
+            self.worker.link = self.link
+            self.worker.start_telemetry(self.pose_link)
+            if self.execution_mode != "lookahead": self.worker.start_timing_log()
+            self.state = "ready"
+            return True
+        except Exception as e:
+            self._fail(e); return False
+
+    # --- ウォームアップ ---
+    async def _priming_move(self, loop, target, velocity, acceleration):
+        """
+        1 回の予備動作を送り、「送信→到着」から運動特性モデルの移動時間を引いた遅れ (秒) を返す。
+        送信時刻の計算 (送信 + 遅れ + 移動時間 = 到着) と同じ形で測るので、モデルの癖も含めて補正できる。
+        本番と同じ経路で送る (pydobot 経由のアームは speed + move_to。姿勢だけ direct_link で読む)。
+        """
+        link = self.pose_link
+        start = await self._call(loop, link.pose)
+        distance = abs(target[2] - start[2])
+        move_duration = float(self.worker.kinematics.duration(distance, velocity, acceleration))
+        sent = time.time()
+        if self.link is not None:
+            await self._call(loop, self.link.send_motion, dobot_link.MotionPackets(velocity, acceleration, target))
+        else:
+            motion = {"velocity": velocity, "acceleration": acceleration, "position": target}
+            await loop.run_in_executor(None, self.worker.send_legacy, self.device, motion)
+        previous = sent
+        while time.time() - sent < move_duration + WARMUP_MOVE_TIMEOUT_S:
+            z = (await self._call(loop, link.pose))[2]; now = time.time()
+            if abs(z - target[2]) <= WARMUP_SETTLE_MM:
+                # 到着は前回と今回の確認の間
+                return (previous + now) / 2 - sent - move_duration
+            previous = now
+            await asyncio.sleep(WARMUP_POLL_S)
+        return None
+
+    async def warm_up(self):
+        """
+        カウントダウン中に待機位置から少し上げ下げして、往復時間と送信→到着の遅れを測る。
+        測れたら worker.measured_latency_s に入れる (測れなければ従来の固定補正のまま)。
+        """
+        worker = self.worker
+        if not worker.config.get("warmup", self.orchestrator.warmup_enabled):
+            self.orchestrator.log(f"[{self.name}] ウォームアップは無効です (固定補正を使います)"); return
+        # 先読みモードは WAIT で時刻を刻むので不要
+        if self.execution_mode == "lookahead":
+            self.orchestrator.log(f"[{self.name}] 先読みモードのためウォームアップを省略します"); return
+        loop = asyncio.get_running_loop(); link = self.pose_link
+        self.state = "warming_up"
+        deadline = worker.first_send_time() - WARMUP_GUARD_S
+        first = motion_plan_compiler.motion_to_dict(worker.motion_plan[0])
+        velocity, acceleration = first["velocity"], first["acceleration"]
+        ready = worker.safe_ready_pos
+        raised = (ready[0], ready[1], ready[2] + WARMUP_AMPLITUDE_MM, ready[3])
+        # 1 往復にかかる時間の見積もり (移動 2 回 + 遅れ (未測定なら固定補正込み) + 予備)
+        expected_latency = worker.command_latency() + worker.loop_compensation()
+        round_trip_s = 2 * (float(worker.kinematics.duration(WARMUP_AMPLITUDE_MM, velocity, acceleration)) + expected_latency + 0.05)
+
+        rtts = []
+        for _ in range(WARMUP_RTT_SAMPLES):
+            sent = time.perf_counter(); await self._call(loop, link.current_index)
+            rtts.append(time.perf_counter() - sent)
+        latencies = []
+        for _ in range(WARMUP_MOVES):
+            if time.time() + round_trip_s > deadline or self.orchestrator.stop_event.is_set(): break
+            for target in (raised, ready):  # 上げたら必ず待機位置に戻す
+                latency = await self._priming_move(loop, target, velocity, acceleration)
+                if latency is not None: latencies.append(latency)
+
+        self.warmup = {'rtt_ms': statistics.median(rtts) * 1000, 'moves': len(latencies), 'latency_s': None}
+        if not latencies:
+            self.orchestrator.log(f"[{self.name}] ウォームアップの時間が取れなかったため、固定補正 (FIRST_HIT_COMPENSATION_S) を使います")
+        else:
+            # 1 回目はコールドスタートを含むので、2 回目以降があればそちらを使う
+            steady = latencies[1:] or latencies
+            self.warmup.update(latency_s=statistics.median(steady), cold_start_ms=latencies[0] * 1000)
+            worker.measured_latency_s = self.warmup['latency_s']
+            self.orchestrator.log(f"[{self.name}] ウォームアップ {len(latencies)}回: 往復 {self.warmup['rtt_ms']:.1f}ms, "
+                                  f"送信の遅れ {self.warmup['latency_s'] * 1000:.1f}ms (初回 {latencies[0] * 1000:.1f}ms)")
+        self.state = "ready"
+
+    async def run(self, loop):
+        self.state = "running"
+        try:
+            if self.execution_mode == "lookahead":
+                await loop.run_in_executor(None, self.worker.run_lookahead)
+            else:
+                await self._run_just_in_time()
+            if self.state == "running": self.state = "finished"
+        except Exception as e:
+            self._fail(e)
+
+    async def _run_just_in_time(self):
+        worker = self.worker; scheduler = self.orchestrator.scheduler; stop_event = self.orchestrator.stop_event
+        master_start_time = self.orchestrator.master_start_time
+        loop_compensation = worker.loop_compensation()
+        current_pos = worker.safe_ready_pos
+        for loop_count in itertools.count():
+            loop_start_time = master_start_time + loop_count * worker.loop_duration
+            for motion_index, (row, packets) in enumerate(worker.iter_motions()):
+                if stop_event.is_set(): return
+                motion = motion_plan_compiler.motion_to_dict(row)
+                send_time, move_duration = worker.schedule_motion(motion, loop_start_time, current_pos, loop_compensation)
+                lateness = await scheduler.wait_until(send_time)
+                if lateness is None or stop_event.is_set(): return
+
+                worker.command_sent.emit(worker.track_name, motion)
+                if motion["action"] == "strike":
+                    scheduler.call_at(time.time() + worker.sound_delay(move_duration), worker.play_hit_sound.emit)
+                try:
+                    if self.link is not None: await self.link.send_motion(packets)
+                    else: await asyncio.get_running_loop().run_in_executor(None, worker.send_legacy, self.device, motion)
+                    sent_at = time.time()  # 送信 (pydobot なら speed + move_to) が戻った時刻
+                    self.consecutive_errors = 0
+                except (TimeoutError, ConnectionError, OSError) as e:
+                    self.consecutive_errors += 1
+                    self.orchestrator.log(f"[{self.name}] 送信失敗 ({self.consecutive_errors}回連続): {e}")
+                    if self.consecutive_errors >= MAX_CONSECUTIVE_ERRORS: raise
+                    continue
+
+                self.motions_sent += 1
+                self.lateness.append(lateness)
+                if lateness > LATE_THRESHOLD_S: self.late_count += 1
+                worker.log_timing(loop_count, motion_index, motion, loop_start_time, send_time, sent_at, lateness, current_pos[2], move_duration)
+                current_pos = motion["position"]
+                if move_duration > 0:
+                    arrival = worker.arrival_time(send_time, move_duration)
+                    worker.estimated_arrival.emit(worker.track_name, arrival - master_start_time, motion["position"][2])
+
+    # --- 停止 ---
+    async def _call(self, loop, method, *args):
+        """リンクのメソッドを呼ぶ (同期版は先読みスレッドや pydobot とロックを共有するのでスレッドプールで)"""
+        if isinstance(self.link, dobot_link.AsyncDobotLink): return await method(*args)
+        return await loop.run_in_executor(None, method, *args)
+
+    async def halt(self, loop, requested_at, sla_ms):
+        """ForceStopExec + キュー消去を送り、静止までの時間を測ってからキューの実行を再開する (退避用)"""
+        if self.device is None: return None
+        self.state = "stopping"
+        # pydobot 経由のアームも、停止だけは dobot_link で直接送る (pydobot とはポートのロックを共有する)
+        link = self.pose_link
+        await self._call(loop, link.halt)
+        halted_at = time.time()
+
+        still_at = None; previous = await self._call(loop, link.pose); previous_at = time.time()
+        while time.time() - halted_at < STOP_TIMEOUT_S:
+            await asyncio.sleep(STILL_POLL_S)
+            pose = await self._call(loop, link.pose); now = time.time()
+            if max(abs(a - b) for a, b in zip(pose[:3], previous[:3])) < STILL_TOLERANCE_MM:
+                still_at = previous_at; break  # 前回の確認の時点で既に止まっていた
+            previous, previous_at = pose, now
+        await self._call(loop, link.start_exec)
+
+        still_ms = (still_at - requested_at) * 1000 if still_at is not None else None
+        self.stop_result = {
+            'halt_sent_ms': (halted_at - requested_at) * 1000,
+            'still_ms': still_ms,
+            'sla_ms': sla_ms,
+            'within_sla': still_ms is not None and still_ms <= sla_ms,
+        }
+        return self.stop_result
+
+    async def park(self, loop):
+        if self.device is None: return
+        # タイミング記録の残りはテレメトリから到着を探すので先に書き切る。
+        # 記録スレッドはイベントループ経由で姿勢を読むので、ループを塞がないようスレッドプールで止める
+        await loop.run_in_executor(None, self.worker.finish_timing_log)
+        await loop.run_in_executor(None, self.worker.finish_telemetry)
+        if isinstance(self.link, dobot_link.AsyncDobotLink): self.link.close()
+        if self.link is not None: self.orchestrator.log(f"通信統計 {self.link.stats_line()}")
+        await loop.run_in_executor(None, self.worker.park, self.device)
+        self.device = None
+        if self.state not in ("error",): self.state = "parked"
+
+    def metrics(self):
+        lateness = list(self.lateness)
+        link_stats = self.link.stats() if self.link is not None else None
+        return {
+            'name': self.name,
+            'port': self.worker.config["port"],
+            'track': self.worker.track_name,
+            'execution_mode': self.execution_mode,
+            'state': self.state,
+            'healthy': self.state in ("ready", "running", "finished", "parked") and self.consecutive_errors == 0,
+            'error': self.error,
+            'motions_sent': self.motions_sent,
+            'late_count': self.late_count,
+            'lateness_mean_ms': sum(lateness) / len(lateness) * 1000 if lateness else None,
+            'lateness_max_ms': max(lateness) * 1000 if lateness else None,
+            'link': link_stats,
+            'warmup': self.warmup,
+            'stop': self.stop_result,
+        }
+
+
+class RobotOrchestrator:
+    """
+    全アームを 1 本のスレッド上の asyncio イベントループで動かす。
+    workers は RobotController のリスト (prepare_plan() 済み)。start() で開始し、request_stop() で止める。
+    on_finished(orchestrator) は退避まで終わった後にイベントループのスレッドから呼ばれる。
+    """
+    def __init__(self, workers, stop_event, master_start_time, default_execution_mode="just_in_time", warmup=True,
+                 stop_sla_ms=STOP_SLA_MS, on_log=print, on_metrics=None, on_finished=None):
+        self.stop_event = stop_event
+        self.warmup_enabled = warmup
+        self.stop_sla_ms = stop_sla_ms
+        self.stop_requested_at = None
+        self._stop_requested = None
+        self.master_start_time = master_start_time
+        self.default_execution_mode = default_execution_mode
+        self.on_log = on_log
+        self.on_metrics = on_metrics
+        self.on_finished = on_finished
+        self.arms = [ArmRunner(worker, self) for worker in workers]
+        self.scheduler = None
+        self._loop = None
+        self._thread = None
+
+    def log(self, message):
+        self.on_log(message)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._thread_main, name="RobotOrchestrator", daemon=True)
+        self._thread.start()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def request_stop(self):
+        """どのスレッドからでも呼べる。待ち合わせ中の送信を打ち切り、全アームを止めてから退避させる"""
+        if self.stop_requested_at is None: self.stop_requested_at = time.time()
+        self.stop_event.set()
+        loop = self._loop
+        if loop is not None and self._stop_requested is not None:
+            try: loop.call_soon_threadsafe(self._stop_requested.set)
+            except RuntimeError: pass  # ループが既に終わっている
+
+    def join(self, timeout=None):
+        if self._thread is not None: self._thread.join(timeout)
+
+    def metrics(self):
+        return {arm.name: arm.metrics() for arm in self.arms}
+
+    def _publish_metrics(self):
+        if self.on_metrics:
+            try: self.on_metrics(self.metrics())
+            except Exception as e: print(f"[orchestrator] メトリクス通知でエラー: {e}")
+
+    def _thread_main(self):
+        try:
+            asyncio.run(self._main())
+        except Exception as e:
+            self.log(f"オーケストレーターでエラー: {e}")
+        finally:
+            self._loop = None
+            if self.on_finished: self.on_finished(self)
+
+    async def _warm_up(self, arm):
+        try: await arm.warm_up()
+        except Exception as e:
+            arm.state = "ready"
+            self.log(f"[{arm.name}] ウォームアップに失敗したため、固定補正を使います: {e}")
+
+    async def _stop_watch(self):
+        """停止要求 (request_stop、または外から立てられた stop_event) を待って全アームを同時に止める"""
+        while not self._stop_requested.is_set() and not self.stop_event.is_set():
+            try: await asyncio.wait_for(self._stop_requested.wait(), MAX_IDLE_WAIT_S)
+            except asyncio.TimeoutError: pass
+        if self.stop_requested_at is None: self.stop_requested_at = time.time()
+        self.scheduler.close()
+        loop = asyncio.get_running_loop()
+        arms = [arm for arm in self.arms if arm.device is not None]
+        results = await asyncio.gather(*(arm.halt(loop, self.stop_requested_at, arm.worker.config.get("stop_sla_ms", self.stop_sla_ms))
+                                         for arm in arms), return_exceptions=True)
+        for arm, result in zip(arms, results):
+            if isinstance(result, Exception):
+                self.log(f"🛑 [{arm.name}] 停止コマンドに失敗: {result}")
+            elif result['still_ms'] is None:
+                self.log(f"🛑 [{arm.name}] {STOP_TIMEOUT_S:.1f}s 以内に静止を確認できませんでした (SLA {result['sla_ms']:.0f}ms)")
+            else:
+                verdict = "OK" if result['within_sla'] else "超過"
+                self.log(f"🛑 [{arm.name}] 停止→静止 {result['still_ms']:.0f}ms (SLA {result['sla_ms']:.0f}ms {verdict})")
+        self._publish_metrics()
+
+    async def _metrics_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL_S)
+            self._publish_metrics()
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self.scheduler = DeadlineScheduler()
+        self._stop_requested = asyncio.Event()
+        if self.stop_event.is_set(): self.scheduler.close()
+        scheduler_task = loop.create_task(self.scheduler.run(self.stop_event))
+        metrics_task = loop.create_task(self._metrics_loop())
+        stop_task = loop.create_task(self._stop_watch())
+        try:
+            # バリア: 全アームの接続と待機位置への移動が終わるまで、どのアームも始めない
+            self.log(f"🤖 {len(self.arms)}台のアームを接続中...")
+            ready = await asyncio.gather(*(arm.prepare(loop) for arm in self.arms))
+            ready_arms = [arm for arm, ok in zip(self.arms, ready) if ok]
+            self._publish_metrics()
+            if not ready_arms:
+                self.log("接続できたアームがありません。"); return
+            slack = self.master_start_time - time.time()
+            names = ", ".join(arm.name for arm in ready_arms)
+            self.log(f"全アーム準備完了 ({names}) / 開始まで {slack:.2f}s")
+            if slack < 0: self.log(f"警告: 準備が開始時刻に {-slack:.2f}s 間に合いませんでした。最初の動作は遅れます。")
+
+            await asyncio.gather(*(self._warm_up(arm) for arm in ready_arms))
+            self._publish_metrics()
+
+            await asyncio.gather(*(arm.run(loop) for arm in ready_arms))
+        finally:
+            # 停止要求で終わった場合は、全アームが止まるのを待ってから退避する
+            if self.stop_event.is_set(): await asyncio.gather(stop_task, return_exceptions=True)
+            else: stop_task.cancel()
+            # 退避は全アーム同時に行う
+            await asyncio.gather(*(arm.park(loop) for arm in self.arms), return_exceptions=True)
+            self.scheduler.close()
+            for task in (scheduler_task, metrics_task): task.cancel()
+            await asyncio.gather(scheduler_task, metrics_task, return_exceptions=True)
+            self._publish_metrics()
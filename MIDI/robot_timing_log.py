@@ -0,0 +1,418 @@
+"""
+ロボットの動作タイミング記録 (JSON Lines) と、それを流し読みして集計するレポート
+
+以前の timing_data_<トラック>_<時刻>.json はインデント付きの JSON 配列で、演奏が終わってから一度に書き、
+レポートを作るときも全体を読み込む必要があった。ここでは
+  - RobotController が動作を送るたびに 1 行 (1 動作) をキューに入れ、書き込みスレッドが追記して flush する
+    (演奏中の fsync はしない。イベントループはファイルに触らない)
+  - レポートはファイルを CHUNK_SIZE 行ずつ読み、誤差の計算と集計を NumPy でまとめて行う。
+    持つのは件数・合計・二乗和・最小・最大と固定幅のヒストグラムだけなので、何時間分の記録でもメモリは一定
+    (ループ別の統計はループの数だけ増えるが、動作の数には依存しない)
+  - 従来の JSON 配列 (.json) も少しずつデコードして同じように読める
+何ファイルでもまとめて集計でき、アーム別 × 動作の種類別 × ループ別の統計と誤差のヒストグラム、
+従来の timing_report_*.txt と同じ精度分布・総合評価 (EXCELLENT / 良好 / ...) を出す。
+
+    python robot_timing_log.py telemetry/timing_data_*.jsonl
+    python robot_timing_log.py ../timing_data_bottom_1758020085.json -o timing_report_bottom.txt
+    python robot_timing_log.py telemetry/timing_data_top_*.jsonl --no-details     # 打撃ごとの表を省く
+
+レコード (1 行):
+    arm, loop_number, motion_index, target_position, planned_time, guided_time,
+    scheduled_send_time, command_sent_time, lateness, predicted_arrival_time,
+    actual_arrival_time, arrival_source, timing_error, motion_type
+時刻は time.time 基準の秒。
+  - scheduled_send_time は送信を予定した時刻、command_sent_time は送信 (pydobot なら speed + move_to) が戻った時刻、
+    lateness はスケジューラーが予定より遅れて起こした分
+  - predicted_arrival_time は予定の送信時刻 + 送信の遅れ + モデルの移動時間から求めた到着の見込み (集計には使わない)
+  - actual_arrival_time は実測した到着 (arrival_source: "pose" = 姿勢テレメトリ、"audio" = 打撃音
+    (strike_latency_analyzer.py --annotate-timing-log))。測れなかった動作は null
+  - timing_error = actual_arrival_time - planned_time (秒、実測が無ければ null)
+精度分布・総合評価・ヒストグラムは実測した動作だけで作る。従来の .json (arm の無いレコード) の到着は実測値として読み、
+arrival_source の無い .jsonl (到着の見込みを actual_arrival_time に入れていた版) の到着は実測として扱わない。
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import argparse
+import datetime
+import threading
+
+import numpy as np
+
+# --- 設定 ---
+DEFAULT_OUTPUT_DIR = 'telemetry'
+CHUNK_SIZE = 4096              # 一度に配列へまとめるレコード数
+READ_BLOCK_SIZE = 1 << 16      # 従来の JSON 配列を読むときの 1 回の読み込み (文字)
+MAIN_MOTION_TYPE = 'strike'    # 精度分布・ループ別・総合評価の対象
+ACCURACY_BUCKETS_MS = (5.0, 10.0, 20.0)
+BUCKET_LABELS = ("🏆 優秀 (±5ms以内):  ", "👍 良好 (±10ms以内): ", "👌 普通 (±20ms以内): ", "⚠️  要改善(±20ms超過): ")
+HIST_RANGE_MS = (-200.0, 600.0)
+HIST_BIN_MS = 5.0
+HIST_BAR_WIDTH = 40
+# 総合評価: ±10ms 以内 (優秀 + 良好) の割合がこの値以上なら
+GRADES = (
+    (0.8, "🌟 EXCELLENT", "素晴らしい精度です！"),
+    (0.6, "✨ 良好", "良い精度です。"),
+    (0.4, "👌 普通", "もう少しで安定します。"),
+    (0.0, "⚠️  要改善", "送信の遅れや補正値を見直してください。"),
+)
+FILENAME_PATTERN = re.compile(r"timing_data_(.+)_\d+\.jsonl?$")
+FORMAT_VERSION = 1
+
+
+class TimingLogWriter:
+    """
+    動作ごとに 1 行を追記する。record() はキューに入れるだけで戻り (演奏のイベントループから呼ぶ)、
+    書き込みと flush は専用スレッドで行う。on_log は書き込みスレッドから呼ばれる
+    """
+    def __init__(self, track, directory=DEFAULT_OUTPUT_DIR, filename=None, on_log=print):
+        os.makedirs(directory, exist_ok=True)
+        self.track = track
+        self.path = os.path.join(directory, filename or f"timing_data_{track}_{int(time.time())}.jsonl")
+        self.on_log = on_log
+        self.count = 0
+        self.error = None
+        self._queue = queue.Queue()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name=f"TimingLog-{track}", daemon=True)
+        self._thread.start()
+
+    def record(self, loop_number, motion_index, target_position, planned_time, guided_time,
+               command_sent_time, actual_arrival_time, motion_type, scheduled_send_time=None, lateness=None,
+               predicted_arrival_time=None, arrival_source=None):
+        """actual_arrival_time は実測した到着だけ (測れなければ None)。見込みは predicted_arrival_time に"""
+        if self.error is not None: return
+        fields = {'arm': self.track, 'loop_number': int(loop_number), 'motion_index': int(motion_index),
+                  'target_position': [float(v) for v in target_position],
+                  'planned_time': planned_time, 'guided_time': guided_time,
+                  'scheduled_send_time': scheduled_send_time, 'command_sent_time': command_sent_time, 'lateness': lateness,
+                  'predicted_arrival_time': predicted_arrival_time,
+                  'actual_arrival_time': actual_arrival_time, 'arrival_source': arrival_source if actual_arrival_time is not None else None,
+                  'timing_error': actual_arrival_time - planned_time if actual_arrival_time is not None else None,
+                  'motion_type': motion_type}
+        self._queue.put(fields)
+
+    def _run(self):
+        try:
+            while True:
+                fields = self._queue.get()
+                if fields is None: break
+                if self.error is not None: continue
+                try:
+                    self._file.write(json.dumps(fields) + "\n")
+                    self._file.flush()
+                    self.count += 1
+                except (OSError, TypeError, ValueError) as e:
+                    self.error = e
+                    self.on_log(f"タイミング記録の書き込みに失敗: {self.path}: {e}")
+        finally:
+            try:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except (OSError, ValueError): pass
+            self._file.close()
+
+    def close(self, timeout=5.0):
+        """残りを書き切ってスレッドを止める (ブロッキング)"""
+        if not self._thread.is_alive(): return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+# --- 読み込み ---
+def arm_from_path(path):
+    match = FILENAME_PATTERN.search(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def _iter_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if not line: continue
+        try: yield json.loads(line)
+        except json.JSONDecodeError: continue   # 落ちたときの書きかけの行
+
+
+def _iter_json_array(f, block_size=READ_BLOCK_SIZE):
+    """JSON 配列の要素を少しずつデコードして返す (ファイル全体を読み込まない)"""
+    decoder = json.JSONDecoder()
+    buffer = ''; pos = 0; eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,[': pos += 1
+        if pos < len(buffer) and buffer[pos] == ']': return
+        try:
+            if pos >= len(buffer): raise json.JSONDecodeError("need more", buffer, pos)
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof: return   # 最後の要素が欠けていれば捨てる
+            more = f.read(block_size)
+            eof = not more
+            buffer = buffer[pos:] + more; pos = 0
+            continue
+        yield item
+        if pos > block_size: buffer = buffer[pos:]; pos = 0
+
+
+def iter_records(path):
+    """1 ファイルのレコードを順に返す (.jsonl でも従来の JSON 配列でもよい)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        head = f.read(1)
+        while head and head.isspace(): head = f.read(1)
+        if head == '[':
+            yield from _iter_json_array(f)
+        else:
+            f.seek(0)
+            yield from _iter_json_lines(f)
+
+
+def _float(value):
+    return np.nan if value is None else value
+
+
+def is_measured(record):
+    """到着が実測値か (従来の .json は実測、arrival_source の無い .jsonl は見込みを入れていたので実測ではない)"""
+    if 'arm' not in record: return True
+    return record.get('arrival_source') is not None
+
+
+def _to_chunk(records):
+    """レコードのリストを列の配列にし、誤差 (ms) と送信の遅れ (ms) をまとめて計算する。到着を実測していない動作の誤差は NaN"""
+    measured = np.array([is_measured(r) for r in records], dtype=bool)
+    planned = np.array([_float(r.get('planned_time')) for r in records], dtype=float)
+    arrival = np.array([_float(r.get('actual_arrival_time')) for r in records], dtype=float)
+    stored = np.array([_float(r.get('timing_error')) for r in records], dtype=float)
+    error_ms = (arrival - planned) * 1000.0
+    missing = ~np.isfinite(error_ms)
+    error_ms[missing] = stored[missing] * 1000.0
+    error_ms[~measured] = np.nan; arrival[~measured] = np.nan
+    scheduled = np.array([_float(r.get('scheduled_send_time')) for r in records], dtype=float)
+    sent = np.array([_float(r.get('command_sent_time')) for r in records], dtype=float)
+    return {'loop': np.array([r.get('loop_number', 0) for r in records], dtype=np.int64),
+            'motion_type': np.array([r.get('motion_type', '') for r in records], dtype=str),
+            'planned': planned, 'arrival': arrival, 'error_ms': error_ms, 'send_ms': (sent - scheduled) * 1000.0}
+
+
+def iter_chunks(paths, chunk_size=CHUNK_SIZE):
+    """(アーム名, 列の dict) を chunk_size レコードずつ返す。アーム名はレコードの arm、無ければファイル名から"""
+    for path in paths:
+        default_arm = arm_from_path(path) or 'unknown'
+        pending = {}
+        for record in iter_records(path):
+            arm = record.get('arm') or default_arm
+            batch = pending.setdefault(arm, [])
+            batch.append(record)
+            if len(batch) >= chunk_size:
+                yield arm, _to_chunk(batch); pending[arm] = []
+        for arm, batch in pending.items():
+            if batch: yield arm, _to_chunk(batch)
+
+
+# --- 集計 ---
+def accuracy_bucket(error_ms):
+    """|誤差| が 5 / 10 / 20ms 以内なら 0 / 1 / 2、それより大きければ 3"""
+    return np.searchsorted(ACCURACY_BUCKETS_MS, np.abs(error_ms), side='left')
+
+
+class ErrorStats:
+    """件数・合計・二乗和・最小・最大と精度分布。hist=True なら固定幅のヒストグラムも持つ"""
+    def __init__(self, hist=False):
+        self.count = 0; self.total = 0.0; self.total_sq = 0.0
+        self.min = np.inf; self.max = -np.inf
+        self.buckets = np.zeros(len(ACCURACY_BUCKETS_MS) + 1, dtype=np.int64)
+        # 両端は範囲外 (下 / 上) の件数
+        self.hist = np.zeros(int(round((HIST_RANGE_MS[1] - HIST_RANGE_MS[0]) / HIST_BIN_MS)) + 2, dtype=np.int64) if hist else None
+
+    def add(self, errors):
+        if len(errors) == 0: return
+        self.count += len(errors)
+        self.total += float(errors.sum()); self.total_sq += float(np.dot(errors, errors))
+        self.min = min(self.min, float(errors.min())); self.max = max(self.max, float(errors.max()))
+        self.buckets += np.bincount(accuracy_bucket(errors), minlength=len(self.buckets))
+        if self.hist is not None:
+            index = np.floor((errors - HIST_RANGE_MS[0]) / HIST_BIN_MS).astype(np.int64) + 1
+            self.hist += np.bincount(np.clip(index, 0, len(self.hist) - 1), minlength=len(self.hist))
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        """母標準偏差 (従来のレポートと同じ)"""
+        return float(np.sqrt(max(self.total_sq / self.count - self.mean ** 2, 0.0))) if self.count else 0.0
+
+
+class TimingAggregate:
+    """
+    アーム × 動作の種類 (ヒストグラム付き) と、アーム × 動作の種類 × ループの到着誤差の統計 (実測した動作だけ)。
+    unmeasured はアームごとの到着を測れなかった動作の数、send_lag はアームごとの「送信完了 − 送信予定」
+    """
+    def __init__(self):
+        self.records = 0
+        self.by_type = {}    # (arm, motion_type) -> ErrorStats(hist=True)
+        self.by_loop = {}    # (arm, motion_type, loop) -> ErrorStats
+        self.unmeasured = {}  # arm -> int
+        self.send_lag = {}   # arm -> ErrorStats
+
+    def add_chunk(self, arm, chunk):
+        self.records += len(chunk['error_ms'])
+        valid = np.isfinite(chunk['error_ms'])
+        self.unmeasured[arm] = self.unmeasured.get(arm, 0) + int(np.count_nonzero(~valid))
+        send_ms = chunk['send_ms'][np.isfinite(chunk['send_ms'])]
+        if len(send_ms): self.send_lag.setdefault(arm, ErrorStats()).add(send_ms)
+        for motion_type in np.unique(chunk['motion_type']):
+            mask = valid & (chunk['motion_type'] == motion_type)
+            errors = chunk['error_ms'][mask]
+            self.by_type.setdefault((arm, str(motion_type)), ErrorStats(hist=True)).add(errors)
+            loops = chunk['loop'][mask]
+            for loop in np.unique(loops):
+                self.by_loop.setdefault((arm, str(motion_type), int(loop)), ErrorStats()).add(errors[loops == loop])
+
+    @property
+    def arms(self):
+        return sorted({arm for arm, _ in self.by_type} | set(self.unmeasured))
+
+    def motion_types(self, arm):
+        return sorted(motion_type for a, motion_type in self.by_type if a == arm)
+
+    def loops(self, arm, motion_type):
+        return sorted((loop, stats) for (a, t, loop), stats in self.by_loop.items() if a == arm and t == motion_type)
+
+
+def aggregate_files(paths, chunk_size=CHUNK_SIZE):
+    aggregate = TimingAggregate()
+    for arm, chunk in iter_chunks(paths, chunk_size): aggregate.add_chunk(arm, chunk)
+    return aggregate
+
+
+def grade(stats):
+    """(評価, コメント)。±10ms 以内の割合で決める"""
+    ratio = (stats.buckets[0] + stats.buckets[1]) / stats.count if stats.count else 0.0
+    for threshold, label, comment in GRADES:
+        if ratio >= threshold: return label, comment
+    return GRADES[-1][1:]
+
+
+# --- レポート ---
+def _arm_lines(aggregate, arm):
+    lines = [f"\n🎯 =================== [{arm}] タイミング解析結果 ==================="]
+    send_lag = aggregate.send_lag.get(arm)
+    if send_lag is not None:
+        lines.append(f"📤 送信完了 − 送信予定: 平均 {send_lag.mean:+.1f}ms, 最大 {send_lag.max:+.1f}ms ({send_lag.count} 回)")
+    unmeasured = aggregate.unmeasured.get(arm, 0)
+    if unmeasured:
+        lines.append(f"❔ 到着を実測していない動作: {unmeasured} 回 (集計から除外。姿勢テレメトリを有効にするか、"
+                     f"strike_latency_analyzer.py --annotate-timing-log で打撃音から埋めてください)")
+    stats = aggregate.by_type.get((arm, MAIN_MOTION_TYPE))
+    if stats is None or stats.count == 0:
+        lines += ["実測した打撃がありません。", "=" * 64]
+        return lines
+    lines += [f"📈 総ストライク数: {stats.count} 回 (実測)",
+              f"⚖️  平均誤差: {stats.mean:+.2f}ms",
+              f"📏 標準偏差: {stats.std:.2f}ms",
+              f"🔺 最大誤差: {stats.max:+.2f}ms",
+              f"🔻 最小誤差: {stats.min:+.2f}ms",
+              "",
+              "🎯 精度分布:"]
+    for label, count in zip(BUCKET_LABELS, stats.buckets):
+        lines.append(f"   {label}{count:3d}回 ({count / stats.count * 100:5.1f}%)")
+    lines += ["", "🔄 ループ別パフォーマンス:"]
+    for loop, loop_stats in aggregate.loops(arm, MAIN_MOTION_TYPE):
+        lines.append(f"   L{loop:02d}: {loop_stats.count:2d}回 平均 {loop_stats.mean:+5.1f}ms "
+                     f"(最大{loop_stats.max:+6.1f}ms, 最小{loop_stats.min:+6.1f}ms)")
+    label, comment = grade(stats)
+    lines += ["", f"🏅 総合評価: {label}", f"💬 コメント: {comment}", "=" * 64]
+    return lines
+
+
+def _histogram_lines(stats):
+    """空でないビンだけを棒グラフにする"""
+    peak = stats.hist.max()
+    lines = []
+    for i in np.nonzero(stats.hist)[0]:
+        if i == 0: label = f"{'':>7} < {HIST_RANGE_MS[0]:+6.0f}"
+        elif i == len(stats.hist) - 1: label = f"{'':>7} ≥ {HIST_RANGE_MS[1]:+6.0f}"
+        else:
+            low = HIST_RANGE_MS[0] + (i - 1) * HIST_BIN_MS
+            label = f"{low:+6.0f} 〜 {low + HIST_BIN_MS:+6.0f}"
+        bar = "█" * max(1, int(round(stats.hist[i] / peak * HIST_BAR_WIDTH)))
+        lines.append(f"   {label}ms {stats.hist[i]:6d} {bar}")
+    return lines
+
+
+def _distribution_lines(aggregate):
+    lines = ["", "", "=" * 80, f"動作別の誤差分布 (ヒストグラム {HIST_BIN_MS:g}ms 幅)", "=" * 80]
+    for arm in aggregate.arms:
+        for motion_type in aggregate.motion_types(arm):
+            stats = aggregate.by_type[(arm, motion_type)]
+            if stats.count == 0: continue
+            lines.append(f"\n[{arm}] {motion_type}: {stats.count}回 平均 {stats.mean:+.2f}ms 標準偏差 {stats.std:.2f}ms "
+                         f"(最大{stats.max:+.1f}ms, 最小{stats.min:+.1f}ms)")
+            lines.extend(_histogram_lines(stats))
+    return lines
+
+
+def _detail_lines(paths, arm, chunk_size):
+    """打撃ごとの表。集計とは別にもう一度ファイルを流し読みする"""
+    yield ""
+    yield ""
+    yield "=" * 80
+    yield f"詳細データ (ストライク動作の時系列記録){'' if arm is None else f' [{arm}]'}"
+    yield "=" * 80
+    yield f"{'打撃番号':>8} {'計画時刻(ms)':>12} {'実際時刻(ms)':>12} {'誤差(ms)':>10}"
+    yield "-" * 80
+    number = 0
+    for chunk_arm, chunk in iter_chunks(paths, chunk_size):
+        if arm is not None and chunk_arm != arm: continue
+        mask = chunk['motion_type'] == MAIN_MOTION_TYPE
+        for planned, arrival, error in zip(chunk['planned'][mask], chunk['arrival'][mask], chunk['error_ms'][mask]):
+            number += 1
+            if np.isfinite(error): yield f"{number:8d} {planned * 1000:15.1f} {arrival * 1000:15.1f} {error:+10.1f}"
+            else: yield f"{number:8d} {planned * 1000:15.1f} {'---':>15} {'---':>10}"
+
+
+def iter_report_lines(paths, aggregate=None, details=True, chunk_size=CHUNK_SIZE):
+    """レポートを 1 行ずつ返す (打撃ごとの表も溜め込まずに書き出せる)"""
+    aggregate = aggregate or aggregate_files(paths, chunk_size)
+    yield "=" * 80
+    yield "ロボット演奏 タイミング解析レポート"
+    yield "=" * 80
+    yield f"生成日時: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    yield f"トラック: {', '.join(aggregate.arms)}"
+    yield f"総記録数: {aggregate.records}"
+    if len(paths) > 1: yield f"ファイル数: {len(paths)}"
+    yield ""
+    for arm in aggregate.arms: yield from _arm_lines(aggregate, arm)
+    yield from _distribution_lines(aggregate)
+    if not details: return
+    arms = aggregate.arms
+    for arm in (arms if len(arms) > 1 else [None]): yield from _detail_lines(paths, arm, chunk_size)
+
+
+def write_report(paths, report_path, details=True, chunk_size=CHUNK_SIZE):
+    tmp_path = report_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for line in iter_report_lines(paths, details=details, chunk_size=chunk_size): f.write(line + "\n")
+    os.replace(tmp_path, report_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ロボットのタイミング記録 (.jsonl / 従来の .json) からレポートを作る")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('-o', '--output', default=None, help="保存先 (省略時は標準出力)")
+    parser.add_argument('--no-details', action='store_true', help="打撃ごとの表を省く")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    if args.output:
+        write_report(args.paths, args.output, details=not args.no_details, chunk_size=args.chunk_size)
+        print(f"レポートを保存しました: {args.output}")
+    else:
+        for line in iter_report_lines(args.paths, details=not args.no_details, chunk_size=args.chunk_size):
+            sys.stdout.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
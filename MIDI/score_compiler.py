@@ -0,0 +1,201 @@
+"""
+楽譜 (JSON) のコンパイル: 読み取り専用の楽譜と、セッションごとの再生状態を分ける
+
+これまでは読み込んだ dict をそのまま使い回し、再生中に items へ is_lit / played_in_loop / lit_start_time を、
+トラックへ beats_per_measure / total_beats を書き込んでいた (music/test1.json に lit_start_time が残っているのはそのため)。
+書き換えられてしまうので、コントローラーやモニターには copy.deepcopy した楽譜を渡していた。
+ここでは
+  - compile_score(dict) が楽譜を 1 度だけ読み取り専用の CompiledScore にする。トラックごとに
+    拍位置・発音時刻 (ms)・長さ・種類コード・ノート ID を NumPy 配列 (書き込み不可) で持ち、ノート ID もここで振る
+  - 再生中のフラグ (このループで鳴らしたか / 点灯を始めた時刻) は PlaybackState の小さな配列に分け、再生ごとに作る
+CompiledScore / CompiledTrack は読み取り専用の Mapping なので、score['top'].get('bpm') や track['items'] のような
+これまでの読み方はそのまま使える (書き込もうとすると TypeError)。判定・再生・ロボットのプラン作成・モニターは
+同じ 1 つの CompiledScore をコピーせずに共有する。JSON に戻すときは to_json()。
+
+長さは楽譜の "num_measures" (省略時は NUM_MEASURES = 2 小節のループ)。32〜128 小節のような長い楽譜 (is_long) は
+練習画面が WINDOW_MEASURES 小節ずつのページで表示し、判定・再生は発音時刻でソートした索引 (searchsorted) で
+いまの時刻の近くだけを見るので、1 フレームの処理は曲の長さによらない。
+"""
+import json
+import types
+from collections.abc import Mapping
+
+import numpy as np
+
+# --- 設定 ---
+NUM_MEASURES = 2
+WINDOW_MEASURES = 2    # 長い楽譜で 1 ページに表示する小節数
+CLASS_NOTE = 0
+CLASS_REST = 1
+CLASS_OTHER = -1
+CLASS_CODES = {'note': CLASS_NOTE, 'rest': CLASS_REST}
+# 実行時に書き込まれていたキー (保存済みのファイルに残っていても読み込まない)
+ITEM_RUNTIME_KEYS = ('is_lit', 'played_in_loop', 'lit_start_time', 'id')
+TRACK_RUNTIME_KEYS = ('beats_per_measure', 'total_beats', 'last_elapsed_ms')
+
+
+def _readonly(array):
+    array.setflags(write=False)
+    return array
+
+
+def _freeze(value):
+    if isinstance(value, Mapping): return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)): return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping): return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple): return [_thaw(v) for v in value]
+    return value
+
+
+class _Frozen(Mapping):
+    """_fields を読み取り専用の Mapping として見せる。属性も初期化後は書き換えられない"""
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False): raise AttributeError(f"{type(self).__name__} は書き換えられません")
+        object.__setattr__(self, name, value)
+
+    def __getitem__(self, key): return self._fields[key]
+    def __iter__(self): return iter(self._fields)
+    def __len__(self): return len(self._fields)
+    # 書き換えられないので、コピーは自分自身でよい (残っている copy.deepcopy も安く済む)
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
+
+
+class CompiledTrack(_Frozen):
+    """
+    1 トラック分。Mapping としては bpm / numerator / denominator / beats_per_measure / total_beats / items (と元の JSON のその他のキー)。
+    entries は items (読み取り専用の dict の tuple)。配列 (すべて items と同じ順): beats, onset_ms, durations, classes (CLASS_*), note_ids (休符は '')
+    ノートだけ: note_index (items 内の位置), note_onset_ms, note_id_list
+    索引: item_order / note_order (発音時刻順の並び) と sorted_onset_ms / sorted_note_onset_ms。範囲の検索は *_between
+    """
+    def __init__(self, name, data, first_note_number=0, num_measures=NUM_MEASURES):
+        self.name = name
+        self.bpm = float(data.get('bpm', 120))
+        self.numerator = data.get('numerator', 4); self.denominator = data.get('denominator', 4)
+        self.ms_per_beat = 60000.0 / self.bpm if self.bpm > 0 else 0.0
+        self.beats_per_measure = (self.numerator / self.denominator) * 4.0
+        self.total_beats = self.beats_per_measure * num_measures
+        self.loop_duration_ms = self.ms_per_beat * self.total_beats
+        self.window_beats = min(self.total_beats, self.beats_per_measure * WINDOW_MEASURES)
+
+        items = []; note_number = first_note_number
+        for item in data.get('items', []):
+            clean = {k: _freeze(v) for k, v in item.items() if k not in ITEM_RUNTIME_KEYS}
+            if clean.get('class') == 'note':
+                # トラック名と通し番号で一意な ID (例: top-0, top-1, ..., bottom-5)
+                clean['id'] = f"{name}-{note_number}"; note_number += 1
+            items.append(types.MappingProxyType(clean))
+        self.entries = tuple(items)   # items の読み取り専用ビュー (Mapping の items() と名前がぶつかるので別名)
+
+        self.beats = _readonly(np.array([item.get('beat', 0.0) for item in items], dtype=float))
+        self.onset_ms = _readonly(self.beats * self.ms_per_beat)
+        self.durations = _readonly(np.array([item.get('duration', 0.0) for item in items], dtype=float))
+        self.classes = _readonly(np.array([CLASS_CODES.get(item.get('class'), CLASS_OTHER) for item in items], dtype=np.int8))
+        self.note_ids = _readonly(np.array([item.get('id', '') for item in items], dtype=str))
+        self.note_index = _readonly(np.flatnonzero(self.classes == CLASS_NOTE))
+        self.note_onset_ms = _readonly(self.onset_ms[self.note_index])
+        self.note_id_list = tuple(items[i]['id'] for i in self.note_index)
+        # 発音時刻順の索引 (同じ時刻なら items の順)
+        self.item_order = _readonly(np.argsort(self.onset_ms, kind='stable'))
+        self.sorted_onset_ms = _readonly(self.onset_ms[self.item_order])
+        self.note_order = _readonly(np.argsort(self.note_onset_ms, kind='stable'))
+        self.sorted_note_onset_ms = _readonly(self.note_onset_ms[self.note_order])
+
+        fields = {k: _freeze(v) for k, v in data.items() if k not in TRACK_RUNTIME_KEYS and k != 'items'}
+        fields.update(beats_per_measure=self.beats_per_measure, total_beats=self.total_beats, items=self.entries)
+        self._fields = types.MappingProxyType(fields)
+        self._frozen = True
+
+    @property
+    def note_count(self):
+        return len(self.note_index)
+
+    def items_between(self, start_ms, end_ms):
+        """発音時刻が start_ms 以上 end_ms 以下の items の位置 (items の順)"""
+        lo = int(np.searchsorted(self.sorted_onset_ms, start_ms, side='left'))
+        hi = int(np.searchsorted(self.sorted_onset_ms, end_ms, side='right'))
+        return np.sort(self.item_order[lo:hi])
+
+    def notes_between(self, start_ms, end_ms):
+        """発音時刻が start_ms 以上 end_ms 以下のノートの番号 (note_onset_ms / note_id_list の位置、ノートの順)"""
+        lo = int(np.searchsorted(self.sorted_note_onset_ms, start_ms, side='left'))
+        hi = int(np.searchsorted(self.sorted_note_onset_ms, end_ms, side='right'))
+        return np.sort(self.note_order[lo:hi])
+
+    def window_start_beat(self, beat):
+        """beat を含むページ (window_beats 拍ずつ) の先頭の拍。短い楽譜は常に 0"""
+        if self.window_beats <= 0 or self.window_beats >= self.total_beats: return 0.0
+        page = min(max(int(beat // self.window_beats), 0), int(np.ceil(self.total_beats / self.window_beats)) - 1)
+        return page * self.window_beats
+
+
+class CompiledScore(_Frozen):
+    """
+    楽譜全体。Mapping としては元の JSON と同じキー (トラックは CompiledTrack、robot_routing などはそのまま読み取り専用で)。
+    tracks: {トラック名: CompiledTrack}、total_notes、loop_duration_ms (全トラックで最も長いループ)
+    num_measures を省略すると楽譜の "num_measures" (無ければ NUM_MEASURES)。is_long は 1 ページに収まらない長い楽譜
+    """
+    def __init__(self, data, num_measures=None, source=None):
+        self.source = source
+        if num_measures is None: num_measures = int(data.get('num_measures', NUM_MEASURES))
+        self.num_measures = num_measures
+        self.is_long = num_measures > WINDOW_MEASURES
+        fields = {}; tracks = {}; note_number = 0
+        for key, value in data.items():
+            if isinstance(value, Mapping) and 'items' in value:
+                track = CompiledTrack(key, value, note_number, num_measures)
+                note_number += track.note_count
+                tracks[key] = fields[key] = track
+            else:
+                fields[key] = _freeze(value)
+        self.tracks = types.MappingProxyType(tracks)
+        self.total_notes = note_number
+        self.loop_duration_ms = max((track.loop_duration_ms for track in tracks.values()), default=0.0)
+        self._fields = types.MappingProxyType(fields)
+        self._frozen = True
+
+    def to_json(self):
+        """保存・ログ用の普通の dict (ノート ID と導出した beats_per_measure / total_beats を含む)"""
+        return _thaw(self)
+
+
+def compile_score(data, num_measures=None, source=None):
+    """dict を CompiledScore にする (すでにコンパイル済みならそのまま返す)"""
+    if isinstance(data, CompiledScore): return data
+    return CompiledScore(data, num_measures, source)
+
+
+def load_score(path, num_measures=None):
+    with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+    return compile_score(data, num_measures, source=path)
+
+
+class PlaybackState:
+    """
+    再生 1 回分の状態。楽譜とは別に、トラックごとに items と同じ長さの小さな配列で持つ
+      played       : このループで鳴らした (ガイド音・点灯を済ませた) か
+      lit_start_ms : 点灯を始めた経過時間 (ms)。点灯していなければ NaN
+    """
+    def __init__(self, score):
+        self.played = {name: np.zeros(len(track.entries), dtype=bool) for name, track in score.tracks.items()}
+        self.lit_start_ms = {name: np.full(len(track.entries), np.nan) for name, track in score.tracks.items()}
+
+    def clear_played(self):
+        for played in self.played.values(): played[:] = False
+
+    def reset(self):
+        self.clear_played()
+        for lit in self.lit_start_ms.values(): lit[:] = np.nan
+
+    def lit_mask(self, track_name, now_ms, duration_ms, index=None):
+        """now_ms の時点で点灯中の items (点灯開始から duration_ms 未満。開始前は消灯)。index を渡すとその位置だけ"""
+        lit = self.lit_start_ms.get(track_name)
+        if lit is None: return np.zeros(0, dtype=bool)
+        if index is not None: lit = lit[index]
+        with np.errstate(invalid='ignore'):
+            diff = now_ms - lit
+            return (diff >= 0) & (diff < duration_ms)
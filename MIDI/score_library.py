@@ -0,0 +1,214 @@
+"""
+楽譜ライブラリ: 楽譜フォルダ (music/) の索引
+
+これまでは FileSelectionDialog.populate_files とエディターの refresh_file_list が開くたびにフォルダを一覧し、
+楽譜の中身 (BPM や難易度) は開くまで分からなかった。ここでは
+  - フォルダを 1 度スキャンして、楽譜ごとに BPM・拍子・トラックごとのノート数・ループの長さ・難易度 (rhythm_difficulty) を
+    索引に持つ。索引は (ファイル名, mtime, サイズ) をキーにフォルダ内の INDEX_FILENAME に保存し、次回の起動でも使う
+  - refresh() は stat だけで変わったファイルを見つけ、そのファイルだけ読み直す
+  - watch() で QFileSystemWatcher (PyQt6 / PySide6) につなぐと、追加・変更・削除のたびに refresh() する
+  - 並べ替え・絞り込み (query) はメモリ上の索引だけで行うので、ファイルは読まない
+
+    python score_library.py ../music                        # 一覧 (名前順)
+    python score_library.py ../music --sort difficulty --min-bpm 90 --max-bpm 120
+"""
+import os
+import json
+import argparse
+
+import rhythm_difficulty
+
+# --- 設定 ---
+# 楽譜フォルダに置く索引 (拡張子を .json にしないのは、楽譜の一覧に混ざらないようにするため)
+INDEX_FILENAME = '.score_index'
+INDEX_VERSION = 1
+NUM_MEASURES = rhythm_difficulty.NUM_MEASURES
+SORT_KEYS = ('name', 'bpm', 'difficulty', 'notes', 'loop_duration_ms', 'mtime')
+
+_LIBRARIES = {}
+
+
+def is_score_file(filename):
+    return filename.endswith('.json') and not filename.startswith('.')
+
+
+def describe_score(data):
+    """楽譜 (JSON の dict) から索引に入れるメタデータを作る"""
+    num_measures = int(data.get('num_measures', NUM_MEASURES))
+    tracks = {}
+    for name, track in data.items():
+        if not isinstance(track, dict) or 'items' not in track: continue
+        bpm = track.get('bpm', 120)
+        beats_per_measure = rhythm_difficulty.beats_per_measure(track)
+        tracks[name] = {
+            'bpm': bpm, 'numerator': track.get('numerator', 4), 'denominator': track.get('denominator', 4),
+            'notes': sum(1 for item in track['items'] if item.get('class') == 'note'),
+            'loop_duration_ms': (60000.0 / bpm) * beats_per_measure * num_measures if bpm > 0 else 0.0,
+        }
+    main = tracks.get('top') or next(iter(tracks.values()), {})
+    difficulty = rhythm_difficulty.score_difficulty(data, num_measures)
+    return {
+        'bpm': main.get('bpm'),
+        'time_signature': f"{main['numerator']}/{main['denominator']}" if main else None,
+        'num_measures': num_measures,
+        'tracks': tracks,
+        'notes': sum(track['notes'] for track in tracks.values()),
+        'loop_duration_ms': max((track['loop_duration_ms'] for track in tracks.values()), default=0.0),
+        # 2 トラックなら総合難易度、1 トラックならそのトラックの難易度
+        'difficulty': difficulty['combined'] if difficulty['combined'] is not None else (difficulty['top'] if difficulty['top'] is not None else difficulty['bottom']),
+        'difficulty_tracks': {name: value for name, value in difficulty.items() if value is not None and name != 'combined'},
+    }
+
+
+def read_entry(job):
+    """(フォルダ, ファイル名, mtime_ns, size) の楽譜を読んで索引のエントリにする (ワーカーからも呼ぶ)"""
+    directory, filename, mtime_ns, size = job
+    path = os.path.join(directory, filename)
+    entry = {'name': filename[:-len('.json')], 'filename': filename, 'path': path, 'mtime_ns': mtime_ns, 'size': size}
+    try:
+        with open(path, 'r', encoding='utf-8') as f: entry.update(describe_score(json.load(f)))
+    except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+        entry['error'] = str(e)
+    return entry
+
+
+class ScoreLibrary:
+    """
+    1 フォルダ分の索引。entries は {ファイル名: エントリ} で、エントリは describe_score の内容に
+    name (拡張子なし) / filename / path / mtime_ns / size を足した dict (読めなかったファイルは metadata の代わりに error)
+    """
+    def __init__(self, directory, index_path=None, on_log=print):
+        self.directory = directory
+        self.index_path = index_path or os.path.join(directory, INDEX_FILENAME)
+        self.on_log = on_log
+        self.entries = {}
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f: index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') != INDEX_VERSION: return
+        for filename, entry in index.get('entries', {}).items():
+            entry['path'] = os.path.join(self.directory, filename)
+            self.entries[filename] = entry
+
+    def save_index(self):
+        """索引を書き出す (途中で落ちても壊れないよう、一時ファイルに書いてから置き換える)"""
+        entries = {filename: {k: v for k, v in entry.items() if k != 'path'} for filename, entry in self.entries.items()}
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'entries': entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            self.on_log(f"楽譜の索引を保存できません: {e}")
+
+    def refresh(self, jobs=None):
+        """
+        フォルダを stat して索引を最新にする (変わったファイルだけ読む。多ければ rhythm_difficulty.run_batch で並列に)。
+        変化があれば (追加, 更新, 削除) のファイル名リストを、無ければ None を返す
+        """
+        try:
+            filenames = [f for f in os.listdir(self.directory) if is_score_file(f)]
+        except OSError as e:
+            self.on_log(f"楽譜フォルダを読めません: {e}")
+            return None
+        added, updated, todo = [], [], []
+        for filename in filenames:
+            try: stat = os.stat(os.path.join(self.directory, filename))
+            except OSError: continue
+            entry = self.entries.get(filename)
+            if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size): continue
+            (updated if entry is not None else added).append(filename)
+            todo.append((self.directory, filename, stat.st_mtime_ns, stat.st_size))
+        for entry in rhythm_difficulty.run_batch(read_entry, todo, jobs): self.entries[entry['filename']] = entry
+        present = set(filenames)
+        removed = [filename for filename in self.entries if filename not in present]
+        for filename in removed: del self.entries[filename]
+        if not (added or updated or removed): return None
+        self.save_index()
+        return added, updated, removed
+
+    def query(self, sort_by='name', descending=False, min_difficulty=None, max_difficulty=None, min_bpm=None, max_bpm=None):
+        """
+        索引だけで絞り込み・並べ替えたエントリのリスト。値の無いエントリ (読めなかった楽譜など) は
+        その条件で絞り込むと外れ、並べ替えでは最後に来る
+        """
+        if sort_by not in SORT_KEYS: raise ValueError(f"並べ替えのキーが不正です: {sort_by} ({', '.join(SORT_KEYS)})")
+
+        def within(value, low, high):
+            if low is None and high is None: return True
+            if value is None: return False
+            return (low is None or value >= low) and (high is None or value <= high)
+
+        entries = [entry for entry in self.entries.values()
+                   if within(entry.get('difficulty'), min_difficulty, max_difficulty) and within(entry.get('bpm'), min_bpm, max_bpm)]
+        key_name = 'mtime_ns' if sort_by == 'mtime' else sort_by
+        present = [entry for entry in entries if entry.get(key_name) is not None]
+        missing = [entry for entry in entries if entry.get(key_name) is None]
+        present.sort(key=lambda entry: (entry[key_name], entry['name']), reverse=descending)
+        missing.sort(key=lambda entry: entry['name'])
+        return present + missing
+
+
+def get_library(directory, on_log=print):
+    """フォルダごとに 1 つの ScoreLibrary を返す (初回だけ索引を読んでスキャンする)"""
+    key = os.path.abspath(directory)
+    library = _LIBRARIES.get(key)
+    if library is None:
+        library = _LIBRARIES[key] = ScoreLibrary(directory, on_log=on_log)
+        library.refresh()
+    return library
+
+
+def watch(watcher, library, on_changed=None):
+    """
+    QFileSystemWatcher (PyQt6 / PySide6 のどちらでも) でフォルダと楽譜ファイルを監視し、
+    変化があれば library.refresh() して on_changed() を呼ぶ。
+    上書き保存で置き換えられたファイルは監視から外れるので、refresh のたびに監視対象を付け直す
+    """
+    def sync_paths():
+        wanted = {library.directory} | {entry['path'] for entry in library.entries.values()}
+        current = set(watcher.files()) | set(watcher.directories())
+        stale = [path for path in current if path not in wanted]
+        new = [path for path in wanted if path not in current and os.path.exists(path)]
+        if stale: watcher.removePaths(stale)
+        if new: watcher.addPaths(new)
+
+    def changed(_path):
+        if library.refresh() is not None and on_changed is not None: on_changed()
+        sync_paths()
+
+    watcher.directoryChanged.connect(changed)
+    watcher.fileChanged.connect(changed)
+    sync_paths()
+    return watcher
+
+
+def format_entry(entry):
+    if 'error' in entry: return f"{entry['name']:<24} (読み込めません: {entry['error']})"
+    difficulty = f"{entry['difficulty']:.2f}" if entry.get('difficulty') is not None else "-"
+    notes = " ".join(f"{name}:{track['notes']}" for name, track in entry['tracks'].items())
+    return (f"{entry['name']:<24} BPM {entry['bpm']:>3} {entry['time_signature']:>5} {entry['num_measures']:>3}小節 "
+            f"{entry['loop_duration_ms'] / 1000:6.2f}s 難易度 {difficulty:>5}  ノート {notes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="楽譜フォルダの索引を作って一覧する")
+    parser.add_argument('directory')
+    parser.add_argument('--sort', choices=SORT_KEYS, default='name')
+    parser.add_argument('--desc', action='store_true')
+    parser.add_argument('--min-difficulty', type=float); parser.add_argument('--max-difficulty', type=float)
+    parser.add_argument('--min-bpm', type=float); parser.add_argument('--max-bpm', type=float)
+    parser.add_argument('--jobs', type=int, default=None, help="読み直す楽譜が多いときの並列数 (省略時は CPU 数)")
+    args = parser.parse_args()
+    library = ScoreLibrary(args.directory)
+    library.refresh(args.jobs)
+    for entry in library.query(args.sort, args.desc, args.min_difficulty, args.max_difficulty, args.min_bpm, args.max_bpm):
+        print(format_entry(entry))
+
+
+if __name__ == "__main__":
+    main()
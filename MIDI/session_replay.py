@@ -0,0 +1,244 @@
+"""
+セッションログ (midi_session_log.py) をヘッドレスに流し直す
+
+    python session_replay.py session_logs/midi_20251020_153000.mlog
+    python session_replay.py log.mlog --realtime --speed 2        # 記録した間隔 (の 1/2) で流す
+    python session_replay.py log.mlog --save result.json          # 再生結果を保存
+    python session_replay.py log.mlog --expect result.json        # 保存した結果と突き合わせる (判定ロジックの回帰テスト)
+    python session_replay.py log.mlog --repeat 200                # 判定経路のベンチマーク
+
+training_module_v5.py と同じ順序で処理する:
+  振り分け (midi_input_hub の表) → 連打の無視 (DEBOUNCE) → judgement.judge_hit → 見逃し (judgement.dropped_notes)
+  → ループの終わりで judgement_history に追加してコントローラーの update_performance_data → judged_notes をクリア
+ループの終わりでは、次のループの各ノートについてコントローラーの get_guided_timing (ロボットが使う誘導後の時刻) も記録する。
+UI は約 60fps のポーリングで見逃しと連打を判定するので、フレーム境界ぎりぎりの打撃は記録時の判定と食い違うことがある
+(その数は session_end に残した判定との比較で表示する)。再生どうしの結果は常に同じになる。
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+import judgement
+import score_compiler
+import midi_input_hub
+import midi_session_log
+
+# --- 設定 ---
+DEFAULT_PAD_TRACKS = {'left': 'top', 'right': 'bottom'}
+DEFAULT_DEBOUNCE_MS = 70
+BOUNDARY_EPSILON_MS = 1e-6
+
+
+class SessionReplay:
+    """1 セッション分の判定状態 (MainWindow の recorded_hits / judgements / judged_notes / judgement_history に相当)"""
+    def __init__(self, start, controller=None):
+        self.start = start
+        self.score = score_compiler.compile_score(start['score'])
+        self.master_start_time = start['master_start_time']
+        self.loop_duration_ms = start.get('loop_duration_ms') or 0
+        self.is_perfect_mode = start.get('is_perfect_mode', False)
+        self.max_loops = start.get('max_loops') or float('inf')
+        self.debounce_ms = start.get('debounce_ms', DEFAULT_DEBOUNCE_MS)
+        self.pad_tracks = start.get('pad_tracks') or DEFAULT_PAD_TRACKS
+        self.tables = [midi_input_hub.build_routing_table(device) for device in (start.get('devices') or [])]
+        self.controller = controller
+
+        self.judgements = []; self.judged_notes = {}; self.judgement_history = []
+        self.last_drop_scan_ms = None   # 前回見逃しを確認したループ内の時刻 (judgement.dropped_notes の since_ms)
+        self.guided_timings = []    # ループごとの {トラック: [誘導後の時刻ms, ...]}
+        self.controller_logs = []
+        self.loop_count = 1
+        self.next_evaluation_time = self.loop_duration_ms
+        self.last_input_time = {}
+        self.finished = False
+        self.ignored = 0
+
+    def elapsed_ms(self, timestamp):
+        return (timestamp - self.master_start_time) * 1000.0
+
+    def advance(self, elapsed_ms):
+        """elapsed_ms までの見逃しとループの終わりを処理する"""
+        if self.finished or self.loop_duration_ms <= 0: return
+        while not self.finished:
+            if self.is_perfect_mode:
+                if elapsed_ms < self.next_evaluation_time: break
+                # 境界の直前までの見逃しを拾ってからループを締める
+                self._drops(self.next_evaluation_time - BOUNDARY_EPSILON_MS)
+                self.evaluate_loop(self.next_evaluation_time)
+            else:
+                if elapsed_ms >= self.loop_duration_ms:
+                    self._drops(self.loop_duration_ms - BOUNDARY_EPSILON_MS); self.finished = True
+                break
+        if not self.finished: self._drops(elapsed_ms)
+
+    def _drops(self, elapsed_ms):
+        if elapsed_ms < 0: return
+        time_in_loop = elapsed_ms % self.loop_duration_ms
+        for track_name, note_id in judgement.dropped_notes(self.score, self.judged_notes, time_in_loop, since_ms=self.last_drop_scan_ms):
+            self.judgements.append({'judgement': 'dropped', 'error_ms': None, 'pad': track_name, 'note_id': note_id, 'hit_time': None})
+            self.judged_notes[note_id] = elapsed_ms
+        self.last_drop_scan_ms = time_in_loop
+
+    def evaluate_loop(self, elapsed_ms):
+        self.judgement_history.append(list(self.judgements))
+        if self.controller is not None:
+            log = self.controller.update_performance_data(self.judgement_history)
+            if log: self.controller_logs.append(log)
+            self.guided_timings.append(self._guided_timings())
+        # 最後のループも判定は judgement_history に移したので、judgements には残さない (二重に数えない)
+        self.judgements.clear(); self.judged_notes.clear(); self.last_drop_scan_ms = None
+        if self.loop_count >= self.max_loops:
+            self.finished = True; return
+        self.loop_count += 1
+        self.next_evaluation_time = (int(round(elapsed_ms / self.loop_duration_ms)) + 1) * self.loop_duration_ms
+
+    def _guided_timings(self):
+        timings = {}
+        for track_name, track in self.score.tracks.items():
+            timings[track_name] = [self.controller.get_guided_timing(track_name, note_ms)[0] for note_ms in track.note_onset_ms.tolist()]
+        return timings
+
+    def note_on(self, timestamp, port, note, velocity):
+        """process_midi_input と同じ処理を 1 打分行う"""
+        elapsed_ms = self.elapsed_ms(timestamp)
+        self.advance(elapsed_ms)
+        if self.finished or port >= len(self.tables): self.ignored += 1; return None
+        route = self.tables[port][note]
+        if route is None or velocity < route.velocity_threshold or route.role != midi_input_hub.DEFAULT_ROLE:
+            self.ignored += 1; return None
+        pad = self.pad_tracks.get(route.pad)
+        if not pad: self.ignored += 1; return None
+        if elapsed_ms - self.last_input_time.get(pad, -float('inf')) < self.debounce_ms: return None
+        self.last_input_time[pad] = elapsed_ms
+        if elapsed_ms < 0: return None  # カウントダウン中は記録しない
+        hit = {'time': elapsed_ms, 'pad': pad}
+        result, error_ms, note_id = judgement.judge_hit(hit, self.score, self.judged_notes)
+        entry = {'judgement': result, 'error_ms': error_ms, 'pad': pad, 'note_id': note_id, 'hit_time': elapsed_ms}
+        self.judgements.append(entry)
+        return entry
+
+    def finish(self, end_timestamp=None):
+        if end_timestamp is not None: self.advance(self.elapsed_ms(end_timestamp))
+
+    def result(self):
+        return {'judgement_history': self.judgement_history, 'judgements': self.judgements,
+                'guided_timings': self.guided_timings, 'controller_logs': self.controller_logs}
+
+
+def load_controller(name, score):
+    """記録したコントローラー名 (表示名) から新しいインスタンスを作る (見つからなければ None)"""
+    if not name: return None
+    import controller_registry
+    controllers = controller_registry.load_controllers()
+    entry = controllers.get(name)
+    if entry is None:
+        print(f"コントローラー '{name}' が見つかりません (コントローラー無しで再生します)"); return None
+    ms_per_beat = 60000.0 / score.get('top', {}).get('bpm', 120)
+    return entry(score, ms_per_beat)
+
+
+def replay_session(session, controller_name=None, realtime=False, speed=1.0, quiet=True):
+    """セッションを 1 回流して SessionReplay を返す"""
+    start = session.start
+    name = controller_name if controller_name is not None else start.get('controller')
+    output = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        score = score_compiler.compile_score(start['score'])
+        replay = SessionReplay(dict(start, score=score), load_controller(name, score))
+        notes = session.notes
+        wall_start = time.perf_counter(); first = notes['t'][0] if len(notes) else 0.0
+        for t, port, note, velocity in notes.tolist():
+            if realtime:
+                delay = (t - first) / speed - (time.perf_counter() - wall_start)
+                if delay > 0: time.sleep(delay)
+            replay.note_on(t, port, note, velocity)
+        replay.finish(session.end_time if session.end_time is not None else (notes['t'][-1] if len(notes) else None))
+    return replay
+
+
+def judgement_key(entry):
+    error = entry.get('error_ms')
+    return (entry.get('judgement'), entry.get('pad'), entry.get('note_id'), None if error is None else round(error, 3))
+
+
+def result_loops(result):
+    """
+    ループごとの判定列 (judgement_history + まだ締めていないループの judgements)。
+    記録時の session_end は最後のループを締めた後も judgements を残していることがあるので、
+    最後の履歴と同じ judgements は足さない
+    """
+    history = list(result.get('judgement_history', []))
+    current = list(result.get('judgements', []))
+    if not current or (history and history[-1] == current): return history
+    return history + [current]
+
+
+def compare(expected, actual):
+    """ループごとの判定列を比べ、(比べた数, 食い違い数) を返す"""
+    expected_loops = result_loops(expected)
+    actual_loops = result_loops(actual)
+    total = mismatched = 0
+    for loop_expected, loop_actual in zip(expected_loops, actual_loops):
+        keys_expected = [judgement_key(j) for j in loop_expected]; keys_actual = [judgement_key(j) for j in loop_actual]
+        total += max(len(keys_expected), len(keys_actual))
+        mismatched += sum(a != b for a, b in zip(keys_expected, keys_actual)) + abs(len(keys_expected) - len(keys_actual))
+    for loop in (expected_loops[len(actual_loops):] or actual_loops[len(expected_loops):]):
+        total += len(loop); mismatched += len(loop)
+    return total, mismatched
+
+
+def summarize(result):
+    counts = {}
+    for loop in result_loops(result):
+        for entry in loop: counts[entry['judgement']] = counts.get(entry['judgement'], 0) + 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="セッションログを判定とコントローラーに流し直す")
+    parser.add_argument('log')
+    parser.add_argument('--session', type=int, default=None, help="ログ内の何番目のセッションか (省略時はすべて)")
+    parser.add_argument('--realtime', action='store_true', help="記録した間隔で流す (省略時はできるだけ速く)")
+    parser.add_argument('--speed', type=float, default=1.0, help="--realtime の再生速度")
+    parser.add_argument('--controller', default=None, help="記録と違うコントローラーで流す (表示名)")
+    parser.add_argument('--save', default=None, help="再生結果を JSON で保存する")
+    parser.add_argument('--expect', default=None, help="保存した再生結果と突き合わせる")
+    parser.add_argument('--repeat', type=int, default=1, help="ベンチマーク用に繰り返す回数")
+    parser.add_argument('--verbose', action='store_true', help="コントローラーの出力を表示する")
+    args = parser.parse_args()
+
+    sessions = midi_session_log.load_sessions(args.log)
+    if args.session is not None: sessions = [sessions[args.session]]
+    if not sessions: print("セッションがありません。"); return
+
+    results = []; regressions = 0
+    for index, session in enumerate(sessions):
+        started = time.perf_counter()
+        for _ in range(max(1, args.repeat)):
+            replay = replay_session(session, args.controller, args.realtime, args.speed, quiet=not args.verbose)
+        elapsed = (time.perf_counter() - started) / max(1, args.repeat)
+        result = replay.result(); results.append(result)
+        hits = len(session.notes)
+        print(f"[{index}] {session.start.get('state')} {hits}打, {len(result['judgement_history'])}ループ, "
+              f"コントローラー {session.start.get('controller') if args.controller is None else args.controller}: {summarize(result)}")
+        if hits and elapsed > 0: print(f"    再生 {elapsed * 1000:.1f}ms ({hits / elapsed:.0f}打/秒)")
+        if session.end and 'judgement_history' in session.end:
+            total, mismatched = compare(session.end, result)
+            print(f"    記録時の判定との食い違い: {mismatched}/{total}")
+    if args.expect:
+        with open(args.expect, 'r', encoding='utf-8') as f: expected = json.load(f)
+        for index, (e, a) in enumerate(zip(expected, results)):
+            total, mismatched = compare(e, a)
+            regressions += mismatched
+            print(f"[{index}] 保存した結果との食い違い: {mismatched}/{total}")
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f: json.dump(results, f, ensure_ascii=False, indent=1)
+        print(f"再生結果を保存しました: {args.save}")
+    if regressions: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+打撃音の録音から実際の打撃時刻を測り、予定とのずれを解析する
+
+    python strike_latency_analyzer.py session.wav --plan telemetry/pose_arm2_1760000000.npz
+    python strike_latency_analyzer.py session.wav --plan ../timing_data_bottom_1758020085.json --wav-start 1758020078.52
+    python strike_latency_analyzer.py session.wav --plan telemetry/timing_data_arm1_1760000000.jsonl --annotate-timing-log arm1_measured.jsonl
+
+  - 録音は onset_detector.py でブロックごとに読み (長い録音でもメモリは一定)、打撃音の立ち上がりを検出する
+  - 予定の打撃時刻は
+      姿勢テレメトリ (.npz): モーションプラン + master_start_time + loop_duration から並べる
+      タイミング記録 (.jsonl / 従来の .json): motion_type == "strike" の planned_time (と command_sent_time)
+  - 録音の先頭の時刻 (time.time 基準) は --wav-start、なければ <wav>.json の "start_time"、
+    どちらもなければファイルの更新時刻 − 長さ (録音を止めた時刻で書かれる前提。数十 ms ずれうるので補正値は書かない)
+  - 予定とオンセットを互いに最も近いもの同士 (±max_offset 以内) で 1 対 1 に対応させ、
+    打撃ごと (ループ内の何打目か) と全体の「打撃音 − 予定」「打撃音 − 送信」の分布を表示する
+
+--write-calibration を付けると、2 ループ目以降の誤差の中央値を STRIKE_CALIBRATION_PATH のアームの
+strike_offset_s に足し込む。robot_control_module_v4.py は起動時にこれを読み、送信の遅れに上乗せする
+(音が予定より遅ければその分早く送る)。何度か録音と書き込みを繰り返すと誤差が 0 に近づく。
+
+--annotate-timing-log OUT を付けると、タイミング記録 (.jsonl) の打撃に対応したオンセットを実測の到着
+(actual_arrival_time, arrival_source = "audio") として書き込んだコピーを OUT に作る。robot_timing_log.py の
+レポートはそれを使って精度分布・総合評価を出す。
+"""
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+import onset_detector
+
+# --- 設定 ---
+STRIKE_CALIBRATION_PATH = 'strike_calibration.json'
+DEFAULT_MAX_OFFSET_S = 0.7      # 一打目は 0.5 秒以上遅れることがあるので広めに取る
+CALIBRATION_GAIN = 1.0          # 測った誤差のうち補正値に反映する割合
+MAX_STRIKE_OFFSET_S = 0.3       # 補正値の上限 (誤検出で極端な値にならないように)
+MIN_CALIBRATION_STRIKES = 8
+DEFAULT_ARM_KEY = '*'           # アーム名が分からないときの既定 (全アームに効く)
+FORMAT_VERSION = 1
+
+
+def load_plan(path, wav_end=None):
+    """
+    予定の打撃を読む。
+    返り値: (planned, loops, indices, command_sent or None, arm_name or None)
+      planned: 打撃の予定時刻 (time.time 基準)、loops: ループ番号、indices: ループ内の何打目か
+    """
+    if path.endswith('.npz'):
+        import pose_telemetry
+        import motion_plan_compiler
+        samples, wall, metadata, motion_plan = pose_telemetry.load_telemetry(path)
+        if motion_plan is None or metadata.get('master_start_time') is None:
+            raise ValueError(f"{path} にモーションプランか master_start_time がありません")
+        until = max(wall[-1] if len(wall) else 0.0, wav_end or 0.0, metadata['master_start_time'])
+        planned = pose_telemetry.planned_strike_times(motion_plan, metadata['master_start_time'], metadata.get('loop_duration', 0), until)
+        per_loop = int(np.count_nonzero(motion_plan['action'] == motion_plan_compiler.ACTION_STRIKE))
+        n = np.arange(len(planned))
+        return planned, n // max(per_loop, 1), n % max(per_loop, 1), None, metadata.get('name')
+
+    import robot_timing_log
+    strikes = sorted((r for r in robot_timing_log.iter_records(path) if r.get('motion_type') == 'strike'), key=lambda r: r['planned_time'])
+    planned = np.array([r['planned_time'] for r in strikes], dtype=float)
+    loops = np.array([r.get('loop_number', 0) for r in strikes], dtype=int)
+    indices = np.zeros(len(strikes), dtype=int)
+    for loop in np.unique(loops): indices[loops == loop] = np.arange(np.count_nonzero(loops == loop))
+    sent = np.array([r.get('command_sent_time', np.nan) for r in strikes], dtype=float)
+    return planned, loops, indices, (sent if np.isfinite(sent).any() else None), None
+
+
+def recording_start(wav_path, explicit=None):
+    """録音先頭の time.time を (値, 出どころ) で返す"""
+    if explicit is not None: return explicit, 'argument'
+    sidecar = wav_path + '.json'
+    if os.path.exists(sidecar):
+        with open(sidecar, 'r', encoding='utf-8') as f: meta = json.load(f)
+        if meta.get('start_time') is not None: return float(meta['start_time']), 'sidecar'
+    return os.path.getmtime(wav_path) - onset_detector.wav_duration(wav_path), 'mtime'
+
+
+def _mutual_nearest(onsets, planned, max_offset_s):
+    nearest_onset = _nearest_index(onsets, planned)
+    nearest_planned = _nearest_index(planned, onsets)
+    matched = np.full(len(planned), np.nan)
+    for i, j in enumerate(nearest_onset):
+        if nearest_planned[j] == i and abs(onsets[j] - planned[i]) <= max_offset_s: matched[i] = onsets[j]
+    return matched
+
+
+def _nearest_index(events, targets):
+    """targets の各時刻に最も近い events の添字 (events は昇順)"""
+    if len(events) == 1: return np.zeros(len(targets), dtype=int)
+    index = np.clip(np.searchsorted(events, targets), 1, len(events) - 1)
+    return np.where(np.abs(events[index] - targets) < np.abs(events[index - 1] - targets), index, index - 1)
+
+
+def align(onsets, planned, max_offset_s=DEFAULT_MAX_OFFSET_S):
+    """
+    予定の打撃とオンセットを互いに最も近いもの同士で 1 対 1 に対応させ、対応したオンセットの時刻 (無ければ NaN) を返す。
+    全体のずれが打撃間隔の半分に近いと隣と取り違えるので、1 回目の中央値のずれだけ予定をずらしてもう一度対応させる。
+    (検出漏れが 1 つあっても後ろの対応が順にずれていかない)
+    """
+    onsets = np.asarray(onsets, dtype=float); planned = np.asarray(planned, dtype=float)
+    if len(onsets) == 0 or len(planned) == 0: return np.full(len(planned), np.nan)
+    first = _mutual_nearest(onsets, planned, max_offset_s)
+    if not np.isfinite(first).any(): return first
+    shift = float(np.nanmedian(first - planned))
+    matched = _mutual_nearest(onsets, planned + shift, max_offset_s)
+    valid = np.isfinite(matched)
+    matched[valid & (np.abs(matched - planned) > max_offset_s)] = np.nan
+    return matched
+
+
+def distribution(values_ms):
+    values = np.asarray(values_ms, dtype=float); values = values[np.isfinite(values)]
+    if len(values) == 0: return None
+    p5, p50, p95 = np.percentile(values, [5, 50, 95])
+    return {'n': int(len(values)), 'mean': float(values.mean()), 'std': float(values.std()),
+            'p5': float(p5), 'median': float(p50), 'p95': float(p95), 'max_abs': float(np.abs(values).max())}
+
+
+def format_distribution(d):
+    if d is None: return "データなし"
+    return (f"n={d['n']:3d}  中央値 {d['median']:+7.1f}ms  平均 {d['mean']:+7.1f}ms  標準偏差 {d['std']:5.1f}ms  "
+            f"5-95% [{d['p5']:+7.1f}, {d['p95']:+7.1f}]ms")
+
+
+def analyze(onsets_wall, planned, loops, indices, command_sent=None, max_offset_s=DEFAULT_MAX_OFFSET_S):
+    """対応付けと分布の計算。結果は dict (JSON にそのまま書ける)"""
+    matched = align(onsets_wall, planned, max_offset_s)
+    error_ms = (matched - planned) * 1000
+    steady = loops > loops.min() if len(loops) else loops.astype(bool)
+    result = {
+        'onsets': int(len(onsets_wall)), 'planned': int(len(planned)), 'matched': int(np.isfinite(matched).sum()),
+        'error_ms': distribution(error_ms),
+        'steady_error_ms': distribution(error_ms[steady]),
+        'first_strike_error_ms': distribution(error_ms[(loops == loops.min()) & (indices == 0)]) if len(loops) else None,
+        'per_strike_error_ms': {int(k): distribution(error_ms[steady & (indices == k)]) for k in np.unique(indices)},
+    }
+    if command_sent is not None:
+        result['command_to_sound_ms'] = distribution((matched - command_sent) * 1000)
+    return result, matched
+
+
+def load_strike_offset(path, arm_name):
+    """補正ファイルからアームの strike_offset_s を読む (無ければ 0)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f: arms = json.load(f).get('arms', {})
+    except (OSError, ValueError):
+        return 0.0
+    entry = arms.get(arm_name) or arms.get(DEFAULT_ARM_KEY) or {}
+    return float(entry.get('strike_offset_s', 0.0))
+
+
+def write_calibration(path, arm_name, result, source):
+    """2 ループ目以降の誤差の中央値を strike_offset_s に足し込む。新しい補正値を返す"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f: calibration = json.load(f)
+    except (OSError, ValueError):
+        calibration = {}
+    arms = calibration.setdefault('arms', {})
+    entry = arms.get(arm_name, {})
+    previous = float(entry.get('strike_offset_s', 0.0))
+    offset = previous + CALIBRATION_GAIN * result['steady_error_ms']['median'] / 1000
+    offset = float(np.clip(offset, -MAX_STRIKE_OFFSET_S, MAX_STRIKE_OFFSET_S))
+    entry.update({
+        'strike_offset_s': offset, 'previous_offset_s': previous,
+        'steady_error_ms': result['steady_error_ms'], 'first_strike_error_ms': result['first_strike_error_ms'],
+        'command_to_sound_ms': result.get('command_to_sound_ms'),
+        'source': source, 'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    arms[arm_name] = entry
+    calibration['format_version'] = FORMAT_VERSION
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(calibration, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return offset
+
+
+def annotate_timing_log(plan_path, out_path, planned, matched):
+    """
+    タイミング記録の打撃のうち、予定時刻 (planned) にオンセット (matched、NaN は未対応) が対応したものへ
+    実測の到着を書き込んだ .jsonl を out_path に作る (1 行ずつ流し読みする)。書き込んだ打撃の数を返す
+    """
+    import robot_timing_log
+    arrivals = {float(p): float(m) for p, m in zip(planned, matched) if np.isfinite(m)}
+    default_arm = robot_timing_log.arm_from_path(plan_path)
+    count = 0
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in robot_timing_log.iter_records(plan_path):
+            record.setdefault('arm', default_arm)
+            arrival = arrivals.get(record.get('planned_time')) if record.get('motion_type') == 'strike' else None
+            if arrival is not None:
+                record.update(actual_arrival_time=arrival, arrival_source='audio', timing_error=arrival - record['planned_time'])
+                count += 1
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, out_path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="打撃音の録音 (WAV) から実際の打撃時刻を測り、予定とのずれを解析する")
+    parser.add_argument('wav')
+    parser.add_argument('--plan', required=True, help="姿勢テレメトリ (.npz) かタイミング記録 (.jsonl / .json)")
+    parser.add_argument('--wav-start', type=float, default=None, help="録音先頭の time.time (省略時は <wav>.json かファイルの更新時刻)")
+    parser.add_argument('--channel', type=int, default=None, help="使うチャンネル (省略時は全チャンネルの平均)")
+    parser.add_argument('--method', choices=('flux', 'energy'), default='flux')
+    parser.add_argument('--max-offset', type=float, default=DEFAULT_MAX_OFFSET_S, help="対応させる最大のずれ (秒)")
+    parser.add_argument('--arm', default=None, help="補正を書き込むアーム名 (省略時はテレメトリのアーム名か '*')")
+    parser.add_argument('--write-calibration', action='store_true', help=f"{STRIKE_CALIBRATION_PATH} の strike_offset_s を更新する")
+    parser.add_argument('--calibration-path', default=STRIKE_CALIBRATION_PATH)
+    parser.add_argument('--show-strikes', action='store_true', help="打撃ごとの誤差を一覧する")
+    parser.add_argument('--annotate-timing-log', default=None, metavar='OUT',
+                        help="タイミング記録 (.jsonl) の打撃に打撃音の時刻を実測の到着として書き込んだコピーを作る")
+    args = parser.parse_args()
+
+    start, start_source = recording_start(args.wav, args.wav_start)
+    duration = onset_detector.wav_duration(args.wav)
+    onsets = onset_detector.detect_onsets_in_wav(args.wav, channel=args.channel, method=args.method) + start
+    planned, loops, indices, command_sent, plan_arm = load_plan(args.plan, wav_end=start + duration)
+
+    # 録音の範囲の予定だけを見る
+    in_range = (planned >= start) & (planned <= start + duration)
+    planned, loops, indices = planned[in_range], loops[in_range], indices[in_range]
+    if command_sent is not None: command_sent = command_sent[in_range]
+    print(f"録音: {args.wav} ({duration:.1f}秒, 先頭 {time.strftime('%H:%M:%S', time.localtime(start))} [{start_source}]) "
+          f"オンセット {len(onsets)}個 / 予定の打撃 {len(planned)}回")
+    if len(planned) == 0 or len(onsets) == 0: print("対応させる打撃がありません。"); return
+
+    result, matched = analyze(onsets, planned, loops, indices, command_sent, args.max_offset)
+    print(f"対応: {result['matched']}/{result['planned']}")
+    print(f"打撃音 − 予定 (全体)      : {format_distribution(result['error_ms'])}")
+    print(f"打撃音 − 予定 (2ループ目〜): {format_distribution(result['steady_error_ms'])}")
+    print(f"打撃音 − 予定 (一打目)    : {format_distribution(result['first_strike_error_ms'])}")
+    if 'command_to_sound_ms' in result:
+        print(f"打撃音 − 送信             : {format_distribution(result['command_to_sound_ms'])}")
+    print("ループ内の打撃ごと (2ループ目〜):")
+    for k, d in result['per_strike_error_ms'].items(): print(f"  {k + 1:3d}打目: {format_distribution(d)}")
+    if args.show_strikes:
+        for p, m, loop, k in zip(planned, matched, loops, indices):
+            error = f"{(m - p) * 1000:+7.1f}ms" if np.isfinite(m) else "   未検出"
+            print(f"  ループ{loop:3d} {k + 1:3d}打目  {error}")
+
+    if args.annotate_timing_log:
+        if not args.plan.endswith('.jsonl'):
+            print("到着を書き込めるのはタイミング記録 (.jsonl) だけです (従来の .json は到着を実測済み)。")
+        elif start_source == 'mtime':
+            print("録音の開始時刻がファイルの更新時刻からの推定のため、到着は書き込みません (--wav-start か <wav>.json を指定してください)。")
+        else:
+            count = annotate_timing_log(args.plan, args.annotate_timing_log, planned, matched)
+            print(f"打撃音の時刻を到着として書き込みました: {args.annotate_timing_log} ({count}/{len(planned)}打)")
+
+    if not args.write_calibration: return
+    steady = result['steady_error_ms']
+    if start_source == 'mtime':
+        print("録音の開始時刻がファイルの更新時刻からの推定のため、補正値は書き込みません (--wav-start か <wav>.json を指定してください)。"); return
+    if steady is None or steady['n'] < MIN_CALIBRATION_STRIKES:
+        print(f"2ループ目以降の打撃が {MIN_CALIBRATION_STRIKES} 回未満のため、補正値は書き込みません。"); return
+    arm = args.arm or plan_arm or DEFAULT_ARM_KEY
+    offset = write_calibration(args.calibration_path, arm, result, os.path.basename(args.wav))
+    print(f"補正値を更新しました: {args.calibration_path} [{arm}] strike_offset_s = {offset * 1000:+.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
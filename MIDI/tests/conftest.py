@@ -0,0 +1,10 @@
+"""
+MIDI/ のモジュールはフラットに import する (python xxx.py で直接動かす) ので、テストからも同じように import できるようにする。
+PyQt6 / mido / pydobot の要らないモジュールだけをテストする
+
+    cd MIDI && python -m pytest -q tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
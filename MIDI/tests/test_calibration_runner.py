@@ -0,0 +1,71 @@
+"""calibration_runner: 計測中の姿勢・速度・移動は pydobot を通らず DobotLink で送ること"""
+import struct
+import threading
+
+import calibration_runner
+import dobot_link
+
+
+class FixedDuration:
+    def duration(self, distance, velocity, acceleration):
+        return 0.08
+
+
+class FakeSerial:
+    """Dobot のように応答するシリアルポート (動きは SimulatedDobot に任せる)"""
+    def __init__(self, robot):
+        self.robot = robot; self.timeout = None
+        self.pending = bytearray(); self.received = bytearray(); self.commands = []
+
+    def write(self, data):
+        self.received += data
+        for cmd_id, params, _ in dobot_link.extract_frames(self.received):
+            self.commands.append(cmd_id)
+            if cmd_id == dobot_link.CMD_GET_POSE:
+                pose = self.robot.pose()
+                reply = struct.pack('<8f', *pose, 0, 0, 0, 0)
+            elif cmd_id == dobot_link.CMD_SET_PTP_COMMON_PARAMS:
+                self.robot.speed(*struct.unpack('<ff', params)); reply = struct.pack('<Q', 0)
+            elif cmd_id == dobot_link.CMD_SET_PTP_CMD:
+                self.robot.move_to(*struct.unpack('<ffff', params[1:])); reply = struct.pack('<Q', 0)
+            else:
+                reply = struct.pack('<Q', 0)
+            self.pending += dobot_link.encode_packet(cmd_id, 0, reply)
+
+    def read(self, size):
+        data = bytes(self.pending[:size]); del self.pending[:size]
+        return data
+
+
+class FakePydobot:
+    """pydobot の Dobot の代わり: ser と lock を持ち、pose() は pydobot と同じく 1 回 0.2 秒待つ"""
+    def __init__(self, port):
+        self.robot = calibration_runner.SimulatedDobot(port, FixedDuration(), noise_ms=0.0, pose_latency_s=0.0005)
+        self.ser = FakeSerial(self.robot); self.lock = threading.Lock()
+        self.slow_poses = 0
+
+    def pose(self):
+        self.slow_poses += 1
+        threading.Event().wait(0.2)
+        return self.robot.pose()
+
+    def speed(self, velocity=100.0, acceleration=100.0):
+        self.robot.speed(velocity, acceleration)
+
+    def move_to(self, x, y, z, r, wait=False):
+        self.robot.move_to(x, y, z, r, wait)
+
+    def close(self):
+        pass
+
+
+def test_sampling_goes_through_the_link():
+    devices = []
+    def factory(port):
+        devices.append(FakePydobot(port)); return devices[-1]
+    session = calibration_runner.CalibrationSession('FAKE', factory, max_samples=2).run()
+    device = devices[0]
+    assert len(session.samples) == 2
+    assert device.slow_poses == 0
+    assert dobot_link.CMD_SET_PTP_CMD in device.ser.commands and dobot_link.CMD_SET_PTP_COMMON_PARAMS in device.ser.commands
+    assert session.pose_rate_hz > calibration_runner.POSE_RATE_WARN_HZ
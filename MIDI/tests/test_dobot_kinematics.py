@@ -0,0 +1,56 @@
+"""dobot_kinematics: フィットの制約と load_or_fit の読み込み"""
+import csv
+import json
+
+import numpy as np
+import pytest
+
+import dobot_kinematics
+
+
+def write_sweep(path, offset_s):
+    """offset_s + 0.5 * 台形モデル の移動時間を持つ tuning_data.csv 形式のスイープ"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['distance', 'target_velocity', 'target_acceleration', 'actual_duration'])
+        for distance in (5.0, 20.0, 40.0, 80.0):
+            for velocity in (100.0, 400.0, 1000.0):
+                for acceleration in (100.0, 400.0, 1000.0):
+                    duration = offset_s + 0.5 * float(dobot_kinematics.trapezoid(distance, velocity, acceleration))
+                    writer.writerow([distance, velocity, acceleration, max(duration, 0.01)])
+
+
+def test_fit_never_returns_a_negative_offset(tmp_path):
+    path = tmp_path / 'tuning_data.csv'
+    write_sweep(path, offset_s=-0.08)
+    model = dobot_kinematics.fit(*dobot_kinematics.read_sweep(str(path)), scale_grid=np.geomspace(0.25, 4.0, 9))
+    assert model.offset_s >= 0.0
+    assert model.gain > 0.0
+
+
+def test_fit_keeps_a_positive_offset(tmp_path):
+    path = tmp_path / 'tuning_data.csv'
+    write_sweep(path, offset_s=0.05)
+    model = dobot_kinematics.fit(*dobot_kinematics.read_sweep(str(path)), scale_grid=np.geomspace(0.25, 4.0, 9))
+    assert model.offset_s == pytest.approx(0.05, abs=1e-6)
+    assert model.residuals['rmse_ms'] < 1e-3
+
+
+def test_load_or_fit_does_not_write_the_model(tmp_path):
+    csv_path = tmp_path / 'tuning_data.csv'; model_path = tmp_path / 'dobot_kinematics.json'
+    write_sweep(csv_path, offset_s=0.05)
+    model = dobot_kinematics.load_or_fit(str(csv_path), str(model_path))
+    assert model.offset_s >= 0.0
+    assert not model_path.exists()
+
+    # CLI と同じく明示的に保存したモデルは、そのまま読み込まれる
+    model.save(str(model_path))
+    assert dobot_kinematics.load_or_fit(str(csv_path), str(model_path)).to_dict()['gain'] == model.gain
+
+
+def test_saved_model_with_negative_offset_is_rejected(tmp_path):
+    model_path = tmp_path / 'dobot_kinematics.json'
+    data = dobot_kinematics.DobotKinematics(0.3, 0.1, -0.0965, 0.29, 0.2).to_dict()
+    model_path.write_text(json.dumps(data), encoding='utf-8')
+    with pytest.raises(ValueError):
+        dobot_kinematics.DobotKinematics.load(str(model_path))
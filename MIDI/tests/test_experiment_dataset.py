@@ -0,0 +1,45 @@
+"""experiment_dataset / experiment_store: セットの条件 (condition) の列"""
+import experiment_dataset
+import experiment_store
+
+SETS = ((1, "線形補間コントローラー"), (2, "Metronome"))
+
+
+def make_records():
+    """各セット テスト → 練習 (2 ループ) → テスト。condition を記録する前の形式"""
+    records = [{'type': 'experiment_start', 'participant': 'p1', 'experiment_start_time': '2026-01-01 10:00:00'}]
+    stats = {'accuracy': 90.0, 'perfect': 3, 'great': 1, 'good': 0, 'dropped': 0}
+    hits = [{'pad': 'top', 'note_id': 'top-0', 'judgement': 'perfect', 'error_ms': 5.0, 'hit_time': 5.0}]
+    for set_index, method in SETS:
+        records.append({'type': 'step', 'set_index': set_index, 'step_index': 1, 'method': experiment_dataset.TEST_METHOD,
+                        'score_file': 'a.json', 'stats': stats, 'raw_hits': hits, 'is_practice': False})
+        for loop in (1, 2):
+            records.append({'type': 'practice_loop', 'set_index': set_index, 'step_index': 2, 'loop_count': loop,
+                            'stats': stats, 'details': hits})
+        records.append({'type': 'step', 'set_index': set_index, 'step_index': 2, 'method': method,
+                        'score_file': 'a.json', 'stats': stats, 'is_practice': True})
+        records.append({'type': 'step', 'set_index': set_index, 'step_index': 3, 'method': experiment_dataset.TEST_METHOD,
+                        'score_file': 'a.json', 'stats': stats, 'raw_hits': hits, 'is_practice': False})
+    return records
+
+
+def test_condition_fills_every_row_of_the_set(tmp_path):
+    root = str(tmp_path / 'dataset')
+    assert experiment_dataset.build_from_records(make_records(), root, 'session1') == 6
+    columns = experiment_dataset.load_table(root, 'hits', ['set', 'step', 'method', 'condition'])
+    expected = dict(SETS)
+    assert len(columns['condition']) == 2 * 4
+    for set_index, condition in zip(columns['set'].tolist(), columns['condition'].tolist()):
+        assert condition == expected[set_index]
+    assert experiment_dataset.TEST_METHOD in columns['method'].tolist()
+
+
+def test_store_groups_tests_by_condition(tmp_path):
+    conn = experiment_store.connect(str(tmp_path / 'experiments.sqlite'))
+    experiment_store.build_from_records(conn, make_records(), 'session1')
+    rows = experiment_store.aggregate(conn, 'hits', 'abs_error', group_by=['condition', 'step_index'], loop=experiment_dataset.TEST_LOOP)
+    assert rows == [("Metronome", 1, 5.0, 1), ("Metronome", 3, 5.0, 1),
+                    ("線形補間コントローラー", 1, 5.0, 1), ("線形補間コントローラー", 3, 5.0, 1)]
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM hits WHERE condition = ?", ("Metronome",)).fetchall()
+    assert any('hits_condition' in row[-1] for row in plan)
+    conn.close()
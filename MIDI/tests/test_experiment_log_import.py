@@ -0,0 +1,99 @@
+"""experiment_log_import: experiment_recorder が書いたテキストを読み戻して、同じテキストに書き直せること"""
+import os
+
+import experiment_dataset
+import experiment_log_import
+import experiment_recorder
+
+METHODS = ("線形補間コントローラー", "Metronome")
+
+
+def pad_stats(perfect):
+    return {'top': {'accuracy': 80.0, 'score': 75.5, 'avg_error': 12.3, 'std_dev': 20.1,
+                    'perfect': perfect, 'great': 1, 'good': 0, 'dropped': 1},
+            'bottom': {'accuracy': 100.0, 'score': 95.0, 'avg_error': -4.0, 'std_dev': 6.5,
+                       'perfect': 2, 'great': 0, 'good': 0, 'dropped': 0}}
+
+
+def make_records():
+    """アプリが記録するのと同じ形のレコード (各セット テスト → 練習 2 ループ → テスト)"""
+    stats = {'accuracy': 87.5, 'score': 80.2, 'avg_error': 8.4, 'std_dev': 15.0}
+    hits = [{'note_id': 'top-1', 'judgement': 'perfect', 'error_ms': 3.0, 'pad': 'top'},
+            {'note_id': 'top-0', 'judgement': 'great', 'error_ms': -70.0, 'pad': 'top'},
+            {'note_id': 'bottom-8', 'judgement': 'perfect', 'error_ms': 12.0, 'pad': 'bottom'},
+            {'note_id': None, 'judgement': 'extra', 'error_ms': None, 'pad': 'top'}]
+    records = [{'type': 'experiment_start', 'experiment_start_time': '2026-01-01 10:00:00',
+                'score_order': ['a', 'b'], 'experiment_order': list(METHODS)}]
+    for set_index, (method, score_file) in enumerate(zip(METHODS, ('a.json', 'b.json')), 1):
+        step = {'type': 'step', 'set_index': set_index, 'score_file': score_file, 'timestamp': '10:00:00'}
+        records.append(dict(step, step_index=1, method=experiment_dataset.TEST_METHOD, stats=stats,
+                            pad_stats=pad_stats(3), raw_hits=hits, is_practice=False))
+        for loop_count in (1, 2):
+            records.append({'type': 'practice_loop', 'set_index': set_index, 'step_index': 2, 'loop_count': loop_count,
+                            'timestamp': f'10:01:0{loop_count}', 'stats': stats, 'pad_stats': pad_stats(loop_count), 'details': []})
+        records.append(dict(step, step_index=2, method=method, stats=stats, pad_stats=pad_stats(4), raw_hits=[], is_practice=True,
+                            robot_history=[{'timestamp': '10:01:00.5', 'track': 'top', 'ideal': 1000.0, 'offset': -5.2, 'guided': 995.0}]))
+        records.append(dict(step, step_index=3, method=experiment_dataset.TEST_METHOD, stats=stats,
+                            pad_stats=pad_stats(5), raw_hits=hits, is_practice=False))
+    records.append({'type': 'experiment_end', 'recorded_at': '2026-01-01 10:30:00'})
+    return records
+
+
+def write_log(tmp_path, records, name='experiment_result_1.txt'):
+    path = str(tmp_path / name)
+    experiment_recorder.write_report(records, path)
+    return path
+
+
+def test_parse_reads_back_steps_loops_and_hits(tmp_path):
+    records, issues = experiment_log_import.parse_experiment_log(write_log(tmp_path, make_records()))
+    assert issues == []
+    steps = [r for r in records if r['type'] == 'step']
+    assert [(s['set_index'], s['step_index'], s['method'], s['is_practice']) for s in steps] == [
+        (1, 1, experiment_dataset.TEST_METHOD, False), (1, 2, METHODS[0], True), (1, 3, experiment_dataset.TEST_METHOD, False),
+        (2, 1, experiment_dataset.TEST_METHOD, False), (2, 2, METHODS[1], True), (2, 3, experiment_dataset.TEST_METHOD, False)]
+    # 【全体】の行には個数が無いので左右の和になる
+    assert steps[0]['stats']['perfect'] == 3 + 2 and steps[0]['stats']['dropped'] == 1
+    assert steps[0]['pad_stats']['bottom']['avg_error'] == -4.0
+    # 打鍵はトラック・番号順に並べ替えて書かれる
+    assert [(h['note_id'], h['judgement'], h['error_ms']) for h in steps[0]['raw_hits']] == [
+        ('bottom-8', 'perfect', 12.0), ('top-0', 'great', -70.0), ('top-1', 'perfect', 3.0), (None, 'extra', None)]
+    loops = [r for r in records if r['type'] == 'practice_loop']
+    assert [(l['set_index'], l['loop_count']) for l in loops] == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert steps[1]['robot_history'] == [{'timestamp': '10:01:00.5', 'track': 'top', 'ideal': 1000.0, 'offset': -5.2, 'guided': 995.0}]
+    assert records[-1] == {'type': 'experiment_end', 'recorded_at': '2026-01-01 10:30:00'}
+
+
+def test_rerender_reproduces_the_text(tmp_path):
+    path = write_log(tmp_path, make_records())
+    records, _ = experiment_log_import.parse_experiment_log(path)
+    with open(path, 'r', encoding='utf-8') as f: assert experiment_recorder.render_report(records) == f.read()
+
+
+def test_truncated_log_reports_the_missing_lines(tmp_path):
+    path = write_log(tmp_path, make_records())
+    with open(path, 'r', encoding='utf-8') as f: text = f.read()
+    cut = text.index("--- ステップ 3", text.index("実験セット 2"))
+    with open(path, 'w', encoding='utf-8') as f: f.write(text[:cut] + "\n--- ステップ 3: 事後テスト (Test 2) ---\n手法: Test (None)\n")
+    records, issues = experiment_log_import.parse_experiment_log(path)
+    assert [(r['set_index'], r['step_index']) for r in records if r['type'] == 'step'][-1] == (2, 2)
+    messages = [message for _, message in issues]
+    assert any("セット 2 ステップ 3" in message for message in messages)
+
+
+def test_import_skips_unchanged_files(tmp_path):
+    root = str(tmp_path / 'dataset')
+    path = write_log(tmp_path, make_records())
+    messages = []
+    assert experiment_log_import.import_logs([path], root, jobs=1, on_log=messages.append) == {path: []}
+    assert os.path.exists(os.path.join(root, experiment_log_import.INDEX_FILENAME))
+    assert messages[-1].startswith("1 ファイル中 1 ファイル")
+    messages.clear()
+    assert experiment_log_import.import_logs([path], root, jobs=1, on_log=messages.append) == {path: []}
+    assert messages == ["1 ファイル中 0 ファイルを解析しました (残りは索引から)"]
+    # 書き直したファイルはハッシュが変わるので解析し直す
+    records = make_records(); records[-1]['recorded_at'] = '2026-01-01 11:00:00'
+    write_log(tmp_path, records)
+    messages.clear()
+    experiment_log_import.import_logs([path], root, jobs=1, on_log=messages.append)
+    assert messages[-1].startswith("1 ファイル中 1 ファイル")
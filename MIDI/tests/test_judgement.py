@@ -0,0 +1,95 @@
+"""judgement: コンパイル済みの楽譜に対する judge_hit / dropped_notes"""
+import pytest
+
+import judgement
+import score_compiler
+
+
+def make_score(num_measures=None):
+    """120BPM 4/4 (1 拍 500ms、2 小節で 4 秒)。上は 4 分音符、下は 2 分音符で 1 拍目の後に休符"""
+    bottom = [{'class': 'note', 'beat': float(beat), 'duration': 2.0} for beat in range(0, 8, 2)]
+    bottom.insert(1, {'class': 'rest', 'beat': 1.0, 'duration': 1.0})
+    score = {'top': {'bpm': 120, 'numerator': 4, 'denominator': 4,
+                     'items': [{'class': 'note', 'beat': float(beat), 'duration': 1.0} for beat in range(8)]},
+             'bottom': {'bpm': 120, 'numerator': 4, 'denominator': 4, 'items': bottom}}
+    if num_measures is not None:
+        score['num_measures'] = num_measures
+        score['top']['items'] = [{'class': 'note', 'beat': float(beat), 'duration': 1.0} for beat in range(num_measures * 4)]
+    return score
+
+
+def judge(score, time_ms, pad='top', judged_notes=None):
+    return judgement.judge_hit({'time': time_ms, 'pad': pad}, score, {} if judged_notes is None else judged_notes)
+
+
+@pytest.mark.parametrize('time_ms, expected', [
+    (500.0, ('perfect', 0.0, 'top-1')),
+    (555.0, ('perfect', 55.0, 'top-1')),
+    (420.0, ('great', -80.0, 'top-1')),
+    (590.0, ('great', 90.0, 'top-1')),
+    (605.0, ('good', 105.0, 'top-1')),
+    (390.0, ('good', -110.0, 'top-1')),
+    (615.0, ('extra', None, None)),
+    (750.0, ('extra', None, None)),
+])
+def test_windows(time_ms, expected):
+    assert judge(score_compiler.compile_score(make_score()), time_ms) == expected
+
+
+def test_note_ids_run_across_tracks_and_skip_rests():
+    score = score_compiler.compile_score(make_score())
+    assert judge(score, 0.0, 'bottom') == ('perfect', 0.0, 'bottom-8')
+    assert judge(score, 1010.0, 'bottom') == ('perfect', 10.0, 'bottom-9')
+    assert judge(score, 500.0, 'unknown') == ('extra', None, None)
+
+
+def test_hits_near_the_loop_boundary_wrap_to_the_first_note():
+    score = score_compiler.compile_score(make_score())
+    assert judge(score, 3950.0) == ('perfect', -50.0, 'top-0')
+    assert judge(score, 4030.0) == ('perfect', 30.0, 'top-0')
+    assert judge(score, 2 * 4000.0 - 100.0) == ('good', -100.0, 'top-0')
+
+
+def test_a_note_is_judged_once_per_loop():
+    score = score_compiler.compile_score(make_score())
+    judged_notes = {}
+    assert judge(score, 510.0, judged_notes=judged_notes) == ('perfect', 10.0, 'top-1')
+    assert judged_notes == {'top-1': 510.0}
+    assert judge(score, 530.0, judged_notes=judged_notes) == ('extra', None, None)
+    # ループの半分 (2 秒) を過ぎれば同じノートをもう一度判定できる
+    assert judge(score, 4520.0, judged_notes=judged_notes) == ('perfect', 20.0, 'top-1')
+    assert judged_notes == {'top-1': 4520.0}
+
+
+def test_ties_go_to_the_earlier_note():
+    score = score_compiler.compile_score(make_score())
+    windows = {'perfect': 250, 'great': 250, 'good': 250}
+    assert judgement.judge_hit({'time': 250.0, 'pad': 'top'}, score, {}, windows) == ('perfect', 250.0, 'top-0')
+    assert judgement.judge_hit({'time': 250.0, 'pad': 'top'}, score, {'top-0': 0.0}, windows) == ('perfect', -250.0, 'top-1')
+
+
+def test_dict_and_compiled_score_agree():
+    data = make_score(); compiled = score_compiler.compile_score(data)
+    for time_ms in range(-200, 8200, 37):
+        for pad in ('top', 'bottom'):
+            assert judge(data, float(time_ms), pad) == judge(compiled, float(time_ms), pad)
+
+
+def test_long_score_uses_its_own_loop():
+    score = score_compiler.compile_score(make_score(num_measures=64))
+    assert score['top'].loop_duration_ms == 64 * 4 * 500.0
+    assert judge(score, 200 * 500.0 + 12.0) == ('perfect', 12.0, 'top-200')
+    assert judge(score, 64 * 4 * 500.0 - 20.0) == ('perfect', -20.0, 'top-0')
+
+
+def test_dropped_notes():
+    score = score_compiler.compile_score(make_score())
+    judged_notes = {'top-0': 0.0}
+    assert judgement.dropped_notes(score, judged_notes, 700.0) == [('top', 'top-1'), ('bottom', 'bottom-8')]
+    # 前回の確認からのぶんだけ: 期限 (発音 + 120ms) が 600〜700ms に入るのは top-1 だけ
+    assert judgement.dropped_notes(score, judged_notes, 700.0, since_ms=600.0) == [('top', 'top-1')]
+    judged_notes.update({'top-1': 700.0, 'bottom-8': 700.0})
+    assert judgement.dropped_notes(score, judged_notes, 1119.0, since_ms=700.0) == []
+    assert judgement.dropped_notes(score, judged_notes, 1121.0, since_ms=1119.0) == [('top', 'top-2'), ('bottom', 'bottom-9')]
+    # ループが戻ったら全体を見直す
+    assert judgement.dropped_notes(score, {}, 130.0, since_ms=3900.0) == [('top', 'top-0'), ('bottom', 'bottom-8')]
@@ -0,0 +1,32 @@
+"""pose_telemetry: 姿勢の記録から到着時刻を測る"""
+import numpy as np
+import pytest
+
+import pose_telemetry
+
+
+def test_level_crossing_interpolates_between_samples():
+    times = np.array([0.0, 0.01, 0.02, 0.03]); z = np.array([0.0, -10.0, -20.0, -30.0])
+    assert pose_telemetry.level_crossing(times, z, -15.0, -1.0) == pytest.approx(0.015)
+    assert pose_telemetry.level_crossing(times, z, -40.0, -1.0) is None
+    assert pose_telemetry.level_crossing(times, -z, 15.0, 1.0) == pytest.approx(0.015)
+
+
+def test_since_reads_across_the_ring_boundary():
+    buffer = pose_telemetry.PoseRingBuffer(capacity=8)
+    for i in range(12): buffer.append(float(i), 0.001, (200.0, 0.0, float(i), 0.0))
+    assert buffer.since(6.5)['t'].tolist() == [7.0, 8.0, 9.0, 10.0, 11.0]
+    assert buffer.since(0.0)['t'].tolist() == [float(i) for i in range(4, 12)]
+
+
+def test_arrival_time_is_in_wall_clock():
+    recorder = pose_telemetry.PoseTelemetryRecorder(lambda: None, 'arm1')
+    recorder.anchor_perf = 100.0; recorder.anchor_wall = 1_700_000_000.0
+    # 100.00 から 10ms ごとに -10 → -30 へ下がる
+    for i, z in enumerate([-10.0, -10.0, -15.0, -20.0, -25.0, -29.0, -30.0, -30.0]):
+        recorder.buffer.append(100.0 + i * 0.01, 0.001, (200.0, 0.0, z, 0.0))
+    arrival = recorder.arrival_time(1_700_000_000.0, -10.0, -30.0)
+    assert arrival == pytest.approx(1_700_000_000.0 + 0.055, abs=1e-6)   # -29.5 (目標の 0.5mm 手前) を横切った時刻
+    # 探し始めより前の動きは見ない / 動きが小さすぎれば測らない
+    assert recorder.arrival_time(1_700_000_000.07, -10.0, -30.0) is None
+    assert recorder.arrival_time(1_700_000_000.0, -30.0, -30.2) is None
@@ -0,0 +1,87 @@
+"""rhythm_difficulty: 以前のエディター (rhythm_editor_module_v4 の _get_2_measure_average_score / evaluate_all_difficulties) と同じ値になること"""
+import copy
+import json
+import os
+
+import pytest
+
+import rhythm_difficulty
+
+MUSIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'music')
+
+# 以前のエディターで計算した値 (上段, 下段, 総合難易度の表示)
+EDITOR_RESULTS = {
+    'pori1.json': (2.5999999999999996, 2.36, "4.98"),
+    'test1.json': (3.25, 4.9375, "3.57"),
+    'test11.json': (2.8, 2.8, "1.64"),
+    'test12.json': (4.16, 4.5600000000000005, "3.56"),
+    'test2.json': (3.3799999999999994, 3.3799999999999994, "3.35"),
+    'test3.json': (3.8674999999999997, 4.42, "3.34"),
+    'test4.json': (3.0, 3.0, "1.84"),
+    'test5.json': (3.2, 3.2, "2.04"),
+    'test6.json': (3.4, 3.4, "2.24"),
+    'test7.json': (3.6, 3.6, "2.44"),
+    'test8.json': (4.0, 0.0, "3.66"),
+    'test9.json': (7.0, 4.166666666666667, "4.71"),
+    'tutorial.json': (2.3, 2.3, "1.14"),
+}
+
+
+def make_track(numerator, denominator, spec):
+    """(長さ, 種類) の並びを頭から詰めたトラック (100BPM)"""
+    items = []; beat = 0.0
+    for duration, item_class in spec:
+        items.append({'beat': beat, 'duration': duration, 'class': item_class}); beat += duration
+    return {'bpm': 100, 'numerator': numerator, 'denominator': denominator, 'items': items}
+
+
+N, R = 'note', 'rest'
+WALTZ = make_track(3, 4, [(1.0, N), (0.5, N), (0.5, N), (1.0, R), (0.75, N), (0.25, N), (2.0, N)])
+COMPOUND = make_track(6, 8, [(0.5, N)] * 3 + [(1.5, N), (0.25, N), (0.25, R), (1.0, N), (1.5, R)])
+SYNCOPATED = make_track(4, 4, [(0.25, R), (0.75, N), (0.5, N), (1.0, N), (0.375, N), (0.125, N), (1.0, R),
+                               (1.5, N), (0.5, N), (2.0, N), (0.5, R), (1.5, N)])
+
+
+def load(filename):
+    with open(os.path.join(MUSIC_DIR, filename), 'r', encoding='utf-8') as f: return json.load(f)
+
+
+@pytest.mark.parametrize('filename', sorted(EDITOR_RESULTS))
+def test_music_folder_matches_the_editor(filename):
+    score = load(filename)
+    top, bottom, combined = EDITOR_RESULTS[filename]
+    assert rhythm_difficulty.track_difficulty(score['top']) == pytest.approx(top, abs=1e-12)
+    assert rhythm_difficulty.track_difficulty(score['bottom']) == pytest.approx(bottom, abs=1e-12)
+    assert f"{rhythm_difficulty.score_difficulty(score)['combined']:.2f}" == combined
+
+
+@pytest.mark.parametrize('track, expected', [(WALTZ, 4.62), (COMPOUND, 5.565), (SYNCOPATED, 6.8100000000000005)])
+def test_time_signatures_match_the_editor(track, expected):
+    assert rhythm_difficulty.track_difficulty(track) == pytest.approx(expected, abs=1e-12)
+
+
+def test_polymeter_matches_the_editor():
+    result = rhythm_difficulty.score_difficulty({'top': SYNCOPATED, 'bottom': WALTZ})
+    assert f"{result['combined']:.2f}" == "8.21"
+
+
+def test_does_not_write_into_the_score():
+    score = load('test3.json'); before = copy.deepcopy(score)
+    rhythm_difficulty.score_difficulty(score)
+    assert score == before
+
+
+def test_empty_and_single_track_scores():
+    assert rhythm_difficulty.track_difficulty({'bpm': 120, 'items': []}) == 0.0
+    assert rhythm_difficulty.score_difficulty({'top': WALTZ}) == {'top': pytest.approx(4.62), 'bottom': None, 'combined': None}
+
+
+def test_batch_gives_the_same_results(tmp_path):
+    paths = [os.path.join(MUSIC_DIR, filename) for filename in sorted(EDITOR_RESULTS)]
+    broken = tmp_path / 'broken.json'; broken.write_text('{"top": ', encoding='utf-8')
+    messages = []
+    results = rhythm_difficulty.score_files(paths + [str(broken)], jobs=1, on_log=messages.append)
+    assert results[str(broken)] is None and len(messages) == 1
+    for path in paths:
+        top, bottom, _ = EDITOR_RESULTS[os.path.basename(path)]
+        assert (results[path]['top'], results[path]['bottom']) == pytest.approx((top, bottom), abs=1e-12)
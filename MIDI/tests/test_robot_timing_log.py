@@ -0,0 +1,141 @@
+"""robot_timing_log: 記録を流し読みした集計が、全件を一度に計算したものと一致すること"""
+import json
+
+import numpy as np
+import pytest
+
+import robot_timing_log
+
+START = 1_700_000_000.0
+TOL = 1e-3   # 時刻が time.time 基準の秒なので、ms の誤差は 1e-4 程度までしか合わない
+
+
+def write_log(directory, track, errors_ms, loops=3, filename=None):
+    """ループごとに strike と lift を交互に送った記録 (誤差は errors_ms を順に使う)"""
+    writer = robot_timing_log.TimingLogWriter(track, str(directory), filename)
+    expected = {'strike': [], 'lift': []}
+    for i, error_ms in enumerate(errors_ms):
+        motion_type = 'strike' if i % 2 == 0 else 'lift'
+        planned = START + i * 0.25
+        writer.record(i * loops // len(errors_ms), i, (200.0, 0.0, -30.0), planned, planned - 0.08,
+                      planned - 0.1, planned + error_ms / 1000.0, motion_type, arrival_source='pose')
+        expected[motion_type].append(error_ms)
+    writer.close()
+    return writer.path, {key: np.array(values) for key, values in expected.items()}
+
+
+def make_errors(n, seed):
+    return np.random.default_rng(seed).normal(8.0, 15.0, n).round(3)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, robot_timing_log.CHUNK_SIZE])
+def test_streaming_stats_match_the_whole_array(tmp_path, chunk_size):
+    path, expected = write_log(tmp_path, 'top', make_errors(301, 0))
+    aggregate = robot_timing_log.aggregate_files([path], chunk_size)
+    assert aggregate.records == 301
+    assert aggregate.arms == ['top'] and aggregate.motion_types('top') == ['lift', 'strike']
+    for motion_type, errors in expected.items():
+        stats = aggregate.by_type[('top', motion_type)]
+        assert stats.count == len(errors)
+        assert stats.mean == pytest.approx(errors.mean(), abs=TOL)
+        assert stats.std == pytest.approx(errors.std(), abs=TOL)
+        assert (stats.min, stats.max) == pytest.approx((errors.min(), errors.max()), abs=TOL)
+        assert stats.hist.sum() == len(errors)
+        assert stats.buckets.tolist() == np.bincount(robot_timing_log.accuracy_bucket(errors), minlength=4).tolist()
+    loops = aggregate.loops('top', 'strike')
+    assert [loop for loop, _ in loops] == [0, 1, 2]
+    assert sum(stats.count for _, stats in loops) == len(expected['strike'])
+
+
+def test_accuracy_bucket_edges():
+    errors = np.array([0.0, -5.0, 5.01, 10.0, -19.9, 20.0, 20.5, -300.0])
+    assert robot_timing_log.accuracy_bucket(errors).tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+
+
+def test_histogram_counts_out_of_range_errors_at_the_edges():
+    stats = robot_timing_log.ErrorStats(hist=True)
+    low, high = robot_timing_log.HIST_RANGE_MS
+    stats.add(np.array([low - 1.0, low, high - 0.1, high, 1e6]))
+    assert stats.hist[0] == 1 and stats.hist[1] == 1
+    assert stats.hist[-2] == 1 and stats.hist[-1] == 2
+
+
+def test_legacy_json_array_reads_the_same(tmp_path):
+    path, expected = write_log(tmp_path, 'bottom', make_errors(50, 1))
+    with open(path, 'r', encoding='utf-8') as f: records = [json.loads(line) for line in f]
+    for record in records: del record['arm']
+    legacy = tmp_path / 'timing_data_bottom_1758020085.json'
+    legacy.write_text(json.dumps(records, indent=2), encoding='utf-8')
+    assert list(robot_timing_log.iter_records(str(legacy))) == records
+    # 小さなブロックで読ませて、要素の途中で切れる場合も通す
+    with open(legacy, 'r', encoding='utf-8') as f: assert list(robot_timing_log._iter_json_array(f, block_size=64)) == records
+    aggregate = robot_timing_log.aggregate_files([str(legacy)], chunk_size=8)
+    assert aggregate.arms == ['bottom']
+    assert aggregate.by_type[('bottom', 'strike')].mean == pytest.approx(expected['strike'].mean(), abs=TOL)
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    path, expected = write_log(tmp_path, 'top', make_errors(10, 2))
+    with open(path, 'a', encoding='utf-8') as f: f.write('{"arm": "top", "loop_num')
+    assert len(list(robot_timing_log.iter_records(path))) == 10
+
+
+def test_report_over_several_files(tmp_path):
+    top, top_expected = write_log(tmp_path, 'top', make_errors(40, 3), filename='timing_data_top_1.jsonl')
+    bottom, _ = write_log(tmp_path, 'bottom', make_errors(20, 4), filename='timing_data_bottom_1.jsonl')
+    lines = list(robot_timing_log.iter_report_lines([top, bottom], chunk_size=16))
+    assert "トラック: bottom, top" in lines and "総記録数: 60" in lines and "ファイル数: 2" in lines
+    assert f"📈 総ストライク数: {len(top_expected['strike'])} 回 (実測)" in lines
+    # 打撃ごとの表はアームごとに strike の数だけ並ぶ
+    rows = [line for line in lines if line[:8].strip().isdigit()]
+    assert len(rows) == 20 + 10
+    assert not any(line[:8].strip().isdigit() for line in robot_timing_log.iter_report_lines([top], details=False))
+
+
+def test_unmeasured_arrivals_are_left_out(tmp_path):
+    """到着を測れなかった動作は誤差の集計に入れず、数と送信の遅れだけ数える"""
+    writer = robot_timing_log.TimingLogWriter('top', str(tmp_path))
+    for i in range(6):
+        planned = START + i * 0.25; measured = i % 3 == 0
+        writer.record(0, i, (200.0, 0.0, -30.0), planned, planned - 0.08, planned - 0.1 + 0.004, planned + 0.012 if measured else None,
+                      'strike', scheduled_send_time=planned - 0.1, lateness=0.0, predicted_arrival_time=planned,
+                      arrival_source='pose' if measured else None)
+    writer.close()
+    records = list(robot_timing_log.iter_records(writer.path))
+    assert [r['actual_arrival_time'] is None for r in records] == [False, True, True, False, True, True]
+    assert all(r['timing_error'] is None and r['arrival_source'] is None for r in records if r['actual_arrival_time'] is None)
+    aggregate = robot_timing_log.aggregate_files([writer.path])
+    assert aggregate.unmeasured == {'top': 4}
+    assert aggregate.by_type[('top', 'strike')].count == 2
+    assert aggregate.by_type[('top', 'strike')].mean == pytest.approx(12.0, abs=TOL)
+    assert aggregate.send_lag['top'].count == 6 and aggregate.send_lag['top'].mean == pytest.approx(4.0, abs=TOL)
+    lines = list(robot_timing_log.iter_report_lines([writer.path]))
+    assert "📈 総ストライク数: 2 回 (実測)" in lines
+    assert sum(line.endswith(' ---') for line in lines) == 4
+
+
+def test_predicted_only_log_has_no_accuracy(tmp_path):
+    """arrival_source の無い .jsonl (見込みを到着として書いていた記録) は実測として数えない"""
+    path = tmp_path / 'timing_data_top_1.jsonl'
+    path.write_text(json.dumps({'arm': 'top', 'loop_number': 0, 'planned_time': START, 'actual_arrival_time': START + 0.01,
+                                'timing_error': 0.01, 'motion_type': 'strike'}) + "\n", encoding='utf-8')
+    lines = list(robot_timing_log.iter_report_lines([str(path)]))
+    assert "実測した打撃がありません。" in lines
+
+
+def test_audio_onsets_fill_in_the_arrivals(tmp_path):
+    """strike_latency_analyzer --annotate-timing-log: 対応した打撃音だけを実測の到着として書き込む"""
+    import strike_latency_analyzer
+    writer = robot_timing_log.TimingLogWriter('top', str(tmp_path), 'timing_data_top_1.jsonl')
+    for i in range(4):
+        planned = START + i * 0.25
+        writer.record(0, i, (200.0, 0.0, -30.0), planned, planned, planned - 0.1, None, 'strike' if i % 2 == 0 else 'lift')
+    writer.close()
+    planned, _, _, _, _ = strike_latency_analyzer.load_plan(writer.path)
+    out = str(tmp_path / 'measured.jsonl')
+    assert strike_latency_analyzer.annotate_timing_log(writer.path, out, planned, planned + np.array([0.02, np.nan])) == 1
+    records = list(robot_timing_log.iter_records(out))
+    assert [r['arrival_source'] for r in records] == ['audio', None, None, None]
+    assert records[0]['timing_error'] == pytest.approx(0.02)
+    aggregate = robot_timing_log.aggregate_files([out])
+    assert aggregate.by_type[('top', 'strike')].count == 1 and aggregate.unmeasured == {'top': 3}
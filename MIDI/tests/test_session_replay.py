@@ -0,0 +1,117 @@
+"""session_replay: ログに書いた打撃を流し直した判定の集計"""
+import midi_input_hub
+import midi_session_log
+import session_replay
+
+PAD_NOTES = {'left': 47, 'right': 48}
+MASTER_START_TIME = 1000.0
+
+
+def make_score():
+    """120BPM 4/4、2 小節 (4 秒) のループ。上は 4 分音符、下は 2 分音符"""
+    return {
+        'top': {'bpm': 120, 'numerator': 4, 'denominator': 4,
+                'items': [{'class': 'note', 'beat': float(beat), 'duration': 1.0} for beat in range(8)]},
+        'bottom': {'bpm': 120, 'numerator': 4, 'denominator': 4,
+                   'items': [{'class': 'note', 'beat': float(beat), 'duration': 2.0} for beat in range(0, 8, 2)]},
+    }
+
+
+def write_session(path, loops, max_loops, offsets_ms=(0.0,)):
+    """全ノートを loops ループ分、offsets_ms の誤差を順に使って叩いたログを書く。書いた打数を返す"""
+    score = make_score()
+    loop_duration_ms = 4000.0
+    writer = midi_session_log.SessionLogWriter(str(path))
+    writer.meta('session_start', timestamp=MASTER_START_TIME, master_start_time=MASTER_START_TIME,
+                loop_duration_ms=loop_duration_ms, score=score,
+                devices=midi_input_hub.default_devices({pad: [note] for pad, note in PAD_NOTES.items()}, 10),
+                pad_tracks=session_replay.DEFAULT_PAD_TRACKS, controller=None, is_perfect_mode=True,
+                max_loops=max_loops, state='test', debounce_ms=session_replay.DEFAULT_DEBOUNCE_MS)
+    hits = []
+    for loop in range(loops):
+        for pad, track_name in session_replay.DEFAULT_PAD_TRACKS.items():
+            for item in score[track_name]['items']:
+                offset = offsets_ms[len(hits) % len(offsets_ms)]
+                hits.append((MASTER_START_TIME + (loop * loop_duration_ms + item['beat'] * 500.0 + offset) / 1000.0, PAD_NOTES[pad]))
+    for timestamp, note in sorted(hits):
+        writer.note_on(timestamp, 0, note, 100)
+    writer.meta('session_end', timestamp=MASTER_START_TIME + loops * loop_duration_ms / 1000.0 + 0.01)
+    writer.close()
+    return len(hits)
+
+
+def test_max_loops_summary_matches_hits(tmp_path):
+    """max_loops で終わったセッションでも、最後のループを二重に数えない"""
+    path = tmp_path / 'limited.mlog'
+    write_session(path, loops=3, max_loops=2)
+    session, = midi_session_log.load_sessions(str(path))
+    replay = session_replay.replay_session(session)
+    result = replay.result()
+
+    notes_per_loop = 12
+    assert replay.finished
+    assert len(result['judgement_history']) == 2
+    assert result['judgements'] == []
+    assert session_replay.summarize(result) == {'perfect': 2 * notes_per_loop}
+    # 3 ループ目の打撃は終わった後なので数えない
+    assert replay.ignored == notes_per_loop
+    assert session_replay.compare(result, result) == (2 * notes_per_loop, 0)
+
+
+def test_recorded_end_with_leftover_judgements_is_not_double_counted(tmp_path):
+    """記録時の session_end が最後のループの judgements を残していても、比較と集計で重ねて数えない"""
+    path = tmp_path / 'limited.mlog'
+    write_session(path, loops=2, max_loops=2)
+    session, = midi_session_log.load_sessions(str(path))
+    result = session_replay.replay_session(session).result()
+    recorded = {'judgement_history': result['judgement_history'], 'judgements': result['judgement_history'][-1]}
+
+    assert session_replay.summarize(recorded) == session_replay.summarize(result)
+    assert session_replay.compare(recorded, result) == (24, 0)
+
+
+def test_log_round_trip(tmp_path):
+    """書いたメタ情報と打撃がそのまま (打撃は時刻順で) 読み戻せる"""
+    path = tmp_path / 'session.mlog'
+    writer = midi_session_log.SessionLogWriter(str(path))
+    writer.meta('session_start', timestamp=10.0, master_start_time=10.5, score={'top': {'bpm': 100, 'items': []}}, state='free')
+    writer.note_on(11.25, 1, 48, 90)
+    writer.note_on(11.0, 0, 47, 64)
+    writer.meta('session_end', timestamp=12.0, judgements=[])
+    writer.meta('session_start', timestamp=20.0, master_start_time=20.0, score={}, state='second')
+    writer.note_on(20.5, 0, 47, 127)
+    writer.close()
+    assert writer.count == 3
+
+    first, second = midi_session_log.load_sessions(str(path))
+    assert first.start['master_start_time'] == 10.5 and first.start['score']['top']['bpm'] == 100
+    assert first.notes.tolist() == [(11.0, 0, 47, 64), (11.25, 1, 48, 90)]
+    assert first.end['event'] == 'session_end' and first.end_time == 12.0
+    # session_end の無い最後のセッションも読める
+    assert second.start['state'] == 'second' and second.end is None
+    assert second.notes.tolist() == [(20.5, 0, 47, 127)]
+
+
+def test_truncated_log_keeps_complete_records(tmp_path):
+    """書き込みの途中で落ちたログは、最後の不完全なレコードだけを捨てて読む"""
+    path = tmp_path / 'session.mlog'
+    hits = write_session(path, loops=1, max_loops=1)
+    data = path.read_bytes()
+    path.write_bytes(data[:-(midi_session_log.RECORD.size + 5)])
+    session, = midi_session_log.load_sessions(str(path))
+    assert len(session.notes) == hits and session.end is None
+
+
+def test_replay_is_deterministic_and_matches_the_recorded_result(tmp_path):
+    """同じログは何度流しても同じ判定になり、保存した結果 (--save / --expect) と食い違わない"""
+    path = tmp_path / 'session.mlog'
+    hits = write_session(path, loops=3, max_loops=None, offsets_ms=(0.0, 30.0, -70.0, 100.0, 400.0))
+    session, = midi_session_log.load_sessions(str(path))
+    first = session_replay.replay_session(session).result()
+    second = session_replay.replay_session(session).result()
+    assert session_replay.compare(first, second) == (sum(session_replay.summarize(first).values()), 0)
+
+    counts = session_replay.summarize(first)
+    assert {'perfect', 'great', 'good'} <= set(counts)
+    # 打撃はどれも 1 回ずつ判定され、見逃しはそれとは別に数える
+    assert sum(counts.get(name, 0) for name in ('perfect', 'great', 'good', 'extra')) == hits
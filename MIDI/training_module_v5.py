@@ -5,8 +5,14 @@ import time
 import copy
 import threading
 import signal
-import importlib
-import inspect
+import controller_registry  # ★ コントローラーはマニフェスト経由で遅延読み込み
+import midi_input_hub  # ★ 複数ポートの MIDI 入力をまとめる
+import judgement  # ★ 判定ロジック (UI 非依存、session_replay.py と共用)
+import score_compiler  # ★ 楽譜は読み取り専用にコンパイルして共有 (再生中の状態は PlaybackState)
+import midi_session_log  # ★ 生の note_on をバイナリで記録
+import experiment_recorder  # ★ 実験データを 1 レコードずつ追記 (バックグラウンドで fsync)
+import experiment_dataset  # ★ 記録の手法名 (テストは TEST_METHOD) をデータセットと共有
+import score_library  # ★ 楽譜フォルダの索引 (BPM・難易度など。変更は QFileSystemWatcher で反映)
 import io
 import wave
 import datetime  # ★ タイムスタンプ用にインポート
@@ -17,12 +23,11 @@ from PyQt6.QtWidgets import (
 )
 from PyQt6.QtCore import (
     Qt, QTimer, QRectF, QPointF, QObject, pyqtSignal, QThread, QPropertyAnimation,
-    QEasingCurve, pyqtProperty, pyqtSlot
+    QEasingCurve, pyqtProperty, pyqtSlot, QFileSystemWatcher
 )
 from PyQt6.QtGui import (
     QPainter, QColor, QFont, QPen, QPixmap, QLinearGradient, QCursor, QPolygonF, QRadialGradient, QBrush, QPainterPath
 )
-import mido
 import pygame
 import pyttsx3
 from PyQt6.QtWidgets import QFrame
@@ -40,6 +45,13 @@ try:
 except ImportError:
     NUMPY_AVAILABLE = False
 
+# --- ★ 音声入力によるパッド検出 (MIDI が無いときの代わり、audio_pad_input.py) ★ ---
+try:
+    import audio_pad_input
+    AUDIO_PAD_AVAILABLE = audio_pad_input.SOUNDDEVICE_AVAILABLE
+except ImportError:
+    AUDIO_PAD_AVAILABLE = False
+
 # --- ★ロボット制御モジュールをここで読み込む★ ---
 try:
     import robot_control_module_v4
@@ -67,8 +79,11 @@ except ImportError:
 
 
 # --- アプリ設定定数 ---
-PAD_MAPPING = {'left': [47, 56], 'right': [48, 29]}; VELOCITY_THRESHOLD = 25; LIT_DURATION = 150; NUM_MEASURES = 2
-JUDGEMENT_WINDOWS = {'perfect': 55, 'great': 90, 'good': 110}; DROPPED_THRESHOLD = 120
+PAD_MAPPING = {'left': [47, 56], 'right': [48, 29]}; PAD_TRACKS = {'left': 'top', 'right': 'bottom'}; VELOCITY_THRESHOLD = 25; LIT_DURATION = 150; NUM_MEASURES = judgement.NUM_MEASURES
+JUDGEMENT_WINDOWS = judgement.JUDGEMENT_WINDOWS; DROPPED_THRESHOLD = judgement.DROPPED_THRESHOLD
+AUDIO_PAD_FALLBACK = True; AUDIO_INPUT_DEVICE = None  # MIDI ポートが無いとき、マイク / ライン入力で打撃を検出する
+SESSION_LOG_ENABLED = True  # 練習中の生の note_on を midi_session_log.LOG_DIR に記録する (session_replay.py で再生)
+SCORE_DIRECTORY = r"C:\卒研\music"  # 楽譜フォルダ (score_library が索引を持つ)
 NOTE_DURATIONS = {'whole': {'duration': 4.0, 'name': "全音符"}, 'half': {'duration': 2.0, 'name': "2分音符"}, 'quarter': {'duration': 1.0, 'name': "4分音符"}, 'eighth': {'duration': 0.5, 'name': "8分音符"}, 'sixteenth': {'duration': 0.25, 'name': "16分音符"}}
 REST_DURATIONS = {'quarter_rest': {'duration': 1.0, 'name': "4分休符"}, 'eighth_rest': {'duration': 0.5, 'name': "8分休符"}, 'sixteenth_rest': {'duration': 0.25, 'name': "16分休符"}}
 ALL_DURATIONS = {**NOTE_DURATIONS, **REST_DURATIONS}
@@ -81,36 +96,8 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 def load_controllers():
-    controllers = {}
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    controller_dir = os.path.join(script_dir, "controllers")
-    if not os.path.exists(controller_dir): return {}
-    if controller_dir not in sys.path: sys.path.insert(0, controller_dir)
-    if script_dir not in sys.path: sys.path.insert(0, script_dir)
-    try:
-        from controllers.base_controller import BaseEntrainmentController
-
-        # ★ 2. 他
-        for filename in os.listdir(controller_dir):
-            if filename.endswith(".py") and filename not in ["base_controller.py", "__init__.py"]:
-                module_name = f"controllers.{filename[:-3]}"
-                try:
-                    module = importlib.import_module(module_name)
-                    for name, obj in inspect.getmembers(module, inspect.isclass):
-                        if issubclass(obj, BaseEntrainmentController) and obj is not BaseEntrainmentController:
-                            try:
-                                instance = obj(None, 0); 
-                                # ★★★ ここからが修正点 ★★★
-                                 # 1. まず、ファイルに定義された名前で登録する
-                                controllers[instance.name] = obj
- 
-                            except Exception as e: print(f"エラー: コントローラー {name} のインスタンス化に失敗: {e}")
-                except ImportError as e: print(f"エラー: コントローラーモジュール {module_name} のインポートに失敗: {e}")
-    except ImportError as e: print(f"エラー: BaseEntrainmentControllerをインポートできませんでした。詳細: {e}")
-
-    # 登録確認
-    print(f"読み込まれたコントローラー: {list(controllers.keys())}")
-    return controllers
+    """controllers/ のコントローラーを {表示名: 遅延ロードエントリ} で返す (実体は選択時に import)"""
+    return controller_registry.load_controllers()
 
 
 # ★★★ 修正版: 順次再生制御（キューイング）を実装した音声クラス ★★★
@@ -695,16 +682,36 @@ class SettingsDialog(QDialog):
 
     
 class FileSelectionDialog(QDialog):
+    # ★ 並べ替え・絞り込み (表示名: score_library.ScoreLibrary.query の引数)
+    SORT_OPTIONS = [
+        ("名前順", {'sort_by': 'name'}),
+        ("難易度 (易しい順)", {'sort_by': 'difficulty'}), ("難易度 (難しい順)", {'sort_by': 'difficulty', 'descending': True}),
+        ("BPM (遅い順)", {'sort_by': 'bpm'}), ("BPM (速い順)", {'sort_by': 'bpm', 'descending': True}),
+    ]
+    DIFFICULTY_FILTERS = [
+        ("難易度: すべて", {}), ("難易度: 〜3", {'max_difficulty': 3.0}),
+        ("難易度: 3〜6", {'min_difficulty': 3.0, 'max_difficulty': 6.0}), ("難易度: 6〜", {'min_difficulty': 6.0}),
+    ]
+    BPM_FILTERS = [
+        ("BPM: すべて", {}), ("BPM: 〜80", {'max_bpm': 80}),
+        ("BPM: 80〜120", {'min_bpm': 80, 'max_bpm': 120}), ("BPM: 120〜", {'min_bpm': 120}),
+    ]
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("ファイルを選択")
         self.setMinimumSize(600, 500)
         self.selected_filepath = None
+        # ★ 一覧はメイン画面の楽譜索引から作る (並べ替え・絞り込みでファイルは読まない)
+        self.library = getattr(parent, 'score_library', None) or score_library.get_library(SCORE_DIRECTORY)
+        self.library.refresh()
 
         # スタイリング
         self.setStyleSheet(f"""
             QDialog {{ background-color: {COLORS['background'].name()}; }}
             QScrollArea {{ border: none; }}
+            QComboBox {{ background: {COLORS['surface'].name()}; color: {COLORS['text_primary'].name()}; border: 1px solid {COLORS['border'].name()}; border-radius: 8px; padding: 6px; font-weight: bold; }}
+            QComboBox:hover {{ border: 1px solid {COLORS['primary'].name()}; }}
         """)
 
         main_layout = QVBoxLayout(self)
@@ -714,6 +721,15 @@ class FileSelectionDialog(QDialog):
         title_label = ModernLabel("ファイルを選択してください", 16, QFont.Weight.Bold, 'text_primary')
         main_layout.addWidget(title_label)
 
+        # ★ 並べ替え・絞り込み
+        filter_layout = QHBoxLayout()
+        self.sort_combo, self.difficulty_combo, self.bpm_combo = QComboBox(), QComboBox(), QComboBox()
+        for combo, options in ((self.sort_combo, self.SORT_OPTIONS), (self.difficulty_combo, self.DIFFICULTY_FILTERS), (self.bpm_combo, self.BPM_FILTERS)):
+            for label, _ in options: combo.addItem(label)
+            combo.currentIndexChanged.connect(self.populate_files)
+            filter_layout.addWidget(combo)
+        main_layout.addLayout(filter_layout)
+
         # スクロールエリアのセットアップ
         scroll_area = QScrollArea()
         scroll_area.setWidgetResizable(True)
@@ -725,7 +741,6 @@ class FileSelectionDialog(QDialog):
         self.files_layout.setSpacing(10)
         
         self.populate_files() # ファイルリストを読み込む
-        self.files_layout.addStretch()
 
         scroll_area.setWidget(scroll_content)
         main_layout.addWidget(scroll_area)
@@ -739,33 +754,37 @@ class FileSelectionDialog(QDialog):
         button_layout.addWidget(cancel_button)
         main_layout.addLayout(button_layout)
 
-    def populate_files(self):
-        target_dir = 'C:\\卒研\\music'
-        if not os.path.exists(target_dir):
-            error_label = ModernLabel(f"ディレクトリが見つかりません:\n{target_dir}", 12, weight=QFont.Weight.Bold, color_key='danger')
-            error_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            self.files_layout.addWidget(error_label)
-            return
+    def _add_message(self, text, weight=QFont.Weight.Normal, color_key='text_muted'):
+        label = ModernLabel(text, 12, weight=weight, color_key=color_key)
+        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.files_layout.addWidget(label)
 
-        try:
-            json_files = [f for f in os.listdir(target_dir) if f.endswith('.json')]
-        except Exception as e:
-            error_label = ModernLabel(f"ファイルリストの取得に失敗しました:\n{e}", 12, weight=QFont.Weight.Bold, color_key='danger')
-            error_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            self.files_layout.addWidget(error_label)
-            return
-        
-        if not json_files:
-            no_files_label = ModernLabel("このフォルダには .json ファイルが見つかりませんでした。", 12, color_key='text_muted')
-            no_files_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            self.files_layout.addWidget(no_files_label)
-            return
-
-        for filename in sorted(json_files):
-            filepath = os.path.join(target_dir, filename)
-            btn = ModernButton(filename.replace('.json', ''), "primary")
-            btn.clicked.connect(lambda checked, p=filepath: self.on_file_selected(p))
-            self.files_layout.addWidget(btn)
+    def populate_files(self):
+        """★ 索引から一覧を作り直す (並べ替え・絞り込みを変えるたびに呼ばれる)"""
+        while self.files_layout.count():
+            widget = self.files_layout.takeAt(0).widget()
+            if widget is not None: widget.deleteLater()
+
+        if not os.path.exists(self.library.directory):
+            self._add_message(f"ディレクトリが見つかりません:\n{self.library.directory}", QFont.Weight.Bold, 'danger')
+        elif not self.library.entries:
+            self._add_message("このフォルダには .json ファイルが見つかりませんでした。")
+        else:
+            query = {}
+            for combo, options in ((self.sort_combo, self.SORT_OPTIONS), (self.difficulty_combo, self.DIFFICULTY_FILTERS), (self.bpm_combo, self.BPM_FILTERS)):
+                query.update(options[max(combo.currentIndex(), 0)][1])
+            entries = self.library.query(**query)
+            if not entries: self._add_message("条件に合う楽譜がありません。")
+            for entry in entries:
+                if 'error' in entry:
+                    text = f"{entry['name']}   (読み込めません)"
+                else:
+                    difficulty = f"{entry['difficulty']:.1f}" if entry.get('difficulty') is not None else "-"
+                    text = f"{entry['name']}   BPM {entry['bpm'] if entry.get('bpm') is not None else '-'} ・ {entry['time_signature'] or '-'} ・ 難易度 {difficulty}"
+                btn = ModernButton(text, "primary")
+                btn.clicked.connect(lambda checked, p=entry['path']: self.on_file_selected(p))
+                self.files_layout.addWidget(btn)
+        self.files_layout.addStretch()
 
     def on_file_selected(self, filepath):
         self.selected_filepath = filepath
@@ -832,6 +851,8 @@ class LogWindow(QDialog):
         self.hide()      # 代わりに非表示にする
 
 class MainWindow(QMainWindow):
+    recorder_log = pyqtSignal(str)  # 実験データ書き込みスレッドからのログ
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Rhythm Interface")
@@ -846,7 +867,8 @@ class MainWindow(QMainWindow):
             'experiment_order': ['linear', 'passthrough', 'metronome'],
             'score_order': ['test1', 'test2', 'test3'],
             'show_score_during_practice': True,
-            'show_feedback_on_score': False
+            'show_feedback_on_score': False,
+            'participant_id': ''  # 実験データ (experiment_dataset) の participant 列
         }
         self.state = "waiting" # waiting, result, または experiment_...
         self.last_input_time = {'top': 0, 'bottom': 0}
@@ -972,6 +994,7 @@ class MainWindow(QMainWindow):
         # ★★★ 実験モード設定ここまで ★★★
 
         self.experiment_data = {}
+        self.experiment_recorder = None
         self.experiment_next_state = None
         self.practice_loop_count_max = float('inf')
         self.practice_start_time = 0 # ★ 練習開始時刻 (is_perfect_mode用)
@@ -989,6 +1012,7 @@ class MainWindow(QMainWindow):
         self.note_sound, self.metronome_click, self.metronome_accent_click, self.countdown_sound, self.snare_sound, self.tom_sound = None, None, None, None, None, None
         self.controller_classes = {}
         self.active_controller = None
+        self.session_log = None
         
         self.viz_window = None
         if MONITOR_AVAILABLE:
@@ -997,6 +1021,11 @@ class MainWindow(QMainWindow):
         self.silent_wav_buffer = None
         
         self.log_window = LogWindow(self) 
+        self.recorder_log.connect(self.log_window.append_log)
+
+        # ★ 楽譜フォルダの索引 (起動時に変わったファイルだけ読み、以後はフォルダの監視で更新)
+        self.score_library = score_library.get_library(SCORE_DIRECTORY, on_log=self.log_window.append_log)
+        self.score_watcher = score_library.watch(QFileSystemWatcher(self), self.score_library)
         
         if ROBOTS_AVAILABLE:
             self.robot_manager = robot_control_module_v4.RobotManager(self)
@@ -1028,7 +1057,7 @@ class MainWindow(QMainWindow):
 
     def _ensure_tutorial_score_exists(self):
         """tutorial.json がなければ作成する (4/4拍子, シンプルなリズム)"""
-        target_path = os.path.join(r"C:\卒研\music", "tutorial.json")
+        target_path = os.path.join(SCORE_DIRECTORY, "tutorial.json")
         if os.path.exists(target_path): return
         
         # シンプルな4分音符のリズム
@@ -1261,7 +1290,7 @@ class MainWindow(QMainWindow):
         if selected_class:
             try:
                 ms_per_beat = 60000.0 / self.template_score['top'].get('bpm', 120)
-                self.active_controller = selected_class(copy.deepcopy(self.template_score), ms_per_beat)
+                self.active_controller = selected_class(self.template_score, ms_per_beat)
                 print(f"--- Controller '{self.active_controller.name}' が選択されました。---")
             except Exception as e: print(f"コントローラーのインスタンス化に失敗: {e}"); self.active_controller = None
 
@@ -1389,12 +1418,9 @@ class MainWindow(QMainWindow):
 
     def init_midi(self):
         try:
-            input_ports = mido.get_input_names()
-            if not input_ports:
-                raise OSError("MIDI入力ポートが見つかりません。")
-            
-            self.inport = mido.open_input(input_ports[0])
-            msg = f"✅ MIDIポートに接続: {input_ports[0]}"
+            # ★ midi_devices.json のポートをすべて開く (無ければ PAD_MAPPING で最初のポート)
+            self.inport = midi_input_hub.open_hub(PAD_MAPPING, VELOCITY_THRESHOLD, on_log=self.log_window.append_log)
+            msg = f"✅ MIDIポートに接続: {self.inport.name}"
             self.label_info.setText(msg)
             self.label_info.set_style(11, QFont.Weight.Normal, 'text_primary') # 通常スタイル
             self.log_window.append_log(msg)
@@ -1409,6 +1435,7 @@ class MainWindow(QMainWindow):
             self.log_window.append_log(msg)
             
             self.inport = None
+            self.init_audio_pad_input()
             
             # ★★★ 変更点: ここでボタンを無効化（False）していた行を削除またはTrueにする ★★★
             self.btn_load_template.setEnabled(True)
@@ -1479,9 +1506,11 @@ class MainWindow(QMainWindow):
         """
         try:
             with open(filepath, 'r', encoding='utf-8') as f: 
-                self.template_score = json.load(f)
-            if 'top' not in self.template_score: 
+                score_data = json.load(f)
+            if 'top' not in score_data: 
                 raise ValueError("無効なファイル形式です。")
+            # ★ 読み取り専用にコンパイルして、判定・再生・ロボット・モニターで共有する (ノート ID もここで振られる)
+            self.template_score = score_compiler.compile_score(score_data, source=filepath)
             
             file_display_name = os.path.basename(filepath).replace('.json', '')
             self.label_template_file.setText(f"📄 ファイル: {file_display_name}")
@@ -1564,16 +1593,8 @@ class MainWindow(QMainWindow):
         # ★★★ ここが重要: 前のセットのデータが残らないように新しく作り直す ★★★
         self.judged_notes = {} 
         
-        # 3. ノート総数の再計算とIDの割り振り
-        self.total_notes = sum(1 for track in self.template_score.values() for item in track.get('items', []) if item['class'] == 'note')
-        
-        note_id = 0
-        for track_name, track in self.template_score.items():
-            for item in track.get('items', []):
-                if item['class'] == 'note': 
-                    # トラック名と連番で一意なIDを振る (例: top-0, top-1...)
-                    item['id'] = f"{track_name}-{note_id}"
-                    note_id += 1
+        # 3. ノート総数 (ID は score_compiler がコンパイル時に振っている: top-0, top-1...)
+        self.total_notes = self.template_score.total_notes
         
         # ログ確認用
         # self.log_window.append_log(f"記録準備完了: {self.total_notes} ノート, バッファをリセットしました。")
@@ -1612,12 +1633,9 @@ class MainWindow(QMainWindow):
         
         self.prepare_for_recording()
         top_score = self.template_score.get("top", {})
-        bottom_score = self.template_score.get("bottom", {})
-        top_bpm = top_score.get("bpm", 120); bottom_bpm = bottom_score.get("bpm", 120)
-        top_beats = top_score.get("total_beats", 8); bottom_beats = bottom_score.get("total_beats", 8)
-        top_duration_ms = top_beats * (60000.0 / top_bpm) if top_bpm > 0 else 0
-        bottom_duration_ms = bottom_beats * (60000.0 / bottom_bpm) if bottom_bpm > 0 else 0
-        master_loop_duration_ms = max(top_duration_ms, bottom_duration_ms)
+        top_bpm = top_score.get("bpm", 120)
+        # ★ ループ長はコンパイル時に拍子から決まる (再生ウィジェットが total_beats を書き込むのを待たない)
+        master_loop_duration_ms = self.template_score.loop_duration_ms
         
         countdown_duration_s = (4 * (60.0 / top_bpm))
         
@@ -1646,7 +1664,7 @@ class MainWindow(QMainWindow):
                 if controller_class:
                     try:
                         ms_per_beat = 60000.0 / top_bpm
-                        controller_to_use = controller_class(copy.deepcopy(self.template_score), ms_per_beat)
+                        controller_to_use = controller_class(self.template_score, ms_per_beat)
                         print(f"--- 実験モード: '{force_controller_name}' を強制使用します。---")
                     except Exception as e:
                         print(f"コントローラー '{force_controller_name}' のインスタンス化に失敗: {e}")
@@ -1698,6 +1716,7 @@ class MainWindow(QMainWindow):
             master_start_time=master_start_time,
             hide_score=should_hide_score
         )
+        self.start_session_log(master_start_time, master_loop_duration_ms)
         show_metronome_ui = False
         
         # 設定でメトロノームがONになっているか確認
@@ -1744,6 +1763,7 @@ class MainWindow(QMainWindow):
         演奏（練習・テスト・デモ）終了時の処理
         """
         # --- 共通のクリーンアップ処理 ---
+        self.stop_session_log()
         pygame.mixer.music.stop()
         if self.viz_window: self.viz_window.stop_monitoring()
         if self.robot_manager: self.robot_manager.stop_control()
@@ -1784,6 +1804,9 @@ class MainWindow(QMainWindow):
             # --- 中止ボタンが押された場合 ---
             if force_stop and is_running_state:
                 self.log_window.append_log("実行が中止されました。")
+                if not getattr(self, 'is_tutorial_active', False):
+                    self.record_experiment('step_aborted', set_index=self.current_experiment_set_index + 1,
+                                           step_index=self.current_experiment_step + 1)
                 
                 # イントロ画面に戻る
                 self.enter_experiment_state("experiment_intro", set_index=self.current_experiment_set_index, step=self.current_experiment_step)
@@ -1837,15 +1860,10 @@ class MainWindow(QMainWindow):
             else:
                 config = self.experiment_steps_config[current_step_idx]
             
-            method_name = "Test (None)"
-            overrides = config.get('setting_overrides') or {}
-            
-            if config.get('force_robot'):
-                method_name = config.get('force_controller_name', 'Robot')
-            elif overrides.get('metronome_on'):
-                method_name = "Metronome"
-            
-            step_log['method'] = method_name
+            step_log['method'] = self._step_method_name(config)
+            # セットの条件 (練習ステップの手法)。前後のテストのステップにも同じ値を入れ、条件ごとに絞り込めるようにする
+            if not getattr(self, 'is_tutorial_active', False):
+                step_log['condition'] = self._experiment_set_condition(current_set_idx)
 
             # データの格納（練習パートならループ詳細、テストなら全打鍵データ）
             # ※ ステップ1が練習とは限らない場合もあるが、experiment_steps_configの構造に依存
@@ -1861,7 +1879,8 @@ class MainWindow(QMainWindow):
                         'note_id': j.get('note_id'),
                         'judgement': j.get('judgement'),
                         'error_ms': j.get('error_ms'),
-                        'pad': j.get('pad')
+                        'pad': j.get('pad'),
+                        'hit_time': j.get('hit_time')
                     })
                 step_log['raw_hits'] = detailed_hits
 
@@ -1869,6 +1888,8 @@ class MainWindow(QMainWindow):
             # チュートリアル中はログを保存しない
             if not getattr(self, 'is_tutorial_active', False):
                 self.experiment_logs.append(step_log)
+                self.record_experiment('step', is_practice=is_practice_step,
+                                       **{k: v for k, v in step_log.items() if k != 'practice_loops'})
                 self.log_window.append_log(f"データを記録しました: Set {current_set_idx+1} - Step {current_step_idx+1}")
             else:
                 self.log_window.append_log(f"チュートリアルのためデータ記録はスキップします。")
@@ -1941,145 +1962,56 @@ class MainWindow(QMainWindow):
             
             self.update_button_states()
 
-    # -------------------------------------------------------
-    # ★★★ 修正版 save_experiment_data_to_file ★★★
-    # インデントを戻して MainWindow のメソッドとして正しく定義
-    # -------------------------------------------------------
+    def start_experiment_recorder(self):
+        """実験データの追記を始める (前回の記録係が残っていれば閉じる)"""
+        if self.experiment_recorder: self.experiment_recorder.close()
+        self.experiment_recorder = None
+        try:
+            self.experiment_recorder = experiment_recorder.new_recorder(on_log=self.recorder_log.emit)
+        except OSError as e:
+            self.log_window.append_log(f"⚠️ 実験データの記録を開始できません: {e}"); return
+        self.experiment_recorder.record(
+            'experiment_start', experiment_start_time=getattr(self, 'experiment_start_time', 'Unknown'),
+            participant=self.settings.get('participant_id', ''),
+            score_order=self.settings.get('score_order', ['test1', 'test2', 'test3']),
+            experiment_order=self.settings.get('experiment_order', ['linear', 'passthrough', 'metronome']))
+        self.log_window.append_log(f"実験データの記録先: {self.experiment_recorder.path}")
+
+    def _step_method_name(self, config):
+        """ステップの設定から記録用の手法名を決める"""
+        overrides = config.get('setting_overrides') or {}
+        if config.get('force_robot'):
+            return config.get('force_controller_name', 'Robot')
+        if overrides.get('metronome_on'):
+            return "Metronome"
+        return experiment_dataset.TEST_METHOD
+
+    def _experiment_set_condition(self, set_index):
+        """セットの練習ステップ (step=1) の手法名 (enter_experiment_state と同じ順序の設定から)"""
+        experiment_order_list = self.settings.get('experiment_order', ['linear', 'passthrough', 'metronome'])
+        try:
+            practice_type = experiment_order_list[set_index]
+        except IndexError:
+            practice_type = 'linear'
+        config = copy.deepcopy(self.experiment_steps_config[1])
+        config.update(self.experiment_practice_configs.get(practice_type, {}))
+        return self._step_method_name(config)
+
+    def record_experiment(self, record_type, **fields):
+        """レコードをキューに入れるだけ (書き込みと fsync は記録係のスレッド)"""
+        if self.experiment_recorder: self.experiment_recorder.record(record_type, **fields)
+
     def save_experiment_data_to_file(self):
         """
-        実験データをテキストファイルに出力する
-        （Score対応、練習ループ詳細記録対応、完了ポップアップ削除版）
+        実験の終わりを記録し、これまでのレコードからテキストのレポートを作る
+        (書き込みは記録係のスレッドで行うので UI は止まらない)
         """
+        if not self.experiment_recorder:
+            self.log_window.append_log("⚠️ 実験データの記録係がありません。レポートは作成できません。"); return
+        self.experiment_recorder.record('experiment_end')
         now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"experiment_result_{now_str}.txt"
-        
-        # 保存先ディレクトリ
-        target_dir = r"C:\卒研\実験データ"
-   
-        # ディレクトリが存在しない場合は作成する
-        if not os.path.exists(target_dir):
-            try:
-                os.makedirs(target_dir)
-                self.log_window.append_log(f"保存用フォルダを作成しました: {target_dir}")
-            except Exception as e:
-                self.log_window.append_log(f"フォルダ作成エラー: {e}")
-                target_dir = os.getcwd()
-        
-        # フルパスを作成
-        save_path = os.path.join(target_dir, filename)
-        
-        try:
-            with open(save_path, "w", encoding="utf-8") as f:
-                # --- ヘッダー情報の書き込み ---
-                f.write("==================================================\n")
-                f.write(f" リズム実験データログ\n")
-                f.write(f" 実験開始日時: {getattr(self, 'experiment_start_time', 'Unknown')}\n")
-                f.write(f" 実験終了日時: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                
-                # 設定された順序情報の書き込み
-                current_score_order = self.settings.get('score_order', ['test1', 'test2', 'test3'])
-                f.write(f" 楽譜順序: {' -> '.join(current_score_order)}\n")
-
-                current_method_order = self.settings.get('experiment_order', ['linear', 'passthrough', 'metronome'])
-                f.write(f" 手法順序: {' -> '.join(current_method_order)}\n")
-                
-                f.write("==================================================\n\n")
-                
-                current_set = -1
-                pad_labels = {'top': '左', 'bottom': '右'} 
-                
-                # --- 各ログデータの書き込み ---
-                for log in self.experiment_logs:
-                    set_idx = log['set_index']
-                    step_idx = log['step_index']
-                    
-                    # セットの区切り
-                    if set_idx != current_set:
-                        f.write(f"\n##################################################\n")
-                        f.write(f" 実験セット {set_idx} (楽譜: {log['score_file']})\n")
-                        f.write(f"##################################################\n")
-                        current_set = set_idx
-                    
-                    step_name = ["事前テスト (Test 1)", "練習 (Practice)", "事後テスト (Test 2)"][step_idx - 1]
-                    f.write(f"\n--- ステップ {step_idx}: {step_name} ---\n")
-                    f.write(f"手法: {log['method']}\n")
-                    f.write(f"日時: {log['timestamp']}\n")
-                    
-                    # --- ステップ全体の統計 ---
-                    stats = log['stats']
-                    f.write(f"【全体】 Acc: {stats.get('accuracy', 0):.1f}%, Score: {stats.get('score', 0):.1f}%, Err: {stats.get('avg_error', 0):.1f}ms, Dev: {stats.get('std_dev', 0):.1f}ms\n")
-                    
-                    # --- 左右別の統計 ---
-                    if 'pad_stats' in log:
-                        for pad_key in ['top', 'bottom']:
-                            if pad_key in log['pad_stats']:
-                                p_s = log['pad_stats'][pad_key]
-                                label = pad_labels.get(pad_key, pad_key)
-                                f.write(f"  [{label}手] Acc: {p_s.get('accuracy',0):.1f}%, Score: {p_s.get('score',0):.1f}%, Err: {p_s.get('avg_error',0):.1f}ms, Dev: {p_s.get('std_dev',0):.1f}ms")
-                                f.write(f" (P:{p_s['perfect']} Gr:{p_s['great']} Go:{p_s['good']} M:{p_s['dropped']})\n")
-                    
-                    # --- 練習ループの詳細推移 (詳細版) ---
-                    if 'practice_loops' in log:
-                        f.write(f"\n  [各ループの推移]\n")
-                        for loop in log['practice_loops']:
-                            l_stats = loop['stats']
-                            l_pad_stats = loop.get('pad_stats', {}) 
-
-                            # ループヘッダー
-                            f.write(f"  > Loop {loop['loop_count']} ({loop['timestamp']})\n")
-                            
-                            # ループ全体統計
-                            f.write(f"    【全体】 Acc: {l_stats.get('accuracy',0):.1f}%, Score: {l_stats.get('score',0):.1f}%, Err: {l_stats.get('avg_error',0):.1f}ms, Dev: {l_stats.get('std_dev',0):.1f}ms\n")
-
-                            # ループ左右別統計
-                            for pad_key in ['top', 'bottom']:
-                                if pad_key in l_pad_stats:
-                                    p_s = l_pad_stats[pad_key]
-                                    label = pad_labels.get(pad_key, pad_key)
-                                    f.write(f"      [{label}手] Acc: {p_s.get('accuracy',0):.1f}%, Score: {p_s.get('score',0):.1f}%, Err: {p_s.get('avg_error',0):.1f}ms, Dev: {p_s.get('std_dev',0):.1f}ms")
-                                    f.write(f" (P:{p_s['perfect']} Gr:{p_s['great']} Go:{p_s['good']} M:{p_s['dropped']})\n")
-                            
-                            f.write("\n")
-                    
-                    # --- テストの詳細打鍵データ (変更なし) ---
-                    elif 'raw_hits' in log:
-                        f.write(f"\n  [打鍵詳細データ]\n")
-                        
-                        def sort_key_func(hit):
-                            nid = hit['note_id']
-                            if not nid: return ("z", 0)
-                            try:
-                                parts = nid.split('-')
-                                return (parts[0], int(parts[1]))
-                            except (ValueError, IndexError):
-                                return (str(nid), 0)
-
-                        sorted_hits = sorted(log['raw_hits'], key=sort_key_func)
-
-                        for hit in sorted_hits:
-                            note_id = hit['note_id'] if hit['note_id'] else "Unknown"
-                            judgement = hit['judgement']
-                            error_str = f"{hit['error_ms']:+.0f}ms" if hit['error_ms'] is not None else "---"
-                            f.write(f"  Note {note_id:<10} : {judgement:<8} {error_str}\n")
-
-                    # --- ロボット制御ログ ---
-                    if 'robot_history' in log and log['robot_history']:
-                        f.write(f"\n  [ロボット制御ログ] (LinearController)\n")
-                        f.write(f"  {'Time':<12} | {'Track':<7} | {'Ideal(ms)':<10} | {'Offset(ms)':<11} | {'Guided(ms)':<10}\n")
-                        f.write(f"  {'-'*12}-+-{'-'*7}-+-{'-'*10}-+-{'-'*11}-+-{'-'*10}\n")
-                        
-                        for r in log['robot_history']:
-                            offset_str = f"{r['offset']:+.1f}"
-                            f.write(f"  {r['timestamp']:<12} | {r['track']:<7} | {r['ideal']:<10.0f} | {offset_str:<11} | {r['guided']:<10.0f}\n")
-            
-            # 完了時のログ出力（ポップアップは削除済み）
-            self.log_window.append_log(f"実験ログを保存しました: {save_path}")
-            
-        except Exception as e:
-            self.log_window.append_log(f"保存エラー: {e}")
-            # エラー時のみポップアップを表示
-            QMessageBox.critical(self, "保存エラー", f"ファイルの保存に失敗しました。\n{e}")
-
+        report_path = os.path.join(os.path.dirname(self.experiment_recorder.path), f"experiment_result_{now_str}.txt")
+        self.experiment_recorder.request_report(report_path)
 
     def get_stats_per_pad(self):
         """ 左右別の統計情報を計算 (上限100%制限を追加) """
@@ -2139,6 +2071,8 @@ class MainWindow(QMainWindow):
             self.viz_window.close()
         if self.robot_manager: self.robot_manager.stop_control()
         if self.thread and self.thread.isRunning(): self.thread.quit(); self.thread.wait()
+        self.stop_session_log()
+        if self.experiment_recorder: self.experiment_recorder.close()
         if hasattr(self, 'inport') and self.inport and not self.inport.closed: self.inport.close()
         if self.log_window:
             self.log_window.closeEvent = lambda e: e.accept() 
@@ -2171,7 +2105,8 @@ class MainWindow(QMainWindow):
                     'note_id': j.get('note_id'),
                     'judgement': j.get('judgement'),
                     'error_ms': j.get('error_ms'),
-                    'pad': j.get('pad')
+                    'pad': j.get('pad'),
+                    'hit_time': j.get('hit_time')
                 })
 
             loop_data = {
@@ -2186,6 +2121,9 @@ class MainWindow(QMainWindow):
             if not hasattr(self, 'current_practice_logs'):
                 self.current_practice_logs = []
             self.current_practice_logs.append(loop_data)
+            if not getattr(self, 'is_tutorial_active', False):
+                self.record_experiment('practice_loop', set_index=self.current_experiment_set_index + 1,
+                                       step_index=self.current_experiment_step + 1, **loop_data)
         # ---------------------------------------------------
 
         if self.active_controller and hasattr(self.active_controller, 'update_performance_data'):
@@ -2395,14 +2333,58 @@ class MainWindow(QMainWindow):
             self.btn_settings.setVisible(False)
             self.btn_exp_finish.setVisible(self.state == "experiment_running")
 
+    def init_audio_pad_input(self):
+        """MIDI の代わりに音声入力から打撃を検出する (mido の入力ポートと同じく iter_pending で取り出せる)"""
+        if not (AUDIO_PAD_FALLBACK and AUDIO_PAD_AVAILABLE): return
+        try:
+            pad_notes = {pad: notes[0] for pad, notes in PAD_MAPPING.items()}
+            self.inport = audio_pad_input.open_input(AUDIO_INPUT_DEVICE, pad_notes=pad_notes)
+        except OSError as e:
+            self.log_window.append_log(f"⚠️ 音声入力も使えません: {e}")
+            return
+        msg = f"🎤 音声入力で打撃を検出: {self.inport.name} (左右の判定: {self.inport.detector.mode})"
+        self.label_info.setText(msg)
+        self.label_info.set_style(11, QFont.Weight.Normal, 'text_primary')
+        self.log_window.append_log(msg)
+
+    def start_session_log(self, master_start_time, loop_duration_ms):
+        """生の note_on の記録を始める。楽譜・デバイス構成・コントローラーも書いておき、session_replay.py で同じ判定を再現する"""
+        self.stop_session_log()
+        if not SESSION_LOG_ENABLED or not getattr(self, 'inport', None) or not hasattr(self.inport, 'raw_sink'): return
+        try:
+            self.session_log = midi_session_log.SessionLogWriter(midi_session_log.new_log_path())
+        except OSError as e:
+            self.log_window.append_log(f"⚠️ セッションログを開けません: {e}"); return
+        max_loops = self.practice_loop_count_max if self.practice_loop_count_max != float('inf') else None
+        self.session_log.meta(
+            'session_start', master_start_time=master_start_time, loop_duration_ms=loop_duration_ms,
+            score=self.template_score.to_json(), devices=getattr(self.inport, 'devices', None), port_name=self.inport.name, pad_tracks=PAD_TRACKS,
+            controller=self.active_controller.name if self.active_controller else None,
+            is_perfect_mode=self.is_perfect_mode, max_loops=max_loops, state=self.state, debounce_ms=self.DEBOUNCE_TIME_MS)
+        self.inport.raw_sink = self.session_log.note_on
+
+    def stop_session_log(self):
+        """記録を終える。判定結果も書いておき、再生結果と突き合わせられるようにする"""
+        session_log = self.session_log
+        if session_log is None: return
+        self.session_log = None
+        if getattr(self, 'inport', None) is not None: self.inport.raw_sink = None
+        session_log.meta('session_end', judgement_history=self.judgement_history, judgements=self.judgements)
+        session_log.close()
+        self.log_window.append_log(f"セッションログ保存: {session_log.path} ({session_log.count}打)")
+
     def process_midi_input(self):
         if not hasattr(self, 'inport') or not self.inport: return
         
         # MIDIメッセージを処理する
         for msg in self.inport.iter_pending():
-            if msg.type == 'note_on' and msg.velocity >= VELOCITY_THRESHOLD:
-                pad = 'top' if msg.note in PAD_MAPPING['left'] else 'bottom' if msg.note in PAD_MAPPING['right'] else None
+            if msg.type == 'note_on':
+                pad = PAD_TRACKS.get(msg.pad)
                 if not pad: continue
+                if msg.role != midi_input_hub.DEFAULT_ROLE:
+                    # 指導者のパッド等は音だけ鳴らして判定しない
+                    if self.state in ["practice_countdown", "recording", "experiment_running"] and self.snare_sound: self.snare_sound.play()
+                    continue
                 current_time_ms = pygame.time.get_ticks() # アプリ起動時からのミリ秒
                 if current_time_ms - self.last_input_time.get(pad, 0) < self.DEBOUNCE_TIME_MS:
                     # 前回の入力から時間が短すぎる場合は無視（スキップ）
@@ -2422,6 +2404,8 @@ class MainWindow(QMainWindow):
 
                 if is_recording_state:
                     hit_time_ms = self.get_elapsed_time()
+                    # 入力は受信 (音声入力は立ち上がり) の時刻を持っているので、ポーリングと検出の遅れを差し引く
+                    hit_time_ms -= max(0.0, time.time() - msg.timestamp) * 1000
                     new_hit = {'time': hit_time_ms, 'pad': pad}
                     self.recorded_hits.append(new_hit)
                     
@@ -2442,70 +2426,7 @@ class MainWindow(QMainWindow):
                         self.editor_window.rhythm_widget.add_user_hit(new_hit)
                         self.editor_window.rhythm_widget.add_feedback_animation(judgement, new_hit)
     def judge_hit(self, hit):
-        pad, hit_time = hit['pad'], hit['time']; track_data = self.template_score.get(pad)
-        if not track_data: return 'extra', None, None
-        bpm = track_data.get('bpm', 120); ms_per_beat = 60000.0 / bpm
-        
-        num = track_data.get('numerator', 4); den = track_data.get('denominator', 4)
-        beats_per_measure = (num / den) * 4.0; total_beats = beats_per_measure * NUM_MEASURES
-        loop_duration_ms = ms_per_beat * total_beats
-        if loop_duration_ms == 0: return 'extra', None, None
-        
-        hit_time_in_loop = hit_time % loop_duration_ms
-        closest_note, min_diff = None, float('inf')
-        
-        for note in track_data.get('items', []):
-            if note['class'] == 'note':
-                note_time = note['beat'] * ms_per_beat
-                
-                # ループを考慮した最短距離を計算
-                diffs = [
-                    abs(hit_time_in_loop - note_time), 
-                    abs(hit_time_in_loop - (note_time - loop_duration_ms)), 
-                    abs(hit_time_in_loop - (note_time + loop_duration_ms))
-                ]
-                diff = min(diffs)
-                
-                # ★★★ 修正: 再判定の許可ロジック ★★★
-                # そのノートが「まだ判定されていない」または「前回の判定からループの半分以上時間が経っている」場合、対象とする
-                last_judged_time = self.judged_notes.get(note.get('id'), -1)
-                is_rejudge_allowed = False
-                
-                if last_judged_time == -1:
-                    is_rejudge_allowed = True
-                else:
-                    # 前回叩いた時間との差が、ループ長の50%を超えていれば、新しいループでの打撃とみなす
-                    if (hit_time - last_judged_time) > (loop_duration_ms * 0.5):
-                        is_rejudge_allowed = True
-
-                # 条件を満たす場合のみ候補にする
-                if is_rejudge_allowed and diff < min_diff:
-                    min_diff, closest_note = diff, note
-
-        # 1. 最も近いノートが見つかったか？
-        if closest_note:
-            # 2. 見つかったノートを基準に、符号付きの「正確な誤差」を計算する
-            note_time = closest_note['beat'] * ms_per_beat
-            # 最も近い基準時間（現在、過去ループ、未来ループ）を探す
-            candidates = [note_time, note_time - loop_duration_ms, note_time + loop_duration_ms]
-            actual_note_time_instance = min(candidates, key=lambda x: abs(hit_time_in_loop - x))
-            
-            error_ms = hit_time_in_loop - actual_note_time_instance
-            
-            # 3. 誤差が 'Good' (110ms) の範囲内か？
-            if abs(error_ms) <= JUDGEMENT_WINDOWS['good']:
-                
-                # ★★★ 重要: ここで判定時間を記録する ★★★
-                self.judged_notes[closest_note['id']] = hit_time
-
-                if abs(error_ms) <= JUDGEMENT_WINDOWS['perfect']: 
-                    return 'perfect', error_ms, closest_note['id']
-                if abs(error_ms) <= JUDGEMENT_WINDOWS['great']: 
-                    return 'great', error_ms, closest_note['id']
-                
-                return 'good', error_ms, closest_note['id']
-
-        return 'extra', None, None
+        return judgement.judge_hit(hit, self.template_score, self.judged_notes)
 
     def register_dropped_note(self, note_id, pad):
         # ★★★ 修正: 辞書のキーチェックに変更（機能的には同じですが型を合わせます） ★★★
@@ -2726,6 +2647,7 @@ class MainWindow(QMainWindow):
             self.log_window.append_log("--- 実験モード開始 ---")
             self.experiment_start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             self.experiment_logs = [] # 全体の記録リスト
+            self.start_experiment_recorder()
             self.current_set_log = {} # 現在のセット（楽譜1つ分）の記録
             self.experiment_data.clear()
             # ★ 修正: "explanation" -> "experiment_explanation"
@@ -2782,7 +2704,7 @@ class MainWindow(QMainWindow):
                             config.update(practice_config) 
 
                 self._current_step_config = config
-                filepath = os.path.join(r"C:\卒研\music", filename)
+                filepath = os.path.join(SCORE_DIRECTORY, filename)
                 self._load_score_from_path(filepath)
                 self.label_template_file.setText(f"📄 {filename.replace('.json', '')} ({config['title']})")
                 self.label_template_file.set_style(font_size=14, weight=QFont.Weight.Bold, color_key='primary')
@@ -2919,7 +2841,7 @@ class MainWindow(QMainWindow):
         page = self.tutorial_page_index
         
         # 共通: tutorial.json をロード
-        tutorial_path = os.path.join(r"C:\卒研\music", "tutorial.json")
+        tutorial_path = os.path.join(SCORE_DIRECTORY, "tutorial.json")
         if not self._load_score_from_path(tutorial_path): return
 
         # 設定の一時退避
@@ -2993,7 +2915,7 @@ class MainWindow(QMainWindow):
              if controller:
                  from controllers.base_controller import BaseEntrainmentController
                  ms_per_beat = 60000.0 / top_bpm
-                 active_ctrl = BaseEntrainmentController(copy.deepcopy(self.template_score), ms_per_beat)
+                 active_ctrl = BaseEntrainmentController(self.template_score, ms_per_beat)
                  master_start = time.time() + countdown_s + robot_prep_s
                  self.robot_manager.start_control(self.template_score, active_ctrl, master_start)
 
@@ -3456,7 +3378,7 @@ class AnalyzerCanvas(GlowingWidget):
         if not self.main.template_score or 'top' not in self.main.template_score: painter.restore(); return
         template = self.main.template_score; top_track = template.get('top')
         bpm = top_track.get('bpm', 120); num = top_track.get('numerator', 4); den = top_track.get('denominator', 4)
-        beats_per_measure = (num / den) * 4.0; total_beats = beats_per_measure * NUM_MEASURES
+        beats_per_measure = (num / den) * 4.0; total_beats = top_track.get('total_beats', beats_per_measure * NUM_MEASURES)  # ★ 長い楽譜は楽譜の小節数
         max_time_ms = (60.0 / bpm * total_beats) * 1000.0 if bpm > 0 else 0
         if max_time_ms <= 0: painter.restore(); return
         lanes = {'template_top': {'y': rect.top() + rect.height() * 0.25, 'label': "左（お手本）", 'color': COLORS['text_secondary'], 'data': top_track}, 'measured_top': {'y': rect.top() + rect.height() * 0.45, 'label': "左（演奏）", 'color': COLORS['primary'], 'data': [h for h in self.main.recorded_hits if h['pad'] == 'top']},}
@@ -3510,22 +3432,21 @@ class EditorRhythmWidget(QWidget):
         self.editor_window = editor_window
         self.setMinimumHeight(240)
         self.item_images, self.score, self.is_playing = item_images, {}, False
+        self.playback = None # ★ 再生中の状態 (score_compiler.PlaybackState)。楽譜そのものは書き換えない
         self.playback_timer = QTimer(self); self.playback_timer.timeout.connect(self.update_playback)
         self.last_metronome_beat, self.margin = -1, 60
         self.last_loop_num = -1
         self.user_hits, self.feedback_animations = [], []
         self.next_evaluation_time = 0
         self.loop_duration_ms = 0
+        self.last_drop_scan_ms = None # ★ 前回見逃しを確認したループ内の時刻 (judgement.dropped_notes の since_ms)
         self.hide_score_content = False
         
     def reset_for_loop(self):
         self.user_hits.clear(); self.feedback_animations.clear()
-        for track in self.score.values():
-            for item in track.get('items', []):
-                item['played_in_loop'] = False
-                if 'lit_start_time' in item: del item['lit_start_time']
-            track['last_elapsed_ms'] = -1
+        if self.playback: self.playback.reset()
         self.last_metronome_beat = -1
+        self.last_drop_scan_ms = None
         self.next_evaluation_time = self.loop_duration_ms
 
     def get_loop_duration(self):
@@ -3605,98 +3526,85 @@ class EditorRhythmWidget(QWidget):
 
         # 6. ループが切り替わったら、全トラックのフラグをリセット
         if current_loop_num != last_loop_num:
-            for track_data in self.score.values():
-                if not isinstance(track_data, dict):
-                    continue
-                for item in track_data.get('items', []):
-                    item['played_in_loop'] = False
-            
+            self.playback.clear_played()
             self.last_loop_num = current_loop_num 
 
         # 7. 全トラックを共通の `current_time_in_loop` で処理
-        for track_data in self.score.values():
-            if not isinstance(track_data, dict):
-                continue
-                
-            track_ms_per_beat = 60000.0 / track_data.get('bpm', 120)
-            if track_ms_per_beat <= 0: continue
+        for track_name, track in self.score.tracks.items():
+            if track.ms_per_beat <= 0: continue
+            played = self.playback.played[track_name]
+            # ★ いまの時刻の近く (-16ms ~ 100ms) のアイテムだけを索引で拾う (長い楽譜でも 1 フレームの処理は一定)
+            nearby = track.items_between(current_time_in_loop - 101, current_time_in_loop + 17)
+            time_diff = current_time_in_loop - track.onset_ms[nearby]
             
-            for item in track_data.get('items', []):
-                if item.get('played_in_loop', False):
-                    continue  
-                
-                note_start_ms = item['beat'] * track_ms_per_beat
-                time_diff = current_time_in_loop - note_start_ms
-                
-                # ★★★ 修正箇所: 判定ロジックの強化 ★★★
-                # 変更前: if -16 <= time_diff <= 50:
-                # 変更後: 「判定範囲内」または「既に時間を過ぎているがまだ処理されていない（すり抜け防止）」場合
-                
-                # 判定ウィンドウ (標準は -16ms ~ 50ms)
-                is_in_window = (-16 <= time_diff <= 50)
-                
-                # すり抜け救済 (過去100ms以内なら遅れても鳴らす)
-                # 特にスタート直後(0ms)のノートが、次のフレームでいきなり 20ms とかになった場合に有効
-                is_missed_start = (50 < time_diff <= 100) and (item['beat'] == 0.0)
-
-                if is_in_window or is_missed_start:
-                    if item.get('class') == 'note':
-                        
-                        # ★★★ 修正: 点滅条件のロジック変更 ★★★
-                        is_first_note = (item.get('beat', -1) == 0.0)
-                        should_blink = False
-
-                        if not is_demo:
-                            # 練習モード: 常に一音目のみ
-                            should_blink = is_first_note
+            # ★★★ 修正箇所: 判定ロジックの強化 ★★★
+            # 変更前: if -16 <= time_diff <= 50:
+            # 変更後: 「判定範囲内」または「既に時間を過ぎているがまだ処理されていない（すり抜け防止）」場合
+            
+            # 判定ウィンドウ (標準は -16ms ~ 50ms)
+            is_in_window = (-16 <= time_diff) & (time_diff <= 50)
+            
+            # すり抜け救済 (過去100ms以内なら遅れても鳴らす)
+            # 特にスタート直後(0ms)のノートが、次のフレームでいきなり 20ms とかになった場合に有効
+            is_missed_start = (50 < time_diff) & (time_diff <= 100) & (track.beats[nearby] == 0.0)
+
+            for i in nearby[(is_in_window | is_missed_start) & ~played[nearby]]:
+                if track.classes[i] == score_compiler.CLASS_NOTE:
+                    
+                    # ★★★ 修正: 点滅条件のロジック変更 ★★★
+                    is_first_note = (track.beats[i] == 0.0)
+                    should_blink = False
+
+                    if not is_demo:
+                        # 練習モード: 常に一音目のみ
+                        should_blink = is_first_note
+                    else:
+                        # デモモード: 設定 ('demo_blink_mode') に従う
+                        # 'all'なら全点灯、'first'なら一音目のみ
+                        mode = main_window.settings.get('demo_blink_mode', 'all')
+                        if mode == 'all':
+                            should_blink = True
                         else:
-                            # デモモード: 設定 ('demo_blink_mode') に従う
-                            # 'all'なら全点灯、'first'なら一音目のみ
-                            mode = main_window.settings.get('demo_blink_mode', 'all')
-                            if mode == 'all':
-                                should_blink = True
-                            else:
-                                should_blink = is_first_note
-                        
-                        if should_blink:
-                            item['lit_start_time'] = absolute_elapsed_ms
-                        
-                        if main_window.settings.get('guide_cue_on', False):  
-                            self.editor_window.play_note_sound()
+                            should_blink = is_first_note
                     
-                    item['played_in_loop'] = True
+                    if should_blink:
+                        self.playback.lit_start_ms[track_name][i] = absolute_elapsed_ms
+                    
+                    if main_window.settings.get('guide_cue_on', False):  
+                        self.editor_window.play_note_sound()
+                
+                played[i] = True
             
-            # 8. 見逃し(dropped)判定 
-            if not is_demo:
-                track_name_key = 'unknown'
-                for key, value in self.score.items():
-                    if value is track_data:
-                        track_name_key = key
-                        break
-
-                for note in track_data.get('items', []):
-                    if note['class'] == 'note' and note.get('id') not in main_window.judged_notes:
-                        note_time = note['beat'] * track_ms_per_beat
-                        if current_time_in_loop > note_time + DROPPED_THRESHOLD:  
-                            main_window.register_dropped_note(note['id'], track_name_key)
+        # 8. 見逃し(dropped)判定 (全トラック)
+        if not is_demo:
+            for track_name_key, note_id in judgement.dropped_notes(self.score, main_window.judged_notes, current_time_in_loop,
+                                                                   since_ms=self.last_drop_scan_ms):
+                main_window.register_dropped_note(note_id, track_name_key)
+            self.last_drop_scan_ms = current_time_in_loop
         
         self.update()
 
     def set_data(self, score_data, loop_duration_ms=0):
-        self.score = score_data
-        for track_data in self.score.values():
-            num, den = track_data.get('numerator', 4), track_data.get('denominator', 4)
-            track_data['beats_per_measure'] = (num / den) * 4.0
-            track_data['total_beats'] = track_data['beats_per_measure'] * NUM_MEASURES
+        # ★ beats_per_measure / total_beats はコンパイル時に決まっている。楽譜は共有なので書き込まない
+        self.score = score_compiler.compile_score(score_data)
+        self.playback = score_compiler.PlaybackState(self.score)
         if loop_duration_ms > 0:
             self.loop_duration_ms = loop_duration_ms
         else:
-            if 'top' in self.score:
-                top_track = self.score['top']
-                ms_per_beat = 60000.0 / top_track.get('bpm', 120)
-                self.loop_duration_ms = ms_per_beat * top_track.get('total_beats', 1)
+            if 'top' in self.score.tracks:
+                self.loop_duration_ms = self.score.tracks['top'].loop_duration_ms
         self.next_evaluation_time = self.loop_duration_ms
         self.update()
+    def view_window(self, track):
+        """
+        長い楽譜 (score.is_long) で表示するページ (先頭の拍, 拍数)。再生位置を含む WINDOW_MEASURES 小節で、
+        再生位置がページの終わりに来たら次のページに切り替わる。短い楽譜は None (楽譜全体を表示)
+        """
+        if not self.score.is_long or track.ms_per_beat <= 0 or self.loop_duration_ms <= 0: return None
+        elapsed_ms = max(self.editor_window.get_elapsed_time(), 0.0) if self.is_playing else 0.0
+        beat = (elapsed_ms % self.loop_duration_ms) / track.ms_per_beat
+        return track.window_start_beat(beat), track.window_beats
+
     def start_playback(self):
         if not self.is_playing:
             self.is_playing = True
@@ -3727,25 +3635,9 @@ class EditorRhythmWidget(QWidget):
         
         if not self.score: return
 
-        current_time_abs = self.editor_window.get_elapsed_time()
         layout_mode = self.editor_window.main_window.settings.get('score_layout', 'vertical')
 
-        # 1. アイテムの点灯状態を更新 (全トラック共通)
-        for track_data in self.score.values():
-                # 安全のため辞書型チェック
-                if not isinstance(track_data, dict): 
-                    continue
-                    
-                for item in track_data.get('items', []):
-                    # ★★★ 修正箇所: 判定条件を厳密化 ★★★
-                    # 以前: (diff) < LIT_DURATION  -> マイナスでもTrueになっていた
-                    # 修正: 0 <= (diff) < LIT_DURATION -> 時間が過ぎていない(マイナス)場合はFalseにする
-                    
-                    if item.get('class') == 'note' and 'lit_start_time' in item:
-                        diff = current_time_abs - item['lit_start_time']
-                        item['is_lit'] = (0 <= diff < LIT_DURATION)
-                    else:
-                        item['is_lit'] = False
+        # 1. アイテムの点灯状態は描画時に PlaybackState.lit_mask で求める (0 <= 経過 < LIT_DURATION のあいだ点灯)
 
         # 2. レイアウト固有の変数を定義
         staff_contexts = {} # 描画に必要なコンテキストを格納 {'top': {...}, 'bottom': {...}}
@@ -3770,7 +3662,8 @@ class EditorRhythmWidget(QWidget):
                     'y': staff_y,
                     'start_x': start_x,
                     'width': drawable_width,
-                    'label_x_offset': 0 # 縦表示はオフセットなし
+                    'label_x_offset': 0, # 縦表示はオフセットなし
+                    'window': self.view_window(self.score.tracks[track_name])
                 }
 
         else: 
@@ -3788,7 +3681,8 @@ class EditorRhythmWidget(QWidget):
                     'y': top_staff_y,
                     'start_x': top_start_x,
                     'width': top_drawable_width,
-                    'label_x_offset': 0 # 左側はオフセットなし
+                    'label_x_offset': 0, # 左側はオフセットなし
+                    'window': self.view_window(self.score.tracks['top'])
                 }
 
             # Bottom (Right) Area
@@ -3801,7 +3695,8 @@ class EditorRhythmWidget(QWidget):
                     'y': bottom_staff_y,
                     'start_x': bottom_start_x,
                     'width': bottom_drawable_width,
-                    'label_x_offset': bottom_start_x - 55 # L/Rラベルや拍子を描画するX座標を調整
+                    'label_x_offset': bottom_start_x - 55, # L/Rラベルや拍子を描画するX座標を調整
+                    'window': self.view_window(self.score.tracks['bottom'])
                 }
 
             # 中央の分割線を描画
@@ -3819,7 +3714,8 @@ class EditorRhythmWidget(QWidget):
                     ctx['start_x'], 
                     ctx['width'], 
                     is_two_track_mode,
-                    ctx['label_x_offset'] # ★ label_x_offset を渡す
+                    ctx['label_x_offset'], # ★ label_x_offset を渡す
+                    ctx['window'] # ★ 長い楽譜の表示ページ
                 )
         
         # 4. ユーザーヒットとフィードバックの描画
@@ -3849,6 +3745,10 @@ class EditorRhythmWidget(QWidget):
                 
             bpm = track.get('bpm', 120)
             total_beats = track.get('total_beats', 8.0)
+            # ★ 長い楽譜は表示中のページの中での位置 (ページの先頭を 0 拍目として描く)
+            window = self.view_window(track) if track else None
+            window_start = 0.0
+            if window: window_start, total_beats = window
             
             ms_per_beat = (60000.0 / bpm) if bpm > 0 else 500.0 # 1拍あたりのミリ秒
             
@@ -3885,7 +3785,7 @@ class EditorRhythmWidget(QWidget):
                 if self.is_playing:
                     # ループを考慮 (e.g. 4500ms -> 4.5拍目)
                     current_time_in_loop_ms = current_time_abs % self.loop_duration_ms
-                    current_beat = current_time_in_loop_ms / ms_per_beat
+                    current_beat = current_time_in_loop_ms / ms_per_beat - window_start
                 else:
                     # 負の時間 (e.g., -250ms) を負のビート (e.g., -0.5拍目) に変換
                     current_beat = current_time_abs / ms_per_beat
@@ -3907,7 +3807,7 @@ class EditorRhythmWidget(QWidget):
                 if self.is_playing:
                     # ループを考慮 (e.g. 4500ms -> 4.5拍目)
                     current_time_in_loop_ms = current_time_abs % self.loop_duration_ms
-                    current_beat = current_time_in_loop_ms / ms_per_beat
+                    current_beat = current_time_in_loop_ms / ms_per_beat - window_start
                 else:
                     # 負の時間 (e.g., -250ms) を負のビート (e.g., -0.5拍目) に変換
                     current_beat = current_time_abs / ms_per_beat
@@ -4002,6 +3902,10 @@ class EditorRhythmWidget(QWidget):
             
             hit_progress = (hit['time'] % self.loop_duration_ms) / self.loop_duration_ms
             hit_beat = hit_progress * total_beats
+            if ctx['window']:
+                # 長い楽譜: 表示中のページの外の打撃は描かない
+                hit_beat -= ctx['window'][0]; total_display_beats = ctx['window'][1] + 1.0
+                if not -1.0 <= hit_beat <= ctx['window'][1]: continue
             hit_pos_fraction = (hit_beat + 1.0) / total_display_beats
             
             x = ctx['start_x'] + hit_pos_fraction * ctx['width']
@@ -4046,6 +3950,10 @@ class EditorRhythmWidget(QWidget):
 
             hit_progress = (anim['hit_time'] % self.loop_duration_ms) / self.loop_duration_ms
             hit_beat = hit_progress * total_beats
+            if ctx['window']:
+                # 長い楽譜: 表示中のページの外の打撃は描かない
+                hit_beat -= ctx['window'][0]; total_display_beats = ctx['window'][1] + 1.0
+                if not -1.0 <= hit_beat <= ctx['window'][1]: continue
             hit_pos_fraction = (hit_beat + 1.0) / total_display_beats
 
             x = ctx['start_x'] + hit_pos_fraction * ctx['width']
@@ -4084,9 +3992,12 @@ class EditorRhythmWidget(QWidget):
             painter.setBrush(cursor_color)
             rect_x = x - (width / 2)
             painter.drawRect(QRectF(rect_x, y1, width, y2 - y1))
-    def draw_staff(self, painter, track_name, track_data, staff_y, start_x, drawable_width, is_two_track_mode, label_x_offset=0):
+    def draw_staff(self, painter, track_name, track_data, staff_y, start_x, drawable_width, is_two_track_mode, label_x_offset=0, window=None):
         beats_per_measure = track_data.get('beats_per_measure', 4.0)
         total_beats = track_data.get('total_beats', 8.0)
+        # ★ 長い楽譜は window = (先頭の拍, 拍数) のページだけを描く (ページの先頭は小節の頭なので、小節線の判定はそのまま)
+        window_start = 0.0
+        if window: window_start, total_beats = window
 
         if total_beats <= 0: return # ガード
         total_display_beats = total_beats + 1.0
@@ -4180,15 +4091,30 @@ class EditorRhythmWidget(QWidget):
                     painter.setPen(QPen(COLORS['text_muted'], 1, Qt.PenStyle.DotLine))
                     painter.drawLine(int(x_sub), int(staff_y - 8), int(x_sub), int(staff_y + 8))
         
-        # ノートと休符
-        for item in track_data.get('items', []):
-            self.draw_item(painter, item, staff_y, start_x, drawable_width, total_beats, total_display_beats)
+        if window:
+            # 何小節目から何小節目を表示しているか
+            first_measure = int(round(window_start / beats_per_measure)) + 1 if beats_per_measure > 0 else 1
+            last_measure = first_measure + int(round(total_beats / beats_per_measure)) - 1 if beats_per_measure > 0 else first_measure
+            painter.setFont(QFont("Segoe UI", 10))
+            painter.setPen(COLORS['text_secondary'])
+            painter.drawText(QRectF(start_x, staff_y - 45, drawable_width, 20), Qt.AlignmentFlag.AlignRight,
+                             f"{first_measure}-{last_measure} / {self.score.num_measures} 小節")
+            # 表示中のページのアイテムだけを索引で拾う
+            index = track_data.items_between(window_start * track_data.ms_per_beat, (window_start + total_beats) * track_data.ms_per_beat)
+            index = index[track_data.beats[index] < window_start + total_beats]
+        else:
+            index = np.arange(len(track_data.entries))
+
+        # ノートと休符 (点灯はノートだけ)
+        lit = self.playback.lit_mask(track_name, self.editor_window.get_elapsed_time(), LIT_DURATION, index) & (track_data.classes[index] == score_compiler.CLASS_NOTE)
+        for i, is_lit in zip(index.tolist(), lit.tolist()):
+            self.draw_item(painter, track_data.entries[i], staff_y, start_x, drawable_width, total_beats, total_display_beats, is_lit, window_start)
 
-    def draw_item(self, painter, item, staff_y, start_x, drawable_width, total_beats_on_track, total_display_beats):
+    def draw_item(self, painter, item, staff_y, start_x, drawable_width, total_beats_on_track, total_display_beats, is_lit=False, beat_offset=0.0):
         if total_display_beats <= 0: return
         
-        # 音符の中心位置を計算（ボックスの左端ではなく中心）
-        x_fraction = (item['beat'] + 1.0) / total_display_beats
+        # 音符の中心位置を計算（ボックスの左端ではなく中心）。長い楽譜はページの先頭 (beat_offset) からの位置
+        x_fraction = (item['beat'] - beat_offset + 1.0) / total_display_beats
         note_center_x = start_x + x_fraction * drawable_width
         
         painter.save()
@@ -4292,7 +4218,7 @@ class EditorRhythmWidget(QWidget):
             
             # 8. 点灯エフェクト
             if self.editor_window.main_window.settings.get('score_blinking_on', True):
-                if item.get('is_lit', False):
+                if is_lit:
                     # グロー効果を音符の中心から
                     for radius, alpha in [(40, 20), (30, 40), (20, 60)]:
                         glow_color = QColor(COLORS['note_glow'])
@@ -4512,7 +4438,7 @@ class EditorWindow(QMainWindow):
         # ★★★ 変更ここまで ★★★
         self.rhythm_widget = EditorRhythmWidget(item_images, self)
         layout.addWidget(self.rhythm_widget)
-        self.rhythm_widget.set_data(copy.deepcopy(template_data), loop_duration_ms)
+        self.rhythm_widget.set_data(template_data, loop_duration_ms)
         self.rhythm_widget.hide_score_content = self.hide_score
         self.countdown_label = QLabel(self)
         self.countdown_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
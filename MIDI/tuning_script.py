@@ -1,4 +1,5 @@
 #dobotの速度・加速度パラメータと、実際の動作速度をチューニングするためのデータを収集するコード
+# ※ 計測点を自動で選ぶ適応サンプリング版は calibration_runner.py (複数ポート同時計測に対応)
 import time
 import csv
 import math
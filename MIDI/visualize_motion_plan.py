@@ -5,75 +5,26 @@ import matplotlib.patches as mpatches
 from matplotlib.collections import LineCollection
 import numpy as np
 
-# --- パラメータ（元のコードと同じ） ---
-MIN_EXPECTED_INTERVAL_S = 0.1
-MAX_EXPECTED_INTERVAL_S = 2.0
-MIN_VELOCITY = 100.0
-MAX_VELOCITY = 400.0
-MIN_ACCELERATION = 100.0
-MAX_ACCELERATION = 800.0
-MAX_BACKSWING_HEIGHT = 70.0
-MIN_BACKSWING_HEIGHT = 32.0
-EXPRESSION_EXPONENT = 0.75
+import motion_plan_compiler as mpc
+
+# --- パラメータ（robot_control_module_v4.py と同じ） ---
+READY_POS = (230, 0, 60, 0)
+STRIKE_POS = (226, 0.3, 41, 0)
+MAX_BACKSWING_HEIGHT = STRIKE_POS[2] + 35.0
+MIN_BACKSWING_HEIGHT = STRIKE_POS[2] + 10.0
 COMMUNICATION_LATENCY_S = 0.050
+TUNING_DATA_CSV_PATH = 'tuning_data.csv'
 
 def generate_motion_plan(note_items, bpm, loop_duration):
-    """モーションプランを生成（元のコードのロジックを再現）"""
-    notes_only = sorted([item for item in note_items if item.get("class") == "note"], 
-                       key=lambda x: x['beat'])
-    
-    if not notes_only:
-        return []
-    
-    motion_plan = []
-    seconds_per_beat = 60.0 / bpm
-    
-    for i, current_note in enumerate(notes_only):
-        current_strike_time = current_note.get("beat", 0) * seconds_per_beat
-        next_note = notes_only[(i + 1) % len(notes_only)]
-        next_strike_time = next_note.get("beat", 0) * seconds_per_beat
-        
-        if i == len(notes_only) - 1:
-            interval = (loop_duration - current_strike_time) + next_strike_time
-        else:
-            interval = next_strike_time - current_strike_time
-        
-        if interval <= 0.02:
-            continue
-        
-        # 表現力パラメータの計算
-        normalized_interval = max(0.0, min(1.0, 
-            (interval - MIN_EXPECTED_INTERVAL_S) / (MAX_EXPECTED_INTERVAL_S - MIN_EXPECTED_INTERVAL_S)))
-        eased_ratio = normalized_interval ** EXPRESSION_EXPONENT
-        
-        backswing_z = MIN_BACKSWING_HEIGHT + (MAX_BACKSWING_HEIGHT - MIN_BACKSWING_HEIGHT) * eased_ratio
-        velocity = MIN_VELOCITY + (MAX_VELOCITY - MIN_VELOCITY) * (1.0 - eased_ratio)
-        acceleration = MIN_ACCELERATION + (MAX_ACCELERATION - MIN_ACCELERATION) * (1.0 - eased_ratio)
-        
-        # Strike動作
-        strike_motion = {
-            "target_time": current_strike_time,
-            "position_z": 22.0,
-            "velocity": MAX_VELOCITY,
-            "acceleration": MAX_ACCELERATION,
-            "action": "strike",
-            "send_time": current_strike_time - 0.1 - COMMUNICATION_LATENCY_S
-        }
-        motion_plan.append(strike_motion)
-        
-        # Upstroke動作
-        upstroke_start_time = current_strike_time + 0.01
-        upstroke_motion = {
-            "target_time": upstroke_start_time,
-            "position_z": backswing_z,
-            "velocity": velocity,
-            "acceleration": acceleration,
-            "action": "upstroke",
-            "send_time": upstroke_start_time - COMMUNICATION_LATENCY_S
-        }
-        motion_plan.append(upstroke_motion)
-    
-    return sorted(motion_plan, key=lambda x: x['target_time'])
+    """モーションプランを生成（ロボット制御と同じ motion_plan_compiler を使用）"""
+    onsets = mpc.note_onsets(note_items, bpm)
+    return mpc.compile_track(onsets, loop_duration, STRIKE_POS, READY_POS, mpc.load_kinematics(TUNING_DATA_CSV_PATH),
+                             min_backswing_z=MIN_BACKSWING_HEIGHT, max_backswing_z=MAX_BACKSWING_HEIGHT)
+
+def send_times(plan):
+    """各モーションのコマンド送信時刻 (振り下ろしは移動時間ぶん前倒し)"""
+    lead = np.where(plan['is_compensated'], 0.0, plan['duration'])
+    return plan['target_time'] - lead - COMMUNICATION_LATENCY_S
 
 def plot_motion_plan(score_data, output_file='motion_plan.png', dpi=150):
     """モーションプランを可視化してグラフとして出力"""
@@ -156,8 +107,12 @@ def plot_motion_plan(score_data, output_file='motion_plan.png', dpi=150):
                    label='Note', zorder=3, marker='o')
         
         # モーション（Strike）
-        strike_send = [m['send_time'] for m in track['motion'] if m['action'] == 'strike']
-        strike_target = [m['target_time'] for m in track['motion'] if m['action'] == 'strike']
+        motion = track['motion']
+        sends = send_times(motion)
+        is_strike = motion['action'] == mpc.ACTION_STRIKE
+        is_upstroke = motion['action'] == mpc.ACTION_UPSTROKE
+        strike_send = sends[is_strike]
+        strike_target = motion['target_time'][is_strike]
         ax1.scatter(strike_send, [2] * len(strike_send), 
                    color='#ef4444', s=30, alpha=0.4, marker='|', zorder=2)
         ax1.scatter(strike_target, [2] * len(strike_target), 
@@ -169,8 +124,8 @@ def plot_motion_plan(score_data, output_file='motion_plan.png', dpi=150):
                     alpha=0.3, linewidth=1, zorder=1)
         
         # モーション（Upstroke）
-        upstroke_send = [m['send_time'] for m in track['motion'] if m['action'] == 'upstroke']
-        upstroke_target = [m['target_time'] for m in track['motion'] if m['action'] == 'upstroke']
+        upstroke_send = sends[is_upstroke]
+        upstroke_target = motion['target_time'][is_upstroke]
         ax1.scatter(upstroke_send, [1] * len(upstroke_send), 
                    color='#3b82f6', s=30, alpha=0.4, marker='|', zorder=2)
         ax1.scatter(upstroke_target, [1] * len(upstroke_target), 
@@ -200,8 +155,8 @@ def plot_motion_plan(score_data, output_file='motion_plan.png', dpi=150):
         ax2.grid(True, color='#4b5563', alpha=0.3, linewidth=0.5)
         
         # Z軸の動き
-        motion_times = [m['target_time'] for m in track['motion']]
-        motion_z = [m['position_z'] for m in track['motion']]
+        motion_times = motion['target_time']
+        motion_z = motion['z']
         
         # 線とエリアプロット
         ax2.plot(motion_times, motion_z, color=track['color'], 
@@ -210,10 +165,10 @@ def plot_motion_plan(score_data, output_file='motion_plan.png', dpi=150):
                         color=track['color'], alpha=0.2, zorder=1)
         
         # Strike と Upstroke のマーカー
-        strike_times = [m['target_time'] for m in track['motion'] if m['action'] == 'strike']
-        strike_z = [m['position_z'] for m in track['motion'] if m['action'] == 'strike']
-        upstroke_times = [m['target_time'] for m in track['motion'] if m['action'] == 'upstroke']
-        upstroke_z = [m['position_z'] for m in track['motion'] if m['action'] == 'upstroke']
+        strike_times = motion['target_time'][is_strike]
+        strike_z = motion['z'][is_strike]
+        upstroke_times = motion['target_time'][is_upstroke]
+        upstroke_z = motion['z'][is_upstroke]
         
         ax2.scatter(strike_times, strike_z, color='#ef4444', 
                    s=60, alpha=0.8, marker='v', label='Strike', zorder=3)